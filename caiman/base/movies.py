@@ -58,7 +58,8 @@ except ImportError:
 from . import timeseries as ts
 from .traces import trace
 
-from ..mmapping import load_memmap
+from ..mmapping import load_memmap, load_memmap_metadata
+from ..zarr_storage import load_zarr
 from ..utils import visualization
 from .. import summary_images as si
 from ..motion_correction import apply_shift_online, motion_correct_online
@@ -1421,7 +1422,7 @@ def load(file_name: Union[str, List[str]],
          outtype=np.float32,
          is3D: bool = False) -> Any:
     """
-    load movie from file. Supports a variety of formats. tif, hdf5, npy and memory mapped. Matlab is experimental.
+    load movie from file. Supports a variety of formats. tif, hdf5, npy, zarr and memory mapped. Matlab is experimental.
 
     Args:
         file_name: string or List[str]
@@ -1728,8 +1729,25 @@ def load(file_name: Union[str, List[str]],
                 logging.debug('loading mmap file in memory')
                 images = np.array(images).astype(outtype)
 
+            mmap_meta = load_memmap_metadata(file_name)
+            if mmap_meta is not None:
+                if fr is None:
+                    fr = mmap_meta['fr']
+                meta_data = dict(mmap_meta, **(meta_data or {}))
+
             logging.debug('mmap')
-            return movie(images, fr=fr)
+            return movie(images, fr=fr, meta_data=meta_data)
+
+        elif extension == '.zarr':
+            Y = load_zarr(file_name)
+            if subindices is None:
+                input_arr = Y[:]
+            elif isinstance(subindices, list):
+                input_arr = Y.oindex[tuple(subindices)]
+            else:
+                input_arr = Y.oindex[subindices] if isinstance(subindices, (np.ndarray, range)) else Y[subindices]
+            if fr is None:
+                fr = Y.attrs.get('fr')
 
         elif extension == '.sbx':
             logging.debug('sbx')
@@ -2156,11 +2174,11 @@ def rolling_window(ndarr, window_size, stride):
 
 def load_iter(file_name, subindices=None, var_name_hdf5: str = 'mov', outtype=np.float32):
     """
-    load iterator over movie from file. Supports a variety of formats. tif, hdf5, avi.
+    load iterator over movie from file. Supports a variety of formats. tif, hdf5, avi, zarr.
 
     Args:
         file_name: string
-            name of file. Possible extensions are tif, avi and hdf5
+            name of file. Possible extensions are tif, avi, hdf5 and zarr
 
         subindices: iterable indexes
             for loading only a portion of the movie
@@ -2243,6 +2261,19 @@ def load_iter(file_name, subindices=None, var_name_hdf5: str = 'mov', outtype=np
                                            1 if subindices.step is None else subindices.step)
                     for ind in subindices:
                         yield Y[ind].astype(outtype)
+        elif extension == '.zarr':
+            Y = load_zarr(file_name)
+            frames = np.arange(Y.shape[0])
+            if subindices is not None:
+                frames = frames[subindices]
+            # read one time-chunk at a time and yield the requested frames in it
+            chunk_t = Y.chunks[0]
+            for t in range(0, Y.shape[0], chunk_t):
+                in_chunk = frames[(frames >= t) & (frames < t + chunk_t)]
+                if len(in_chunk) > 0:
+                    block = Y[in_chunk.min():in_chunk.max() + 1]
+                    for ind in in_chunk:
+                        yield block[ind - in_chunk.min()].astype(outtype)
         else:  # fall back to memory inefficient version
             for y in load(file_name, var_name_hdf5=var_name_hdf5,
                           subindices=subindices, outtype=outtype):
@@ -2250,3 +2281,4 @@ def load_iter(file_name, subindices=None, var_name_hdf5: str = 'mov', outtype=np
     else:
         logging.error(f"File request:[{file_name}] not found!")
         raise Exception('File not found!')
+
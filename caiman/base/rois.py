@@ -34,6 +34,7 @@ import time
 from typing import Any, Dict, List, Optional, Tuple
 import zipfile
 
+from ..executors import parallel_map
 from ..motion_correction import tile_and_correct
 
 try:
@@ -1212,10 +1213,7 @@ def extract_binary_masks_blob_parallel(A,
     pars = []
     for a in range(A.shape[-1]):
         pars.append([A[:, a], neuron_radius, dims, num_std_threshold, minCircularity, minInertiaRatio, minConvexity])
-    if dview is not None:
-        res = dview.map_sync(extract_binary_masks_blob_parallel_place_holder, pars)
-    else:
-        res = list(map(extract_binary_masks_blob_parallel_place_holder, pars))
+    res = parallel_map(dview, extract_binary_masks_blob_parallel_place_holder, pars)
 
     masks = []
     is_pos = []
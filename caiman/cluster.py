@@ -23,7 +23,7 @@ import ipyparallel
 from ipyparallel import Client
 import logging
 import multiprocessing
-from multiprocessing import Pool
+import multiprocessing.pool
 import numpy as np
 import os
 import platform
@@ -35,6 +35,8 @@ import sys
 import time
 from typing import Any, Dict, List, Optional, Tuple, Union
 
+from .executors import (DaskExecutor, Executor, FuturesExecutor, IPyParallelExecutor, MultiprocessingExecutor,
+                        parallel_map)
 from .mmapping import load_memmap
 
 logger = logging.getLogger(__name__)
@@ -136,9 +138,6 @@ def apply_to_patch(mmap_file, shape: Tuple[Any, Any, Any], dview, rf, stride, fu
     Returns:
         results
 
-    Raises:
-        Exception 'Something went wrong'
-
     """
     # This function is (currently) only used in some demos and use_cases code. Unclear if it's still necessary,
     # and it's been broken for awhile.
@@ -172,18 +171,7 @@ def apply_to_patch(mmap_file, shape: Tuple[Any, Any, Any], dview, rf, stride, fu
         args_in.append((mmap_file.filename, id_f, id_2d, function, args, kwargs))
 
     logger.debug("Flat index is of length " + str(len(idx_flat)))
-    if dview is not None:
-        try:
-            file_res = dview.map_sync(function_place_holder, args_in)
-            dview.results.clear()
-
-        except:
-            raise Exception('Something went wrong')
-        finally:
-            logger.warn('You may think that it went well but reality is harsh') # TODO Figure out a better message
-    else:
-
-        file_res = list(map(function_place_holder, args_in))
+    file_res = parallel_map(dview, function_place_holder, args_in)
     return file_res, idx_flat, shape_grid
 
 
@@ -292,10 +280,13 @@ def stop_server(ipcluster: str = 'ipcluster', pdir: str = None, profile: str = N
 
         pdir : Undocumented
         profile: Undocumented
-        dview: Undocumented
+        dview: Executor, multiprocessing Pool or ipyparallel view
+            workers to release. ipyparallel clusters are stopped
 
     """
-    if 'multiprocessing' in str(type(dview)):
+    if isinstance(dview, Executor) and not isinstance(dview, IPyParallelExecutor):
+        dview.shutdown()
+    elif isinstance(dview, multiprocessing.pool.Pool):
         dview.terminate()
     else:
         logger.info("Stopping cluster...")
@@ -365,20 +356,27 @@ def setup_cluster(backend: str = 'multiprocessing',
                   n_processes: int = None,
                   single_thread: bool = False,
                   ignore_preexisting: bool = False,
-                  maxtasksperchild: int = None) -> Tuple[Any, Any, Optional[int]]:
+                  maxtasksperchild: int = None,
+                  memory_limit: int = None) -> Tuple[Any, Any, Optional[int]]:
     """Setup and/or restart a parallel cluster.
     Args:
         backend: str
-            'multiprocessing' [alias 'local'], 'ipyparallel', and 'SLURM'
+            'multiprocessing' [alias 'local'], 'ipyparallel', 'SLURM', 'threads' or 'dask'
             ipyparallel and SLURM backends try to restart if cluster running.
             backend='multiprocessing' raises an exception if a cluster is running.
+            'threads' runs the tasks on a thread pool of the current process,
+            'dask' on a local dask distributed cluster (requires dask)
         ignore_preexisting: bool
             If True, ignores the existence of an already running multiprocessing
             pool, which is usually indicative of a previously-started CaImAn cluster
+        memory_limit: int
+            Number of bytes a worker may allocate while running a task (process based
+            backends only). Tasks exceeding it fail with a MemoryError
 
     Returns:
         c: ipyparallel.Client object; only used for ipyparallel and SLURM backends, else None
-        dview: ipyparallel dview object, or for multiprocessing: Pool object
+        dview: Executor (see caiman.executors) wrapping the ipyparallel view, the multiprocessing
+            Pool, the thread pool or the dask client, or None when single_thread is True
         n_processes: number of workers in dview. None means guess at number of machine cores.
     """
 
@@ -406,13 +404,13 @@ def setup_cluster(backend: str = 'multiprocessing',
             pdir, profile = os.environ['IPPPDIR'], os.environ['IPPPROFILE']
             logger.info([pdir, profile])
             c = Client(ipython_dir=pdir, profile=profile)
-            dview = c[:]
+            dview = IPyParallelExecutor(c[:], memory_limit=memory_limit)
         elif backend == 'ipyparallel':
             stop_server()
             start_server(ncpus=n_processes)
             c = Client()
             logger.info(f'Started ipyparallel cluster: Using {len(c)} processes')
-            dview = c[:len(c)]
+            dview = IPyParallelExecutor(c[:len(c)], memory_limit=memory_limit)
 
         elif (backend == 'multiprocessing') or (backend == 'local'):
             if len(multiprocessing.active_children()) > 0:
@@ -438,7 +436,14 @@ def setup_cluster(backend: str = 'multiprocessing',
                     pass
             c = None
 
-            dview = Pool(n_processes, maxtasksperchild=maxtasksperchild)
+            dview = MultiprocessingExecutor(n_workers=n_processes, memory_limit=memory_limit,
+                                            maxtasksperchild=maxtasksperchild)
+        elif backend == 'threads':
+            c = None
+            dview = FuturesExecutor(n_workers=n_processes, memory_limit=memory_limit)
+        elif backend == 'dask':
+            c = None
+            dview = DaskExecutor(n_workers=n_processes, memory_limit=memory_limit)
         else:
             raise Exception('Unknown Backend')
 
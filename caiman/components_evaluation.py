@@ -9,6 +9,7 @@ Created on Thu Oct 20 12:12:34 2016
 from builtins import range
 from past.utils import old_div
 
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import itertools
 import logging
@@ -18,12 +19,13 @@ import tensorflow as tf
 import scipy
 from scipy.sparse import csc_matrix
 from scipy.stats import norm
-from typing import Any, List, Tuple, Union
+from typing import Any, List, Optional, Tuple, Union
 import warnings
 
+from caiman import model_registry
+from caiman.executors import parallel_map
 from caiman.paths import caiman_datadir
-from .utils.stats import mode_robust, mode_robust_fast
-from .utils.utils import load_graph
+from .utils.stats import mode_robust, mode_robust_fast, mode_robust_rows
 
 try:
     cv2.setNumThreads(0)
@@ -38,12 +40,55 @@ except:
         return a
 
 
+def _exceptionality_block(traces: np.ndarray, N: int, robust_std: bool, sigma_factor: float,
+                          erfc: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ exceptionality of a block of traces, the moving sum of the log-probabilities is written in erfc """
+    T = traces.shape[-1]
+    srt = np.sort(traces, axis=1)
+    md = mode_robust_rows(srt, presorted=True)
+
+    # only consider values under the mode to determine the noise standard deviation
+    if robust_std:
+        # half of the deviations under the mode, the largest ones are the first sorted values
+        Ns = np.round(np.sum(srt < md[:, None], 1) * .5).astype(int)
+        iqr_h = (md - srt[np.arange(len(srt)), T - 1 - (T - Ns) % T]).astype(np.float64)
+        iqr_h[iqr_h <= 0] = np.nan
+
+        # approximate standard deviation as iqr/1.349
+        sd_r = 2 * iqr_h / 1.349
+    else:
+        ff1 = traces - md[:, None]
+        ff1 = -ff1 * (ff1 < 0)
+        Ns = np.sum(ff1 > 0, 1)
+        sd_r = np.sqrt(old_div(np.sum(ff1**2, 1), Ns))
+    del srt
+
+    # compute z value
+    z = old_div((traces - md[:, None]), (sigma_factor * sd_r[:, None]))
+
+    # probability of observing values larger or equal to z given normal
+    # distribution with mean md and std sd_r, in logarithm so that multiplication
+    # becomes sum, computed with this numerically stable function
+    erf = scipy.special.log_ndtr(-z)
+
+    # moving sum
+    np.cumsum(erf, 1, out=erfc)
+    erfc[:, N:] -= erfc[:, :-N]
+
+    # select the maximum value of such probability for each trace
+    fitness = np.min(erfc, 1)
+
+    return fitness, sd_r, md
+
+
 @profile
 def compute_event_exceptionality(traces: np.ndarray,
                                  robust_std: bool = False,
                                  N: int = 5,
                                  use_mode_fast: bool = False,
-                                 sigma_factor: float = 3.) -> Tuple[np.ndarray, np.ndarray, Any, Any]:
+                                 sigma_factor: float = 3.,
+                                 block_size: Optional[int] = None,
+                                 n_threads: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, Any, Any]:
     """
     Define a metric and order components according to the probability of some "exceptional events" (like a spike).
 
@@ -53,22 +98,29 @@ def compute_event_exceptionality(traces: np.ndarray,
     Then, the probability of having N consecutive events is estimated.
     This probability is used to order the components.
 
-    Args:
-        Y: ndarray
-            movie x,y,t
-
-        A: scipy sparse array
-            spatial components
+    The traces are processed in blocks of rows, in parallel threads, so that the temporary
+    arrays are bounded by the block size. The mode is the half-sample mode of mode_robust,
+    computed for all the rows of a block at once (see utils.stats.mode_robust_rows).
 
+    Args:
         traces: ndarray
             Fluorescence traces
 
         N: int
             N number of consecutive events
 
+        use_mode_fast: bool
+            kept for backwards compatibility, mode_robust and mode_robust_fast give the same mode
+
         sigma_factor: float
             multiplicative factor for noise estimate (added for backwards compatibility)
 
+        block_size: int or None
+            number of traces processed at once, by default blocks of about 4M samples
+
+        n_threads: int or None
+            number of threads processing the blocks, by default os.cpu_count()
+
     Returns:
         fitness: ndarray
             value estimate of the quality of components (the lesser the better)
@@ -80,52 +132,27 @@ def compute_event_exceptionality(traces: np.ndarray,
             the components ordered according to the fitness
     """
 
-    T = np.shape(traces)[-1]
-    if use_mode_fast:
-        md = mode_robust_fast(traces, axis=1)
-    else:
-        md = mode_robust(traces, axis=1)
-
-    ff1 = traces - md[:, None]
-
-    # only consider values under the mode to determine the noise standard deviation
-    ff1 = -ff1 * (ff1 < 0)
-    if robust_std:
+    traces = np.asarray(traces)
+    K, T = traces.shape
+    if block_size is None:
+        block_size = max(2**22 // max(T, 1), 1)
+    blocks = [slice(i, min(i + block_size, K)) for i in range(0, K, block_size)]
 
-        # compute 25 percentile
-        ff1 = np.sort(ff1, axis=1)
-        ff1[ff1 == 0] = np.nan
-        Ns = np.round(np.sum(ff1 > 0, 1) * .5)
-        iqr_h = np.zeros(traces.shape[0])
+    erfc = np.empty((K, T))
+    fitness, sd_r = np.empty(K), np.empty(K)
+    md = np.empty(K, dtype=traces.dtype if traces.dtype.kind == 'f' else np.float64)
 
-        for idx, _ in enumerate(ff1):
-            iqr_h[idx] = ff1[idx, -Ns[idx]]
-
-        # approximate standard deviation as iqr/1.349
-        sd_r = 2 * iqr_h / 1.349
+    def process(block):
+        fitness[block], sd_r[block], md[block] = _exceptionality_block(
+            traces[block], N, robust_std, sigma_factor, erfc[block])
 
+    n_threads = min(n_threads or os.cpu_count() or 1, len(blocks))
+    if n_threads > 1:
+        with ThreadPoolExecutor(n_threads) as executor:
+            list(executor.map(process, blocks))
     else:
-        Ns = np.sum(ff1 > 0, 1)
-        sd_r = np.sqrt(old_div(np.sum(ff1**2, 1), Ns))
-
-    # compute z value
-    z = old_div((traces - md[:, None]), (sigma_factor * sd_r[:, None]))
-
-    # probability of observing values larger or equal to z given normal
-    # distribution with mean md and std sd_r
-    #erf = 1 - norm.cdf(z)
-
-    # use logarithm so that multiplication becomes sum
-    #erf = np.log(erf)
-    # compute with this numerically stable function
-    erf = scipy.special.log_ndtr(-z)
-
-    # moving sum
-    erfc = np.cumsum(erf, 1)
-    erfc[:, N:] -= erfc[:, :-N]
-
-    # select the maximum value of such probability for each trace
-    fitness = np.min(erfc, 1)
+        for block in blocks:
+            process(block)
 
     return fitness, erfc, sd_r, md
 
@@ -267,15 +294,89 @@ def classify_components_ep(Y, A, C, b, f, Athresh=0.1, Npeaks=5, tB=-3, tA=10, t
 #%%
 
 
+def load_CNN_model(model_name: str = os.path.join(caiman_datadir(), 'model', 'cnn_model'),
+                   use_keras: bool = True) -> Any:
+    """ load the CNN classifier of components from the model registry, so that each
+    model file is read from disk only once per process (see caiman.model_registry)
+
+    Args:
+        model_name: str
+            path of the model without extension, absolute or relative to caiman_datadir()
+
+        use_keras: bool
+            prefer the .json/.h5 keras model to the .h5.pb tensorflow graph. Models
+            exported to ONNX or TF-Lite are used first when they exist.
+
+    Returns:
+        classifier: caiman.model_registry.Classifier
+    """
+    try:
+        backend, _ = model_registry.find_model(model_name)
+    except FileNotFoundError:
+        raise FileNotFoundError("File for requested model {} not found".format(model_name))
+    if backend == 'keras' and not use_keras:
+        backend = 'tensorflow'
+    logging.info('Using model {} with backend {}'.format(model_name, backend))
+    return model_registry.get_classifier(model_name, backend=backend)
+
+
+def extract_crops(A, dims, half_crop, patch_size: int = 50) -> np.ndarray:
+    """ crops of the spatial components around their centers of mass, normalized
+    and resized to the input size of the CNN classifier. The crops are filled
+    from the nonzero entries of A without densifying the components.
+
+    Args:
+        A: scipy.sparse matrix or np.ndarray (# pixels x # components)
+            spatial components
+
+        dims: tuple
+            dimensions of the FOV
+
+        half_crop: tuple
+            half size of the crop in each dimension
+
+        patch_size: int
+            size of the resized crops
+
+    Returns:
+        crops: np.ndarray (# components x patch_size x patch_size)
+    """
+    A = csc_matrix(A)
+    dims, half_crop = np.array(dims), np.array(half_crop)
+    K = A.shape[-1]
+    comp = np.repeat(np.arange(K), np.diff(A.indptr))
+    x, y = np.unravel_index(A.indices, dims, order='F')
+    mass = np.bincount(comp, A.data, minlength=K)
+    coms = np.stack([np.bincount(comp, A.data * x, minlength=K),
+                     np.bincount(comp, A.data * y, minlength=K)], 1) / mass[:, None]
+    coms = np.minimum(np.maximum(coms, half_crop), dims - half_crop).astype(int)
+    x, y = x - coms[comp, 0] + half_crop[0], y - coms[comp, 1] + half_crop[1]
+    inside = (x >= 0) & (x < 2 * half_crop[0]) & (y >= 0) & (y < 2 * half_crop[1])
+    crops = np.zeros((K, 2 * half_crop[0], 2 * half_crop[1]), dtype=A.dtype)
+    crops[comp[inside], x[inside], y[inside]] = A.data[inside]
+    crops /= np.sqrt((crops**2).sum((1, 2)))[:, None, None]
+    # cv2 resizes all channels of an image at once (up to 128 channels in recent versions)
+    final_crops = np.zeros((K, patch_size, patch_size), dtype=crops.dtype)
+    for i in range(0, K, 128):
+        resized = cv2.resize(np.ascontiguousarray(crops[i:i + 128].transpose(1, 2, 0)),
+                             (patch_size, patch_size))
+        final_crops[i:i + 128] = resized.reshape((patch_size, patch_size, -1)).transpose(2, 0, 1)
+    return final_crops
+
+
 def evaluate_components_CNN(A,
                             dims,
                             gSig,
                             model_name: str = os.path.join(caiman_datadir(), 'model', 'cnn_model'),
                             patch_size: int = 50,
                             loaded_model=None,
-                            isGPU: bool = False) -> Tuple[Any, np.array]:
+                            isGPU: bool = False,
+                            batch_size: int = 1024) -> Tuple[Any, np.array]:
     """ evaluate component quality using a CNN network
 
+    The crops are extracted and classified in batches of batch_size
+    components. Models loaded from model_name are shared through the model registry
+    (see load_CNN_model); loaded_model can also be a keras model or a tensorflow graph.
     """
 
     import os
@@ -291,51 +392,24 @@ def evaluate_components_CNN(A,
         logging.info('Using Tensorflow')
 
     if loaded_model is None:
-        if use_keras:
-            if os.path.isfile(os.path.join(caiman_datadir(), model_name + ".json")):
-                model_file = os.path.join(caiman_datadir(), model_name + ".json")
-                model_weights = os.path.join(caiman_datadir(), model_name + ".h5")
-            elif os.path.isfile(model_name + ".json"):
-                model_file = model_name + ".json"
-                model_weights = model_name + ".h5"
-            else:
-                raise FileNotFoundError("File for requested model {} not found".format(model_name))
-            with open(model_file, 'r') as json_file:
-                print('USING MODEL:' + model_file)
-                loaded_model_json = json_file.read()
-
-            loaded_model = model_from_json(loaded_model_json)
-            loaded_model.load_weights(model_name + '.h5')
-            #loaded_model.compile('sgd', 'mse')
-        else:
-            if os.path.isfile(os.path.join(caiman_datadir(), model_name + ".h5.pb")):
-                model_file = os.path.join(caiman_datadir(), model_name + ".h5.pb")
-            elif os.path.isfile(model_name + ".h5.pb"):
-                model_file = model_name + ".h5.pb"
-            else:
-                raise FileNotFoundError("File for requested model {} not found".format(model_name))
-            loaded_model = load_graph(model_file)
-
-        logging.debug("Loaded model from disk")
+        loaded_model = load_CNN_model(model_name, use_keras)
 
     half_crop = np.minimum(gSig[0] * 4 + 1, patch_size), np.minimum(gSig[1] * 4 + 1, patch_size)
-    dims = np.array(dims)
-    coms = [scipy.ndimage.center_of_mass(mm.toarray().reshape(dims, order='F')) for mm in A.tocsc().T]
-    coms = np.maximum(coms, half_crop)
-    coms = np.array([np.minimum(cms, dims - half_crop) for cms in coms]).astype(np.int)
-    crop_imgs = [
-        mm.toarray().reshape(dims, order='F')[com[0] - half_crop[0]:com[0] + half_crop[0], com[1] -
-                                              half_crop[1]:com[1] + half_crop[1]] for mm, com in zip(A.tocsc().T, coms)
-    ]
-    final_crops = np.array([cv2.resize(im / np.linalg.norm(im), (patch_size, patch_size)) for im in crop_imgs])
-    if use_keras:
-        predictions = loaded_model.predict(final_crops[:, :, :, np.newaxis], batch_size=32, verbose=1)
-    else:
-        tf_in = loaded_model.get_tensor_by_name('prefix/conv2d_20_input:0')
-        tf_out = loaded_model.get_tensor_by_name('prefix/output_node0:0')
-        with tf.Session(graph=loaded_model) as sess:
-            predictions = sess.run(tf_out, feed_dict={tf_in: final_crops[:, :, :, np.newaxis]})
-            sess.close()
+    A = csc_matrix(A)
+    final_crops, predictions = [], []
+    for i in range(0, A.shape[-1], batch_size):
+        crops = extract_crops(A[:, i:i + batch_size], dims, half_crop, patch_size)
+        if not isinstance(loaded_model, tf.Graph):
+            predictions.append(loaded_model.predict(crops[:, :, :, np.newaxis], batch_size=32))
+        else:
+            tf_in = loaded_model.get_tensor_by_name('prefix/conv2d_20_input:0')
+            tf_out = loaded_model.get_tensor_by_name('prefix/output_node0:0')
+            with tf.Session(graph=loaded_model) as sess:
+                predictions.append(sess.run(tf_out, feed_dict={tf_in: crops[:, :, :, np.newaxis]}))
+                sess.close()
+        final_crops.append(crops)
+    final_crops = np.concatenate(final_crops) if final_crops else np.zeros((0, patch_size, patch_size))
+    predictions = np.concatenate(predictions) if predictions else np.zeros((0, 2))
 
     return predictions, final_crops
 
@@ -794,14 +868,9 @@ def estimate_components_quality(traces,
                     thresh_C
                 ])
 
-            if dview is None:
-                res = map(evaluate_components_placeholder, params)
-            else:
+            if dview is not None:
                 logging.info('Component evaluation in parallel')
-                if 'multiprocessing' in str(type(dview)):
-                    res = dview.map_async(evaluate_components_placeholder, params).get(4294967)
-                else:
-                    res = dview.map_sync(evaluate_components_placeholder, params)
+            res = parallel_map(dview, evaluate_components_placeholder, params)
 
             for r_ in res:
                 fitness_raw__, fitness_delta__, erfc_raw__, erfc_delta__, r_values__, _ = r_
@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Executors: a common interface to the parallel backends
+
+Functions that take a dview argument accept None (single thread), a multiprocessing Pool,
+an ipyparallel view, a concurrent.futures executor, a dask distributed Client or one of the
+Executors below. as_executor wraps any of them into an Executor, which offers:
+
+    map(func, args)             ordered list of results
+    imap(func, args)            ordered results, yielded as soon as they are available
+    imap_unordered(func, args)  results yielded in order of completion
+    cancel()                    drops the tasks that have not completed yet
+    shutdown()                  releases the workers
+
+Every task is timed (see Executor.task_times and Executor.timing) and, on process based
+backends under Linux, can be given a memory limit: a task whose worker allocates more than
+memory_limit bytes fails with a MemoryError instead of bringing down the machine. The limit
+applies to the data segment and anonymous mappings (RLIMIT_DATA), not to the address space,
+which also counts the memory mapped movies the tasks read.
+
+dask is an optional dependency.
+"""
+
+import concurrent.futures
+import ipyparallel
+import logging
+import multiprocessing
+import multiprocessing.pool
+import numpy as np
+import os
+import psutil
+import sys
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+    # RLIMIT_DATA bounds the anonymous mappings of numpy arrays only on Linux
+    HAS_RESOURCE = sys.platform.startswith('linux')
+except ImportError:     # Windows
+    HAS_RESOURCE = False
+
+try:
+    import dask.distributed
+    HAS_DASK = True
+except ImportError:
+    HAS_DASK = False
+
+logger = logging.getLogger(__name__)
+
+
+def run_task(pars: Tuple) -> Tuple[Any, float]:
+    """ Runs func(arg) on a worker, timing it and bounding its address space
+
+    Args:
+        pars: tuple
+            func, arg, memory_limit (bytes the worker may allocate, or None)
+
+    Returns:
+        res:
+            the result of func(arg)
+
+        elapsed: float
+            duration of the task in seconds
+    """
+    func, arg, memory_limit = pars
+    limits = None
+    if memory_limit is not None and HAS_RESOURCE:
+        limits = resource.getrlimit(resource.RLIMIT_DATA)
+        soft = psutil.Process().memory_info().data + int(memory_limit)
+        if limits[1] != resource.RLIM_INFINITY:
+            soft = min(soft, limits[1])
+        resource.setrlimit(resource.RLIMIT_DATA, (soft, limits[1]))
+    start = time.time()
+    try:
+        res = func(arg)
+    finally:
+        if limits is not None:
+            resource.setrlimit(resource.RLIMIT_DATA, limits)
+    return res, time.time() - start
+
+
+class Executor(object):
+    """ Base class of the executors, which runs the tasks in the calling thread
+
+    Attributes:
+        backend:
+            the wrapped pool, view, executor or client. Attributes that are not defined
+            by the Executor are looked up on the backend, so that code written for a
+            multiprocessing Pool or an ipyparallel view keeps working
+
+        n_workers: int
+            number of workers
+
+        memory_limit: int or None
+            number of bytes a worker may allocate while running a task (process based backends)
+
+        task_times: list
+            duration of every completed task, in seconds
+    """
+    process_based = False
+
+    def __init__(self, backend=None, n_workers: int = 1, memory_limit: Optional[int] = None) -> None:
+        self.backend = backend
+        self.n_workers = n_workers
+        self.memory_limit = memory_limit
+        self.task_times: List[float] = []
+        self._cancelled = False
+        if memory_limit is not None and not (self.process_based and HAS_RESOURCE):
+            logger.warning(f'{type(self).__name__} cannot enforce a memory limit per task, ignoring it')
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for attributes not found on the executor itself
+        if name.startswith('__') or 'backend' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.__dict__['backend'], name)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(n_workers={self.n_workers})'
+
+    def _pars(self, func: Callable, args: Iterable) -> List[Tuple]:
+        memory_limit = self.memory_limit if self.process_based else None
+        return [(func, arg, memory_limit) for arg in args]
+
+    def _results(self, pars: List[Tuple], ordered: bool) -> Iterator[Tuple[Any, float]]:
+        """ Yields the (result, elapsed) pairs of run_task, overridden by every backend """
+        for par in pars:
+            if self._cancelled:
+                raise concurrent.futures.CancelledError()
+            yield run_task(par)
+
+    def _stream(self, func: Callable, args: Iterable, ordered: bool) -> Iterator:
+        self._cancelled = False
+        pars = self._pars(func, args)
+        start, n_tasks = time.time(), len(self.task_times)
+        for res, elapsed in self._results(pars, ordered):
+            self.task_times.append(elapsed)
+            yield res
+        times = self.task_times[n_tasks:]
+        if times:
+            logger.debug(f'{type(self).__name__}: {len(times)} tasks of {getattr(func, "__name__", func)} '
+                         f'in {time.time() - start:.2f}s (task mean {np.mean(times):.3f}s, max {np.max(times):.3f}s)')
+
+    def map(self, func: Callable, args: Iterable) -> List:
+        """ Applies func to every element of args and returns the results in order """
+        return list(self._stream(func, args, ordered=True))
+
+    def imap(self, func: Callable, args: Iterable) -> Iterator:
+        """ Applies func to every element of args, yielding the results in order as they become available """
+        return self._stream(func, args, ordered=True)
+
+    def imap_unordered(self, func: Callable, args: Iterable) -> Iterator:
+        """ Applies func to every element of args, yielding the results as soon as each task completes """
+        return self._stream(func, args, ordered=False)
+
+    def cancel(self) -> None:
+        """ Cancels the tasks that have not completed yet. Their results are not returned """
+        self._cancelled = True
+
+    def shutdown(self) -> None:
+        """ Releases the workers """
+        pass
+
+    def terminate(self) -> None:
+        """ Same as shutdown, for code written for multiprocessing Pools """
+        self.shutdown()
+
+    def timing(self) -> Dict[str, float]:
+        """ Summary of the durations of the tasks run so far """
+        times = np.array(self.task_times)
+        return {'n_tasks': len(times),
+                'total': float(times.sum()) if len(times) else 0.,
+                'mean': float(times.mean()) if len(times) else 0.,
+                'max': float(times.max()) if len(times) else 0.}
+
+
+class SerialExecutor(Executor):
+    """ Runs the tasks one after the other in the calling thread """
+    pass
+
+
+class MultiprocessingExecutor(Executor):
+    """ Runs the tasks on a multiprocessing Pool
+
+    Args:
+        pool: multiprocessing.pool.Pool or None
+            pool to use. If None a pool of n_workers processes is started
+
+        n_workers: int or None
+            number of processes of the pool, by default os.cpu_count() as for multiprocessing.Pool.
+            Give it with a pool started with another number of processes
+
+        maxtasksperchild: int
+            passed to the pool, when starting one
+    """
+    process_based = True
+
+    def __init__(self, pool=None, n_workers: Optional[int] = None, memory_limit: Optional[int] = None,
+                 maxtasksperchild: Optional[int] = None) -> None:
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        if pool is None:
+            pool = multiprocessing.Pool(n_workers, maxtasksperchild=maxtasksperchild)
+        self.maxtasksperchild = maxtasksperchild
+        super().__init__(pool, n_workers, memory_limit)
+
+    def _results(self, pars, ordered):
+        if ordered:
+            # chunked dispatch, as good for many small tasks as for a few large ones
+            chunksize = max(1, len(pars) // (4 * self.n_workers))
+            results = self.backend.imap(run_task, pars, chunksize=chunksize)
+        else:
+            results = self.backend.imap_unordered(run_task, pars)
+        for res in results:
+            if self._cancelled:
+                raise concurrent.futures.CancelledError()
+            yield res
+
+    def cancel(self) -> None:
+        """ Terminates the running tasks and restarts the pool """
+        super().cancel()
+        self.backend.terminate()
+        self.backend.join()
+        self.backend = multiprocessing.Pool(self.n_workers, maxtasksperchild=self.maxtasksperchild)
+
+    def shutdown(self) -> None:
+        self.backend.terminate()
+
+
+class FuturesExecutor(Executor):
+    """ Runs the tasks on a concurrent.futures executor
+
+    Args:
+        executor: concurrent.futures.Executor or None
+            executor to use. If None a ThreadPoolExecutor with n_workers threads is started,
+            which suits tasks that spend their time in numpy, scipy or I/O
+
+        n_workers: int or None
+            max_workers of the executor, by default os.cpu_count(). Give it with an executor
+            started with another max_workers
+    """
+
+    def __init__(self, executor=None, n_workers: Optional[int] = None, memory_limit: Optional[int] = None) -> None:
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_workers)
+        self.process_based = isinstance(executor, concurrent.futures.ProcessPoolExecutor)
+        self._futures: List = []
+        super().__init__(executor, n_workers, memory_limit)
+
+    def _results(self, pars, ordered):
+        self._futures = [self.backend.submit(run_task, par) for par in pars]
+        try:
+            for future in (self._futures if ordered else concurrent.futures.as_completed(self._futures)):
+                yield future.result()
+        finally:
+            self.cancel()
+
+    def cancel(self) -> None:
+        """ Cancels the tasks that have not started yet """
+        super().cancel()
+        for future in self._futures:
+            future.cancel()
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self.backend.shutdown(wait=False)
+
+
+class IPyParallelExecutor(Executor):
+    """ Runs the tasks on the engines of an ipyparallel view """
+    process_based = True
+
+    def __init__(self, view, memory_limit: Optional[int] = None) -> None:
+        self._async_result = None
+        super().__init__(view, len(view), memory_limit)
+
+    def _results(self, pars, ordered):
+        # results of a load balanced view can be streamed in completion order
+        kwargs = {} if ordered or not isinstance(self.backend, ipyparallel.LoadBalancedView) else {'ordered': False}
+        self._async_result = self.backend.map_async(run_task, pars, **kwargs)
+        try:
+            yield from self._async_result
+        finally:
+            self.backend.results.clear()
+
+    def cancel(self) -> None:
+        """ Aborts the tasks that have not started yet """
+        super().cancel()
+        if self._async_result is not None and not self._async_result.ready():
+            self._async_result.abort()
+
+
+class DaskExecutor(Executor):
+    """ Runs the tasks on a dask distributed Client (dask is optional)
+
+    Args:
+        client: dask.distributed.Client or None
+            client to use. If None a local cluster of n_workers single threaded processes is started
+    """
+    process_based = True
+
+    def __init__(self, client=None, n_workers: Optional[int] = None, memory_limit: Optional[int] = None) -> None:
+        if not HAS_DASK:
+            raise Exception('dask.distributed module unavailable')
+        if client is None:
+            client = dask.distributed.Client(n_workers=n_workers, threads_per_worker=1, processes=True)
+        self._futures: List = []
+        super().__init__(client, len(client.scheduler_info()['workers']), memory_limit)
+
+    def _results(self, pars, ordered):
+        self._futures = self.backend.map(run_task, pars, pure=False)
+        try:
+            for future in (self._futures if ordered else dask.distributed.as_completed(self._futures)):
+                yield future.result()
+        finally:
+            self.cancel()
+
+    def cancel(self) -> None:
+        """ Cancels the tasks that have not completed yet """
+        super().cancel()
+        pending = [future for future in self._futures if not future.done()]
+        if pending:
+            self.backend.cancel(pending)
+
+    def shutdown(self) -> None:
+        self.backend.close()
+
+
+def as_executor(dview, memory_limit: Optional[int] = None) -> Executor:
+    """ Wraps whatever was passed as dview into an Executor
+
+    Args:
+        dview:
+            None, an Executor, a multiprocessing Pool, a concurrent.futures executor, a dask
+            distributed Client or an ipyparallel view
+
+        memory_limit: int or None
+            bytes a worker may allocate while running a task, when wrapping a backend
+
+    Returns:
+        executor: Executor
+            dview itself if it already is one, SerialExecutor if dview is None
+
+    Raises:
+        TypeError 'Unsupported parallel backend'
+    """
+    if isinstance(dview, Executor):
+        return dview
+    if dview is None:
+        return SerialExecutor(memory_limit=memory_limit)
+    if isinstance(dview, multiprocessing.pool.Pool):
+        return MultiprocessingExecutor(dview, memory_limit=memory_limit)
+    if isinstance(dview, concurrent.futures.Executor):
+        return FuturesExecutor(dview, memory_limit=memory_limit)
+    if HAS_DASK and isinstance(dview, dask.distributed.Client):
+        return DaskExecutor(dview, memory_limit=memory_limit)
+    if hasattr(dview, 'map_sync'):
+        return IPyParallelExecutor(dview, memory_limit=memory_limit)
+    raise TypeError(f'Unsupported parallel backend {type(dview)}')
+
+
+def parallel_map(dview, func: Callable, args: Iterable) -> List:
+    """ map(func, args) on the workers of dview (see as_executor), results in order """
+    return as_executor(dview).map(func, args)
@@ -13,18 +13,33 @@ from past.builtins import basestring
 from past.utils import old_div
 
 import ipyparallel as parallel
-from itertools import chain
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from itertools import chain, islice
+import json
 import logging
 import numpy as np
 import os
 import pickle
+import scipy.sparse
 import sys
+import threading
 import tifffile
+import time
 from typing import Any, Dict, List, Optional, Tuple, Union
 import pathlib
+import zlib
 
 import caiman as cm
-from caiman.paths import memmap_frames_filename
+from caiman.executors import as_executor, parallel_map
+from caiman.paths import memmap_frames_filename, memmap_metadata_filename
+from caiman.shared_arrays import SharedArrays, attach
+from caiman.zarr_storage import is_zarr, zarr_to_memmap
+
+# dtypes that can be stored in a memmap file. Integer types are only meant to hold raw data
+MEMMAP_DTYPES = ('float32', 'uint16', 'int16')
+MEMMAP_METADATA_VERSION = 1
 
 
 def prepare_shape(mytuple: Tuple) -> Tuple:
@@ -35,10 +50,209 @@ def prepare_shape(mytuple: Tuple) -> Tuple:
     return tuple(map(lambda x: np.uint64(x), mytuple))
 
 
+def check_memmap_dtype(dtype) -> np.dtype:
+    """ Validates that dtype is one of the types supported for memory mapped files and returns it as np.dtype """
+    dtype = np.dtype(dtype)
+    if dtype.name not in MEMMAP_DTYPES:
+        raise ValueError(f'Unsupported memmap dtype {dtype.name} (should be one of {MEMMAP_DTYPES})')
+    return dtype
+
+
+def compute_memmap_checksums(filename: str, chunk_bytes: int = 2**26) -> List[int]:
+    """ Computes the crc32 checksum of each consecutive chunk of chunk_bytes bytes of a file
+
+    Args:
+        filename: str
+            path of the file
+
+        chunk_bytes: int
+            size of each chunk in bytes
+
+    Returns:
+        checksums: list of int
+            one checksum per chunk
+    """
+    checksums = []
+    with open(filename, 'rb') as f:
+        while True:
+            buf = f.read(chunk_bytes)
+            if not buf:
+                break
+            checksums.append(zlib.crc32(buf))
+    return checksums
+
+
+class ChunkChecksums(object):
+    """ crc32 checksums of consecutive chunks of a file, as in compute_memmap_checksums, updated
+    with the bytes as they are written so that the file does not have to be read back
+
+    Args:
+        chunk_bytes: int
+            size of each chunk in bytes
+    """
+    def __init__(self, chunk_bytes: int = 2**26) -> None:
+        self.chunk_bytes = chunk_bytes
+        self.checksums: List[int] = []
+        self._crc, self._n_bytes = 0, 0
+
+    def update(self, data: np.ndarray) -> None:
+        """ Adds the bytes of data, in their C order, to the current chunk """
+        buf = memoryview(np.ascontiguousarray(data)).cast('B')
+        while len(buf) > 0:
+            n = min(len(buf), self.chunk_bytes - self._n_bytes)
+            self._crc = zlib.crc32(buf[:n], self._crc)
+            self._n_bytes += n
+            buf = buf[n:]
+            if self._n_bytes == self.chunk_bytes:
+                self.checksums.append(self._crc)
+                self._crc, self._n_bytes = 0, 0
+
+    def result(self) -> List[int]:
+        """ Checksums of the chunks written so far, the last one possibly incomplete """
+        return self.checksums + ([self._crc] if self._n_bytes > 0 else [])
+
+
+def save_memmap_metadata(filename: str,
+                         dims: Tuple,
+                         T: int,
+                         order: str = 'C',
+                         dtype=np.float32,
+                         fr: Optional[float] = None,
+                         source_files: Optional[List] = None,
+                         compute_checksums: bool = False,
+                         checksum_chunk_bytes: int = 2**26,
+                         checksums: Optional[List[int]] = None) -> str:
+    """ Writes the JSON sidecar describing a memory mapped file
+
+    The sidecar stores the shape, order and dtype of the data, so that the file can
+    be loaded without parsing its name, together with the frame rate, the provenance
+    of the data and per-chunk checksums of the raw bytes.
+
+    Args:
+        filename: str
+            path of the memory mapped file (must already be written)
+
+        dims: tuple
+            frame dimensions
+
+        T: int
+            number of frames
+
+        order: str
+            'C' or 'F', order in which the (pixels x frames) matrix is stored
+
+        dtype: np.dtype
+            one of float32, uint16, int16
+
+        fr: float
+            frame rate, if known
+
+        source_files: list
+            files the data was generated from
+
+        compute_checksums: bool
+            whether to store per-chunk checksums, read from the whole file unless given in checksums
+
+        checksum_chunk_bytes: int
+            size in bytes of the chunks the checksums are computed over
+
+        checksums: list of int
+            checksums computed while writing the file (see ChunkChecksums)
+
+    Returns:
+        fname_meta: str
+            path of the sidecar file
+    """
+    dtype = check_memmap_dtype(dtype)
+    if source_files is not None:
+        source_files = [f if isinstance(f, str) else '<array>' for f in source_files]
+    metadata = {
+        'version': MEMMAP_METADATA_VERSION,
+        'dims': [int(d) for d in dims],
+        'T': int(T),
+        'order': order,
+        'dtype': dtype.name,
+        'fr': None if fr is None else float(fr),
+        'provenance': {
+            'source_files': source_files,
+            'caiman_version': cm.__version__,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'checksum_chunk_bytes': int(checksum_chunk_bytes),
+        'checksums': None
+    }
+    if compute_checksums:
+        metadata['checksums'] = (compute_memmap_checksums(filename, checksum_chunk_bytes) if checksums is None
+                                 else [int(c) for c in checksums])
+    fname_meta = memmap_metadata_filename(filename)
+    with open(fname_meta, 'w') as f:
+        json.dump(metadata, f, indent=1)
+    return fname_meta
+
+
+def load_memmap_metadata(filename: str) -> Optional[Dict]:
+    """ Reads the JSON sidecar of a memory mapped file
+
+    Args:
+        filename: str
+            path of the memory mapped file
+
+    Returns:
+        metadata: dict or None
+            content of the sidecar, or None if the file has no sidecar
+    """
+    fname_meta = memmap_metadata_filename(filename)
+    if not os.path.exists(fname_meta):
+        return None
+    with open(fname_meta, 'r') as f:
+        metadata = json.load(f)
+    if metadata.get('version', 0) > MEMMAP_METADATA_VERSION:
+        logging.warning(f"Memmap metadata {fname_meta} was written by a newer version of CaImAn")
+    return metadata
+
+
+def verify_memmap(filename: str) -> List[int]:
+    """ Checks the content of a memory mapped file against the checksums stored in its sidecar
+
+    Args:
+        filename: str
+            path of the memory mapped file
+
+    Returns:
+        bad_chunks: list of int
+            indices of the chunks whose checksum does not match
+
+    Raises:
+        ValueError "No checksums available"
+    """
+    metadata = load_memmap_metadata(filename)
+    if metadata is None or metadata.get('checksums') is None:
+        raise ValueError('No checksums available for file ' + str(filename))
+    checksums = compute_memmap_checksums(filename, metadata['checksum_chunk_bytes'])
+    expected = metadata['checksums']
+    bad_chunks = [i for i, (c, e) in enumerate(zip(checksums, expected)) if c != e]
+    # a truncated or extended file also counts as corrupt from the first differing chunk on
+    bad_chunks += list(range(min(len(checksums), len(expected)), max(len(checksums), len(expected))))
+    return bad_chunks
+
+
+def to_memmap_dtype(Yr: np.ndarray, dtype, add_to_movie: float = 0) -> np.ndarray:
+    """ Converts a (pixels x frames) block to the dtype of a memmap file, adding add_to_movie.
+        Float data also gets a small offset, integer data is rounded and clipped to the range of the type """
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return np.ascontiguousarray(np.clip(np.round(Yr + add_to_movie), info.min, info.max), dtype=dtype)
+    return np.ascontiguousarray(Yr, dtype=np.float32) + np.float32(0.0001) + np.float32(add_to_movie)
+
+
 #%%
 def load_memmap(filename: str, mode: str = 'r') -> Tuple[Any, Tuple, int]:
     """ Load a memory mapped file created by the function save_memmap
 
+    If a JSON sidecar (see save_memmap_metadata) exists next to the file, the
+    shape, order and dtype are read from it, otherwise they are parsed from the
+    file name and the data is assumed to be float32.
+
     Args:
         filename: str
             path of the file to be loaded
@@ -66,14 +280,24 @@ def load_memmap(filename: str, mode: str = 'r') -> Tuple[Any, Tuple, int]:
     # Strip path components and use CAIMAN_DATA/example_movies
     # TODO: Eventually get the code to save these in a different dir
     file_to_load = filename
-    filename = os.path.split(filename)[-1]
-    fpart = filename.split('_')[1:-1]  # The filename encodes the structure of the map
-    d1, d2, d3, T, order = int(fpart[-9]), int(fpart[-7]), int(fpart[-5]), int(fpart[-1]), fpart[-3]
-    Yr = np.memmap(file_to_load, mode=mode, shape=prepare_shape((d1 * d2 * d3, T)), dtype=np.float32, order=order)
-    if d3 == 1:
-        return (Yr, (d1, d2), T)
+    metadata = load_memmap_metadata(file_to_load)
+    if metadata is not None:
+        dims, T, order = tuple(metadata['dims']), metadata['T'], metadata['order']
+        dtype = check_memmap_dtype(metadata['dtype'])
     else:
-        return (Yr, (d1, d2, d3), T)
+        filename = os.path.split(filename)[-1]
+        fpart = filename.split('_')[1:-1]  # The filename encodes the structure of the map
+        d1, d2, d3, T, order = int(fpart[-9]), int(fpart[-7]), int(fpart[-5]), int(fpart[-1]), fpart[-3]
+        dims = (d1, d2) if d3 == 1 else (d1, d2, d3)
+        dtype = np.float32
+    Yr = np.memmap(file_to_load, mode=mode, shape=prepare_shape((int(np.prod(dims)), T)), dtype=dtype, order=order)
+    return (Yr, dims, T)
+
+
+def memmap_layout(filename: str) -> Tuple[str, np.dtype]:
+    """ Returns the order ('C' or 'F') and the dtype of a memory mapped file """
+    Yr, _, _ = load_memmap(filename)
+    return ('F' if np.isfortran(Yr) else 'C'), Yr.dtype
 
 
 #%%
@@ -89,7 +313,9 @@ def save_memmap_each(fnames: List[str],
                      add_to_movie: float = 0,
                      border_to_0: int = 0,
                      order: str = 'C',
-                     slices=None) -> List[str]:
+                     slices=None,
+                     dtype=np.float32,
+                     fr: Optional[float] = None) -> List[str]:
     """
     Create several memory mapped files using parallel processing
 
@@ -128,6 +354,12 @@ def save_memmap_each(fnames: List[str],
 
         slices: (undocumented)
 
+        dtype: np.dtype
+            data type of the memory mapped files (float32, uint16 or int16)
+
+        fr: float
+            frame rate, stored in the metadata of the files
+
     Returns:
         fnames_tot: list
             paths to the created memory map files
@@ -145,30 +377,24 @@ def save_memmap_each(fnames: List[str],
         if base_name is not None:
             pars.append([
                 f, base_name + '{:04d}'.format(idx), resize_fact[idx], remove_init, idx_xy, order,
-                var_name_hdf5, xy_shifts[idx], is_3D, add_to_movie, border_to_0, slices
+                var_name_hdf5, xy_shifts[idx], is_3D, add_to_movie, border_to_0, slices, dtype, fr
             ])
         else:
             pars.append([
                 f,
                 os.path.splitext(f)[0], resize_fact[idx], remove_init, idx_xy, order, var_name_hdf5,
-                xy_shifts[idx], is_3D, add_to_movie, border_to_0, slices
+                xy_shifts[idx], is_3D, add_to_movie, border_to_0, slices, dtype, fr
             ])
 
     # Perform the job using whatever computing framework we're set to use
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            fnames_new = dview.map_async(save_place_holder, pars).get(4294967)
-        else:
-            fnames_new = my_map(dview, save_place_holder, pars)
-    else:
-        fnames_new = list(map(save_place_holder, pars))
+    fnames_new = parallel_map(dview, save_place_holder, pars)
 
     return fnames_new
 
 
 #%%
 def save_memmap_join(mmap_fnames: List[str], base_name: str = None, n_chunks: int = 20, dview=None,
-                     add_to_mov=0) -> str:
+                     add_to_mov=0, compute_checksums: bool = False) -> str:
     """
     Makes a large file memmap from a number of smaller files
 
@@ -187,10 +413,14 @@ def save_memmap_join(mmap_fnames: List[str], base_name: str = None, n_chunks: in
 
     tot_frames = 0
     order = 'C'
+    dtype = None
     for f in mmap_fnames:
         Yr, dims, T = load_memmap(f)
         logging.debug((f, T))  # TODO: Add a text header so this isn't just numeric output, but what to say?
         tot_frames += T
+        if dtype is not None and Yr.dtype != dtype:
+            raise ValueError('All the files to join must have the same dtype')
+        dtype = Yr.dtype
         del Yr
 
     d = np.prod(dims)
@@ -204,7 +434,7 @@ def save_memmap_join(mmap_fnames: List[str], base_name: str = None, n_chunks: in
     fname_tot = os.path.join(os.path.split(mmap_fnames[0])[0], fname_tot)
     logging.info("Memmap file for fname_tot: " + str(fname_tot))
 
-    big_mov = np.memmap(fname_tot, mode='w+', dtype=np.float32, shape=prepare_shape((d, tot_frames)), order='C')
+    big_mov = np.memmap(fname_tot, mode='w+', dtype=dtype, shape=prepare_shape((d, tot_frames)), order='C')
 
     step = np.int(old_div(d, n_chunks))
     pars = []
@@ -218,19 +448,23 @@ def save_memmap_join(mmap_fnames: List[str], base_name: str = None, n_chunks: in
         # last batch should include the leftover pixels
         pars[-1][-2] = d
 
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            dview.map_async(save_portion, pars).get(4294967)
-        else:
-            my_map(dview, save_portion, pars)
-
-    else:
-        list(map(save_portion, pars))
+    parallel_map(dview, save_portion, pars)
 
     np.savez(base_name + '.npz', mmap_fnames=mmap_fnames, fname_tot=fname_tot)
 
     logging.info('Deleting big mov')
     del big_mov
+    source_files: List = []
+    fr = None
+    for f in mmap_fnames:
+        metadata = load_memmap_metadata(f)
+        if metadata is None:
+            source_files.append(f)
+        else:
+            source_files += metadata['provenance']['source_files'] or [f]
+            fr = metadata['fr'] if fr is None else fr
+    save_memmap_metadata(fname_tot, dims, tot_frames, order=order, dtype=dtype, fr=fr, source_files=source_files,
+                         compute_checksums=compute_checksums)
     sys.stdout.flush()
     return fname_tot
 
@@ -281,20 +515,23 @@ def save_portion(pars) -> int:
     use_mmap_save = False
     big_mov, d, tot_frames, fnames, idx_start, idx_end, add_to_mov = pars
     Ttot = 0
-    Yr_tot = np.zeros((idx_end - idx_start, tot_frames), dtype=np.float32)
-    logging.debug("Shape of Yr_tot is " + str(Yr_tot.shape))
+    dtype = None
+    Yr_tot = None
     for f in fnames:
         logging.debug("Saving portion to " + str(f))
         Yr, _, T = load_memmap(f)
-        Yr_tot[:, Ttot:Ttot +
-               T] = np.ascontiguousarray(Yr[idx_start:idx_end], dtype=np.float32) + np.float32(add_to_mov)
+        if Yr_tot is None:
+            dtype = Yr.dtype
+            Yr_tot = np.zeros((idx_end - idx_start, tot_frames), dtype=dtype)
+            logging.debug("Shape of Yr_tot is " + str(Yr_tot.shape))
+        Yr_tot[:, Ttot:Ttot + T] = np.ascontiguousarray(Yr[idx_start:idx_end], dtype=dtype) + dtype.type(add_to_mov)
         Ttot = Ttot + T
         del Yr
 
     logging.debug("Index start and end are " + str(idx_start) + " and " + str(idx_end))
 
     if use_mmap_save:
-        big_mov = np.memmap(big_mov, mode='r+', dtype=np.float32, shape=prepare_shape((d, tot_frames)), order='C')
+        big_mov = np.memmap(big_mov, mode='r+', dtype=dtype, shape=prepare_shape((d, tot_frames)), order='C')
         big_mov[idx_start:idx_end, :] = Yr_tot
         del big_mov
     else:
@@ -323,7 +560,8 @@ def save_place_holder(pars: List) -> str:
     """
     # todo: todocument
 
-    (f, base_name, resize_fact, remove_init, idx_xy, order, var_name_hdf5, xy_shifts, is_3D, add_to_movie, border_to_0, slices) = pars
+    (f, base_name, resize_fact, remove_init, idx_xy, order, var_name_hdf5, xy_shifts, is_3D, add_to_movie, border_to_0, slices,
+     dtype, fr) = pars
 
     return save_memmap([f],
                        base_name=base_name,
@@ -336,7 +574,9 @@ def save_place_holder(pars: List) -> str:
                        is_3D=is_3D,
                        add_to_movie=add_to_movie,
                        border_to_0=border_to_0,
-                       slices=slices)
+                       slices=slices,
+                       dtype=dtype,
+                       fr=fr)
 
 
 #%%
@@ -353,7 +593,10 @@ def save_memmap(filenames: List[str],
                 border_to_0=0,
                 dview=None,
                 n_chunks: int = 100,
-                slices=None) -> str:
+                slices=None,
+                dtype=np.float32,
+                fr: Optional[float] = None,
+                compute_checksums: bool = False) -> str:
     """ Efficiently write data from a list of tif files into a memory mappable file
 
     Args:
@@ -397,14 +640,28 @@ def save_memmap(filenames: List[str],
             directions. For instance
             slices = [slice(0,200),slice(0,100),slice(0,100)] will take
             the first 200 frames and the 100 pixels along x and y dimensions.
+
+        dtype: np.dtype
+            data type of the memory mapped file, one of float32, uint16 or int16.
+            Integer types halve the size of the file for raw data; values are
+            rounded and clipped to the range of the type
+
+        fr: float
+            frame rate, stored in the metadata of the file
+
+        compute_checksums: bool
+            whether to store per-chunk checksums of the file in its metadata (see verify_memmap)
     Returns:
         fname_new: the name of the mapped file, the format is such that
-            the name will contain the frame dimensions and the number of frames
+            the name will contain the frame dimensions and the number of frames.
+            A JSON sidecar with the same stem holds the metadata of the file
 
     """
     if type(filenames) is not list:
         raise Exception('input should be a list of filenames')
 
+    dtype = check_memmap_dtype(dtype)
+
     if slices is not None:
         slices = [slice(0, None) if sl is None else sl for sl in slices]
 
@@ -433,7 +690,9 @@ def save_memmap(filenames: List[str],
                                               xy_shifts=xy_shifts,
                                               is_3D=is_3D,
                                               slices=slices,
-                                              add_to_movie=add_to_movie)
+                                              add_to_movie=add_to_movie,
+                                              dtype=dtype,
+                                              fr=fr)
         else:
             fname_parts = filenames
 
@@ -442,10 +701,38 @@ def save_memmap(filenames: List[str],
             raise Exception('You cannot merge files in F order, they must be in C order for CaImAn')
 
         fname_new = cm.save_memmap_join(fname_parts, base_name=base_name,
-                                        dview=dview, n_chunks=n_chunks)
+                                        dview=dview, n_chunks=n_chunks, compute_checksums=compute_checksums)
+
+    elif is_zarr(filenames[0]) and order == 'C' and tuple(resize_fact) == (1, 1, 1) and remove_init == 0 \
+            and idx_xy is None and xy_shifts is None and border_to_0 == 0 and slices is None:
+        # the chunks of the store are copied to the rows of the file they cover
+        fname_new = zarr_to_memmap(filenames[0], base_name=base_name, add_to_movie=add_to_movie, dtype=dtype, fr=fr,
+                                   compute_checksums=compute_checksums)
+
+    elif isinstance(filenames[0], basestring) and os.path.splitext(filenames[0])[1] == '.mmap' \
+            and tuple(resize_fact) == (1, 1, 1) and remove_init == 0 and idx_xy is None and xy_shifts is None \
+            and border_to_0 == 0 and slices is None and memmap_layout(filenames[0]) == ('F' if order == 'C' else 'C', dtype):
+        # only the layout changes, e.g. F order output of motion correction to C order for CNMF
+        fname_new = transpose_memmap(filenames[0], order=order, base_name=base_name, dview=dview,
+                                     add_to_movie=add_to_movie)
+
+    elif isinstance(filenames[0], basestring) and not is_3D:
+        fname_new = save_memmap_streaming(filenames[0],
+                                          base_name=base_name,
+                                          resize_fact=resize_fact,
+                                          remove_init=remove_init,
+                                          idx_xy=idx_xy,
+                                          order=order,
+                                          var_name_hdf5=var_name_hdf5,
+                                          xy_shifts=xy_shifts,
+                                          add_to_movie=add_to_movie,
+                                          border_to_0=border_to_0,
+                                          slices=slices,
+                                          dtype=dtype,
+                                          fr=fr,
+                                          compute_checksums=compute_checksums)
 
     else:
-        # TODO: can be done online
         Ttot = 0
         for idx, f in enumerate(filenames):
             if isinstance(f, str):     # Might not always be filenames.
@@ -507,7 +794,7 @@ def save_memmap(filenames: List[str],
             T, dims = Yr.shape[0], Yr.shape[1:]
             Yr = np.transpose(Yr, list(range(1, len(dims) + 1)) + [0])
             Yr = np.reshape(Yr, (np.prod(dims), T), order='F')
-            Yr = np.ascontiguousarray(Yr, dtype=np.float32) + np.float32(0.0001) + np.float32(add_to_movie)
+            Yr = to_memmap_dtype(Yr, dtype, add_to_movie)
 
             if idx == 0:
                 fname_tot = base_name + '_d1_' + str(
@@ -518,17 +805,18 @@ def save_memmap(filenames: List[str],
                 if len(filenames) > 1:
                     big_mov = np.memmap(fname_tot,
                                         mode='w+',
-                                        dtype=np.float32,
+                                        dtype=dtype,
                                         shape=prepare_shape((np.prod(dims), T)),
                                         order=order)
                     big_mov[:, Ttot:Ttot + T] = Yr
                     del big_mov
                 else:
                     logging.debug('SAVING WITH numpy.tofile()')
-                    Yr.tofile(fname_tot)
+                    # tofile always writes in C order, the transpose gives the F layout
+                    (Yr.T if order == 'F' else Yr).tofile(fname_tot)
             else:
                 big_mov = np.memmap(fname_tot,
-                                    dtype=np.float32,
+                                    dtype=dtype,
                                     mode='r+',
                                     shape=prepare_shape((np.prod(dims), Ttot + T)),
                                     order=order)
@@ -546,10 +834,389 @@ def save_memmap(filenames: List[str],
         except OSError:
             pass
         os.rename(fname_tot, fname_new)
+        save_memmap_metadata(fname_new, dims, Ttot, order=order, dtype=dtype, fr=fr, source_files=filenames,
+                             compute_checksums=compute_checksums)
+
+    return fname_new
+
+
+def _read_frames(frames, n_frames: int) -> Optional[np.ndarray]:
+    """ Reads the next n_frames frames from an iterator into an array, None once it is exhausted """
+    block = list(islice(frames, n_frames))
+    return np.array(block) if len(block) > 0 else None
+
+
+def _write_frames(big_mov: np.memmap, Yr: np.ndarray, t_start: int,
+                  checksums: Optional[ChunkChecksums] = None) -> None:
+    big_mov[:, t_start:t_start + Yr.shape[1]] = Yr
+    if checksums is not None:
+        # F order files are written frame after frame, in the order of their bytes
+        checksums.update(Yr.T)
+
+
+def save_memmap_streaming(filename: str,
+                          base_name: str = 'Yr',
+                          resize_fact: Tuple = (1, 1, 1),
+                          remove_init: int = 0,
+                          idx_xy: Tuple = None,
+                          order: str = 'F',
+                          var_name_hdf5: str = 'mov',
+                          xy_shifts: Optional[List] = None,
+                          add_to_movie: float = 0,
+                          border_to_0: int = 0,
+                          slices=None,
+                          dtype=np.float32,
+                          fr: Optional[float] = None,
+                          block_size: int = 500,
+                          compute_checksums: bool = False) -> str:
+    """ Writes a 2D movie file into a memory mappable file in a single pass over the data.
+
+    The movie is read with movies.load_iter in blocks of block_size frames; shifts,
+    slicing, resizing and add_to_movie are applied to each block, which is then written
+    into the preallocated output file. Reading the next block and writing the previous
+    one run in a thread pool while the current block is processed, so at most three
+    blocks are in memory at any time. Parameters are as in save_memmap. The checksums of
+    F order files are computed on the blocks as they are written.
+
+    Args:
+        block_size: int
+            number of frames read at a time. When downsampling in time it is
+            rounded to a multiple of the downsampling factor
+
+    Returns:
+        fname_new: the name of the mapped file
+
+    Raises:
+        Exception 'You cannot slice in x and y and then use add_to_movie'
+    """
+    from caiman.base.movies import load_iter
+    from caiman.source_extraction.cnmf.utilities import get_file_size
+
+    dtype = check_memmap_dtype(dtype)
+    fx, fy, fz = resize_fact
+    if border_to_0 > 0 and type(slices) is list:
+        raise Exception(
+            'You cannot slice in x and y and then use add_to_movie: if you only want to slice in time do not pass in a list but just a slice object'
+        )
+
+    _, T_file = get_file_size(filename, var_name_hdf5=var_name_hdf5)
+    if slices is not None:
+        t_slice, xy_slices = slices[0], tuple(slices[1:])
+    else:
+        t_slice = slice(remove_init, None)
+        xy_slices = () if idx_xy is None else tuple(idx_xy)
+    frame_idx = np.arange(T_file)[t_slice]
+    subindices = slice(*t_slice.indices(T_file)) if isinstance(t_slice, slice) else frame_idx
+
+    # temporal resizing averages groups of frames, which must not straddle two blocks
+    if fz < 1:
+        step = int(np.round(1 / fz))
+        block_size = max(step, block_size // step * step)
+    n_frames = len(frame_idx)
+    if n_frames == 0:
+        raise ValueError('No frames to save in ' + str(filename))
+    block_lengths = [block_size] * (n_frames // block_size) + ([n_frames % block_size] if n_frames % block_size else [])
+    T = int(sum(np.maximum(1, int(fz * bl)) for bl in block_lengths)) if fz != 1 else n_frames
+
+    frames = load_iter(filename, subindices=subindices, var_name_hdf5=var_name_hdf5)
+    # the border is rewritten at the end, and C order files are not written sequentially
+    checksums = ChunkChecksums() if compute_checksums and order == 'F' and border_to_0 == 0 else None
+    big_mov = None
+    min_mov = np.inf
+    t_in, t_out = 0, 0
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        next_block = executor.submit(_read_frames, frames, block_lengths[0])
+        write = None
+        for idx_block, bl in enumerate(block_lengths):
+            block = next_block.result()
+            if idx_block + 1 < len(block_lengths):
+                next_block = executor.submit(_read_frames, frames, block_lengths[idx_block + 1])
+
+            mov = cm.movie(block, fr=1)
+            if xy_shifts is not None:
+                mov = mov.apply_shifts([xy_shifts[i] for i in frame_idx[t_in:t_in + bl]],
+                                       interpolation='cubic', remove_blanks=False)
+            if len(xy_slices) > 0:
+                mov = mov[(slice(None),) + xy_slices]
+            if border_to_0 > 0:
+                # the minimum of the movie is known at the end only: the border is set to 0 here and
+                # the minimum, resized like the movie, is added afterwards (resizing is linear)
+                min_mov = min(min_mov, np.nanmin(mov))
+                dims_in = mov.shape[1:]
+                mov[:, :border_to_0] = mov[:, -border_to_0:] = 0
+                mov[:, :, :border_to_0] = mov[:, :, -border_to_0:] = 0
+            if fx != 1 or fy != 1 or fz != 1:
+                mov = mov.resize(fx=fx, fy=fy, fz=fz)
+
+            Tb, dims = mov.shape[0], mov.shape[1:]
+            Yr = to_memmap_dtype(np.reshape(mov, (Tb, np.prod(dims)), order='F').T, dtype, add_to_movie)
+            del mov, block
+
+            if big_mov is None:
+                fname_new = memmap_frames_filename(base_name, dims, T, order)
+                fname_new = os.path.join(os.path.split(filename)[0], fname_new)
+                big_mov = np.memmap(fname_new, mode='w+', dtype=dtype, shape=prepare_shape((np.prod(dims), T)),
+                                    order=order)
+            if write is not None:
+                write.result()
+            write = executor.submit(_write_frames, big_mov, Yr, t_out, checksums)
+            t_in += bl
+            t_out += Tb
+            logging.debug(f'Streamed {t_in} of {n_frames} frames to memmap')
+        write.result()
+
+    if border_to_0 > 0:
+        # value of the border as in save_memmap (see movie.calc_min), weighted by the resized border
+        border = np.zeros((1,) + dims_in, dtype=np.float32)
+        border[:, :border_to_0] = border[:, -border_to_0:] = 1
+        border[:, :, :border_to_0] = border[:, :, -border_to_0:] = 1
+        if fx != 1 or fy != 1:
+            border = cm.movie(border, fr=1).resize(fx=fx, fy=fy)
+        weights = np.ravel(border[0], order='F')
+        pixels = np.where(weights != 0)[0]
+        for t0 in range(0, T, block_size):
+            vals = np.asarray(big_mov[pixels, t0:t0 + block_size], dtype=np.float32) + \
+                np.float32(min_mov + 1) * weights[pixels, None]
+            big_mov[pixels, t0:t0 + block_size] = (to_memmap_dtype(vals, dtype) if np.issubdtype(dtype, np.integer)
+                                                   else vals)
+
+    big_mov.flush()
+    del big_mov
+    save_memmap_metadata(fname_new, dims, T, order=order, dtype=dtype, fr=fr, source_files=[filename],
+                         compute_checksums=compute_checksums,
+                         checksums=None if checksums is None else checksums.result())
+    return fname_new
+
+
+def transpose_memmap(filename: str,
+                     order: str = 'C',
+                     base_name: Optional[str] = None,
+                     dview=None,
+                     add_to_movie: float = 0,
+                     band_size: int = 4096,
+                     tile_size: int = 2048) -> str:
+    """ Rewrites a memory mapped file in the given order, out of core and in parallel
+
+    The (pixels x frames) matrix is split into bands that are contiguous in the output
+    (bands of pixels for a C order output, bands of frames for an F order output), and
+    each band is assigned to a task. A task copies its band in tiles of band_size x tile_size
+    elements, so that every read from the input and every write to the output is a long
+    contiguous run rather than a single element stride. Throughput is logged at the end.
+
+    Args:
+        filename: str
+            memory mapped file to convert
+
+        order: str
+            'C' (pixel-major, as needed by CNMF) or 'F' (frame-major)
+
+        base_name: str
+            base name of the output file. If not given it is derived from the input file name
+
+        dview: cluster handle
+            used to process the bands in parallel. If None it will be single thread
+
+        add_to_movie: float
+            value added to each element while copying
+
+        band_size: int
+            number of output-major rows (pixels or frames) per task
 
+        tile_size: int
+            length of the tiles along the other dimension
+
+    Returns:
+        fname_new: str
+            path of the converted file
+    """
+    Yr, dims, T = load_memmap(filename)
+    d, order_in, dtype = Yr.shape[0], 'F' if np.isfortran(Yr) else 'C', Yr.dtype
+    del Yr
+    if base_name is None:
+        base_name = os.path.split(filename)[-1]
+        base_name = base_name[:base_name.find('_d1_')] if '_d1_' in base_name else os.path.splitext(base_name)[0]
+        base_name += '_' + order
+    fname_new = memmap_frames_filename(base_name, dims, T, order)
+    fname_new = os.path.join(os.path.split(filename)[0], fname_new)
+    if os.path.abspath(fname_new) == os.path.abspath(filename):
+        raise ValueError('Input and output of transpose_memmap are the same file')
+    big_mov = np.memmap(fname_new, mode='w+', dtype=dtype, shape=prepare_shape((d, T)), order=order)
+    del big_mov
+
+    n_out = d if order == 'C' else T
+    pars = [[filename, fname_new, order, add_to_movie, start, min(start + band_size, n_out), tile_size]
+            for start in range(0, n_out, band_size)]
+    start_time = time.time()
+    parallel_map(dview, transpose_portion, pars)
+    elapsed = time.time() - start_time
+
+    nbytes = d * T * dtype.itemsize
+    logging.info(f'Transposed {filename} ({order_in} -> {order}): {nbytes / 2**20:.1f} MB in {elapsed:.2f} s '
+                 f'({nbytes / 2**20 / max(elapsed, 1e-9):.1f} MB/s)')
+
+    metadata = load_memmap_metadata(filename)
+    save_memmap_metadata(fname_new, dims, T, order=order, dtype=dtype,
+                         fr=None if metadata is None else metadata['fr'],
+                         source_files=[filename] if metadata is None else metadata['provenance']['source_files'])
     return fname_new
 
 
+def transpose_portion(pars: List) -> int:
+    """ Copies one band of a memory mapped file into the output of transpose_memmap, tile by tile
+
+    Returns:
+        nbytes: int
+            number of bytes copied
+    """
+    fname_in, fname_out, order, add_to_movie, start, end, tile_size = pars
+    Yr, _, T = load_memmap(fname_in)
+    # the output has no metadata until all the portions are written
+    big_mov = np.memmap(fname_out, mode='r+', dtype=Yr.dtype, shape=prepare_shape(Yr.shape), order=order)
+    n_other = T if order == 'C' else Yr.shape[0]
+    add = Yr.dtype.type(add_to_movie)
+    for tile_start in range(0, n_other, tile_size):
+        tile_end = min(tile_start + tile_size, n_other)
+        if order == 'C':
+            tile = (slice(start, end), slice(tile_start, tile_end))
+        else:
+            tile = (slice(tile_start, tile_end), slice(start, end))
+        big_mov[tile] = np.array(Yr[tile]) + add
+    big_mov.flush()
+    nbytes = (end - start) * n_other * Yr.dtype.itemsize
+    del Yr, big_mov
+    return nbytes
+
+
+#%%
+def _read_into(f, byte_offset: int, buf: np.ndarray) -> int:
+    """ Fills buf with the bytes of f starting at byte_offset, with a single sequential read """
+    view = memoryview(buf).cast('B')
+    f.seek(byte_offset)
+    n_read = 0
+    while n_read < len(view):
+        n = f.readinto(view[n_read:])
+        if not n:
+            raise IOError(f'Unexpected end of file while reading {len(view)} bytes at offset {byte_offset}')
+        n_read += n
+    return n_read
+
+
+def _will_need(fd: int, byte_offset: int, n_bytes: int) -> None:
+    """ Asks the kernel to start reading a byte range ahead of time, where supported """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, byte_offset, n_bytes, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+
+
+def load_memmap_patch(filename: str,
+                      slices: List[slice],
+                      out: Optional[np.ndarray] = None,
+                      max_gap_bytes: int = 2**20,
+                      block_bytes: int = 2**26) -> Tuple[np.ndarray, Dict]:
+    """ Reads a rectangular patch of a memory mapped file with a few large sequential reads
+
+    Indexing the memory mapped file with the flat pixel indices of a patch touches the
+    pages of every pixel row one at a time, which amounts to random I/O over the whole
+    file. Here the pixels of the patch are coalesced into runs that are contiguous in the
+    file (one run per column of the patch for a C order file), runs separated by less
+    than max_gap_bytes are merged, and every merged range is read with a single read of
+    at most about block_bytes bytes while the kernel is asked to prefetch the next one.
+
+    Args:
+        filename: str
+            memory mapped file created by save_memmap
+
+        slices: list of slices
+            spatial extent of the patch along each dimension of the frames
+
+        out: np.ndarray
+            float32 array of shape (pixels of the patch, T) to be filled, for instance a
+            np.memmap on local storage. If None it is allocated in memory
+
+        max_gap_bytes: int
+            gaps between runs up to this size are read through rather than skipped
+
+        block_bytes: int
+            approximate size of a single read
+
+    Returns:
+        out: np.ndarray
+            patch pixels x frames, pixels in F order as in the memory mapped file
+
+        stats: dict
+            bytes_read, bytes_used, n_reads and time spent reading the patch
+    """
+    start_time = time.time()
+    Yr, dims, T = load_memmap(filename)
+    dtype, offset, order = Yr.dtype, Yr.offset, 'F' if np.isfortran(Yr) else 'C'
+    d = Yr.shape[0]
+    del Yr
+    isz = dtype.itemsize
+    slices = [slice(*sl.indices(dim)[:2]) for sl, dim in zip(slices, dims)]
+    patch_dims = tuple(sl.stop - sl.start for sl in slices)
+    n_pix = int(np.prod(patch_dims))
+    # flat indices of the patch pixels, in the F order of the patch
+    pix = np.ravel_multi_index(tuple(idx + sl.start for idx, sl in
+                                     zip(np.unravel_index(np.arange(n_pix), patch_dims, order='F'), slices)),
+                               dims, order='F')
+    if out is None:
+        out = np.empty((n_pix, T), dtype=np.float32)
+    stats = {'bytes_read': 0, 'bytes_used': n_pix * T * isz, 'n_reads': 0, 'time': 0.}
+    if n_pix == 0 or T == 0:
+        return out, stats
+
+    with open(filename, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        if order == 'C':
+            # each column of the patch is a run of patch_dims[0] contiguous pixel rows
+            h, row_bytes = patch_dims[0], T * isz
+            starts = pix[::h]
+            groups: List[List[int]] = [[0]]
+            for k in range(1, len(starts)):
+                gap = (starts[k] - starts[k - 1] - h) * row_bytes
+                size = (starts[k] + h - starts[groups[-1][0]]) * row_bytes
+                if gap <= max_gap_bytes and size <= block_bytes:
+                    groups[-1].append(k)
+                else:
+                    groups.append([k])
+            ranges = [(starts[g[0]], starts[g[-1]] + h) for g in groups]
+            for gi, (g, (first, last)) in enumerate(zip(groups, ranges)):
+                if gi + 1 < len(ranges):
+                    nxt = ranges[gi + 1]
+                    _will_need(fd, offset + nxt[0] * row_bytes, (nxt[1] - nxt[0]) * row_bytes)
+                buf = np.empty((last - first, T), dtype=dtype)
+                stats['bytes_read'] += _read_into(f, offset + first * row_bytes, buf)
+                stats['n_reads'] += 1
+                for k in g:
+                    out[k * h:(k + 1) * h] = buf[starts[k] - first:starts[k] - first + h]
+        else:
+            # frames are contiguous: read the span of the patch within each frame, and read
+            # through the rest of the frame when it is small enough
+            pmin, pmax = int(pix.min()), int(pix.max()) + 1
+            span = pmax - pmin
+            frame_bytes = d * isz
+            n_frames = max(1, block_bytes // frame_bytes)
+            for t0 in range(0, T, n_frames):
+                t1 = min(t0 + n_frames, T)
+                if t1 < T:
+                    _will_need(fd, offset + (t1 * d + pmin) * isz, (min(t1 + n_frames, T) - t1) * frame_bytes)
+                buf = np.empty((t1 - t0, d), dtype=dtype)
+                if (d - span) * isz <= max_gap_bytes:
+                    stats['bytes_read'] += _read_into(f, offset + (t0 * d + pmin) * isz,
+                                                      buf.reshape(-1)[:(t1 - t0 - 1) * d + span])
+                    stats['n_reads'] += 1
+                else:
+                    for t in range(t0, t1):
+                        stats['bytes_read'] += _read_into(f, offset + (t * d + pmin) * isz, buf[t - t0, :span])
+                        stats['n_reads'] += 1
+                out[:, t0:t1] = buf[:, pix - pmin].T
+
+    stats['time'] = time.time() - start_time
+    return out, stats
+
+
 #%%
 
 
@@ -563,70 +1230,62 @@ def parallel_dot_product(A: np.ndarray, b, block_size: int = 5000, dview=None, t
             pixels x time
 
         b: time x comps
+
+    Returns:
+        the product, in the type of A and b combined (float32 for a float32 movie and factor)
     """
 
-    import pickle
     pars = []
     d1, d2 = np.shape(A)
-    b = pickle.dumps(b)
-    logging.debug('parallel dot product block size: ' + str(block_size))
+    dtype = np.result_type(A.dtype, b.dtype, np.float32)
+    # b is published once rather than pickled with every task
+    with SharedArrays(dview) as shared:
+        b_shared = shared.publish(b)
+        logging.debug('parallel dot product block size: ' + str(block_size))
 
-    if block_size < d1:
-        for idx in range(0, d1 - block_size, block_size):
-            idx_to_pass = list(range(idx, idx + block_size))
-            pars.append([A.filename, idx_to_pass, b, transpose])
+        if block_size < d1:
+            for idx in range(0, d1 - block_size, block_size):
+                idx_to_pass = list(range(idx, idx + block_size))
+                pars.append([A.filename, idx_to_pass, b_shared, transpose])
 
-        if (idx + block_size) < d1:
-            idx_to_pass = list(range(idx + block_size, d1))
-            pars.append([A.filename, idx_to_pass, b, transpose])
+            if (idx + block_size) < d1:
+                idx_to_pass = list(range(idx + block_size, d1))
+                pars.append([A.filename, idx_to_pass, b_shared, transpose])
 
-    else:
-        idx_to_pass = list(range(d1))
-        pars.append([A.filename, idx_to_pass, b, transpose])
+        else:
+            idx_to_pass = list(range(d1))
+            pars.append([A.filename, idx_to_pass, b_shared, transpose])
 
-    logging.debug('Start product')
-    b = pickle.loads(b)
+        logging.debug('Start product')
 
-    if transpose:
-        output = np.zeros((d2, np.shape(b)[-1]), dtype=np.float32)
-    else:
-        output = np.zeros((d1, np.shape(b)[-1]), dtype=np.float32)
-
-    if dview is None:
         if transpose:
-            #            b = pickle.loads(b)
-            logging.debug('Transposing')
-            for _, pr in enumerate(pars):
-                iddx, rs = dot_place_holder(pr)
-                output = output + rs
+            output = np.zeros((d2, np.shape(b)[-1]), dtype=dtype)
         else:
-            for _, pr in enumerate(pars):
-                iddx, rs = dot_place_holder(pr)
-                output[iddx] = rs
-
-    else:
-        for itera in range(0, len(pars), num_blocks_per_run):
-
-            if 'multiprocessing' in str(type(dview)):
-                results = dview.map_async(dot_place_holder, pars[itera:itera + num_blocks_per_run]).get(4294967)
-            else:
-                results = dview.map_sync(dot_place_holder, pars[itera:itera + num_blocks_per_run])
-
-            logging.debug('Processed:' + str([itera, itera + len(results)]))
+            output = np.zeros((d1, np.shape(b)[-1]), dtype=dtype)
 
+        if dview is None:
             if transpose:
+                #            b = pickle.loads(b)
                 logging.debug('Transposing')
-
-                for _, res in enumerate(results):
-                    output += res[1]
-
+                for _, pr in enumerate(pars):
+                    iddx, rs = dot_place_holder(pr)
+                    output = output + rs
             else:
-                logging.debug('Filling')
-                for res in results:
-                    output[res[0]] = res[1]
+                for _, pr in enumerate(pars):
+                    iddx, rs = dot_place_holder(pr)
+                    output[iddx] = rs
 
-            if 'multiprocessing' not in str(type(dview)):
-                dview.clear()
+        else:
+            executor = as_executor(dview)
+            for itera in range(0, len(pars), num_blocks_per_run):
+                # blocks are accumulated as soon as they are computed
+                for res in executor.imap_unordered(dot_place_holder, pars[itera:itera + num_blocks_per_run]):
+                    if transpose:
+                        output += res[1]
+                    else:
+                        output[res[0]] = res[1]
+
+                logging.debug('Processed:' + str([itera, min(itera + num_blocks_per_run, len(pars))]))
 
     return output
 
@@ -637,70 +1296,122 @@ def dot_place_holder(par: List) -> Tuple:
 
     A_name, idx_to_pass, b_, transpose = par
     A_, _, _ = load_memmap(A_name)
-    b_ = pickle.loads(b_).astype(np.float32)
+    b_ = pickle.loads(b_) if isinstance(b_, bytes) else attach(b_)
+    dtype = np.result_type(A_.dtype, b_.dtype, np.float32)
+    b_ = b_.astype(dtype, copy=False)
 
     logging.debug((idx_to_pass[-1]))
     if 'sparse' in str(type(b_)):
         if transpose:
             #            outp = (b_.tocsr()[idx_to_pass].T.dot(
             #                A_[idx_to_pass])).T.astype(np.float32)
-            outp = (b_.T.tocsc()[:, idx_to_pass].dot(A_[idx_to_pass])).T.astype(np.float32)
+            outp = (b_.T.tocsc()[:, idx_to_pass].dot(A_[idx_to_pass])).T.astype(dtype)
         else:
-            outp = (b_.T.dot(A_[idx_to_pass].T)).T.astype(np.float32)
+            outp = (b_.T.dot(A_[idx_to_pass].T)).T.astype(dtype)
     else:
         if transpose:
-            outp = A_[idx_to_pass].T.dot(b_[idx_to_pass]).astype(np.float32)
+            outp = A_[idx_to_pass].T.dot(b_[idx_to_pass]).astype(dtype)
         else:
-            outp = A_[idx_to_pass].dot(b_).astype(np.float32)
+            outp = A_[idx_to_pass].dot(b_).astype(dtype)
 
     del b_, A_
     return idx_to_pass, outp
 
 
 #%%
-def save_tif_to_mmap_online(movie_iterable, save_base_name='YrOL_', order='C', add_to_movie=0, border_to_0=0) -> str:
-    # todo: todocument
-
-    if isinstance(movie_iterable, basestring):         # Allow specifying a filename rather than its data rep
-        with tifffile.TiffFile(movie_iterable) as tf:  # And load it if that happens
-            movie_iterable = cm.movie(tf)
-
-    count = 0
-    new_mov = []
-
-    dims = (len(movie_iterable),) + movie_iterable[0].shape    # TODO: Don't pack length into dims
-
-    fname_tot = (memmap_frames_filename(save_base_name, dims[1:], dims[0], order))
-
-    big_mov = np.memmap(fname_tot,
-                        mode='w+',
-                        dtype=np.float32,
-                        shape=prepare_shape((np.prod(dims[1:]), dims[0])),
-                        order=order)
+def _factor_digest(x) -> str:
+    # digest of the values and type of a dense or sparse factor
+    h = hashlib.blake2b(digest_size=16)
+    if scipy.sparse.issparse(x):
+        x = scipy.sparse.csc_matrix(x)
+        x.sort_indices()
+        for arr in (x.data, x.indices, x.indptr):
+            h.update(np.ascontiguousarray(arr).data)
+    else:
+        x = np.ascontiguousarray(x)
+        h.update(x.data)
+    h.update(str((x.shape, x.dtype.str)).encode())
+    return h.hexdigest()
 
-    for page in movie_iterable:
-        if count % 100 == 0:
-            logging.debug(count)
 
-        if 'tifffile' in str(type(movie_iterable[0])):
-            page = page.asarray()
+class ProductCache(object):
+    """ Products of memory mapped movies with spatial and temporal factors, kept for reuse
 
-        img = np.array(page, dtype=np.float32)
-        new_img = img
-        if save_base_name is not None:
-            big_mov[:, count] = np.reshape(new_img, np.prod(dims[1:]), order='F')
-        else:
-            new_mov.append(new_img)
+    The updates of the temporal components, the residuals and the background all need the
+    products Y'*A (frames x components) or Y*f' (pixels x components) of the movie Y (pixels
+    x frames) with the current footprints A or traces f. dot_product() computes them with
+    parallel_dot_product and returns the cached ones as long as neither the file nor the
+    factor changed.
 
-        if border_to_0 > 0:
-            img[:border_to_0, :] = 0
-            img[:, :border_to_0] = 0
-            img[:, -border_to_0:] = 0
-            img[-border_to_0:, :] = 0
+    Entries are keyed on the file (path, size and modification time) and on a digest of the
+    factor values, so that changing the factor (or rewriting the file) never returns a stale
+    product. The least recently used entries are dropped beyond max_bytes. CNMF.fit clears
+    the shared instance product_cache when it returns.
 
-        big_mov[:, count] = np.reshape(img + add_to_movie, np.prod(dims[1:]), order='F')
+    Args:
+        max_bytes: int
+            memory the cached products may use
+    """
 
-        count += 1
-    big_mov.flush()
-    del big_mov
-    return fname_tot
+    def __init__(self, max_bytes: int = 2**30) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[Tuple, np.ndarray]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(v.nbytes for v in self._entries.values())
+
+    def clear(self) -> None:
+        """ Drops all the cached products """
+        with self._lock:
+            self._entries.clear()
+
+    def dot_product(self, Y, b, block_size: int = 5000, dview=None, transpose: bool = False,
+                    num_blocks_per_run: int = 20) -> np.ndarray:
+        """ Returns Y*b, or Y'*b if transpose, computed by parallel_dot_product unless cached
+
+        Args:
+            Y: memory mapped ndarray
+                movie, pixels x frames. Products with other arrays are computed and not cached
+
+            b: ndarray or sparse matrix
+                frames x components, or pixels x components if transpose
+
+            block_size, dview, transpose, num_blocks_per_run:
+                see parallel_dot_product
+
+        Returns:
+            product: np.ndarray
+                pixels x components, or frames x components if transpose, in the type of
+                Y and b combined. Cached products are read-only
+        """
+        if not isinstance(Y, np.memmap):
+            return np.asarray(b.T.dot(Y).T if transpose else (b.T.dot(Y.T)).T)
+
+        stat = os.stat(Y.filename)
+        key = (os.path.abspath(Y.filename), stat.st_size, stat.st_mtime_ns, transpose, _factor_digest(b))
+        with self._lock:
+            product = self._entries.get(key)
+            if product is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return product
+            self.misses += 1
+
+        product = parallel_dot_product(Y, b, block_size=block_size, dview=dview, transpose=transpose,
+                                       num_blocks_per_run=num_blocks_per_run)
+        product.flags.writeable = False
+        with self._lock:
+            self._entries[key] = product
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                self._entries.popitem(last=False)
+            logging.debug(f'Product cache: {self.hits} hits, {self.misses} misses, '
+                          f'{self.nbytes / 2**20:.1f} MB')
+        return product
+
+
+# products shared by the stages of a CNMF fit
+product_cache = ProductCache()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Model registry: a process-wide cache of the neural network models used by CaImAn
+
+The CNN classifiers of components (offline, see components_evaluation.evaluate_components_CNN,
+and online, see the sniper_mode of OnACID) and the Mask R-CNN of VolPy are loaded through
+the registry, so that each model is read from disk once per process, on first use:
+
+    get_classifier(model_name)   Classifier with a thread-safe predict(x, batch_size)
+    get_model(key, loader)       any other model, as returned by loader()
+
+The registry keeps at most max_models models resident and evicts the least recently
+used one when it is full (see set_max_models). Evicted models are not closed, since their
+users may still hold them: they are released when the last reference goes away. A classifier is warmed up with a dummy
+batch when it is loaded, so that the first real call does not pay for graph building.
+
+Classifiers are stored as keras models (.json/.h5) or frozen tensorflow graphs (.h5.pb).
+If a model has also been exported next to them to ONNX (.onnx) or TF-Lite (.tflite),
+these CPU backends are used instead (onnxruntime is an optional dependency).
+"""
+
+from collections import OrderedDict
+import logging
+import numpy as np
+import os
+import threading
+from typing import Any, Callable, Hashable, Optional
+
+from caiman.paths import caiman_datadir
+
+try:
+    import onnxruntime
+    HAS_ONNXRUNTIME = True
+except ImportError:
+    HAS_ONNXRUNTIME = False
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('onnx', 'tflite', 'keras', 'tensorflow')
+EXTENSIONS = {'onnx': '.onnx', 'tflite': '.tflite', 'keras': '.json', 'tensorflow': '.h5.pb'}
+
+
+class Entry(object):
+    """ a resident model and the lock that serializes its use """
+
+    def __init__(self, model: Any):
+        self.model = model
+        self.lock = threading.RLock()
+
+
+class ModelRegistry(object):
+    """ Thread-safe LRU cache of loaded models """
+
+    def __init__(self, max_models: int = 4):
+        self.max_models = max_models
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading: dict = {}
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Entry:
+        """ Returns the entry of the model stored under key, calling loader() to load it
+        if it is not resident. Concurrent requests for the same model load it once.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._entries:
+                    return self._entries[key]
+            logger.info('Loading model {}'.format(key))
+            entry = Entry(loader())
+            with self._lock:
+                self._entries[key] = entry
+                self._loading.pop(key, None)
+                while len(self._entries) > max(self.max_models, 1):
+                    # not closed: callers may still hold the model, it is released with their references
+                    old_key, _ = self._entries.popitem(last=False)
+                    logger.info('Evicting model {}'.format(old_key))
+        return entry
+
+    def keys(self) -> list:
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self) -> None:
+        """ Drops and closes all the models, which must not be used afterwards """
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            close = getattr(entry.model, 'close', None)
+            if close is not None:
+                close()
+
+
+registry = ModelRegistry()
+
+
+def set_max_models(max_models: int) -> None:
+    """ Sets the maximal number of models kept resident by the registry """
+    registry.max_models = max_models
+
+
+class Classifier(object):
+    """ CNN classifier with a common, thread-safe predict for all backends """
+
+    def __init__(self, backend: str, model: Any, input_name: Optional[str] = None,
+                 output_name: Optional[str] = None):
+        self.backend = backend
+        self.model = model
+        self.lock = threading.RLock()
+        if backend == 'tensorflow':
+            import tensorflow as tf
+            self.tf_in = model.get_tensor_by_name(input_name)
+            self.tf_out = model.get_tensor_by_name(output_name)
+            self.session = tf.Session(graph=model)
+        elif backend == 'onnx':
+            self.input_name = model.get_inputs()[0].name
+        elif backend == 'tflite':
+            model.allocate_tensors()
+
+    @property
+    def input_shape(self) -> tuple:
+        """ shape of one input sample """
+        if self.backend == 'keras':
+            shape = self.model.input_shape[1:]
+        elif self.backend == 'tensorflow':
+            shape = self.tf_in.shape.as_list()[1:]
+        elif self.backend == 'onnx':
+            shape = self.model.get_inputs()[0].shape[1:]
+        else:
+            shape = self.model.get_input_details()[0]['shape'][1:]
+        return tuple(int(s) if isinstance(s, (int, np.integer)) and s > 0 else 1 for s in shape)
+
+    def predict(self, x: np.ndarray, batch_size: int = 32, **kwargs) -> np.ndarray:
+        """ Class probabilities of the samples in x, evaluated in batches of batch_size """
+        x = np.asarray(x, dtype=np.float32)
+        with self.lock:
+            if self.backend == 'keras':
+                return self.model.predict(x, batch_size=batch_size, verbose=0)
+            out = []
+            for i in range(0, len(x), batch_size):
+                out.append(self._predict_batch(x[i:i + batch_size]))
+            return np.concatenate(out) if out else np.zeros((0,))
+
+    def _predict_batch(self, x: np.ndarray) -> np.ndarray:
+        if self.backend == 'tensorflow':
+            return self.session.run(self.tf_out, feed_dict={self.tf_in: x})
+        elif self.backend == 'onnx':
+            return self.model.run(None, {self.input_name: x})[0]
+        details_in = self.model.get_input_details()[0]
+        if tuple(details_in['shape']) != x.shape:
+            self.model.resize_tensor_input(details_in['index'], x.shape)
+            self.model.allocate_tensors()
+        self.model.set_tensor(details_in['index'], x)
+        self.model.invoke()
+        return self.model.get_tensor(self.model.get_output_details()[0]['index'])
+
+    def warm_up(self) -> None:
+        """ runs a dummy sample through the model """
+        self.predict(np.zeros((1,) + self.input_shape, dtype=np.float32))
+
+    def close(self) -> None:
+        if self.backend == 'tensorflow':
+            self.session.close()
+
+
+def _has_keras() -> bool:
+    try:
+        import tensorflow.keras
+        return True
+    except ImportError:
+        return False
+
+
+def find_model(model_name: str, backend: Optional[str] = None) -> tuple:
+    """ Finds the files of a model
+
+    Args:
+        model_name: str
+            path of the model without extension, absolute or relative to
+            caiman_datadir() or caiman_datadir()/model
+
+        backend: str or None
+            one of BACKENDS, or None to choose the first available one
+
+    Returns:
+        backend: str
+            the backend of the model files found
+
+        path: str
+            path of the model without extension
+    """
+    backends = BACKENDS if backend is None else (backend,)
+    for path in (model_name, os.path.join(caiman_datadir(), model_name),
+                 os.path.join(caiman_datadir(), 'model', model_name)):
+        for backend in backends:
+            if (backend == 'onnx' and not HAS_ONNXRUNTIME) or (backend == 'keras' and not _has_keras()):
+                continue
+            if os.path.isfile(path + EXTENSIONS[backend]):
+                return backend, os.path.abspath(path)
+    raise FileNotFoundError("File for requested model {} not found".format(model_name))
+
+
+def load_classifier(path: str, backend: str, input_name: Optional[str] = None,
+                    output_name: Optional[str] = None) -> Classifier:
+    """ Loads the classifier stored at path (without extension) with the given backend """
+    if backend == 'keras':
+        from tensorflow.keras.models import model_from_json
+        with open(path + '.json', 'r') as json_file:
+            model = model_from_json(json_file.read())
+        model.load_weights(path + '.h5')
+    elif backend == 'tensorflow':
+        from caiman.utils.utils import load_graph
+        model = load_graph(path + '.h5.pb')
+    elif backend == 'onnx':
+        model = onnxruntime.InferenceSession(path + '.onnx', providers=['CPUExecutionProvider'])
+    elif backend == 'tflite':
+        import tensorflow as tf
+        model = tf.lite.Interpreter(model_path=path + '.tflite')
+    else:
+        raise ValueError('Unknown backend {}'.format(backend))
+    return Classifier(backend, model, input_name=input_name, output_name=output_name)
+
+
+def get_classifier(model_name: str, backend: Optional[str] = None,
+                   input_name: str = 'prefix/conv2d_20_input:0',
+                   output_name: str = 'prefix/output_node0:0', warm_up: bool = True) -> Classifier:
+    """ Returns the classifier model_name from the registry, loading it on first use
+
+    Args:
+        model_name: str
+            path of the model without extension (see find_model)
+
+        backend: str or None
+            one of BACKENDS, or None to choose the first one with model files
+
+        input_name, output_name: str
+            input and output tensors of frozen tensorflow graphs
+
+        warm_up: bool
+            run a dummy sample through the model when it is loaded
+
+    Returns:
+        classifier: Classifier
+    """
+    backend, path = find_model(model_name, backend)
+
+    def loader():
+        classifier = load_classifier(path, backend, input_name=input_name, output_name=output_name)
+        if warm_up:
+            classifier.warm_up()
+        return classifier
+
+    return registry.get(('classifier', path, backend), loader).model
+
+
+def get_model(key: Hashable, loader: Callable[[], Any]) -> Entry:
+    """ Returns the registry entry of any other model, loading it with loader() on first
+    use. Use the model under the lock of the entry if it is not thread-safe:
+
+        entry = get_model(key, loader)
+        with entry.lock:
+            entry.model.detect(...)
+    """
+    return registry.get(key, loader)
@@ -48,12 +48,14 @@ import collections
 import cv2
 import gc
 import h5py
+import hashlib
 import itertools
 import logging
 import numpy as np
 from numpy.fft import ifftshift
 import os
 import pylab as pl
+import threading
 import tifffile
 from typing import List, Optional, Tuple
 from skimage.transform import resize as resize_sk
@@ -62,8 +64,10 @@ from skimage.transform import warp as warp_sk
 import caiman as cm
 import caiman.base.movies
 import caiman.motion_correction
+from caiman.executors import as_executor, parallel_map
 from caiman.paths import memmap_frames_filename
 from .mmapping import prepare_shape
+from . import zarr_storage
 
 try:
     cv2.setNumThreads(0)
@@ -82,6 +86,19 @@ try:
 except ImportError:
     HAS_CUDA = False
 
+try:
+    import pyfftw
+    pyfftw.interfaces.cache.enable()
+    HAS_PYFFTW = True
+except ImportError:
+    HAS_PYFFTW = False
+
+try:
+    import scipy.fft as scipy_fft
+    HAS_SCIPY_FFT = True
+except ImportError:     # scipy < 1.4
+    HAS_SCIPY_FFT = False
+
 try:
     profile
 except:
@@ -392,7 +409,8 @@ class MotionCorrect(object):
             self.coord_shifts_els += _coord_shifts_els
 
     def apply_shifts_movie(self, fname, rigid_shifts:bool=None, save_memmap:bool=False,
-                           save_base_name:str='MC', order:str='F', remove_min:bool=True):
+                           save_base_name:str='MC', order:str='F', remove_min:bool=True,
+                           save_zarr:bool=False, zarr_chunks:Optional[Tuple]=None):
         """
         Applies shifts found by registering one file to a different file. Useful
         for cases when shifts computed from a structural channel are applied to a
@@ -420,6 +438,14 @@ class MotionCorrect(object):
             remove_min: bool (True)
                 If minimum value is negative, subtract it from the data
 
+            save_zarr: bool (False)
+                flag for saving the resulting file in a compressed zarr store
+                (save_base_name + '.zarr')
+
+            zarr_chunks: tuple
+                chunk shape of the zarr store. If None chunks are aligned to the
+                default patch grid (see zarr_storage.patch_aligned_chunks)
+
         Returns:
             m_reg: caiman movie object
                 caiman movie object with applied shifts (not memory mapped)
@@ -495,6 +521,8 @@ class MotionCorrect(object):
             big_mov.flush()
             del big_mov
             return fname_tot
+        elif save_zarr:
+            return zarr_storage.save_zarr([m_reg], save_base_name + '.zarr', chunks=zarr_chunks)
         else:
             return cm.movie(m_reg)
 
@@ -1159,26 +1187,7 @@ def motion_correct_parallel(file_names, fr=10, template=None, margins_out=0,
             args_in.append((f, fr, margins_out, template, max_shift_w,
                             max_shift_h, remove_blanks, apply_smooth, save_hdf5))
 
-    try:
-        if dview is not None:
-            if 'multiprocessing' in str(type(dview)):
-                file_res = dview.map_async(
-                    process_movie_parallel, args_in).get(4294967)
-            else:
-                file_res = dview.map_sync(process_movie_parallel, args_in)
-                dview.results.clear()
-        else:
-            file_res = list(map(process_movie_parallel, args_in))
-
-    except:
-        try:
-            if (dview is not None) and 'multiprocessing' not in str(type(dview)):
-                dview.results.clear()
-
-        except UnboundLocalError:
-            logging.error('could not close client')
-
-        raise
+    file_res = parallel_map(dview, process_movie_parallel, args_in)
 
     return file_res
 
@@ -1781,6 +1790,283 @@ def register_translation(src_image, target_image, upsample_factor=1,
 
     return shifts, src_freq, _compute_phasediff(CCmax)
 
+def _fft(name, x, n_threads=1, **kwargs):
+    """ FFT function name of numpy.fft applied to x, with pyfftw or scipy.fft when available so that
+    stacks of images are transformed by n_threads threads
+    """
+    if HAS_PYFFTW:
+        return getattr(pyfftw.interfaces.numpy_fft, name)(x, threads=n_threads, **kwargs)
+    if HAS_SCIPY_FFT:
+        return getattr(scipy_fft, name)(x, workers=n_threads, **kwargs)
+    return getattr(np.fft, name)(x, **kwargs)
+
+
+def _dft_leading_axes(spectrum, kernels):
+    """ Applies one (n_frames x n_samples x axis length) DFT kernel along each image axis but the last
+    of a stack of spectra (frames along the first axis)
+    """
+    for axis, kernel in enumerate(kernels, 1):
+        moved = np.moveaxis(spectrum, axis, -1)
+        kernel = np.swapaxes(kernel, 1, 2).reshape(
+            (len(kernel),) + (1,) * (moved.ndim - 3) + kernel.shape[:0:-1])
+        spectrum = np.moveaxis(np.matmul(moved, kernel), -1, axis)
+    return spectrum
+
+
+def register_translation_batch(frames, template, upsample_factor=1, shifts_lb=None, shifts_ub=None,
+                               max_shifts=(10, 10), n_threads=1, template_spectrum=None):
+    """ Registers a stack of 2D or 3D frames to a template, same as register_translation (or
+    register_translation_3d) on each frame
+
+    The spectrum of the template is computed once, the frames are transformed together with
+    real FFTs and the subpixel refinement (upsampled DFT around the peak of each cross
+    correlation) is done for all the frames at once by matrix products.
+
+    Args:
+        frames: ndarray
+            images to register, frames along the first axis
+
+        template: ndarray
+            reference image, or one reference image per frame (e.g. the patches of the
+            template matching the patches of a frame)
+
+        upsample_factor: int, optional
+            images are registered to within 1 / upsample_factor of a pixel
+
+        shifts_lb, shifts_ub: tuple, optional
+            lower and upper bounds of the shifts, for all the frames
+
+        max_shifts: tuple
+            maximum shifts along each axis, when the bounds are not given
+
+        n_threads: int
+            number of threads of the FFTs
+
+        template_spectrum: ndarray, optional
+            conjugated real FFT of the template (see TemplateSpectra), computed if not given
+
+    Returns:
+        shifts: ndarray (n_frames x number of dimensions)
+            shift required to register each frame with the template
+
+        phasediffs: ndarray
+            global phase difference between each frame and the template
+
+    Raises:
+        ValueError "Error: images must really be same size for register_translation_batch"
+    """
+    frames = np.asarray(frames, dtype=np.float64)
+    n_frames, shape = frames.shape[0], frames.shape[1:]
+    ndim = len(shape)
+    axes = tuple(range(-ndim, 0))
+    if template.shape[-ndim:] != shape:
+        raise ValueError("Error: images must really be same size for "
+                         "register_translation_batch")
+
+    # Whole-pixel shift - cross-correlations by real FFTs
+    src_freq = _fft('rfftn', frames, n_threads, axes=axes)
+    if template_spectrum is None:
+        template_spectrum = _fft('rfftn', np.asarray(template, dtype=np.float64), n_threads, axes=axes).conj()
+    image_product = src_freq * template_spectrum
+    cross_correlation = _fft('irfftn', image_product, n_threads, s=shape, axes=axes)
+
+    # Locate maxima
+    new_cross_corr = np.abs(cross_correlation)
+
+    def set_zero(axis, sl):
+        index = [slice(None)] * (ndim + 1)
+        index[axis + 1] = sl
+        new_cross_corr[tuple(index)] = 0
+
+    for axis in range(ndim):
+        if (shifts_lb is not None) or (shifts_ub is not None):
+            if (shifts_lb[axis] < 0) and (shifts_ub[axis] >= 0):
+                set_zero(axis, slice(shifts_ub[axis], shifts_lb[axis]))
+            else:
+                set_zero(axis, slice(None, shifts_lb[axis]))
+                set_zero(axis, slice(shifts_ub[axis], None))
+        else:
+            set_zero(axis, slice(max_shifts[axis], -max_shifts[axis]))
+
+    maxima = np.argmax(new_cross_corr.reshape(n_frames, -1), 1)
+    shifts = np.stack(np.unravel_index(maxima, shape), 1).astype(np.float64)
+    midpoints = np.fix(np.array(shape) / 2)
+    shifts = np.where(shifts > midpoints, shifts - np.array(shape), shifts)
+
+    if upsample_factor == 1:
+        CCmax = cross_correlation.reshape(n_frames, -1).max(1)
+    # If upsampling > 1, then refine the estimates with matrix multiply DFTs
+    else:
+        # Initial shift estimates in upsampled grid
+        shifts = np.round(shifts * upsample_factor) / upsample_factor
+        upsampled_region_size = int(np.ceil(upsample_factor * 1.5))
+        # Center of output arrays at dftshift + 1
+        dftshift = np.fix(upsampled_region_size / 2.0)
+        sample_region_offset = dftshift - shifts * upsample_factor
+        # the kernels of _upsampled_dft, one per frame and axis, conjugated
+        samples = np.arange(upsampled_region_size)
+        kernels = [np.exp((1j * 2 * np.pi / (n * upsample_factor)) *
+                          (samples[None, :, None] - sample_region_offset[:, axis, None, None]) *
+                          (ifftshift(np.arange(n)) - np.floor(n / 2))[None, None, :])
+                   for axis, n in enumerate(shape)]
+        # the frequencies of the last axis missing from the real FFTs are the conjugates of the
+        # opposite ones, their DFTs along the other axes follow from the ones of the latter
+        opposite = [(-np.arange(n)) % n for n in shape[:-1]]
+        cross_correlation = np.concatenate([
+            _dft_leading_axes(image_product, kernels[:-1]),
+            _dft_leading_axes(image_product[..., 1:(shape[-1] + 1) // 2],
+                              [kernel[..., opp].conj() for kernel, opp in zip(kernels, opposite)]
+                              ).conj()[..., ::-1]], -1)
+        cross_correlation = np.matmul(cross_correlation, np.swapaxes(kernels[-1], 1, 2).reshape(
+            (n_frames,) + (1,) * (ndim - 2) + kernels[-1].shape[:0:-1]))
+        cross_correlation /= frames[0].size * upsample_factor ** 2
+        # Locate maxima and map back to original pixel grid
+        maxima = np.argmax(np.abs(cross_correlation).reshape(n_frames, -1), 1)
+        maxima = np.stack(np.unravel_index(maxima, cross_correlation.shape[1:]), 1) - dftshift
+        shifts = shifts + maxima / upsample_factor
+        CCmax = cross_correlation.reshape(n_frames, -1).max(1)
+
+    # If its only one row or column the shift along that dimension has no
+    # effect. We set to zero.
+    shifts[:, np.array(shape) == 1] = 0
+
+    return shifts, _compute_phasediff(CCmax)
+
+
+def apply_shifts_dft_batch(frames, shifts, diffphases, border_nan=True, n_threads=1):
+    """ Shifts a stack of 2D or 3D frames using inverse DFTs, same as apply_shifts_dft(frame, shift,
+    diffphase, is_freq=False) on each frame
+
+    Args:
+        frames: ndarray
+            images to shift, frames along the first axis
+
+        shifts: ndarray (n_frames x number of dimensions)
+            shifts to apply
+
+        diffphases: ndarray
+            phase differences from register_translation_batch
+
+        border_nan : bool or string, optional
+            specifies how to deal with borders. (True, False, 'copy', 'min')
+
+        n_threads: int
+            number of threads of the FFTs
+
+    Returns:
+        new_imgs: ndarray
+            shifted frames
+    """
+    frames = np.asarray(frames, dtype=np.float64)
+    shifts = np.asarray(shifts, dtype=np.float64)
+    is3D = frames.ndim == 4
+    axes = tuple(range(1, frames.ndim))
+    # as in apply_shifts_dft, which shifts volumes the other way
+    sign = -1 if is3D else 1
+    Greg = _fft('fftn', frames, n_threads, axes=axes)
+    # the phase ramps are separable
+    phases = np.asarray(diffphases, dtype=np.float64)
+    for axis, n in zip(axes, frames.shape[1:]):
+        freqs = ifftshift(np.arange(-np.fix(n / 2.), np.ceil(n / 2.)))
+        ramp_shape = [len(frames)] + [1] * len(axes)
+        ramp_shape[axis] = n
+        ramp = -sign * 2 * np.pi * shifts[:, axis - 1, None] * freqs[None, :] / n
+        if axis == 1:
+            ramp += phases[:, None]
+        Greg *= np.exp(1j * ramp).reshape(ramp_shape)
+    new_imgs = np.real(_fft('ifftn', Greg, n_threads, axes=axes))
+
+    # shifts in the order used by apply_shifts_dft
+    for new_img, shift in zip(new_imgs, np.concatenate([shifts[:, 1::-1], shifts[:, 2:]], 1)):
+        _fill_borders(new_img, shift, border_nan, is3D)
+
+    return new_imgs
+
+
+class TemplateSpectra(object):
+    """ Cache of the spectra of motion correction templates and of their patches
+
+    Registering frames to a template needs the conjugate of its FFT, pw-rigid registration the
+    ones of all its patches. They do not change while a template is in use, so they are computed
+    once per template, offset, patch grid and shape and then reused for every frame. FFT plans
+    are reused by the FFT backend itself (pyfftw's interfaces cache or scipy.fft's plan cache).
+
+    Templates are recognized by identity first, then by content. The cache holds at most
+    max_entries spectra and drops the least recently used ones, so that the processes running
+    the motion correction tasks do not accumulate the spectra of the successive templates.
+    invalidate drops all of them, which must be done when a template is modified in place.
+
+    Args:
+        n_threads: int
+            number of threads of the FFTs
+
+        max_entries: int
+            number of spectra kept (the rigid and pw-rigid ones of a template by default)
+
+    Attributes:
+        hits, misses: int
+            number of spectra found in the cache and computed
+    """
+
+    def __init__(self, n_threads: int = 1, max_entries: int = 2) -> None:
+        self.n_threads = n_threads
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """ Drops all the spectra, to be called when a template is updated in place """
+        with self._lock:
+            self._template = None
+            self._digest: Optional[str] = None
+            self._spectra: collections.OrderedDict = collections.OrderedDict()
+
+    @property
+    def nbytes(self) -> int:
+        """ Memory used by the cached spectra """
+        return sum(spectrum.nbytes for spectrum in self._spectra.values())
+
+    def report(self) -> dict:
+        """ Number of cached spectra, their size in bytes and the hits and misses of the cache """
+        return {'n_spectra': len(self._spectra), 'nbytes': self.nbytes, 'hits': self.hits, 'misses': self.misses}
+
+    def get(self, template: np.ndarray, add_to_movie=0, overlaps: Optional[Tuple] = None,
+            strides: Optional[Tuple] = None) -> np.ndarray:
+        """ Conjugated real FFT of template + add_to_movie, or of its patches (see patch_stack) if
+        overlaps and strides are given, as used by register_translation_batch
+        """
+        with self._lock:
+            if template is not self._template:
+                template_c = np.ascontiguousarray(template)
+                self._digest = (hashlib.blake2b(template_c.data).hexdigest() +
+                                str((template_c.shape, template_c.dtype.str)))
+                self._template = template
+
+            key = (self._digest, float(add_to_movie), None if overlaps is None else tuple(overlaps),
+                   None if strides is None else tuple(strides))
+            if key in self._spectra:
+                self.hits += 1
+                self._spectra.move_to_end(key)
+                return self._spectra[key]
+            else:
+                self.misses += 1
+                spectrum = template.astype(np.float64) + add_to_movie
+                if overlaps is not None:
+                    spectrum = patch_stack(spectrum, overlaps, strides)[0]
+                spectrum = _fft('rfftn', spectrum, self.n_threads, axes=tuple(range(-template.ndim, 0))).conj()
+                self._spectra[key] = spectrum
+                while len(self._spectra) > self.max_entries:
+                    self._spectra.popitem(last=False)
+                logging.debug(f'Template spectra cache: {len(self._spectra)} spectra, {self.nbytes / 2**20:.1f} MB')
+                return spectrum
+
+
+# spectra of the templates used by the motion correction tasks run in this process
+_template_spectra = TemplateSpectra()
+
+
 #%%
 
 def apply_shifts_dft(src_freq, shifts, diffphase, is_freq=True, border_nan=True):
@@ -1865,6 +2151,27 @@ def apply_shifts_dft(src_freq, shifts, diffphase, is_freq=True, border_nan=True)
         Greg = np.dstack([np.real(Greg), np.imag(Greg)])
         new_img = ifftn(Greg)[:, :, 0]
 
+    _fill_borders(new_img, shifts, border_nan, is3D)
+
+    return new_img
+
+
+def _fill_borders(new_img, shifts, border_nan, is3D=False):
+    """ Fills, in place, the borders of an image shifted by apply_shifts_dft (shifts in the order used there)
+
+    Args:
+        new_img: ndarray
+            shifted image
+
+        shifts: array
+            applied shifts, (x, y) reversed for 2D images as in apply_shifts_dft
+
+        border_nan : bool or string
+            specifies how to deal with borders. (True, False, 'copy', 'min')
+
+        is3D: bool
+            whether new_img is a volume
+    """
     if border_nan is not False:
         max_w, max_h, min_w, min_h = 0, 0, 0, 0
         max_h, max_w = np.ceil(np.maximum(
@@ -1911,8 +2218,6 @@ def apply_shifts_dft(src_freq, shifts, diffphase, is_freq=True, border_nan=True)
                 if min_d < 0:
                     new_img[:, :, min_d:] = new_img[:, :, min_d-1, np.newaxis]
 
-    return new_img
-
 
 #%%
 def sliding_window(image, overlaps, strides):
@@ -1978,6 +2283,39 @@ def sliding_window_3d(image, overlaps, strides):
                 # yield the current window
                 yield (dim_1, dim_2, dim_3, x, y, z, image[x:x + windowSize[0], y:y + windowSize[1], z:z + windowSize[2]])
 
+def patch_stack(image, overlaps, strides):
+    """ All the patches of sliding_window (or sliding_window_3d) stacked in one array
+
+    The patches are gathered from a strided view of the image, in the order of sliding_window.
+
+    Args:
+        image: ndarray 2D or 3D
+            image that needs to be sliced
+
+        overlaps, strides: tuple
+            overlaps and strides of the patches in each dimension
+
+    Returns:
+        patches: ndarray
+            the patches, along the first axis
+
+        grid: list
+            coordinates of each patch in the patch grid
+
+        starts: list
+            position of each patch in the image
+    """
+    window = tuple(np.add(overlaps, strides))
+    ranges = [list(range(0, dim - size, stride)) + [dim - size]
+              for dim, size, stride in zip(image.shape, window, strides)]
+    view = np.lib.stride_tricks.as_strided(
+        image, shape=tuple(np.subtract(image.shape, window) + 1) + window,
+        strides=image.strides * 2, writeable=False)
+    patches = view[np.ix_(*ranges)].reshape((-1,) + window)
+    grid = list(itertools.product(*[range(len(rng)) for rng in ranges]))
+    starts = list(itertools.product(*ranges))
+    return patches, grid, starts
+
 def iqr(a):
     return np.percentile(a, 75) - np.percentile(a, 25)
 
@@ -1995,27 +2333,32 @@ def create_weight_matrix_for_blending(img, overlaps, strides):
     """
     shapes = np.add(strides, overlaps)
 
-    max_grid_1, max_grid_2 = np.max(
-        np.array([it[:2] for it in sliding_window(img, overlaps, strides)]), 0)
-
-    for grid_1, grid_2, _, _, _ in sliding_window(img, overlaps, strides):
-
-        weight_mat = np.ones(shapes)
-
-        if grid_1 > 0:
-            weight_mat[:overlaps[0], :] = np.linspace(
-                0, 1, overlaps[0])[:, None]
-        if grid_1 < max_grid_1:
-            weight_mat[-overlaps[0]:,
-                       :] = np.linspace(1, 0, overlaps[0])[:, None]
-        if grid_2 > 0:
-            weight_mat[:, :overlaps[1]] = weight_mat[:, :overlaps[1]
-                                                     ] * np.linspace(0, 1, overlaps[1])[None, :]
-        if grid_2 < max_grid_2:
-            weight_mat[:, -overlaps[1]:] = weight_mat[:, -
-                                                      overlaps[1]:] * np.linspace(1, 0, overlaps[1])[None, :]
-
-        yield weight_mat
+    grid = [it[:2] for it in sliding_window(img, overlaps, strides)]
+    max_grid_1, max_grid_2 = np.max(np.array(grid), 0)
+
+    # there are at most nine different matrices, depending on the borders of the patch
+    weight_mats: dict = {}
+    for grid_1, grid_2 in grid:
+        key = (grid_1 > 0, grid_1 < max_grid_1, grid_2 > 0, grid_2 < max_grid_2)
+        if key not in weight_mats:
+            weight_mat = np.ones(shapes)
+
+            if grid_1 > 0:
+                weight_mat[:overlaps[0], :] = np.linspace(
+                    0, 1, overlaps[0])[:, None]
+            if grid_1 < max_grid_1:
+                weight_mat[-overlaps[0]:,
+                           :] = np.linspace(1, 0, overlaps[0])[:, None]
+            if grid_2 > 0:
+                weight_mat[:, :overlaps[1]] = weight_mat[:, :overlaps[1]
+                                                         ] * np.linspace(0, 1, overlaps[1])[None, :]
+            if grid_2 < max_grid_2:
+                weight_mat[:, -overlaps[1]:] = weight_mat[:, -
+                                                          overlaps[1]:] * np.linspace(1, 0, overlaps[1])[None, :]
+            weight_mat.flags.writeable = False
+            weight_mats[key] = weight_mat
+
+        yield weight_mats[key]
 
 def high_pass_filter_space(img_orig, gSig_filt=None, freq=None, order=None):
     """
@@ -2067,7 +2410,7 @@ def high_pass_filter_space(img_orig, gSig_filt=None, freq=None, order=None):
 
 def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=None, newstrides=None, upsample_factor_grid=4,
                      upsample_factor_fft=10, show_movie=False, max_deviation_rigid=2, add_to_movie=0, shifts_opencv=False, gSig_filt=None,
-                     use_cuda=False, border_nan=True):
+                     use_cuda=False, border_nan=True, template_spectra=None):
     """ perform piecewise rigid motion correction iteration, by
         1) dividing the FOV in patches
         2) motion correcting each patch separately
@@ -2118,6 +2461,9 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
         border_nan : bool or string, optional
             specifies how to deal with borders. (True, False, 'copy', 'min')
 
+        template_spectra: TemplateSpectra, optional
+            cache of the spectra of the template and its patches, to reuse them across frames
+
     Returns:
         (new_img, total_shifts, start_step, xy_grid)
             new_img: ndarray, corrected image
@@ -2125,6 +2471,7 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
 
     """
 
+    template_orig = template
     img = img.astype(np.float64).copy()
     template = template.astype(np.float64).copy()
 
@@ -2136,9 +2483,17 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
     img = img + add_to_movie
     template = template + add_to_movie
 
+    use_cache = template_spectra is not None and not (HAS_CUDA and use_cuda)
+
     # compute rigid shifts
-    rigid_shts, sfr_freq, diffphase = register_translation(
-        img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts, use_cuda=use_cuda)
+    if use_cache:
+        rigid_shts, diffphase = register_translation_batch(
+            img[None], template, upsample_factor_fft, max_shifts=max_shifts,
+            template_spectrum=template_spectra.get(template_orig, add_to_movie))
+        rigid_shts, diffphase, sfr_freq = rigid_shts[0], diffphase[0], None
+    else:
+        rigid_shts, sfr_freq, diffphase = register_translation(
+            img, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts, use_cuda=use_cuda)
 
     if max_deviation_rigid == 0:
 
@@ -2156,18 +2511,15 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
                     'The use of FFT and filtering options have not been tested. Set opencv=True')
 
             new_img = apply_shifts_dft(
-                sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase, border_nan=border_nan)
+                img if sfr_freq is None else sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase,
+                is_freq=sfr_freq is not None, border_nan=border_nan)
 
         return new_img - add_to_movie, (-rigid_shts[0], -rigid_shts[1]), None, None
     else:
         # extract patches
-        templates = [
-            it[-1] for it in sliding_window(template, overlaps=overlaps, strides=strides)]
-        xy_grid = [(it[0], it[1]) for it in sliding_window(
-            template, overlaps=overlaps, strides=strides)]
+        templates, xy_grid, _ = patch_stack(template, overlaps=overlaps, strides=strides)
         num_tiles = np.prod(np.add(xy_grid[-1], 1))
-        imgs = [it[-1]
-                for it in sliding_window(img, overlaps=overlaps, strides=strides)]
+        imgs, _, _ = patch_stack(img, overlaps=overlaps, strides=strides)
         dim_grid = tuple(np.add(xy_grid[-1], 1))
 
         if max_deviation_rigid is not None:
@@ -2183,11 +2535,17 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
             ub_shifts = None
 
         # extract shifts for each patch
-        shfts_et_all = [register_translation(
-            a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts, use_cuda=use_cuda) for a, b, c in zip(
-            imgs, templates, [upsample_factor_fft] * num_tiles)]
-        shfts = [sshh[0] for sshh in shfts_et_all]
-        diffs_phase = [sshh[2] for sshh in shfts_et_all]
+        if HAS_CUDA and use_cuda:
+            shfts_et_all = [register_translation(
+                a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts, use_cuda=use_cuda) for a, b, c in zip(
+                imgs, templates, [upsample_factor_fft] * num_tiles)]
+            shfts = [sshh[0] for sshh in shfts_et_all]
+            diffs_phase = [sshh[2] for sshh in shfts_et_all]
+        else:
+            shfts, diffs_phase = register_translation_batch(
+                imgs, templates, upsample_factor_fft, shifts_lb=lb_shifts, shifts_ub=ub_shifts,
+                max_shifts=max_shifts, template_spectrum=template_spectra.get(
+                    template_orig, add_to_movie, overlaps, strides) if use_cache else None)
         # create a vector field
         shift_img_x = np.reshape(np.array(shfts)[:, 0], dim_grid)
         shift_img_y = np.reshape(np.array(shfts)[:, 1], dim_grid)
@@ -2217,14 +2575,7 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
 
         newshapes = np.add(newstrides, newoverlaps)
 
-        imgs = [it[-1]
-                for it in sliding_window(img, overlaps=newoverlaps, strides=newstrides)]
-
-        xy_grid = [(it[0], it[1]) for it in sliding_window(
-            img, overlaps=newoverlaps, strides=newstrides)]
-
-        start_step = [(it[2], it[3]) for it in sliding_window(
-            img, overlaps=newoverlaps, strides=newstrides)]
+        imgs, xy_grid, start_step = patch_stack(img, overlaps=newoverlaps, strides=newstrides)
 
         dim_new_grid = tuple(np.add(xy_grid[-1], 1))
 
@@ -2250,26 +2601,21 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
             raise Exception(
                 'The use of FFT and filtering options have not been tested. Set opencv=True')
 
-        imgs = [apply_shifts_dft(im, (
-            sh[0], sh[1]), dffphs, is_freq=False, border_nan=border_nan) for im, sh, dffphs in zip(
-            imgs, total_shifts, total_diffs_phase)]
+        imgs = apply_shifts_dft_batch(imgs, total_shifts, total_diffs_phase, border_nan=border_nan)
 
-        normalizer = np.zeros_like(img) * np.nan
         new_img = np.zeros_like(img) * np.nan
 
         weight_matrix = create_weight_matrix_for_blending(
             img, newoverlaps, newstrides)
 
         if max_shear < 0.5:
-            for (x, y), (_, _), im, (_, _), weight_mat in zip(start_step, xy_grid, imgs, total_shifts, weight_matrix):
-
-                prev_val_1 = normalizer[x:x + newshapes[0], y:y + newshapes[1]]
-
-                normalizer[x:x + newshapes[0], y:y + newshapes[1]] = np.nansum(
-                    np.dstack([~np.isnan(im) * 1 * weight_mat, prev_val_1]), -1)
-                prev_val = new_img[x:x + newshapes[0], y:y + newshapes[1]]
-                new_img[x:x + newshapes[0], y:y + newshapes[1]
-                        ] = np.nansum(np.dstack([im * weight_mat, prev_val]), -1)
+            # weighted sums of the patches, ignoring their nan borders
+            normalizer = np.zeros_like(img)
+            new_img = np.zeros_like(img)
+            for (x, y), im, weight_mat in zip(start_step, imgs, weight_matrix):
+                valid = ~np.isnan(im)
+                normalizer[x:x + newshapes[0], y:y + newshapes[1]] += valid * weight_mat
+                new_img[x:x + newshapes[0], y:y + newshapes[1]] += np.where(valid, im * weight_mat, 0)
 
             new_img = old_div(new_img, normalizer)
 
@@ -2295,7 +2641,8 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
 
         if show_movie:
             img = apply_shifts_dft(
-                sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase, border_nan=border_nan)
+                img if sfr_freq is None else sfr_freq, (-rigid_shts[0], -rigid_shts[1]), diffphase,
+                is_freq=sfr_freq is not None, border_nan=border_nan)
             img_show = np.vstack([new_img, img])
 
             img_show = cv2.resize(img_show, None, fx=1, fy=1)
@@ -2313,7 +2660,7 @@ def tile_and_correct(img, template, strides, overlaps, max_shifts, newoverlaps=N
 #%%        
 def tile_and_correct_3d(img:np.ndarray, template:np.ndarray, strides:Tuple, overlaps:Tuple, max_shifts:Tuple, newoverlaps:Optional[Tuple]=None, newstrides:Optional[Tuple]=None, upsample_factor_grid:int=4,
                      upsample_factor_fft:int=10, show_movie:bool=False, max_deviation_rigid:int=2, add_to_movie:int=0, shifts_opencv:bool=True, gSig_filt=None,
-                     use_cuda:bool=False, border_nan:bool=True):
+                     use_cuda:bool=False, border_nan:bool=True, template_spectra=None):
     """ perform piecewise rigid motion correction iteration, by
         1) dividing the FOV in patches
         2) motion correcting each patch separately
@@ -2364,6 +2711,9 @@ def tile_and_correct_3d(img:np.ndarray, template:np.ndarray, strides:Tuple, over
         border_nan : bool or string, optional
             specifies how to deal with borders. (True, False, 'copy', 'min')
 
+        template_spectra: TemplateSpectra, optional
+            cache of the spectra of the patches of the template, to reuse them across frames
+
     Returns:
         (new_img, total_shifts, start_step, xyz_grid)
             new_img: ndarray, corrected image
@@ -2371,6 +2721,7 @@ def tile_and_correct_3d(img:np.ndarray, template:np.ndarray, strides:Tuple, over
 
     """
 
+    template_orig = template
     img = img.astype(np.float64).copy()
     template = template.astype(np.float64).copy()
 
@@ -2402,13 +2753,9 @@ def tile_and_correct_3d(img:np.ndarray, template:np.ndarray, strides:Tuple, over
         return new_img - add_to_movie, (-rigid_shts[0], -rigid_shts[1], -rigid_shts[2]), None, None
     else:
         # extract patches
-        templates = [
-            it[-1] for it in sliding_window_3d(template, overlaps=overlaps, strides=strides)]
-        xyz_grid = [(it[0], it[1], it[2]) for it in sliding_window_3d(
-            template, overlaps=overlaps, strides=strides)]
+        templates, xyz_grid, _ = patch_stack(template, overlaps=overlaps, strides=strides)
         num_tiles = np.prod(np.add(xyz_grid[-1], 1))
-        imgs = [it[-1]
-                for it in sliding_window_3d(img, overlaps=overlaps, strides=strides)]
+        imgs, _, _ = patch_stack(img, overlaps=overlaps, strides=strides)
         dim_grid = tuple(np.add(xyz_grid[-1], 1))
 
         if max_deviation_rigid is not None:
@@ -2424,11 +2771,10 @@ def tile_and_correct_3d(img:np.ndarray, template:np.ndarray, strides:Tuple, over
             ub_shifts = None
 
         # extract shifts for each patch
-        shfts_et_all = [register_translation_3d(
-            a, b, c, shifts_lb=lb_shifts, shifts_ub=ub_shifts, max_shifts=max_shifts) for a, b, c in zip(
-            imgs, templates, [upsample_factor_fft] * num_tiles)]
-        shfts = [sshh[0] for sshh in shfts_et_all]
-        diffs_phase = [sshh[2] for sshh in shfts_et_all]
+        shfts, diffs_phase = register_translation_batch(
+            imgs, templates, upsample_factor_fft, shifts_lb=lb_shifts, shifts_ub=ub_shifts,
+            max_shifts=max_shifts, template_spectrum=None if template_spectra is None else template_spectra.get(
+                template_orig, add_to_movie, overlaps, strides))
         # create a vector field
         shift_img_x = np.reshape(np.array(shfts)[:, 0], dim_grid)
         shift_img_y = np.reshape(np.array(shfts)[:, 1], dim_grid)
@@ -2462,14 +2808,7 @@ def tile_and_correct_3d(img:np.ndarray, template:np.ndarray, strides:Tuple, over
 
         newshapes = np.add(newstrides, newoverlaps)
 
-        imgs = [it[-1]
-                for it in sliding_window_3d(img, overlaps=newoverlaps, strides=newstrides)]
-
-        xyz_grid = [(it[0], it[1], it[2]) for it in sliding_window_3d(
-            img, overlaps=newoverlaps, strides=newstrides)]
-
-        start_step = [(it[3], it[4], it[5]) for it in sliding_window_3d(
-            img, overlaps=newoverlaps, strides=newstrides)]
+        imgs, xyz_grid, start_step = patch_stack(img, overlaps=newoverlaps, strides=newstrides)
 
         dim_new_grid = tuple(np.add(xyz_grid[-1], 1))
 
@@ -2498,9 +2837,7 @@ def tile_and_correct_3d(img:np.ndarray, template:np.ndarray, strides:Tuple, over
             raise Exception(
                 'The use of FFT and filtering options have not been tested. Set opencv=True')
 
-        imgs = [apply_shifts_dft(im, (
-            sh[0], sh[1], sh[2]), dffphs, is_freq=False, border_nan=border_nan) for im, sh, dffphs in zip(
-            imgs, total_shifts, total_diffs_phase)]
+        imgs = apply_shifts_dft_batch(imgs, total_shifts, total_diffs_phase, border_nan=border_nan)
 
         normalizer = np.zeros_like(img) * np.nan
         new_img = np.zeros_like(img) * np.nan
@@ -2828,6 +3165,9 @@ def motion_correct_batch_rigid(fname, max_shifts, dview=None, splits=56, num_spl
             new_templ = np.nanmedian(np.dstack([r[-1] for r in res_rig]), -1)
         if gSig_filt is not None:
             new_templ = high_pass_filter_space(new_templ, gSig_filt)
+        # the spectra of the previous template are not needed anymore
+        logging.debug(f'Template spectra cache: {_template_spectra.report()}')
+        _template_spectra.invalidate()
 
 #        logging.debug((old_div(np.linalg.norm(new_templ - old_templ), np.linalg.norm(old_templ))))
 
@@ -2959,6 +3299,9 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
         new_templ = np.nanmedian(np.dstack([r[-1] for r in res_el]), -1)
         if gSig_filt is not None:
             new_templ = high_pass_filter_space(new_templ, gSig_filt)
+        # the spectra of the previous template are not needed anymore
+        logging.debug(f'Template spectra cache: {_template_spectra.report()}')
+        _template_spectra.invalidate()
 
     total_template = new_templ
     templates = []
@@ -2985,6 +3328,76 @@ def motion_correct_batch_pwrigid(fname, max_shifts, strides, overlaps, add_to_mo
     return fname_tot_els, total_template, templates, x_shifts, y_shifts, z_shifts, coord_shifts
 
 
+def correct_rigid_batch(imgs, template, max_shifts, add_to_movie=0, upsample_factor_fft=10, shifts_opencv=False,
+                        gSig_filt=None, border_nan=True, batch_size=32, n_threads=1, template_spectra=None):
+    """ Rigid motion correction of a stack of frames, same as tile_and_correct with max_deviation_rigid=0
+    on each frame but registering batch_size frames at a time with register_translation_batch
+
+    Args:
+        imgs: ndarray
+            frames to correct, along the first axis
+
+        template: ndarray
+            reference image
+
+        max_shifts: tuple
+            max shifts in x and y
+
+        add_to_movie, upsample_factor_fft, shifts_opencv, gSig_filt, border_nan:
+            see tile_and_correct
+
+        batch_size: int
+            number of frames registered together
+
+        n_threads: int
+            number of threads of the FFTs
+
+        template_spectra: TemplateSpectra, optional
+            cache of the spectrum of the template, to reuse it across calls
+
+    Returns:
+        mc: ndarray
+            corrected frames (float32)
+
+        shifts: ndarray (n_frames x 2)
+            applied shifts
+    """
+    if gSig_filt is not None and not shifts_opencv:
+        raise Exception(
+            'The use of FFT and filtering options have not been tested. Set opencv=True')
+
+    if template_spectra is None:
+        template_spectra = TemplateSpectra(n_threads)
+    template_spectrum = template_spectra.get(template, add_to_movie)
+    template = template.astype(np.float64) + add_to_movie
+    mc = np.zeros(imgs.shape, dtype=np.float32)
+    shifts = np.zeros((len(imgs), 2))
+    for start in range(0, len(imgs), batch_size):
+        block = np.array(imgs[start:start + batch_size], dtype=np.float64)
+        if gSig_filt is not None:
+            block_orig = block
+            block = np.array([high_pass_filter_space(img, gSig_filt) for img in block_orig])
+        block = block + add_to_movie
+
+        rigid_shts, diffphases = register_translation_batch(
+            block, template, upsample_factor=upsample_factor_fft, max_shifts=max_shifts, n_threads=n_threads,
+            template_spectrum=template_spectrum)
+
+        if shifts_opencv:
+            if gSig_filt is not None:
+                block = block_orig
+            new_imgs = np.array([apply_shift_iteration(img, (-sh[0], -sh[1]), border_nan=border_nan)
+                                 for img, sh in zip(block, rigid_shts)])
+        else:
+            new_imgs = apply_shifts_dft_batch(block, -rigid_shts, diffphases, border_nan=border_nan,
+                                              n_threads=n_threads)
+
+        mc[start:start + len(block)] = new_imgs - add_to_movie
+        shifts[start:start + len(block)] = -rigid_shts
+
+    return mc, shifts
+
+
 #%% in parallel
 def tile_and_correct_wrapper(params):
     """Does motion correction on specified image frames
@@ -3009,7 +3422,7 @@ def tile_and_correct_wrapper(params):
     img_name, out_fname, idxs, shape_mov, template, strides, overlaps, max_shifts,\
         add_to_movie, max_deviation_rigid, upsample_factor_grid, newoverlaps, newstrides, \
         shifts_opencv, nonneg_movie, gSig_filt, is_fiji, use_cuda, border_nan, var_name_hdf5, \
-        is3D, indices = params
+        is3D, indices, n_threads = params
 
 
     if isinstance(img_name,tuple):
@@ -3021,33 +3434,45 @@ def tile_and_correct_wrapper(params):
 
     imgs = cm.load(img_name, subindices=idxs, var_name_hdf5=var_name_hdf5,is3D=is3D)
     imgs = imgs[(slice(None),) + indices]
-    mc = np.zeros(imgs.shape, dtype=np.float32)
     if not imgs[0].shape == template.shape:
         template = template[indices]
-    for count, img in enumerate(imgs):
-        if count % 10 == 0:
-            logging.debug(count)
-        if is3D:
-            mc[count], total_shift, start_step, xyz_grid = tile_and_correct_3d(img, template, strides, overlaps, max_shifts,
-                                                                       add_to_movie=add_to_movie, newoverlaps=newoverlaps,
-                                                                       newstrides=newstrides,
-                                                                       upsample_factor_grid=upsample_factor_grid,
-                                                                       upsample_factor_fft=10, show_movie=False,
-                                                                       max_deviation_rigid=max_deviation_rigid,
-                                                                       shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
-                                                                       use_cuda=use_cuda, border_nan=border_nan)
-            shift_info.append([tuple(-np.array(total_shift)), start_step, xyz_grid])
+    # the spectra of the template are reused by the next tasks of this process with the same template
+    _template_spectra.n_threads = n_threads
+    if max_deviation_rigid == 0 and not is3D and not (HAS_CUDA and use_cuda):
+        # rigid registration, batched over the frames
+        mc, shifts = correct_rigid_batch(imgs, template, max_shifts, add_to_movie=add_to_movie,
+                                         upsample_factor_fft=10, shifts_opencv=shifts_opencv,
+                                         gSig_filt=gSig_filt, border_nan=border_nan, n_threads=n_threads,
+                                         template_spectra=_template_spectra)
+        shift_info = [[tuple(sh), None, None] for sh in shifts]
+    else:
+        mc = np.zeros(imgs.shape, dtype=np.float32)
+        for count, img in enumerate(imgs):
+            if count % 10 == 0:
+                logging.debug(count)
+            if is3D:
+                mc[count], total_shift, start_step, xyz_grid = tile_and_correct_3d(img, template, strides, overlaps, max_shifts,
+                                                                           add_to_movie=add_to_movie, newoverlaps=newoverlaps,
+                                                                           newstrides=newstrides,
+                                                                           upsample_factor_grid=upsample_factor_grid,
+                                                                           upsample_factor_fft=10, show_movie=False,
+                                                                           max_deviation_rigid=max_deviation_rigid,
+                                                                           shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
+                                                                           use_cuda=use_cuda, border_nan=border_nan,
+                                                                           template_spectra=_template_spectra)
+                shift_info.append([tuple(-np.array(total_shift)), start_step, xyz_grid])
             
-        else:
-            mc[count], total_shift, start_step, xy_grid = tile_and_correct(img, template, strides, overlaps, max_shifts,
-                                                                       add_to_movie=add_to_movie, newoverlaps=newoverlaps,
-                                                                       newstrides=newstrides,
-                                                                       upsample_factor_grid=upsample_factor_grid,
-                                                                       upsample_factor_fft=10, show_movie=False,
-                                                                       max_deviation_rigid=max_deviation_rigid,
-                                                                       shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
-                                                                       use_cuda=use_cuda, border_nan=border_nan)
-            shift_info.append([total_shift, start_step, xy_grid])
+            else:
+                mc[count], total_shift, start_step, xy_grid = tile_and_correct(img, template, strides, overlaps, max_shifts,
+                                                                           add_to_movie=add_to_movie, newoverlaps=newoverlaps,
+                                                                           newstrides=newstrides,
+                                                                           upsample_factor_grid=upsample_factor_grid,
+                                                                           upsample_factor_fft=10, show_movie=False,
+                                                                           max_deviation_rigid=max_deviation_rigid,
+                                                                           shifts_opencv=shifts_opencv, gSig_filt=gSig_filt,
+                                                                           use_cuda=use_cuda, border_nan=border_nan,
+                                                                           template_spectra=_template_spectra)
+                shift_info.append([total_shift, start_step, xy_grid])
 
     if out_fname is not None:
         outv = np.memmap(out_fname, mode='r+', dtype=np.float32,
@@ -3122,23 +3547,22 @@ def motion_correction_piecewise(fname, splits, strides, overlaps, add_to_movie=0
     else:
         fname_tot = None
 
+    # the FFTs of a single process use all the cores, the workers of a pool one each
+    n_threads = os.cpu_count() if dview is None else 1
     pars = []
     for idx in idxs:
         logging.debug('Processing: frames: {}'.format(idx))
         pars.append([fname, fname_tot, idx, shape_mov, template, strides, overlaps, max_shifts, np.array(
             add_to_movie, dtype=np.float32), max_deviation_rigid, upsample_factor_grid,
             newoverlaps, newstrides, shifts_opencv, nonneg_movie, gSig_filt, is_fiji,
-            use_cuda, border_nan, var_name_hdf5, is3D, indices])
+            use_cuda, border_nan, var_name_hdf5, is3D, indices, n_threads])
 
     if dview is not None:
         logging.info('** Starting parallel motion correction **')
+        executor = as_executor(dview)
+        res = executor.map(tile_and_correct_wrapper, pars)
         if HAS_CUDA and use_cuda:
-            res = dview.map(tile_and_correct_wrapper,pars)
-            dview.map(close_cuda_process, range(len(pars)))
-        elif 'multiprocessing' in str(type(dview)):
-            res = dview.map_async(tile_and_correct_wrapper, pars).get(4294967)
-        else:
-            res = dview.map_sync(tile_and_correct_wrapper, pars)
+            executor.map(close_cuda_process, range(len(pars)))
         logging.info('** Finished parallel motion correction **')
     else:
         res = list(map(tile_and_correct_wrapper, pars))
@@ -43,3 +43,8 @@ def memmap_frames_filename(basename: str, dims: Tuple, frames: int, order: str =
     else:
         dimfield_2 = 1
     return f"{basename}_d1_{dimfield_0}_d2_{dimfield_1}_d3_{dimfield_2}_order_{order}_frames_{frames}_.mmap"
+
+
+def memmap_metadata_filename(mmap_fname: str) -> str:
+    # The JSON sidecar that describes a memmap file sits next to it and shares its stem
+    return os.path.splitext(mmap_fname)[0] + '.json'
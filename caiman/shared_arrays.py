@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Publishing arrays once for all the tasks of a parallel computation
+
+Tasks that all need the same large array (the temporal components C, the spatial
+footprints A, ...) used to receive it either pickled in their arguments or through a
+temporary .npy file. A SharedArrays registry publishes each array once and returns a
+lightweight, picklable handle to pass to the tasks instead; attach turns the handle back
+into an array inside the worker:
+
+    with SharedArrays(dview) as shared:
+        C_handle = shared.publish(C)
+        results = parallel_map(dview, func, [(C_handle, ...) for ...])
+
+    def func(pars):
+        C = attach(pars[0])
+
+Depending on the executor the array is:
+    - passed as is, when tasks run in the calling process (single thread, thread pools)
+    - copied into a multiprocessing.shared_memory block, for worker processes on the local
+      machine (multiprocessing and process pools), without any pickling or file I/O
+    - saved to a temporary .npy file, for ipyparallel and dask workers that might run on other
+      machines (set SLURM_SUBMIT_DIR to a shared folder in that case)
+
+Sparse matrices are published as their data, indices and indptr arrays. Everything is released
+deterministically when leaving the with block (or calling release).
+"""
+
+import logging
+import numpy as np
+import os
+import scipy.sparse
+import shutil
+import tempfile
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from .executors import FuturesExecutor, MultiprocessingExecutor, SerialExecutor, as_executor
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+    HAS_SHARED_MEMORY = True
+except ImportError:     # python < 3.8
+    HAS_SHARED_MEMORY = False
+
+# shared memory blocks created by the registries of this process
+_published: Dict[str, Any] = {}
+# blocks attached by the tasks run in this process, with the registry they belong to
+_attached: Dict[str, Tuple[str, Any]] = {}
+# SharedMemory registers the blocks it attaches to with the resource tracker (POSIX only)
+_TRACKED = HAS_SHARED_MEMORY and os.name == 'posix'
+
+
+class SharedArrayHandle(NamedTuple):
+    """ Picklable reference to a dense array in a shared memory block """
+    name: str
+    shape: Tuple
+    dtype: str
+    pid: int        # process that published the block
+    registry: str
+
+
+class SparseHandle(NamedTuple):
+    """ Picklable reference to a CSC or CSR matrix whose arrays were published """
+    format: str
+    shape: Tuple
+    data: Any
+    indices: Any
+    indptr: Any
+
+
+def _attach_block(handle: SharedArrayHandle) -> np.ndarray:
+    if handle.name in _published:
+        shm = _published[handle.name]
+    else:
+        if handle.name not in _attached:
+            # blocks of registries used by earlier tasks are not needed anymore
+            for name, (registry, shm) in list(_attached.items()):
+                if registry != handle.registry:
+                    try:
+                        shm.close()
+                        del _attached[name]
+                    except BufferError:     # still referenced
+                        pass
+            shm = shared_memory.SharedMemory(name=handle.name)
+            if _TRACKED and os.getpid() != handle.pid:
+                # only the publisher unlinks the block: the resource tracker of this process must not
+                # do it when the process exits (the publisher registers it again before unlinking it)
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            _attached[handle.name] = (handle.registry, shm)
+        shm = _attached[handle.name][1]
+    return np.ndarray(handle.shape, dtype=handle.dtype, buffer=shm.buf)
+
+
+def attach(handle) -> Any:
+    """ Returns the array a handle created by SharedArrays.publish refers to
+
+    Arrays backed by shared memory or files are views shared by all the tasks, copy them before modifying them.
+    Anything that is not a handle is returned as is.
+    """
+    if isinstance(handle, SharedArrayHandle):
+        return _attach_block(handle)
+    if isinstance(handle, SparseHandle):
+        matrix = scipy.sparse.csc_matrix if handle.format == 'csc' else scipy.sparse.csr_matrix
+        return matrix((attach(handle.data), attach(handle.indices), attach(handle.indptr)),
+                      shape=handle.shape, copy=False)
+    if isinstance(handle, str) and handle.endswith('.npy'):
+        return np.load(handle, mmap_mode='r')
+    return handle
+
+
+class SharedArrays(object):
+    """ Registry of the arrays published for the tasks of an executor
+
+    Args:
+        dview:
+            anything accepted by caiman.executors.as_executor. It determines how arrays
+            are published (see the module documentation)
+    """
+
+    def __init__(self, dview=None) -> None:
+        executor = as_executor(dview)
+        if isinstance(executor, (SerialExecutor, MultiprocessingExecutor, FuturesExecutor)):
+            self.mode = 'memory' if not executor.process_based else 'shared' if HAS_SHARED_MEMORY else 'file'
+        else:
+            self.mode = 'file'
+        self._names: List[str] = []
+        self._folder: Optional[str] = None
+        # the process that creates, and unlinks, the shared memory blocks
+        self.pid = os.getpid()
+        self._id = f'{self.pid}_{id(self)}'
+        self.nbytes = 0
+
+    def __enter__(self) -> 'SharedArrays':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+    def __del__(self) -> None:
+        self.release()
+
+    def _publish_dense(self, array: np.ndarray) -> Any:
+        array = np.ascontiguousarray(array)
+        self.nbytes += array.nbytes
+        if self.mode == 'shared':
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            _published[shm.name] = shm
+            self._names.append(shm.name)
+            handle = SharedArrayHandle(shm.name, array.shape, array.dtype.str, self.pid, self._id)
+            _attach_block(handle)[...] = array
+            return handle
+        if self._folder is None:
+            # on a cluster the submission folder is visible from every node
+            self._folder = tempfile.mkdtemp(dir=os.environ.get('SLURM_SUBMIT_DIR'))
+        fname = os.path.join(self._folder, f'array_{len(self._names)}.npy')
+        np.save(fname, array)
+        self._names.append(fname)
+        return fname
+
+    def publish(self, array: Union[np.ndarray, scipy.sparse.spmatrix]) -> Any:
+        """ Publishes a dense array or a sparse matrix and returns the handle to pass to the tasks
+
+        Sparse matrices other than CSR are converted to CSC.
+        """
+        if self.mode == 'memory':
+            return array
+        if scipy.sparse.issparse(array):
+            if array.format != 'csr':
+                array = scipy.sparse.csc_matrix(array)
+            return SparseHandle(array.format, array.shape, self._publish_dense(array.data),
+                                self._publish_dense(array.indices), self._publish_dense(array.indptr))
+        return self._publish_dense(np.asarray(array))
+
+    def release(self) -> None:
+        """ Frees the shared memory blocks and removes the temporary files """
+        for name in self._names:
+            if self.mode == 'shared' and os.getpid() == self.pid:
+                shm = _published.pop(name, None)
+                if shm is not None:
+                    if _TRACKED:
+                        # workers sharing the resource tracker of this process unregistered the block
+                        resource_tracker.register(shm._name, 'shared_memory')
+                    shm.unlink()
+                    try:
+                        shm.close()
+                    except BufferError:
+                        # arrays on the block are still referenced, the memory is freed with them
+                        pass
+        self._names = []
+        if self._folder is not None:
+            shutil.rmtree(self._folder, ignore_errors=True)
+            self._folder = None
+        if self.nbytes:
+            logging.debug(f'Released {self.nbytes / 2**20:.1f} MB of published arrays')
+            self.nbytes = 0
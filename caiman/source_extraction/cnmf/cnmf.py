@@ -38,7 +38,7 @@ import pathlib
 from .estimates import Estimates
 from .initialization import initialize_components, compute_W
 from .map_reduce import run_CNMF_patches
-from .merging import merge_components
+from .merging import MergeGraph, merge_components
 from .params import CNMFParams
 from .pre_processing import preprocess_data
 from .spatial import update_spatial_components
@@ -46,6 +46,7 @@ from .temporal import update_temporal_components, constrained_foopsi_parallel
 from .utilities import update_order
 from ... import mmapping
 from ...components_evaluation import estimate_components_quality
+from ...executors import parallel_map
 from ...motion_correction import MotionCorrect
 from ...utils.utils import save_dict_to_hdf5, load_dict_from_hdf5
 from caiman import summary_images
@@ -337,6 +338,7 @@ class CNMF(object):
             raise Exception('File not found!')
 
         base_name = pathlib.Path(fnames[0]).stem + "_memmap_"
+        patch_file = None
         if extension == '.mmap':
             fname_new = fnames[0]
             Yr, dims, T = mmapping.load_memmap(fnames[0])
@@ -361,17 +363,22 @@ class CNMF(object):
                 # b0 = 0 if self.params.get('motion', 'border_nan') is 'copy' else 0
                 b0 = 0
                 fname_new = mmapping.save_memmap(fname_mc, base_name=base_name, order='C',
-                                                 border_to_0=b0)
+                                                 border_to_0=b0, fr=self.params.get('data', 'fr'))
             else:
-                fname_new = mmapping.save_memmap(fnames, base_name=base_name, order='C')
+                fname_new = mmapping.save_memmap(fnames, base_name=base_name, order='C',
+                                                 fr=self.params.get('data', 'fr'))
+                if extension == '.zarr' and len(fnames) == 1:
+                    # patches are read from the compressed chunks, the memory mapped
+                    # file is only needed for the steps on the whole FOV
+                    patch_file = fnames[0]
             Yr, dims, T = mmapping.load_memmap(fname_new)
 
         images = np.reshape(Yr.T, [T] + list(dims), order='F')
         self.mmap_file = fname_new
         if not include_eval:
-            return self.fit(images, indices=indices)
+            return self.fit(images, indices=indices, patch_file=patch_file)
 
-        fit_cnm = self.fit(images, indices=indices)
+        fit_cnm = self.fit(images, indices=indices, patch_file=patch_file)
         Cn = summary_images.local_correlations(images[::max(T//1000, 1)], swap_dim=False)
         Cn[np.isnan(Cn)] = 0
         fit_cnm.save(fname_new[:-5]+'_init.hdf5')
@@ -416,7 +423,7 @@ class CNMF(object):
         cnm.mmap_file = self.mmap_file
         return cnm.fit(images)
 
-    def fit(self, images, indices=(slice(None), slice(None))):
+    def fit(self, images, indices=(slice(None), slice(None)), patch_file=None):
         """
         This method uses the cnmf algorithm to find sources in data.
         it is calling every function from the cnmf folder
@@ -427,6 +434,11 @@ class CNMF(object):
 
             indices: list of slice objects along dimensions (x,y[,z]) for processing only part of the FOV
 
+            patch_file: str, optional
+                zarr store (see caiman.zarr_storage) holding the same movie as images. When
+                patches are used, the patch workers read from it instead of from the memory
+                mapped file
+
         Returns:
             self: updated using the cnmf algorithm with C,A,S,b,f computed according to the given initial values
 
@@ -439,6 +451,13 @@ class CNMF(object):
         http://www.cell.com/neuron/fulltext/S0896-6273(15)01084-3
 
         """
+        try:
+            return self._fit(images, indices=indices, patch_file=patch_file)
+        finally:
+            # the products of the movie cached by the stages of the fit are not reused afterwards
+            mmapping.product_cache.clear()
+
+    def _fit(self, images, indices, patch_file):
         # Todo : to compartment
         if isinstance(indices, slice):
             indices = [indices]
@@ -598,7 +617,7 @@ class CNMF(object):
 
             self.estimates.A, self.estimates.C, self.estimates.YrA, self.estimates.b, self.estimates.f, \
                 self.estimates.sn, self.estimates.optional_outputs = run_CNMF_patches(
-                    images.filename, self.dims + (T,), self.params,
+                    images.filename if patch_file is None else patch_file, self.dims + (T,), self.params,
                     dview=self.dview, memory_fact=self.params.get('patch', 'memory_fact'),
                     gnb=self.params.get('init', 'nb'), border_pix=self.params.get('patch', 'border_pix'),
                     low_rank_background=self.params.get('patch', 'low_rank_background'),
@@ -608,13 +627,14 @@ class CNMF(object):
             self.estimates.bl, self.estimates.c1, self.estimates.g, self.estimates.neurons_sn = None, None, None, None
             logging.info("merging")
             self.estimates.merged_ROIs = [0]
-
+            # the merge loops below merge the output of the previous merge
+            merge_graph = MergeGraph()
 
             if self.params.get('init', 'center_psf'):  # merge taking best neuron
                 if self.params.get('patch', 'nb_patch') > 0:
 
                     while len(self.estimates.merged_ROIs) > 0:
-                        self.merge_comps(Yr, mx=np.Inf, fast_merge=True)
+                        self.merge_comps(Yr, mx=np.Inf, fast_merge=True, merge_graph=merge_graph)
 
                     logging.info("update temporal")
                     self.update_temporal(Yr, use_init=False)
@@ -627,7 +647,7 @@ class CNMF(object):
                     self.update_temporal(Yr, use_init=False)
                 else:
                     while len(self.estimates.merged_ROIs) > 0:
-                        self.merge_comps(Yr, mx=np.Inf, fast_merge=True)
+                        self.merge_comps(Yr, mx=np.Inf, fast_merge=True, merge_graph=merge_graph)
                         #if len(self.estimates.merged_ROIs) > 0:
                             #not_merged = np.setdiff1d(list(range(len(self.estimates.YrA))),
                             #                          np.unique(np.concatenate(self.estimates.merged_ROIs)))
@@ -646,7 +666,7 @@ class CNMF(object):
                         self.estimates.S = self.estimates.C
             else:
                 while len(self.estimates.merged_ROIs) > 0:
-                    self.merge_comps(Yr, mx=np.Inf)
+                    self.merge_comps(Yr, mx=np.Inf, merge_graph=merge_graph)
 
                 logging.info("update temporal")
                 self.update_temporal(Yr, use_init=False)
@@ -716,8 +736,8 @@ class CNMF(object):
         if 'numpy.ndarray' in str(type(Yr)):
             YA = (Ab.T.dot(Yr)).T * nA2_inv_mat
         else:
-            YA = mmapping.parallel_dot_product(Yr, Ab, dview=self.dview, block_size=block_size,
-                                           transpose=True, num_blocks_per_run=num_blocks_per_run) * nA2_inv_mat
+            YA = mmapping.product_cache.dot_product(Yr, Ab, dview=self.dview, block_size=block_size,
+                                                    transpose=True, num_blocks_per_run=num_blocks_per_run) * nA2_inv_mat
 
         AA = Ab.T.dot(Ab) * nA2_inv_mat
         self.estimates.YrA = (YA - (AA.T.dot(Cf)).T)[:, :self.estimates.A.shape[-1]].T
@@ -755,13 +775,7 @@ class CNMF(object):
         args_in = [(F[jj], None, jj, None, None, None, None,
                     args) for jj in range(F.shape[0])]
 
-        if 'multiprocessing' in str(type(self.dview)):
-            results = self.dview.map_async(
-                constrained_foopsi_parallel, args_in).get(4294967)
-        elif self.dview is not None:
-            results = self.dview.map_sync(constrained_foopsi_parallel, args_in)
-        else:
-            results = list(map(constrained_foopsi_parallel, args_in))
+        results = parallel_map(self.dview, constrained_foopsi_parallel, args_in)
 
         if sys.version_info >= (3, 0):
             results = list(zip(*results))
@@ -937,8 +951,12 @@ class CNMF(object):
 
         return self
 
-    def merge_comps(self, Y, mx=50, fast_merge=True, max_merge_area=None):
+    def merge_comps(self, Y, mx=50, fast_merge=True, max_merge_area=None, merge_graph=None):
         """merges components
+
+        Args:
+            merge_graph: MergeGraph
+                see merging.merge_components, for repeated calls on the merged components
         """
         self.estimates.A, self.estimates.C, self.estimates.nr, self.estimates.merged_ROIs, self.estimates.S, \
         self.estimates.bl, self.estimates.c1, self.estimates.neurons_sn, self.estimates.g, self.empty_merged, \
@@ -949,7 +967,7 @@ class CNMF(object):
                              bl=self.estimates.bl, c1=self.estimates.c1, sn=self.estimates.neurons_sn,
                              g=self.estimates.g, thr=self.params.get('merging', 'merge_thr'), mx=mx,
                              fast_merge=fast_merge, merge_parallel=self.params.get('merging', 'merge_parallel'),
-                             max_merge_area=max_merge_area)
+                             max_merge_area=max_merge_area, merge_graph=merge_graph)
 
         return self
 
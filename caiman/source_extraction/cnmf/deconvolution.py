@@ -10,6 +10,7 @@ Created on Tue Sep  1 16:11:25 2015
 from builtins import range
 from past.utils import old_div
 import numpy as np
+import os
 import scipy.signal
 import scipy.linalg
 
@@ -179,6 +180,151 @@ def constrained_foopsi(fluor, bl=None,  c1=None, g=None,  sn=None, p=None, metho
     return c, bl, c1, g, sn, sp, lam
 
 
+def oasis_batch_supported(p, method_deconvolution='oasis', optimize_g=0, s_min=None, **kwargs):
+    """ Whether constrained_foopsi_batch deconvolves the traces with compiled code that does not
+    hold the GIL: OASIS with p <= 1, or p = 2 with the L1 penalty (s_min=None), without
+    optimizing g and without the automatic L0 threshold s_min=0
+    """
+    return (method_deconvolution == 'oasis' and (p in (0, 1) or p == 2 and s_min is None)
+            and not optimize_g and s_min != 0)
+
+
+def constrained_foopsi_batch(fluor, bl=None, c1=None, g=None, sn=None, p=None, method_deconvolution='oasis',
+                             bas_nonneg=True, noise_range=[.25, .5], noise_method='logmexp', lags=5,
+                             fudge_factor=1., optimize_g=0, s_min=None, n_threads=None, **kwargs):
+    """ Infer the most likely discretized spike trains underlying many fluorescence traces
+
+    Same as calling constrained_foopsi on every row of fluor. When oasis_batch_supported, the
+    traces are deconvolved by compiled code that releases the GIL, split over n_threads threads.
+    Otherwise constrained_foopsi is called for each trace, in threads as well. With p=2 this is
+    also the case for the traces whose AR coefficients have no real decay constants in (0, 1).
+
+    Args:
+        fluor: np.ndarray
+            fluorescence traces (K x T)
+
+        bl, c1, g, sn: [optional] np.ndarray
+            baselines (K), initial concentrations (K, not used by OASIS), AR coefficients (K x p)
+            and noise levels (K) of the traces. Estimated from the data if not given
+
+        n_threads: [optional] int
+            number of threads, all the cpus by default
+
+        other args:
+            see constrained_foopsi
+
+    Returns:
+        c: np.ndarray
+            The inferred denoised fluorescence signals (K x T)
+
+        bl, c1, g, sn: np.ndarray
+            As explained above, one row per trace
+
+        sp: np.ndarray
+            Discretized deconvolved neural activity (K x T)
+
+        lam: np.ndarray
+            Regularization parameters
+
+    Raises:
+        Exception("You must specify the value of p")
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if p is None:
+        raise Exception("You must specify the value of p")
+
+    fluor = np.atleast_2d(fluor)
+    K, T = fluor.shape
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    n_threads = max(min(n_threads, K), 1)
+    if sn is None:
+        sn = GetSn(fluor, noise_range, noise_method)
+    sn = np.broadcast_to(np.asarray(sn, dtype=np.float64), (K,))
+    if g is None:
+        g = [np.array([0.]) if p == 0 else estimate_time_constant(y, p, sn_, lags, fudge_factor)
+             for y, sn_ in zip(fluor, sn)]
+    g = np.reshape(np.asarray(g, dtype=np.float64), (K, -1))
+
+    if p == 0:
+        c = np.maximum(fluor, 0)
+        return c, np.zeros(K), np.zeros(K), g, sn, c.copy(), np.repeat(None, K)
+
+    blocks = [slice(rows[0], rows[-1] + 1) for rows in np.array_split(np.arange(K), n_threads)]
+    with ThreadPoolExecutor(n_threads) as executor:
+        if oasis_batch_supported(p, method_deconvolution, optimize_g, s_min) and p == 1:
+            from caiman.source_extraction.cnmf.oasis import constrained_oasisAR1_rows
+            if bl is None:
+                Y = np.ascontiguousarray(fluor, dtype=np.float32)
+                b = np.percentile(Y, 15, axis=1).astype(np.float32)  # initial estimate of baseline
+            else:
+                bl = np.broadcast_to(np.asarray(bl, dtype=np.float64), (K,))
+                Y = np.ascontiguousarray(fluor - bl[:, None], dtype=np.float32)
+                b = np.zeros(K, dtype=np.float32)
+            c, sp = np.empty_like(Y), np.empty_like(Y)
+            lam = np.empty(K, dtype=np.float32)
+            g_ = np.ascontiguousarray(g[:, 0], dtype=np.float32)
+            sn_ = np.ascontiguousarray(sn, dtype=np.float32)
+            s_min_ = 0 if s_min is None else s_min
+            # every thread fills the outputs of a block of rows
+            list(executor.map(lambda rows: constrained_oasisAR1_rows(
+                Y[rows], g_[rows], sn_[rows], b[rows], c[rows], sp[rows], lam[rows],
+                optimize_b=bl is None, b_nonneg=bas_nonneg, penalty=1 if s_min is None else 0,
+                s_min=s_min_), blocks))
+            if bl is None:
+                bl = b.astype(np.float64)
+            g = g_[:, None].astype(np.float64)
+            c1 = c[:, 0].copy()
+            # remove intial calcium to align with the other foopsi methods, as constrained_foopsi
+            c -= c1[:, None] * g ** np.arange(T)
+            return c, bl, c1, g, sn, sp, lam.astype(np.float64)
+
+        bl = np.repeat(None, K) if bl is None else np.broadcast_to(bl, (K,))
+        c1 = np.repeat(None, K) if c1 is None else np.broadcast_to(c1, (K,))
+        rows = np.arange(0)
+        if oasis_batch_supported(p, method_deconvolution, optimize_g, s_min) and p == 2:
+            from caiman.source_extraction.cnmf.oasis import constrained_oasisAR2_rows
+            decimate = 5
+            disc = g[:, 0] ** 2 + 4 * g[:, 1]
+            d = (g[:, 0] + np.sqrt(np.maximum(disc, 0))) / 2
+            r = (g[:, 0] - np.sqrt(np.maximum(disc, 0))) / 2
+            if T >= decimate:
+                rows = np.where((disc >= 0) & (r > 0) & (d < 1))[0]
+        if len(rows):
+            optimize_b = bl[rows[0]] is None
+            if optimize_b:
+                Y = np.ascontiguousarray(fluor[rows], dtype=np.float32)
+            else:
+                Y = np.ascontiguousarray(fluor[rows] - bl[rows, None].astype(np.float64), dtype=np.float32)
+            Yd = np.ascontiguousarray(Y[:, :T // decimate * decimate].reshape(len(rows), -1, decimate).mean(2))
+            b = (np.percentile(Yd, 15, axis=1).astype(np.float32) if optimize_b  # initial estimate of baseline
+                 else np.zeros(len(rows), dtype=np.float32))
+            c_rows, sp_rows = np.empty((len(rows), T)), np.empty((len(rows), T))
+            lam_rows = np.empty(len(rows))
+            g_rows = np.ascontiguousarray(g[rows])
+            sn_rows = np.ascontiguousarray(sn[rows], dtype=np.float32)
+            row_blocks = [slice(block[0], block[-1] + 1) for block in
+                          np.array_split(np.arange(len(rows)), min(n_threads, len(rows)))]
+            # every thread fills the outputs of a block of rows
+            list(executor.map(lambda block: constrained_oasisAR2_rows(
+                Y[block], Yd[block], g_rows[block], sn_rows[block], b[block], c_rows[block], sp_rows[block],
+                lam_rows[block], optimize_b=optimize_b, b_nonneg=bas_nonneg, decimate=decimate), row_blocks))
+            c1_rows = c_rows[:, 0].copy()
+            # remove intial calcium to align with the other foopsi methods, as constrained_foopsi
+            c_rows -= c1_rows[:, None] * d[rows, None] ** np.arange(T)
+        others = np.setdiff1d(np.arange(K), rows)
+        results = dict(zip(others, executor.map(lambda k: constrained_foopsi(
+            fluor[k], bl=bl[k], c1=c1[k], g=g[k], sn=sn[k], p=p, method_deconvolution=method_deconvolution,
+            bas_nonneg=bas_nonneg, noise_range=noise_range, noise_method=noise_method, lags=lags,
+            fudge_factor=fudge_factor, optimize_g=optimize_g, s_min=s_min, **kwargs), others)))
+    for i, k in enumerate(rows):
+        results[k] = (c_rows[i], b[i] if optimize_b else bl[k], c1_rows[i], g[k], sn[k], sp_rows[i], lam_rows[i])
+    c, bl, c1, g, sn, sp, lam = zip(*[results[k] for k in range(K)])
+    return (np.stack(c), np.array(bl, dtype=np.float64), np.array(c1, dtype=np.float64),
+            np.stack([np.ravel(g_) for g_ in g]), np.array(sn, dtype=np.float64), np.stack(sp), np.array(lam))
+
+
 def G_inv_mat(x, mode, NT, gs, gd_vec, bas_flag=True, c1_flag=True):
     """
     Fast computation of G^{-1}*x and G^{-T}*x
@@ -1029,7 +1175,7 @@ def GetSn(fluor, range_ff=[0.25, 0.5], method='logmexp'):
     Args:
         fluor    : nparray
             One dimensional array containing the fluorescence intensities with
-            one entry per time-bin.
+            one entry per time-bin, or several traces along the last axis
     
         range_ff : (1,2) array, nonnegative, max value <= 0.5
             range of frequency (x Nyquist rate) over which the spectrum is averaged  
@@ -1038,18 +1184,18 @@ def GetSn(fluor, range_ff=[0.25, 0.5], method='logmexp'):
             method of averaging: Mean, median, exponentiated mean of logvalues (default)
 
     Returns:
-        sn       : noise standard deviation
+        sn       : noise standard deviation (one per trace)
     """
 
     ff, Pxx = scipy.signal.welch(fluor)
     ind1 = ff > range_ff[0]
     ind2 = ff < range_ff[1]
     ind = np.logical_and(ind1, ind2)
-    Pxx_ind = Pxx[ind]
+    Pxx_ind = Pxx[..., ind]
     sn = {
-        'mean': lambda Pxx_ind: np.sqrt(np.mean(old_div(Pxx_ind, 2))),
-        'median': lambda Pxx_ind: np.sqrt(np.median(old_div(Pxx_ind, 2))),
-        'logmexp': lambda Pxx_ind: np.sqrt(np.exp(np.mean(np.log(old_div(Pxx_ind, 2)))))
+        'mean': lambda Pxx_ind: np.sqrt(np.mean(old_div(Pxx_ind, 2), -1)),
+        'median': lambda Pxx_ind: np.sqrt(np.median(old_div(Pxx_ind, 2), -1)),
+        'logmexp': lambda Pxx_ind: np.sqrt(np.exp(np.mean(np.log(old_div(Pxx_ind, 2)), -1)))
     }[method](Pxx_ind)
 
     return sn
@@ -16,7 +16,7 @@ import time
 import caiman
 from .utilities import detrend_df_f, decimation_matrix
 from .spatial import threshold_components
-from .temporal import constrained_foopsi_parallel
+from .temporal import deconvolve_traces
 from .merging import merge_iteration, merge_components
 from ...components_evaluation import (
         evaluate_components_CNN, estimate_components_quality_auto,
@@ -157,6 +157,7 @@ class Estimates(object):
         self.AtY_buf = None
         self.sv = None
         self.groups = None
+        self.timings = None
 
         self.dims = dims
         self.shifts:List = []
@@ -752,8 +753,8 @@ class Estimates(object):
         if 'numpy.ndarray' in str(type(Yr)):
             YA = (Ab.T.dot(Yr)).T * nA2_inv_mat
         else:
-            YA = caiman.mmapping.parallel_dot_product(Yr, Ab, dview=self.dview,
-                        block_size=2000, transpose=True, num_blocks_per_run=5) * nA2_inv_mat
+            YA = caiman.mmapping.product_cache.dot_product(Yr, Ab, dview=self.dview, block_size=2000,
+                                                           transpose=True, num_blocks_per_run=5) * nA2_inv_mat
 
         AA = Ab.T.dot(Ab) * nA2_inv_mat
         self.R = (YA - (AA.T.dot(Cf)).T)[:, :self.A.shape[-1]].T
@@ -1182,27 +1183,8 @@ class Estimates(object):
         args['noise_range'] = params.get('temporal', 'noise_range')
         args['fudge_factor'] = params.get('temporal', 'fudge_factor')
 
-        args_in = [(F[jj], None, jj, None, None, None, None,
-                    args) for jj in range(F.shape[0])]
-
-        if 'multiprocessing' in str(type(dview)):
-            results = dview.map_async(
-                constrained_foopsi_parallel, args_in).get(4294967)
-        elif dview is not None:
-            results = dview.map_sync(constrained_foopsi_parallel, args_in)
-        else:
-            results = list(map(constrained_foopsi_parallel, args_in))
-
-        results = list(zip(*results))
-
-        order = list(results[7])
-        self.C = np.stack([results[0][i] for i in order])
-        self.S = np.stack([results[1][i] for i in order])
-        self.bl = [results[3][i] for i in order]
-        self.c1 = [results[4][i] for i in order]
-        self.g = [results[6][i] for i in order]
-        self.neurons_sn = [results[5][i] for i in order]
-        self.lam = [results[8][i] for i in order]
+        self.C, self.S, _, self.bl, self.c1, self.neurons_sn, self.g, self.lam = \
+            deconvolve_traces(F, dview=dview, **args)
         self.YrA = F - self.C
 
         if dff_flag:
@@ -1211,22 +1193,9 @@ class Estimates(object):
                                 ' estimates.detrend_df_f before attempting' +
                                 ' to deconvolve.')
             else:
-                args_in = [(self.F_dff[jj], None, jj, 0, 0, self.g[jj], None,
-                        args) for jj in range(F.shape[0])]
-
-                if 'multiprocessing' in str(type(dview)):
-                    results = dview.map_async(
-                        constrained_foopsi_parallel, args_in).get(4294967)
-                elif dview is not None:
-                    results = dview.map_sync(constrained_foopsi_parallel,
-                                             args_in)
-                else:
-                    results = list(map(constrained_foopsi_parallel, args_in))
-
-                results = list(zip(*results))
-                order = list(results[7])
-                self.F_dff_dec = np.stack([results[0][i] for i in order])
-                self.S_dff = np.stack([results[1][i] for i in order])
+                self.F_dff_dec, self.S_dff = deconvolve_traces(
+                    self.F_dff, dview=dview, bl=[0] * F.shape[0], c1=[0] * F.shape[0],
+                    g=self.g, **args)[:2]
 
     def merge_components(self, Y, params, mx=50, fast_merge=True,
                          dview=None, max_merge_area=None):
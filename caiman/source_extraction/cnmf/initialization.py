@@ -15,6 +15,7 @@ different set of methods like ICA PCA, greedy roi
 #\author: Eftychios A. Pnevmatikakis
 
 from builtins import range
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import logging
 from math import sqrt
@@ -22,6 +23,7 @@ import matplotlib.animation as animation
 import matplotlib.pyplot as plt
 from multiprocessing import current_process
 import numpy as np
+import os
 from past.utils import old_div
 import scipy
 import scipy.ndimage as nd
@@ -1903,7 +1905,8 @@ def extract_ac(data_filtered, data_raw, ind_ctr, patch_dims):
 
 
 @profile
-def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1, parallel=False):
+def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1, parallel=False,
+              chunk_size=1000, max_bytes=2**30):
     """compute background according to ring model
     solves the problem
         min_{W,b0} ||X-W*X|| with X = Y - A*C - b0*1'
@@ -1912,6 +1915,13 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1, p
     Problem parallelizes over pixels i
     Fluctuating background activity is W*X, constant baselines b0.
 
+    The normal equations of all pixels are assembled from the products of
+    X with its shifts by the (differences of the) ring offsets, which are
+    accumulated in one pass over X, and the pixels with the same ring (all
+    pixels not close to the border) are solved together. The products are
+    accumulated and solved for strips of rows of the FOV, as many rows as
+    fit into max_bytes.
+
     Args:
         Y: np.ndarray (2D or 3D)
             movie, raw data in 2D or 3D (pixels x time).
@@ -1924,13 +1934,19 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1, p
         radius: int
             radius of ring
         data_fits_in_memory: [optional] bool
-            If true, use faster but more memory consuming computation
+            If true, X is computed at once for each strip, otherwise in chunks
+            of chunk_size frames, so that memory usage does not grow with the
+            number of frames
         ssub: int
             spatial downscale factor
         tsub: int
             temporal downscale factor
         parallel: bool
-            If true, use multiprocessing to process pixels in parallel
+            If true, use multiple threads to solve for the pixels in parallel
+        chunk_size: int
+            number of frames processed at once if data_fits_in_memory is False
+        max_bytes: int
+            memory for the products of each strip of rows
 
     Returns:
         W: scipy.sparse.csr_matrix (pixels x pixels)
@@ -1950,65 +1966,211 @@ def compute_W(Y, A, C, dims, radius, data_fits_in_memory=True, ssub=1, tsub=1, p
     radius = int(round(radius / float(ssub)))
     ring = disk(radius + 1)
     ring[1:-1, 1:-1] -= disk(radius)
-    ringidx = [i - radius - 1 for i in np.nonzero(ring)]
-
-    def get_indices_of_pixels_on_ring(pixel):
-        x = pixel % d1 + ringidx[0]
-        y = pixel // d1 + ringidx[1]
-        inside = (x >= 0) * (x < d1) * (y >= 0) * (y < d2)
-        return x[inside] + y[inside] * d1
+    ringidx = np.array([i - radius - 1 for i in np.nonzero(ring)])
+    offsets = _ring_offsets(ringidx)
 
     b0 = np.array(Y.mean(1)) - A.dot(C.mean(1))
 
     if ssub > 1:
-        ds_mat = caiman.source_extraction.cnmf.utilities.decimation_matrix(dims, ssub)
-        ds = lambda x: ds_mat.dot(x)
-    else:
-        ds = lambda x: x
-
-    if data_fits_in_memory:
-        if ssub == 1 and tsub == 1:
-            X = Y - A.dot(C) - b0[:, None]
-        else:
-            X = decimate_last_axis(ds(Y), tsub) - \
-                (ds(A).dot(decimate_last_axis(C, tsub)) if A.size > 0 else 0) - \
-                ds(b0).reshape((-1, 1), order='F')
-
-        def process_pixel(p):
-            index = get_indices_of_pixels_on_ring(p)
-            B = X[index]
-            tmp = np.array(B.dot(B.T))
-            tmp[np.diag_indices(len(tmp))] += np.trace(tmp) * 1e-5
-            tmp2 = X[p]
-            data = pd_solve(tmp, B.dot(tmp2))
-            return index, data
+        ds_mat = spr.csr_matrix(caiman.source_extraction.cnmf.utilities.decimation_matrix(dims, ssub))
+        A_ds = ds_mat.dot(A) if A.size > 0 else A
+        b0_ds = ds_mat.dot(b0)
     else:
+        A_ds, b0_ds = A, b0
+    if spr.issparse(A_ds):
+        A_ds = spr.csr_matrix(A_ds)
 
-        def process_pixel(p):
-            index = get_indices_of_pixels_on_ring(p)
-            if ssub == 1 and tsub == 1:
-                B = Y[index] - A[index].dot(C) - b0[index, None]
+    def residual_chunks(r0, r1):
+        # residual of the pixels in rows r0:r1
+        sl = slice(r0 * d1, r1 * d1)
+        if ssub > 1:
+            ds_rows = ds_mat[sl]
+            lo, hi = ds_rows.indices.min(), ds_rows.indices.max() + 1
+            ds_rows = ds_rows[:, lo:hi]
+        step = T if data_fits_in_memory else max(chunk_size // tsub, 1) * tsub
+        for t0 in range(0, T, step):
+            C_ = C[:, t0:t0 + step]
+            if ssub == 1:
+                Y_ = Y[sl, t0:t0 + step]
             else:
-                B = decimate_last_axis(ds(Y), tsub)[index] - \
-                    (ds(A)[index].dot(decimate_last_axis(C, tsub)) if A.size > 0 else 0) - \
-                    ds(b0).reshape((-1, 1), order='F')[index]
-            tmp = np.array(B.dot(B.T))
-            tmp[np.diag_indices(len(tmp))] += np.trace(tmp) * 1e-5
-            if ssub == 1 and tsub == 1:
-                tmp2 = Y[p] - A[p].dot(C).ravel() - b0[p]
+                Y_ = ds_rows.dot(Y[lo:hi, t0:t0 + step])
+            if tsub == 1:
+                X = Y_ - (A_ds[sl].dot(C_) if A.size > 0 else 0) - b0_ds[sl, None]
             else:
-                tmp2 = decimate_last_axis(ds(Y), tsub)[p] - \
-                    (ds(A)[p].dot(decimate_last_axis(C, tsub)) if A.size > 0 else 0) - \
-                    ds(b0).reshape((-1, 1), order='F')[p]
-            data = pd_solve(tmp, B.dot(tmp2))
-            return index, data
-
-    Q = list((parmap if parallel else map)(process_pixel, range(d1 * d2)))
-    indices, data = np.transpose(Q)
-    indptr = np.concatenate([[0], np.cumsum(list(map(len, indices)))])
-    indices = np.concatenate(indices)
-    data = np.concatenate(data)
-    return spr.csr_matrix((data, indices, indptr), dtype='float32'), b0.astype(np.float32)
+                X = decimate_last_axis(Y_, tsub) - \
+                    (A_ds[sl].dot(decimate_last_axis(C_, tsub)) if A.size > 0 else 0) - \
+                    b0_ds[sl, None]
+            yield np.asarray(X)
+
+    # rows of a strip are solved from the products of the rows within the ring radius
+    R = radius + 1
+    rows = max(max_bytes // (4 * len(offsets) * d1) - 2 * R, 1)
+    counts, indices, data = [], [], []
+    for y0 in range(0, d2, rows):
+        y1 = min(y0 + rows, d2)
+        c0, c1 = max(y0 - R, 0), min(y1 + R, d2)
+        covs = _ring_covariances(residual_chunks(c0, c1), (d1, c1 - c0), offsets)
+        strip = _solve_ring_model(offsets, covs, (d1, d2), ringidx, (y0, y1), c0, parallel=parallel)
+        del covs
+        for l, s in zip((counts, indices, data), strip):
+            l.append(s)
+    indptr = np.concatenate([[0], np.cumsum(np.concatenate(counts))])
+    W = spr.csr_matrix((np.concatenate(data), np.concatenate(indices), indptr), shape=(d1 * d2, d1 * d2))
+    return W, b0.astype(np.float32)
+
+
+def _canonical_offset(dx, dy):
+    """ of the offsets d and -d the one with dy > 0, or dy == 0 and dx >= 0 """
+    canonical = (dy > 0) | ((dy == 0) & (dx >= 0))
+    return canonical, np.where(canonical, dx, -dx), np.where(canonical, dy, -dy)
+
+
+def _ring_offsets(ringidx):
+    """ canonical offsets (see _canonical_offset) of the ring pixels and of their differences """
+    dx = np.concatenate([(ringidx[0][None] - ringidx[0][:, None]).ravel(), ringidx[0]])
+    dy = np.concatenate([(ringidx[1][None] - ringidx[1][:, None]).ravel(), ringidx[1]])
+    _, dx, dy = _canonical_offset(dx, dy)
+    return np.unique(np.stack([dx, dy], 1), axis=0)
+
+
+def _ring_covariances(X_chunks, dims, offsets, tile=16):
+    """Accumulates the products of the residual X with its shifts by all
+    offsets needed for the normal equations of the ring model. The products
+    of all pixels in a row with the pixels of a shifted row are computed as
+    one matrix product (for tiles of the rows if they are long).
+
+    Args:
+        X_chunks: iterable of np.ndarray (pixels x frames)
+            consecutive chunks of frames of the residual, pixels in F order
+
+        dims: tuple
+            x, y dimensions
+
+        offsets: np.ndarray (# offsets x 2)
+            canonical x, y offsets (see _ring_offsets)
+
+        tile: int
+            length of the tiles of the rows
+
+    Returns:
+        covs: np.ndarray (# offsets x y x x), float32
+            covs[k, y, x] = sum_t X[(x, y), t] * X[(x, y) + offsets[k], t]
+    """
+    d1, d2 = dims
+    covs = np.zeros((len(offsets), d2, d1), dtype=np.float32)
+    for X in X_chunks:
+        X = X.astype(np.float64, copy=False).reshape((d2, d1, -1))
+        for ey in np.unique(offsets[:, 1]):
+            if ey >= d2:
+                continue
+            ks = np.where(offsets[:, 1] == ey)[0]
+            ex = offsets[ks, 0]
+            for x0 in range(0, d1, tile):
+                x1 = min(x0 + tile, d1)
+                lo, hi = max(x0 + ex.min(), 0), min(x1 + ex.max(), d1)
+                if hi <= lo:
+                    continue
+                # products of the pixels x0:x1 of each row with pixels lo:hi of the row ey below
+                P = np.matmul(X[:d2 - ey, x0:x1], X[ey:, lo:hi].transpose(0, 2, 1))
+                x = np.arange(x0, x1)
+                cols = x[None] + ex[:, None]
+                valid = (cols >= 0) & (cols < d1)
+                cols = np.clip(cols, lo, hi - 1) - lo
+                covs[ks, :d2 - ey, x0:x1] += (P[:, x - x0, cols] * valid).transpose(1, 0, 2)
+    return covs
+
+
+def _solve_ring_model(offsets, covs, dims, ringidx, rows, first_row=0, parallel=False, max_elements=2**24):
+    """Solves the normal equations of the ring model for the pixels of a strip
+    of rows, pixels with the same set of ring pixels inside the FOV in stacked
+    solves
+
+    Args:
+        offsets: np.ndarray (# offsets x 2)
+            canonical x, y offsets (see _ring_offsets)
+
+        covs: np.ndarray
+            output of _ring_covariances for the rows first_row, first_row + 1, ...
+
+        dims: tuple
+            x, y dimensions of the FOV
+
+        ringidx: np.ndarray (2 x # ring pixels)
+            x, y offsets of the ring pixels
+
+        rows: tuple
+            first and last (exclusive) row of the strip
+
+        first_row: int
+            row of the FOV of covs[:, 0]
+
+        parallel: bool
+            If true, solve blocks of pixels in multiple threads
+
+        max_elements: int
+            maximal number of elements of the stacked normal equations
+
+    Returns:
+        counts: np.ndarray
+            number of ring pixels inside the FOV of each pixel of the strip
+
+        indices, data: np.ndarray
+            ring pixels and weights of the pixels of the strip (CSR layout)
+    """
+    d1, d2 = dims
+    lut = {tuple(o): k for k, o in enumerate(offsets)}
+    size = covs[0].size
+    covs = covs.ravel()
+
+    def lookup(dx, dy, base, alt):
+        # position in covs of X[p + base].dot(X[p + base + d]) relative to pixel p,
+        # which is X[p + alt].dot(X[p + alt - d]) if -d is the canonical offset
+        canonical, cx, cy = _canonical_offset(dx, dy)
+        ids = np.vectorize(lambda x, y: lut[(x, y)], otypes=[int])(cx, cy)
+        return ids * size + np.where(canonical, base, alt)
+
+    ox, oy = ringidx
+    o = ox + oy * d1
+    # Gram matrix: entry (a, b) is X[p + o_a].dot(X[p + o_b])
+    G_pos = lookup(ox[None] - ox[:, None], oy[None] - oy[:, None], o[:, None], o[None])
+    # right hand side: entry a is X[p + o_a].dot(X[p])
+    v_pos = lookup(-ox, -oy, o, 0 * o)
+
+    first = rows[0] * d1
+    p = np.arange(first, rows[1] * d1)
+    px, py = p % d1, p // d1
+    inside = ((px[:, None] + ox >= 0) & (px[:, None] + ox < d1) &
+              (py[:, None] + oy >= 0) & (py[:, None] + oy < d2))
+    counts = inside.sum(1)
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    indices = np.zeros(indptr[-1], dtype=np.int32)
+    data = np.zeros(indptr[-1], dtype=np.float32)
+
+    def solve_block(pixels, ring):
+        local = p[pixels, None] - first_row * d1
+        G = covs[G_pos[ring[:, None], ring] + local[..., None]].astype(np.float64)
+        v = covs[v_pos[ring] + local].astype(np.float64)
+        G[:, np.arange(len(ring)), np.arange(len(ring))] += np.trace(G, axis1=1, axis2=2)[:, None] * 1e-5
+        pos = indptr[pixels][:, None] + np.arange(len(ring))
+        indices[pos] = p[pixels, None] + o[ring]
+        data[pos] = np.linalg.solve(G, v[..., None])[..., 0]
+
+    blocks = []
+    patterns, group = np.unique(inside, axis=0, return_inverse=True)
+    for g, pattern in enumerate(patterns):
+        ring = np.where(pattern)[0]
+        if len(ring) == 0:
+            continue
+        pixels = np.where(group == g)[0]
+        step = max(max_elements // len(ring)**2, 1)
+        blocks += [(pixels[i:i + step], ring) for i in range(0, len(pixels), step)]
+    if parallel and len(blocks) > 1:
+        with ThreadPoolExecutor(min(len(blocks), os.cpu_count() or 1)) as executor:
+            list(executor.map(lambda block: solve_block(*block), blocks))
+    else:
+        for block in blocks:
+            solve_block(*block)
+    return counts, indices, data
 
 #%%
 def nnsvd_init(X, n_components, r_ov=10, eps=1e-6, random_state=42):
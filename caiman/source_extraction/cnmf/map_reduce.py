@@ -30,8 +30,10 @@ from sklearn.decomposition import NMF
 import time
 from typing import Set
 
-from ...mmapping import load_memmap
+from ...mmapping import load_memmap, load_memmap_patch, to_memmap_dtype
 from ...cluster import extract_patch_coordinates
+from ...executors import parallel_map
+from ...zarr_storage import is_zarr, load_zarr
 
 #%%
 def cnmf_patches(args_in):
@@ -41,7 +43,8 @@ def cnmf_patches(args_in):
 
         Args:
             file_name: string
-                full path to an npy file (2D, pixels x time) containing the movie
+                full path to a memory mapped file (2D, pixels x time) or to a zarr
+                store (time x space) containing the movie
 
             shape: tuple of thre elements
                 dimensions of the original movie across y, x, and time
@@ -102,7 +105,11 @@ def cnmf_patches(args_in):
     logger.debug(name_log + 'START')
 
     logger.debug(name_log + 'Read file')
-    Yr, dims, timesteps = load_memmap(file_name)
+    if is_zarr(file_name):
+        Y = load_zarr(file_name)
+        dims, timesteps = Y.shape[1:], Y.shape[0]
+    else:
+        Yr, dims, timesteps = load_memmap(file_name)
 
     # slicing array (takes the min and max index in n-dimensional space and
     # cuts the box they define)
@@ -115,13 +122,27 @@ def cnmf_patches(args_in):
     # insert slice for timesteps, equivalent to :
     slices.insert(0, slice(timesteps))
 
-    images = np.reshape(Yr.T, [timesteps] + list(dims), order='F')
-    if params.get('patch', 'in_memory'):
-        images = np.array(images[tuple(slices)], dtype=np.float32)
+    if is_zarr(file_name):
+        # only the chunks covering the patch are read and decompressed, and converted as
+        # when the movie is saved to a memory mapped file
+        images = to_memmap_dtype(Y[tuple(slices)], np.float32)
+        n_chunks = np.prod([(sl.stop - 1) // c - sl.start // c + 1 for sl, c in zip(slices[1:], Y.chunks[1:])])
+        n_chunks_tot = np.prod([-(-dim // c) for dim, c in zip(dims, Y.chunks[1:])])
+        read_stats = {'bytes_read': int(Y.nbytes_stored * n_chunks // n_chunks_tot),
+                      'bytes_used': images.size * Y.dtype.itemsize}
+    elif params.get('patch', 'in_memory'):
+        del Yr
+        # coalesced sequential reads instead of fancy indexing the shared memory map
+        Yr_patch, read_stats = load_memmap_patch(file_name, slices[1:])
+        images = np.reshape(Yr_patch.T, [timesteps] + [sl.stop - sl.start for sl in slices[1:]], order='F')
     else:
-        images = images[slices]
+        # zero-copy view of the shared memory map, read as the patch is fitted
+        images = np.reshape(Yr.T, [timesteps] + list(dims), order='F')[tuple(slices)]
+        read_stats = None
 
-    logger.debug(name_log+'file loaded')
+    if read_stats is not None:
+        logger.debug(name_log + 'file loaded, read {:.1f} MB for {:.1f} MB of patch'.format(
+            read_stats['bytes_read'] / 2**20, read_stats['bytes_used'] / 2**20))
 
     if (np.sum(np.abs(np.diff(images.reshape(timesteps, -1).T)))) > 0.1:
 
@@ -135,13 +156,14 @@ def cnmf_patches(args_in):
         cnm = cnmf.CNMF(n_processes=1, params=opts)
 
         cnm = cnm.fit(images)
-        return [idx_, shapes, scipy.sparse.coo_matrix(cnm.estimates.A),
-                cnm.estimates.b, cnm.estimates.C, cnm.estimates.f,
-                cnm.estimates.S, cnm.estimates.bl, cnm.estimates.c1,
-                cnm.estimates.neurons_sn, cnm.estimates.g, cnm.estimates.sn,
-                cnm.params.to_dict(), cnm.estimates.YrA]
+        res = [idx_, shapes, scipy.sparse.coo_matrix(cnm.estimates.A),
+               cnm.estimates.b, cnm.estimates.C, cnm.estimates.f,
+               cnm.estimates.S, cnm.estimates.bl, cnm.estimates.c1,
+               cnm.estimates.neurons_sn, cnm.estimates.g, cnm.estimates.sn,
+               cnm.params.to_dict(), cnm.estimates.YrA, read_stats]
     else:
-        return None
+        res = None
+    return res
 # %%
 
 
@@ -159,7 +181,8 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
 
     Args:
         file_name: string
-            full path to an npy file (2D, pixels x time) containing the movie
+            full path to a memory mapped file (2D, pixels x time) or to a zarr
+            store (see caiman.zarr_storage) containing the movie
 
         shape: tuple of three elements
             dimensions of the original movie across y, x, and time
@@ -242,21 +265,7 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
                 foo.reshape(dims, order='F')))
     logging.info('Patch size: {0}'.format(id_2d))
     st = time.time()
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            file_res = dview.map_async(cnmf_patches, args_in).get(4294967)
-        else:
-            try:
-                file_res = dview.map_sync(cnmf_patches, args_in)
-                dview.results.clear()
-            except:
-                print('Something went wrong')
-                raise
-            finally:
-                logging.info('Patch processing complete')
-
-    else:
-        file_res = list(map(cnmf_patches, args_in))
+    file_res = parallel_map(dview, cnmf_patches, args_in)
 
     logging.info('Elapsed time for processing patches: \
                  {0}s'.format(str(time.time() - st).split('.')[0]))
@@ -267,7 +276,7 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
     num_patches = len(file_res)
     for jj, fff in enumerate(file_res):
         if fff is not None:
-            idx_, shapes, A, b, C, f, S, bl, c1, neurons_sn, g, sn, _, YrA = fff
+            idx_, shapes, A, b, C, f, S, bl, c1, neurons_sn, g, sn, _, YrA, _ = fff
             for _ in range(np.shape(b)[-1]):
                 count_bgr += 1
 
@@ -290,7 +299,7 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
                     file_res[jj][8] = c1[keep]
                     file_res[jj][9] = neurons_sn[keep]
                     file_res[jj][10] = g[keep]
-                file_res[jj][-1] = YrA[keep]
+                file_res[jj][13] = YrA[keep]
 
             # for ii in range(np.shape(A)[-1]):
             #     new_comp = A[:, ii] / np.sqrt(A[:, ii].power(2).sum())
@@ -300,6 +309,13 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
 
             patch_id += 1
 
+    read_stats = [fff[-1] for fff in file_res if fff is not None and fff[-1] is not None]
+    if read_stats:
+        bytes_read = sum(st['bytes_read'] for st in read_stats)
+        bytes_used = sum(st['bytes_used'] for st in read_stats)
+        logging.info('Patch loading: read {:.1f} MB for {:.1f} MB of patches ({:.0f}% used)'.format(
+            bytes_read / 2**20, bytes_used / 2**20, 100. * bytes_used / max(bytes_read, 1)))
+
     # INITIALIZING
     nb_patch = params.get('patch', 'nb_patch')
     C_tot = np.zeros((count, T), dtype=np.float32)
@@ -324,7 +340,7 @@ def run_CNMF_patches(file_name, shape, params, gnb=1, dview=None,
     for fff in file_res:
         if fff is not None:
 
-            idx_, shapes, A, b, C, f, S, bl, c1, neurons_sn, g, sn, _, YrA = fff
+            idx_, shapes, A, b, C, f, S, bl, c1, neurons_sn, g, sn, _, YrA, _ = fff
             A = A.tocsc()
 
             sn_tot[idx_] = sn
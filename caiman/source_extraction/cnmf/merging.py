@@ -11,23 +11,147 @@ Created on Tue Sep  8 16:23:57 2015
 #\copyright GNU General Public License v2.0
 
 from builtins import range
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import numpy as np
 import logging
+import os
 from past.utils import old_div
 import scipy
-from scipy.sparse import csgraph, csc_matrix, lil_matrix, csr_matrix
+from scipy.sparse import coo_matrix, csgraph, csc_matrix
 
 from .spatial import update_spatial_components, threshold_components
 from .temporal import update_temporal_components
-from .deconvolution import constrained_foopsi
+from .deconvolution import constrained_foopsi, constrained_foopsi_batch
 from .utilities import update_order_greedy
+from ...executors import parallel_map
+from ...shared_arrays import SharedArrays, attach
 
 
+class MergeGraph(object):
+    """ Pairs of spatially overlapping components and the correlations of their traces
+
+    Merging needs the correlation of the traces of every pair of components whose footprints
+    overlap. The graph keeps these pairs (i < j) and correlations from one call of merge_components
+    to the next: after a merge the pairs of the removed components are dropped and only the pairs
+    of the new components are computed, instead of the whole A'*A and all the correlations.
+    This pays off when merge_components is called repeatedly on its own output (merging until
+    no more components are merged); the graph is rebuilt whenever the components it is given
+    differ from the ones it describes, compared with a hash of their contents.
+
+    Args:
+        A: sparse matrix
+            matrix of spatial components (d x K), no components if None
+
+        C: np.ndarray
+            matrix of temporal components (K x T)
+    """
+
+    def __init__(self, A=None, C=None):
+        self.n_components = 0
+        self.rows = self.cols = np.zeros(0, dtype=np.int64)
+        self.corr = np.zeros(0)
+        self.fingerprint = None
+        if A is not None:
+            self.reset(A, C)
+
+    def reset(self, A, C):
+        """ Computes the graph of the components A, C from scratch """
+        A = csc_matrix(A)
+        self.n_components = A.shape[1]
+        overlaps = scipy.sparse.triu(A.T.dot(A), k=1).tocoo()
+        self.rows, self.cols, self.corr = self._edges(overlaps.row, overlaps.col, overlaps.data > 0, C)
+        self.fingerprint = self._fingerprint(A, C)
+
+    @staticmethod
+    def _fingerprint(A, C):
+        """ hash of the contents of A (csc) and C """
+        digest = hashlib.blake2b(repr((A.shape, np.shape(C), A.dtype.str, np.asarray(C).dtype.str)).encode())
+        for array in (A.indptr, A.indices, A.data, C):
+            digest.update(np.ascontiguousarray(array).view(np.uint8))
+        return digest.digest()
+
+    @staticmethod
+    def _edges(rows, cols, keep, C, max_elements=2**23):
+        """ Sorted pairs (rows[keep], cols[keep]) and the Pearson correlations of their traces in C """
+        rows, cols = rows[keep].astype(np.int64), cols[keep].astype(np.int64)
+        order = np.lexsort((cols, rows))
+        rows, cols = rows[order], cols[order]
+        C = np.asarray(C)
+        T = C.shape[1]
+        nodes = np.unique(np.concatenate((rows, cols)))
+        mean = np.zeros(len(C))
+        norm = np.zeros(len(C))
+        step = max(max_elements // max(T, 1), 1)
+        for i in range(0, len(nodes), step):
+            idx = nodes[i:i + step]
+            mean[idx] = C[idx].mean(axis=1)
+            norm[idx] = np.linalg.norm(C[idx] - mean[idx, None], axis=1)
+        corr = np.zeros(len(rows))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for i in range(0, len(rows), step):
+                r, c = rows[i:i + step], cols[i:i + step]
+                corr[i:i + step] = np.einsum('ij,ij->i', C[r] - mean[r, None], C[c] - mean[c, None]) / (
+                    norm[r] * norm[c])
+        return rows, cols, np.clip(corr, -1, 1)
+
+    def matches(self, A, C):
+        """ Whether the graph describes the components A, C """
+        return self._fingerprint(csc_matrix(A), C) == self.fingerprint
+
+    def groups(self, thr):
+        """ Groups of components to merge, connected by overlapping pairs correlated above thr
+
+        Returns:
+            groups: list
+                indices of the components of each group with at least two components
+
+            cor: np.ndarray
+                sum of the correlations of the overlapping pairs of each group
+        """
+        K = self.n_components
+        above = self.corr > thr
+        graph = coo_matrix((np.ones(above.sum()), (self.rows[above], self.cols[above])), shape=(K, K))
+        nb, labels = csgraph.connected_components(graph)
+        sizes = np.bincount(labels, minlength=nb)
+        members = np.split(np.argsort(labels, kind='stable'), np.cumsum(sizes)[:-1])
+        same = labels[self.rows] == labels[self.cols]
+        cor = np.bincount(labels[self.rows[same]], weights=self.corr[same], minlength=nb)
+        merged = np.where(sizes > 1)[0]
+        return [members[i] for i in merged], cor[merged]
+
+    def update(self, keep, A, C):
+        """ Updates the graph after a merge or a removal of components
+
+        Args:
+            keep: np.ndarray
+                sorted indices of the components that are kept, they become the first components
+
+            A, C:
+                components after the change: the kept ones followed by the new ones
+        """
+        A = csc_matrix(A)
+        index = -np.ones(self.n_components, dtype=np.int64)
+        index[keep] = np.arange(len(keep))
+        rows, cols = index[self.rows], index[self.cols]
+        kept = (rows >= 0) & (cols >= 0)
+        # overlaps of the new components with all the others, each pair counted once
+        overlaps = A[:, len(keep):].T.dot(A).tocoo()
+        new_rows, new_cols = overlaps.col, overlaps.row + len(keep)
+        new_rows, new_cols, new_corr = self._edges(new_rows, new_cols, (overlaps.data > 0) & (new_rows < new_cols), C)
+        rows = np.concatenate((rows[kept], new_rows))
+        cols = np.concatenate((cols[kept], new_cols))
+        corr = np.concatenate((self.corr[kept], new_corr))
+        order = np.lexsort((cols, rows))
+        self.rows, self.cols, self.corr = rows[order], cols[order], corr[order]
+        self.n_components = A.shape[1]
+        self.fingerprint = self._fingerprint(A, C)
+
 
 def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
                      spatial_params, dview=None, thr=0.85, fast_merge=True,
                      mx=1000, bl=None, c1=None, sn=None, g=None,
-                     merge_parallel=False, max_merge_area=None):
+                     merge_parallel=False, max_merge_area=None, merge_graph=None):
 
     """ Merging of spatially overlapping components that have highly correlated temporal activity
 
@@ -95,6 +219,11 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
             maximum area (in pixels) of merged components,
             used to determine whether to merge
 
+        merge_graph: MergeGraph
+            graph of the overlapping components, reused if it describes A and C and
+            updated with the merges. Pass the same graph to the calls that merge
+            the output of the previous call
+
     Returns:
         A:     sparse matrix
                 matrix of merged spatial components (d x K)
@@ -149,41 +278,16 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
 
     [d, t] = np.shape(Y)
 
-    # % find graph of overlapping spatial components
-    A_corr = scipy.sparse.triu(A.T * A)
-    A_corr.setdiag(0)
-    A_corr = A_corr.tocsc()
-    FF2 = A_corr > 0
-    C_corr = scipy.sparse.lil_matrix(A_corr.shape)
-    for ii in range(nr):
-        overlap_indices = A_corr[ii, :].nonzero()[1]
-        if len(overlap_indices) > 0:
-            # we chesk the correlation of the calcium traces for eahc overlapping components
-            corr_values = [scipy.stats.pearsonr(C[ii, :], C[jj, :])[
-                0] for jj in overlap_indices]
-            C_corr[ii, overlap_indices] = corr_values
-
-    FF1 = (C_corr + C_corr.T) > thr
-    FF3 = FF1.multiply(FF2)
-
-    nb, connected_comp = csgraph.connected_components(
-        FF3)  # % extract connected components
+    # % find graph of overlapping spatial components and the correlations of their traces
+    graph = MergeGraph() if merge_graph is None else merge_graph
+    if graph.matches(A, C):
+        logging.debug('Reusing the graph of the merged components')
+    else:
+        graph.reset(A, C)
+    groups, cor = graph.groups(thr)
 
     p = temporal_params['p']
-    list_conxcomp_initial = []
-    for i in range(nb):  # we list them
-        if np.sum(connected_comp == i) > 1:
-            list_conxcomp_initial.append((connected_comp == i).T)
-    list_conxcomp = np.asarray(list_conxcomp_initial).T
-
-    if list_conxcomp.ndim > 1:
-        cor = np.zeros((np.shape(list_conxcomp)[1], 1))
-        for i in range(np.size(cor)):
-            fm = np.where(list_conxcomp[:, i])[0]
-            for j1 in range(np.size(fm)):
-                for j2 in range(j1 + 1, np.size(fm)):
-                    cor[i] = cor[i] + C_corr[fm[j1], fm[j2]]
-
+    if len(groups) > 0:
 #        if not fast_merge:
 #            Y_res = Y - A.dot(C) #residuals=background=noise
         if np.size(cor) > 1:
@@ -194,66 +298,49 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
 
         nbmrg = min((np.size(ind), mx))   # number of merging operations
 
+        merged_ROIs = [groups[ind[i]] for i in range(nbmrg)]
+        Acsc_mats = [A[:, merged_ROI] for merged_ROI in merged_ROIs]
+        Ctmp_mats = [C[merged_ROI] + R[merged_ROI] for merged_ROI in merged_ROIs]
+        C_to_norms = [np.sqrt(np.ravel(Acsc.power(2).sum(
+                axis=0)) * np.sum(Ctmp ** 2, axis=1)) for (Acsc, Ctmp) in zip(Acsc_mats, Ctmp_mats)]
+        indxs = [np.argmax(C_to_norm) for C_to_norm in C_to_norms]
         if merge_parallel:
-            merged_ROIs = [np.where(list_conxcomp[:, ind[i]])[0] for i in range(nbmrg)]
-            Acsc_mats = [csc_matrix(A[:, merged_ROI]) for merged_ROI in merged_ROIs]
-            Ctmp_mats = [C[merged_ROI] + R[merged_ROI] for merged_ROI in merged_ROIs]
-            C_to_norms = [np.sqrt(np.ravel(Acsc.power(2).sum(
-                    axis=0)) * np.sum(Ctmp ** 2, axis=1)) for (Acsc, Ctmp) in zip(Acsc_mats, Ctmp_mats)]
-            indxs = [np.argmax(C_to_norm) for C_to_norm in C_to_norms]
             g_idxs = [merged_ROI[indx] for (merged_ROI, indx) in zip(merged_ROIs, indxs)]
-            fms = [fast_merge]*nbmrg
-            tps = [temporal_params]*nbmrg
-            gs = [g]*nbmrg
-            
-            if dview is None:
-               merge_res = list(map(merge_iter, zip(Acsc_mats, C_to_norms, Ctmp_mats, fms, gs, g_idxs, indxs, tps)))
-            elif 'multiprocessin' in str(type(dview)):
-               merge_res = list(dview.map(merge_iter, zip(Acsc_mats, C_to_norms, Ctmp_mats, fms, gs, g_idxs, indxs, tps)))
-            else:
-               merge_res = list(dview.map_sync(merge_iter, zip(Acsc_mats, C_to_norms, Ctmp_mats, fms, gs, g_idxs, indxs, tps)))
-               dview.results.clear()        
-            #merge_res = list(dview.map(merge_iter, zip(Acsc_mats, C_to_norms, Ctmp_mats, fms, gs, g_idxs, indxs, tps)))
-            bl_merged = np.array([res[0] for res in merge_res])
-            c1_merged = np.array([res[1] for res in merge_res])
-            A_merged = csc_matrix(scipy.sparse.vstack([csc_matrix(res[2]) for res in merge_res]).T)
-            C_merged = np.vstack([res[3] for res in merge_res])
-            g_merged = np.vstack([res[4] for res in merge_res])
-            sn_merged = np.array([res[5] for res in merge_res])
-            S_merged = np.vstack([res[6] for res in merge_res])
-            R_merged = np.vstack([res[7] for res in merge_res])
+            # A and C + R are published once, each task extracts the components it merges
+            with SharedArrays(dview) as shared:
+                A_shared, CR_shared = shared.publish(A), shared.publish(C + R)
+                merge_res = parallel_map(dview, merge_iter, [
+                    (A_shared, CR_shared, merged_ROI, C_to_norm, fast_merge, g, g_idx, indx, temporal_params)
+                    for merged_ROI, C_to_norm, g_idx, indx in zip(merged_ROIs, C_to_norms, g_idxs, indxs)])
         else:
-            # we initialize the values
-            A_merged = lil_matrix((d, nbmrg))
-            C_merged = np.zeros((nbmrg, t))
-            R_merged = np.zeros((nbmrg, t))
-            S_merged = np.zeros((nbmrg, t))
-            bl_merged = np.zeros((nbmrg, 1))
-            c1_merged = np.zeros((nbmrg, 1))
-            sn_merged = np.zeros((nbmrg, 1))
-            g_merged = np.zeros((nbmrg, p))
-            merged_ROIs = []
-            for i in range(nbmrg):
-                merged_ROI = np.where(list_conxcomp[:, ind[i]])[0]
+            for merged_ROI in merged_ROIs:
                 logging.info('Merging components {}'.format(merged_ROI))
-                merged_ROIs.append(merged_ROI)
-                Acsc = A.tocsc()[:, merged_ROI]
-                Ctmp = np.array(C)[merged_ROI, :] + np.array(R)[merged_ROI, :]
-                C_to_norm = np.sqrt(np.ravel(Acsc.power(2).sum(
-                    axis=0)) * np.sum(Ctmp ** 2, axis=1))
-                indx = np.argmax(C_to_norm)
-                g_idx = [merged_ROI[indx]]
-                bm, cm, computedA, computedC, gm, sm, ss, yra = merge_iteration(Acsc, C_to_norm, Ctmp, fast_merge, g, g_idx,
-                                                                                indx, temporal_params)
-
-                A_merged[:, i] = csr_matrix(computedA).T
-                C_merged[i, :] = computedC
-                R_merged[i, :] = yra
-                S_merged[i, :] = ss[:t]
-                bl_merged[i] = bm
-                c1_merged[i] = cm
-                sn_merged[i] = sm
-                g_merged[i, :] = gm
+            # the groups are disjoint: their rank 1 NMFs run in threads and their traces are
+            # deconvolved together
+            n_threads = max(min(temporal_params.get('n_threads') or os.cpu_count() or 1, nbmrg), 1)
+            with ThreadPoolExecutor(n_threads) as executor:
+                rank1 = list(executor.map(lambda args: merge_rank1(*args, fast_merge),
+                                          zip(Acsc_mats, C_to_norms, Ctmp_mats, indxs)))
+            c_in = np.array([res[1] for res in rank1])
+            if g is None:
+                deconvC, bm, cm, gm, sm, ss, _ = constrained_foopsi_batch(c_in, **temporal_params)
+            else:
+                deconvolved = [constrained_foopsi(c, g=[merged_ROI[indx]], **temporal_params)
+                               for c, merged_ROI, indx in zip(c_in, merged_ROIs, indxs)]
+                deconvC, bm, cm, gm, sm, ss, _ = zip(*deconvolved)
+            merge_res = [(bm[i], cm[i], rank1[i][0], deconvC[i], gm[i], sm[i], ss[i], c_in[i] - deconvC[i])
+                         for i in range(nbmrg)]
+
+        bl_merged = np.array([res[0] for res in merge_res]).reshape(-1, 1)
+        c1_merged = np.array([res[1] for res in merge_res]).reshape(-1, 1)
+        A_merged = csc_matrix(scipy.sparse.hstack([csc_matrix(res[2]).reshape((-1, 1)) for res in merge_res]))
+        C_merged = np.vstack([res[3] for res in merge_res])
+        g_merged = np.zeros((nbmrg, p))
+        for i, res in enumerate(merge_res):
+            g_merged[i, :] = res[4]
+        sn_merged = np.array([res[5] for res in merge_res]).reshape(-1, 1)
+        S_merged = np.vstack([res[6][:t] for res in merge_res])
+        R_merged = np.vstack([res[7] for res in merge_res])
 
         empty = np.ravel((C_merged.sum(1) == 0) + (A_merged.sum(0) == 0))
         if np.any(empty):
@@ -291,6 +378,7 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
                 g = np.vstack((g, g_merged))
 
             nr = nr - len(neur_id) + len(C_merged)
+            graph.update(good_neurons, A, C)
 
     else:
         logging.info('No more components merged!')
@@ -300,12 +388,39 @@ def merge_components(Y, A, b, C, R, f, S, sn_pix, temporal_params,
     return A, C, nr, merged_ROIs, S, bl, c1, sn, g, empty, R
 
 def merge_iter(a):
-    Acsc, C_to_norm, Ctmp, fast_merge, g, g_idx, indx, temporal_params = a
+    A, CR, merged_ROI, C_to_norm, fast_merge, g, g_idx, indx, temporal_params = a
+    Acsc = attach(A)[:, merged_ROI]
+    Ctmp = np.array(attach(CR)[merged_ROI])
     res = merge_iteration(Acsc, C_to_norm, Ctmp, fast_merge, g, g_idx,
                           indx, temporal_params)
     return res
 
-def merge_iteration(Acsc, C_to_norm, Ctmp, fast_merge, g, g_idx, indx, temporal_params):
+def merge_rank1(Acsc, C_to_norm, Ctmp, indx, fast_merge=True):
+    """ Merges a group of components into a single spatial footprint and fluorescence trace
+
+    Args:
+        Acsc: sparse matrix
+            spatial components of the group (d x k)
+
+        C_to_norm: np.ndarray
+            norm of each component of the group (vector of length k)
+
+        Ctmp: np.ndarray
+            temporal components plus residuals of the group (k x T)
+
+        indx: int
+            index of the component with the largest norm
+
+        fast_merge: bool
+            if true perform rank 1 merging, otherwise takes best neuron
+
+    Returns:
+        computedA: np.ndarray
+            merged spatial component (vector of length d)
+
+        c_in: np.ndarray
+            merged fluorescence trace, to deconvolve (vector of length T)
+    """
     if fast_merge:
         # we normalize the values of different A's to be able to compare them efficiently. we then sum them
 
@@ -341,6 +456,11 @@ def merge_iteration(Acsc, C_to_norm, Ctmp, fast_merge, g, g_idx, indx, temporal_
     r = ((Acsc.T.dot(computedA)).dot(Ctmp))/(computedA.T.dot(computedA)) - computedC
     # we then compute the traces ( deconvolution ) to have a clean c and noise in the background
     c_in =  np.array(computedC+r).squeeze()
+    return computedA, c_in
+
+
+def merge_iteration(Acsc, C_to_norm, Ctmp, fast_merge, g, g_idx, indx, temporal_params):
+    computedA, c_in = merge_rank1(Acsc, C_to_norm, Ctmp, indx, fast_merge)
     if g is not None:
         deconvC, bm, cm, gm, sm, ss, lam_ = constrained_foopsi(
             c_in, g=g_idx, **temporal_params)
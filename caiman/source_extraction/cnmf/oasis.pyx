@@ -7,10 +7,12 @@ Created on Mon Apr 4 18:21:13 2016
 import numpy as np
 cimport numpy as np
 cimport cython
-from libc.math cimport sqrt, log, exp, fmax, fabs
+from libc.math cimport sqrt, log, exp, fmax, fmin, fabs, pow, INFINITY
+from libc.stdlib cimport malloc, free
 from scipy.optimize import fminbound, minimize
 from cpython cimport bool
 from libcpp.vector cimport vector
+from scipy.linalg.cython_lapack cimport dgesv
 
 ctypedef np.float32_t SINGLE
 
@@ -1063,3 +1065,589 @@ def constrained_oasisAR1(np.ndarray[SINGLE, ndim=1] y, SINGLE g, SINGLE sn,
     s[0] = 0
     s[1:] -= g * c[:-1]
     return c, s, b, g, lam
+
+
+# batched deconvolution of many traces, without the GIL
+
+
+@cython.cdivision(True)
+cdef Py_ssize_t _merge_pools(SINGLE* v, SINGLE* w, Py_ssize_t* t, Py_ssize_t* l, Py_ssize_t n,
+                             SINGLE g, SINGLE s_min) noexcept nogil:
+    # backtracks through the pools in order, merging them until no constraint is violated
+    cdef Py_ssize_t i = 0, j
+    for j in range(1, n):
+        i += 1
+        v[i] = v[j]
+        w[i] = w[j]
+        t[i] = t[j]
+        l[i] = l[j]
+        while i > 0 and v[i - 1] / w[i - 1] * pow(g, l[i - 1]) + s_min > v[i] / w[i]:
+            i -= 1
+            v[i] += v[i + 1] * pow(g, l[i])
+            w[i] += w[i + 1] * pow(g, 2 * l[i])
+            l[i] += l[i + 1]
+    return i + 1
+
+
+@cython.cdivision(True)
+cdef void _pools_to_c(SINGLE* v, SINGLE* w, Py_ssize_t* t, Py_ssize_t* l, Py_ssize_t n,
+                      SINGLE g, SINGLE s_min, bint first, SINGLE* c) noexcept nogil:
+    # values of the pools below s_min (0 for the first pool of the trace) are set to 0
+    cdef Py_ssize_t j, k
+    cdef SINGLE tmp
+    for j in range(n):
+        tmp = v[j] / w[j]
+        if tmp < (0 if first and j == 0 else s_min):
+            tmp = 0
+        for k in range(l[j]):
+            c[t[j] + k] = tmp
+            tmp *= g
+
+
+@cython.cdivision(True)
+cdef void _pool_shifts(SINGLE* w, Py_ssize_t* t, Py_ssize_t* l, Py_ssize_t n, SINGLE g,
+                       SINGLE* tmp) noexcept nogil:
+    # change of c for a unit change of lambda, |s|_1 instead of |c|_1 for the last pool
+    cdef Py_ssize_t i, j
+    cdef SINGLE aa
+    for i in range(n):
+        if i == n - 1:
+            aa = 1 / w[i]
+        else:
+            aa = (1 - pow(g, l[i])) / w[i]
+        for j in range(l[i]):
+            tmp[t[i] + j] = aa
+            aa *= g
+
+
+cdef double _rss(SINGLE* y, SINGLE* c, double b, Py_ssize_t T) noexcept nogil:
+    cdef Py_ssize_t k
+    cdef double res, rss = 0
+    for k in range(T):
+        res = y[k] - b - c[k]
+        rss += res * res
+    return rss
+
+
+cdef double _sum(SINGLE* c, Py_ssize_t T) noexcept nogil:
+    cdef Py_ssize_t k
+    cdef double total = 0
+    for k in range(T):
+        total += c[k]
+    return total
+
+
+cdef double _mean_residual(SINGLE* y, SINGLE* c, Py_ssize_t T) noexcept nogil:
+    # mean of y - c
+    cdef Py_ssize_t k
+    cdef double total = 0
+    for k in range(T):
+        total += y[k] - c[k]
+    return total / T
+
+
+@cython.cdivision(True)
+cdef void _constrained_oasisAR1_row(SINGLE* y, SINGLE* c, SINGLE* s, Py_ssize_t T, SINGLE g,
+                                    SINGLE sn, SINGLE* b_io, SINGLE* lam_out, bint optimize_b,
+                                    bint b_nonneg, int max_iter, int penalty, SINGLE s_min,
+                                    SINGLE* v, SINGLE* w, Py_ssize_t* t, Py_ssize_t* l,
+                                    SINGLE* tmp) noexcept nogil:
+    # same steps as constrained_oasisAR1 with optimize_g=0 and decimate=1, with the pools
+    # kept in preallocated arrays
+    cdef Py_ssize_t i, k, n
+    cdef int count = 0
+    cdef double thresh, RSS, aa, bb, cc, dlam, dphi, db, shift, lb
+    cdef double lam = 0, b = 0
+
+    thresh = sn * sn * T
+    lb = 0 if b_nonneg else -INFINITY
+    if optimize_b:
+        b = fmax(b_io[0], lb)
+    for i in range(T):
+        v[i] = y[i] - b
+        w[i] = 1
+        t[i] = i
+        l[i] = 1
+    n = _merge_pools(v, w, t, l, T, g, 0)
+    _pools_to_c(v, w, t, l, n, g, 0, True, c)
+
+    if not optimize_b:
+        RSS = _rss(y, c, 0, T)
+        # until noise constraint is tight or spike train is empty
+        while RSS < thresh * (1 - 1e-4) and _sum(c, T) > 1e-9:
+            # update lam
+            _pool_shifts(w, t, l, n, g, tmp)
+            aa = bb = 0
+            for k in range(T):
+                aa += tmp[k] * tmp[k]
+                bb += (y[k] - c[k]) * tmp[k]
+            cc = RSS - thresh
+            dlam = (-bb + sqrt(bb * bb - aa * cc)) / aa
+            lam += dlam
+            for i in range(n - 1):  # perform shift
+                v[i] -= dlam * (1 - pow(g, l[i]))
+            v[n - 1] -= dlam  # correct last pool; |s|_1 instead |c|_1
+            n = _merge_pools(v, w, t, l, n, g, 0)
+            _pools_to_c(v, w, t, l, n, g, 0, True, c)
+            RSS = _rss(y, c, 0, T)
+
+    else:
+        # update b and lam
+        db = fmax(_mean_residual(y, c, T), lb) - b
+        b += db
+        lam -= db / (1 - g)
+        # correct last pool
+        v[n - 1] -= lam * pow(g, l[n - 1])  # |s|_1 instead |c|_1
+        _pools_to_c(v + n - 1, w + n - 1, t + n - 1, l + n - 1, 1, g, 0, n == 1, c)
+        RSS = _rss(y, c, b, T)
+        # until noise constraint is tight or spike train is empty or max_iter reached
+        while fabs(RSS - thresh) > thresh * 1e-4 and _sum(c, T) > 1e-9 and count < max_iter:
+            count += 1
+            # calc total shift dphi due to contribution of baseline and lambda
+            _pool_shifts(w, t, l, n, g, tmp)
+            shift = 0
+            for i in range(n):
+                shift += (1 - pow(g, l[i])) ** 2 / w[i]
+            shift /= T * (1 - g)
+            aa = bb = 0
+            for k in range(T):
+                tmp[k] -= shift
+                aa += tmp[k] * tmp[k]
+                bb += (y[k] - b - c[k]) * tmp[k]
+            cc = RSS - thresh
+            if bb * bb - aa * cc > 0:
+                dphi = (-bb + sqrt(bb * bb - aa * cc)) / aa
+            else:
+                dphi = -bb / aa
+            if b_nonneg:
+                dphi = fmax(dphi, -b / (1 - g))
+            b += dphi * (1 - g)
+            for i in range(n):  # perform shift
+                v[i] -= dphi * (1 - pow(g, l[i]))
+            n = _merge_pools(v, w, t, l, n, g, 0)
+            _pools_to_c(v, w, t, l, n, g, 0, True, c)
+            # update b and lam
+            db = fmax(_mean_residual(y, c, T), lb) - b
+            b += db
+            dlam = -db / (1 - g)
+            lam += dlam
+            # correct last pool
+            v[n - 1] -= dlam * pow(g, l[n - 1])  # |s|_1 instead |c|_1
+            _pools_to_c(v + n - 1, w + n - 1, t + n - 1, l + n - 1, 1, g, 0, n == 1, c)
+            RSS = _rss(y, c, b, T)
+
+    if penalty == 0:  # thresholded solution, see oasisAR1
+        if s_min < 0:
+            s_min = -s_min * sn * sqrt(1 - g)
+        for i in range(T):
+            v[i] = y[i] - b
+            w[i] = 1
+            t[i] = i
+            l[i] = 1
+        n = _merge_pools(v, w, t, l, T, g, s_min)
+        _pools_to_c(v, w, t, l, n, g, s_min, True, c)
+
+    # construct s
+    s[0] = 0
+    for k in range(1, T):
+        s[k] = c[k] - g * c[k - 1]
+    b_io[0] = b
+    lam_out[0] = lam
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def constrained_oasisAR1_rows(SINGLE[:, ::1] Y, SINGLE[::1] g, SINGLE[::1] sn, SINGLE[::1] b,
+                              SINGLE[:, ::1] C, SINGLE[:, ::1] S, SINGLE[::1] lam,
+                              bint optimize_b=False, bint b_nonneg=True, int max_iter=5,
+                              int penalty=1, SINGLE s_min=-3):
+    """ Infer the most likely discretized spike trains underlying AR(1) fluorescence traces
+
+    Solves the problem of constrained_oasisAR1 (with optimize_g=0 and decimate=1) for every row
+    of Y, in compiled code that does not hold the GIL: threads can process different rows at
+    the same time. With penalty=0 s_min must not be 0 (the thresholded solution of oasisAR1
+    is computed).
+
+    Parameters
+    ----------
+    Y : array of float, shape (K, T)
+        Fluorescence traces (with baseline already subtracted, if known, see optimize_b).
+    g : array of float, shape (K,)
+        Parameters of the AR(1) processes.
+    sn : array of float, shape (K,)
+        Standard deviations of the noise.
+    b : array of float, shape (K,)
+        Initial estimates of the baselines if optimize_b, overwritten with the baselines.
+    C, S : arrays of float, shape (K, T)
+        Filled with the denoised fluorescence and the deconvolved activity.
+    lam : array of float, shape (K,)
+        Filled with the sparsity penalty parameters of the dual problems.
+    optimize_b, b_nonneg, max_iter, penalty, s_min :
+        As in constrained_oasisAR1.
+    """
+
+    cdef:
+        Py_ssize_t K = Y.shape[0], T = Y.shape[1], r
+        SINGLE *v
+        SINGLE *w
+        SINGLE *tmp
+        Py_ssize_t *t
+        Py_ssize_t *l
+
+    if T == 0 or K == 0:
+        return
+    v = <SINGLE*> malloc(3 * T * sizeof(SINGLE))
+    t = <Py_ssize_t*> malloc(2 * T * sizeof(Py_ssize_t))
+    if v == NULL or t == NULL:
+        free(v)
+        free(t)
+        raise MemoryError()
+    w = v + T
+    tmp = v + 2 * T
+    l = t + T
+    with nogil:
+        for r in range(K):
+            _constrained_oasisAR1_row(&Y[r, 0], &C[r, 0], &S[r, 0], T, g[r], sn[r], &b[r], &lam[r],
+                                      optimize_b, b_nonneg, max_iter, penalty, s_min, v, w, t, l, tmp)
+    free(v)
+    free(t)
+
+
+cdef void _oasisAR1_row(SINGLE* y, SINGLE b, SINGLE g, SINGLE lam, Py_ssize_t T, SINGLE* c, SINGLE* s,
+                        SINGLE* v, SINGLE* w, Py_ssize_t* t, Py_ssize_t* l) noexcept nogil:
+    # same as oasisAR1(y - b, g, lam)
+    cdef Py_ssize_t i, n
+    for i in range(T):
+        v[i] = (y[i] - b) - lam * (1 if i == T - 1 else (1 - g))
+        w[i] = 1
+        t[i] = i
+        l[i] = 1
+    n = _merge_pools(v, w, t, l, T, g, 0)
+    _pools_to_c(v, w, t, l, n, g, 0, True, c)
+    s[0] = 0
+    for i in range(1, T):
+        s[i] = c[i] - g * c[i - 1]
+
+
+ctypedef void (*_dgesv_t)(int*, int*, double*, int*, int*, double*, int*, int*) noexcept nogil
+# LAPACK does not raise, no check of Python exceptions (that needs the GIL) after the calls
+cdef _dgesv_t _dgesv = <_dgesv_t> dgesv
+
+
+cdef bint _solve_active(double* KK, Py_ssize_t ld, Py_ssize_t* idx, char* P, Py_ssize_t m, double* Ky,
+                        double tol, double* A, double* mu, int* ipiv) noexcept nogil:
+    # mu = solve(KK[P][:, P], Ky[P]) for the masked rows idx of KK, with tol * I added if singular
+    cdef Py_ssize_t i, j, ii, jj
+    cdef int n = 0, one = 1, info = 0
+    cdef int attempt
+    for i in range(m):
+        n += P[i]
+    if n == 0:
+        return False
+    for attempt in range(2):
+        ii = 0
+        for i in range(m):
+            if not P[i]:
+                continue
+            jj = 0
+            for j in range(m):
+                if P[j]:
+                    A[ii + jj * n] = KK[idx[i] * ld + idx[j]] + (tol if attempt and ii == jj else 0)
+                    jj += 1
+            mu[ii] = Ky[idx[i]]
+            ii += 1
+        _dgesv(&n, &one, A, &n, ipiv, mu, &n, &info)
+        if info == 0:
+            break
+    return True
+
+
+cdef void _nnls_row(double* KK, Py_ssize_t ld, double* Ky, double* s, char* mask, Py_ssize_t m_all,
+                    double tol, Py_ssize_t* idx, double* sm, char* P, double* grad, double* A,
+                    double* mu, int* ipiv) noexcept nogil:
+    # same as _nnls(KK[:m_all, :m_all], Ky[:m_all], s[:m_all], mask[:m_all], tol), writing s in place
+    cdef Py_ssize_t i, j, k, m = 0, it, best
+    cdef double a, val
+    cdef bint any_neg
+    for i in range(m_all):
+        if mask[i]:
+            idx[m] = i
+            m += 1
+    for i in range(m):
+        sm[i] = s[idx[i]]
+        P[i] = sm[i] > 0
+    for i in range(m):
+        grad[i] = Ky[idx[i]]
+        for j in range(m):
+            if P[j]:
+                grad[i] -= KK[idx[i] * ld + idx[j]] * sm[j]
+    for it in range(m):
+        best = 0
+        for i in range(1, m):
+            if grad[i] > grad[best]:
+                best = i
+        P[best] = True
+        _solve_active(KK, ld, idx, P, m, Ky, tol, A, mu, ipiv)
+        while True:
+            # step back towards the previous solution until all of mu is non-negative
+            any_neg = False
+            a = INFINITY
+            k = 0
+            for i in range(m):
+                if P[i]:
+                    if mu[k] < 0:
+                        any_neg = True
+                        val = sm[i] / (sm[i] - mu[k])
+                        if val < a:
+                            a = val
+                    k += 1
+            if not any_neg:
+                break
+            k = 0
+            for i in range(m):
+                if P[i]:
+                    sm[i] += a * (mu[k] - sm[i])
+                    k += 1
+            for i in range(m):
+                if sm[i] <= tol:
+                    P[i] = False
+            if not _solve_active(KK, ld, idx, P, m, Ky, tol, A, mu, ipiv):
+                break
+        k = 0
+        for i in range(m):
+            if P[i]:
+                sm[i] = mu[k]
+                k += 1
+        val = -INFINITY
+        for i in range(m):
+            grad[i] = Ky[idx[i]]
+            for j in range(m):
+                if P[j]:
+                    grad[i] -= KK[idx[i] * ld + idx[j]] * sm[j]
+            if grad[i] > val:
+                val = grad[i]
+        if val < tol:
+            break
+    for i in range(m_all):
+        s[i] = 0
+    for i in range(m):
+        s[idx[i]] = sm[i]
+
+
+@cython.cdivision(True)
+cdef int _onnls_row(SINGLE* y, Py_ssize_t T, double g1, double g2, double lam, char* mask, Py_ssize_t window,
+                    double tol, double* c, double* s) noexcept nogil:
+    # same as onnls(y, (g1, g2), lam, mask=mask, window=window, tol=tol), returns -1 if out of memory
+    cdef Py_ssize_t i, j, k, u, n, off, shift, last = 0, w = min(T, window)
+    cdef double d = (g1 + sqrt(g1 * g1 + 4 * g2)) / 2, r = (g1 - sqrt(g1 * g1 + 4 * g2)) / 2, acc
+    cdef double *h
+    cdef double *KK
+    cdef double *A
+    cdef double *Ky
+    cdef double *sm
+    cdef double *grad
+    cdef double *mu
+    cdef SINGLE *_y
+    cdef Py_ssize_t *idx
+    cdef char *P
+    cdef int *ipiv
+
+    shift = min(w, 100)
+    KK = <double*> malloc((2 * w * w + 5 * w) * sizeof(double))
+    _y = <SINGLE*> malloc(T * sizeof(SINGLE))
+    idx = <Py_ssize_t*> malloc(w * sizeof(Py_ssize_t))
+    P = <char*> malloc(w * sizeof(char))
+    ipiv = <int*> malloc(w * sizeof(int))
+    if KK == NULL or _y == NULL or idx == NULL or P == NULL or ipiv == NULL:
+        free(KK)
+        free(_y)
+        free(idx)
+        free(P)
+        free(ipiv)
+        return -1
+    A = KK + w * w
+    h = A + w * w
+    Ky = h + w
+    sm = Ky + w
+    grad = sm + w
+    mu = grad + w
+
+    for k in range(T):
+        _y[k] = y[k] - <SINGLE> (lam * (1 - g1 - g2))
+    if T > 1:
+        _y[T - 2] = y[T - 2] - <SINGLE> (lam * (1 - g1))
+    _y[T - 1] = y[T - 1] - <SINGLE> lam
+    for k in range(w):
+        if d == r:
+            h[k] = exp(log(d) * (k + 1)) * (k + 1)
+        else:
+            h[k] = (exp(log(d) * (k + 1)) - exp(log(r) * (k + 1))) / (d - r)
+    # K'K of the kernel matrix K[i:, i] = h[:w - i], KK[a, a - j] = sum_{u <= w - 1 - a} h[u] h[u + j]
+    for j in range(w):
+        acc = 0
+        for u in range(w - j):
+            acc += h[u] * h[u + j]
+            KK[(w - 1 - u) * w + w - 1 - u - j] = acc
+            KK[(w - 1 - u - j) * w + w - 1 - u] = acc
+    for k in range(T):
+        s[k] = 0
+
+    i = 0
+    while i < max(1, T - w):
+        for j in range(w):
+            acc = 0
+            for k in range(j, w):
+                acc += h[k - j] * _y[i + k]
+            Ky[j] = acc
+        _nnls_row(KK, w, Ky, s + i, mask + i, w, tol, idx, sm, P, grad, A, mu, ipiv)
+        # subtract contribution of spikes already committed to
+        for k in range(w):
+            acc = 0
+            for j in range(min(k + 1, shift)):
+                acc += h[k - j] * s[i + j]
+            _y[i + k] = <SINGLE> (_y[i + k] - acc)
+        last = i
+        i += shift
+    n = T - last - shift
+    off = w - n
+    for j in range(n):
+        acc = 0
+        for k in range(j, n):
+            acc += h[k - j] * _y[last + shift + k]
+        Ky[j] = acc
+    _nnls_row(KK + off * w + off, w, Ky, s + last + shift, mask + last + shift, n, 1e-9, idx, sm, P, grad,
+              A, mu, ipiv)
+
+    for k in range(T):
+        c[k] = 0
+    for k in range(T):
+        if s[k] > tol:
+            for j in range(min(w, T - k)):
+                c[k + j] += s[k] * h[j]
+    free(KK)
+    free(_y)
+    free(idx)
+    free(P)
+    free(ipiv)
+    return 0
+
+
+@cython.cdivision(True)
+cdef int _constrained_oasisAR2_row(SINGLE* y, SINGLE* yd, Py_ssize_t T, Py_ssize_t Td, int decimate,
+                                   double g1, double g2, SINGLE sn, SINGLE* b_io, double* lam_out,
+                                   bint optimize_b, bint b_nonneg, double* c, double* s, SINGLE* v,
+                                   SINGLE* w, Py_ssize_t* t, Py_ssize_t* l, SINGLE* tmp, SINGLE* cd,
+                                   SINGLE* sd, char* mask) noexcept nogil:
+    # same steps as constrained_oasisAR2 with optimize_g=0, max_iter=1 and penalty=1
+    cdef Py_ssize_t i, k, window
+    cdef double d = (g1 + sqrt(g1 * g1 + 4 * g2)) / 2, f_lam = 1 - g1 - g2, b, db, lam, total
+    cdef SINGLE aa = <SINGLE> pow(d, decimate), lam_d, smax
+    cdef int status
+
+    window = <Py_ssize_t> fmin(T, fmax(200, -5 / log(d)))
+    # initial estimate of b and lam on downsampled data using AR1 model
+    _constrained_oasisAR1_row(yd, cd, sd, Td, aa, <SINGLE> (sn / sqrt(decimate)), b_io, &lam_d, optimize_b,
+                              b_nonneg, 5, 1, -3, v, w, t, l, tmp)
+    b = b_io[0]
+    _oasisAR1_row(y, <SINGLE> b, <SINGLE> d, <SINGLE> (<double> lam_d * (1 - <double> aa) / (1 - d)), T, cd, sd,
+                  v, w, t, l)
+    lam = lam_d * (1 - pow(d, decimate)) / f_lam
+    # this window size seems necessary and sufficient
+    smax = sd[0]
+    for k in range(1, T):
+        smax = max(smax, sd[k])
+    for k in range(T):
+        mask[k] = False
+    for k in range(T):
+        if sd[k] > smax / 10.:
+            for i in range(max(k - 2, 0), min(k + 3, T)):
+                mask[i] = True
+    if b_nonneg:
+        b = fmax(b, 0)
+
+    for k in range(T):
+        tmp[k] = y[k] - <SINGLE> b
+    status = _onnls_row(tmp, T, g1, g2, lam, mask, window, 1e-9, c, s)
+
+    if optimize_b:
+        total = 0
+        for k in range(T):
+            total += y[k] - c[k]
+        db = fmax(total / T, 0 if b_nonneg else -INFINITY) - b
+        b += db
+        lam -= db / f_lam
+    b_io[0] = <SINGLE> b
+    lam_out[0] = lam
+    return status
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def constrained_oasisAR2_rows(SINGLE[:, ::1] Y, SINGLE[:, ::1] Yd, double[:, ::1] g, SINGLE[::1] sn,
+                              SINGLE[::1] b, double[:, ::1] C, double[:, ::1] S, double[::1] lam,
+                              bint optimize_b=False, bint b_nonneg=True, int decimate=5):
+    """ Infer the most likely discretized spike trains underlying AR(2) fluorescence traces
+
+    Solves the problem of constrained_oasisAR2 (with optimize_g=0, max_iter=1 and penalty=1)
+    for every row of Y, in compiled code that does not hold the GIL: threads can process
+    different rows at the same time.
+
+    Parameters
+    ----------
+    Y : array of float, shape (K, T)
+        Fluorescence traces (with baseline already subtracted, if known, see optimize_b).
+    Yd : array of float, shape (K, T // decimate)
+        Traces decimated in time, for the initial estimates of the baselines and lambdas.
+    g : array of float, shape (K, 2)
+        Parameters of the AR(2) processes, with real positive roots smaller than 1.
+    sn : array of float, shape (K,)
+        Standard deviations of the noise.
+    b : array of float, shape (K,)
+        Initial estimates of the baselines of Yd if optimize_b, overwritten with the baselines.
+    C, S : arrays of float, shape (K, T)
+        Filled with the denoised fluorescence and the deconvolved activity.
+    lam : array of float, shape (K,)
+        Filled with the sparsity penalty parameters of the dual problems.
+    optimize_b, b_nonneg, decimate :
+        As in constrained_oasisAR2.
+    """
+
+    cdef:
+        Py_ssize_t K = Y.shape[0], T = Y.shape[1], Td = Yd.shape[1], r
+        int status = 0
+        SINGLE *v
+        SINGLE *w
+        SINGLE *tmp
+        SINGLE *cd
+        SINGLE *sd
+        Py_ssize_t *t
+        Py_ssize_t *l
+        char *mask
+
+    if T == 0 or K == 0:
+        return
+    v = <SINGLE*> malloc(5 * T * sizeof(SINGLE))
+    t = <Py_ssize_t*> malloc(2 * T * sizeof(Py_ssize_t))
+    mask = <char*> malloc(T * sizeof(char))
+    if v == NULL or t == NULL or mask == NULL:
+        free(v)
+        free(t)
+        free(mask)
+        raise MemoryError()
+    w = v + T
+    tmp = v + 2 * T
+    cd = v + 3 * T
+    sd = v + 4 * T
+    l = t + T
+    with nogil:
+        for r in range(K):
+            status = _constrained_oasisAR2_row(&Y[r, 0], &Yd[r, 0], T, Td, decimate, g[r, 0], g[r, 1], sn[r],
+                                               &b[r], &lam[r], optimize_b, b_nonneg, &C[r, 0], &S[r, 0],
+                                               v, w, t, l, tmp, cd, sd, mask)
+            if status:
+                break
+    free(v)
+    free(t)
+    free(mask)
+    if status:
+        raise MemoryError()
@@ -43,12 +43,13 @@ from .oasis import OASIS
 from .params import CNMFParams
 from .pre_processing import get_noise_fft
 from .utilities import update_order, get_file_size, peak_local_max, decimation_matrix
-from ... import mmapping
+from ... import mmapping, model_registry
 from ...components_evaluation import compute_event_exceptionality
+from ...executors import parallel_map
 from ...motion_correction import (motion_correct_iteration_fast,
                                   tile_and_correct, high_pass_filter_space,
                                   sliding_window)
-from ...utils.utils import save_dict_to_hdf5, load_dict_from_hdf5, parmap, load_graph
+from ...utils.utils import save_dict_to_hdf5, load_dict_from_hdf5, parmap
 from ...utils.stats import pd_solve
 from ... import summary_images
 
@@ -305,34 +306,12 @@ class OnACID(object):
             self.tf_in = None
             self.tf_out = None
         else:
-            try:
-                from tensorflow.keras.models import model_from_json
-                logging.info('Using Keras')
-                use_keras = True
-            except(ModuleNotFoundError):
-                use_keras = False
-                logging.info('Using Tensorflow')
-            if use_keras:
-                path = self.params.get('online', 'path_to_model').split(".")[:-1]
-                json_path = ".".join(path + ["json"])
-                model_path = ".".join(path + ["h5"])
-                json_file = open(json_path, 'r')
-                loaded_model_json = json_file.read()
-                json_file.close()
-                loaded_model = model_from_json(loaded_model_json)
-                loaded_model.load_weights(model_path)
-                #opt = tf.keras.optimizers.rmsprop(lr=0.0001, decay=1e-6)
-                #loaded_model.compile(loss=tf.keras.losses.categorical_crossentropy,
-                #                     optimizer=opt, metrics=['accuracy'])
-                self.tf_in = None
-                self.tf_out = None
-            else:
-                path = self.params.get('online', 'path_to_model').split(".")[:-1]
-                model_path = '.'.join(path + ['h5', 'pb'])
-                loaded_model = load_graph(model_path)
-                self.tf_in = loaded_model.get_tensor_by_name('prefix/conv2d_1_input:0')
-                self.tf_out = loaded_model.get_tensor_by_name('prefix/output_node0:0')
-                loaded_model = tf.Session(graph=loaded_model)
+            # shared through the model registry, loaded once per process
+            path = '.'.join(self.params.get('online', 'path_to_model').split(".")[:-1])
+            loaded_model = model_registry.get_classifier(path, input_name='prefix/conv2d_1_input:0')
+            logging.info('Using model {} with backend {}'.format(path, loaded_model.backend))
+            self.tf_in = None
+            self.tf_out = None
         self.loaded_model = loaded_model
 
         if self.is1p:
@@ -375,10 +354,10 @@ class OnACID(object):
                         estim.downscale_matrix.dot(Yres)))
             Yres = Yres.reshape((d1, d2, -1), order='F')
 
-            (self.estimates.first_moment, self.estimates.second_moment,
-                self.estimates.crosscorr, self.estimates.col_ind, self.estimates.row_ind,
-                self.estimates.num_neigbors, self.estimates.corrM, self.estimates.corr_img) = \
-            summary_images.prepare_local_correlations(Yres, swap_dim=True, eight_neighbours=False)
+            self.estimates.corr_stats = summary_images.LocalCorrelations(
+                Yres, window=self.params.get('online', 'minibatch_shape'), swap_dim=True,
+                eight_neighbours=False)
+            self.estimates.corr_img = self.estimates.corr_stats.image()
             self.estimates.max_img = Yres.max(-1)
 
         self.comp_upd = []
@@ -386,6 +365,8 @@ class OnACID(object):
         self.t_detect:List = []
         self.t_motion:List = []
         self.t_stat:List = []
+        self.t_demix:List = []
+        self.t_deconv:List = []
 
         return self
 
@@ -421,6 +402,7 @@ class OnACID(object):
         if len(self.estimates.ind_new) > 0:
             self.estimates.mean_buff = self.estimates.Yres_buf.mean(0)
 
+        t_demix = time()
         if (not self.params.get('online', 'simultaneously')) or self.params.get('preprocess', 'p') == 0:
             # get noisy fluor value via NNLS (project data on shapes & demix)
             C_in = self.estimates.noisyC[:self.M, t - 1].copy()
@@ -433,12 +415,15 @@ class OnACID(object):
             else:
                 self.estimates.C_on[:self.M, t], self.estimates.noisyC[:self.M, t] = HALS4activity(
                     frame, self.estimates.Ab, C_in, self.estimates.AtA, iters=num_iters_hals, groups=self.estimates.groups)
+            self.t_demix.append(time() - t_demix)
+            t_deconv = time()
             if self.params.get('preprocess', 'p'):
                 # denoise & deconvolve
                 for i, o in enumerate(self.estimates.OASISinstances):
                     o.fit_next(self.estimates.noisyC[nb_ + i, t])
                     self.estimates.C_on[nb_ + i, t - o.get_l_of_last_pool() +
                               1: t + 1] = o.get_c_of_last_pool()
+            self.t_deconv.append(time() - t_deconv)
 
         else:
             if self.is1p:
@@ -459,6 +444,9 @@ class OnACID(object):
             for i, o in enumerate(self.estimates.OASISinstances):
                 self.estimates.C_on[nb_ + i, t - o.get_l_of_last_pool() + 1: t +
                           1] = o.get_c_of_last_pool()
+            # demixing and deconvolution are done jointly
+            self.t_demix.append(time() - t_demix)
+            self.t_deconv.append(0.)
 
         #self.estimates.mean_buff = self.estimates.Yres_buf.mean(0)
         res_frame = frame - self.estimates.Ab.dot(self.estimates.C_on[:self.M, t])
@@ -478,13 +466,10 @@ class OnACID(object):
         if self.params.get('online', 'update_num_comps'):
 
             if self.params.get('online', 'use_corr_img'):
-                corr_img_mode = 'simple'  #'exponential'  # 'cumulative'
-                self.estimates.corr_img = summary_images.update_local_correlations(
-                    t + 1 if corr_img_mode == 'cumulative' else mbs, 
+                corr_stats = self.estimates.corr_stats
+                corr_img_mode = corr_stats.mode
+                self.estimates.corr_img = corr_stats.update(
                     res_frame.reshape((1,) + self.estimates.dims, order='F'),
-                    self.estimates.first_moment, self.estimates.second_moment,
-                    self.estimates.crosscorr, self.estimates.col_ind, self.estimates.row_ind,
-                    self.estimates.num_neigbors, self.estimates.corrM,
                     del_frames=[self.estimates.Yres_buf[self.estimates.Yres_buf.cur]]
                     if corr_img_mode == 'simple' else None)
             self.estimates.mean_buff += (res_frame-self.estimates.Yres_buf[self.estimates.Yres_buf.cur])/self.params.get('online', 'minibatch_shape')
@@ -501,178 +486,8 @@ class OnACID(object):
                 rho = np.reshape(rho, np.prod(self.params.get('data', 'dims')))
                 self.estimates.rho_buf.append(rho)
 
-            # old_max_img = self.estimates.max_img.copy()
-            if self.params.get('preprocess', 'p') == 1:
-                g_est = np.mean(self.estimates.g)
-            elif self.params.get('preprocess', 'p') == 2:
-                g_est = np.mean(self.estimates.g, 0)
-            else:
-                g_est = 0
-            use_corr = self.params.get('online', 'use_corr_img')
-            (self.estimates.Ab, Cf_temp, self.estimates.Yres_buf, self.estimates.rho_buf,
-                self.estimates.CC, self.estimates.CY, self.ind_A, self.estimates.sv,
-                self.estimates.groups, self.estimates.ind_new, self.ind_new_all,
-                self.estimates.sv, self.cnn_pos) = update_num_components(
-                t, self.estimates.sv, self.estimates.Ab, self.estimates.C_on[:self.M, (t - mbs + 1):(t + 1)],
-                self.estimates.Yres_buf, self.estimates.Yr_buf, self.estimates.rho_buf,
-                self.params.get('data', 'dims'), self.params.get('init', 'gSig'),
-                self.params.get('init', 'gSiz'), self.ind_A, self.estimates.CY, self.estimates.CC,
-                rval_thr=self.params.get('online', 'rval_thr'),
-                thresh_fitness_delta=self.params.get('online', 'thresh_fitness_delta'),
-                thresh_fitness_raw=self.params.get('online', 'thresh_fitness_raw'),
-                thresh_overlap=self.params.get('online', 'thresh_overlap'), groups=self.estimates.groups,
-                batch_update_suff_stat=self.params.get('online', 'batch_update_suff_stat'),
-                gnb=self.params.get('init', 'nb'), sn=self.estimates.sn, 
-                g=g_est, s_min=self.params.get('temporal', 's_min'),
-                Ab_dense=self.estimates.Ab_dense if self.params.get('online', 'use_dense') else None,
-                oases=self.estimates.OASISinstances if self.params.get('preprocess', 'p') else None,
-                N_samples_exceptionality=self.params.get('online', 'N_samples_exceptionality'),
-                max_num_added=self.params.get('online', 'max_num_added'),
-                min_num_trial=self.params.get('online', 'min_num_trial'),
-                loaded_model = self.loaded_model, test_both=self.params.get('online', 'test_both'),
-                thresh_CNN_noisy = self.params.get('online', 'thresh_CNN_noisy'),
-                sniper_mode=self.params.get('online', 'sniper_mode'),
-                use_peak_max=self.params.get('online', 'use_peak_max'),
-                mean_buff=self.estimates.mean_buff,
-                tf_in=self.tf_in, tf_out=self.tf_out,
-                ssub_B=ssub_B, W=self.estimates.W if self.is1p else None,
-                b0=self.estimates.b0 if self.is1p else None,
-                corr_img=self.estimates.corr_img if use_corr else None,
-                first_moment=self.estimates.first_moment if use_corr else None,
-                second_moment=self.estimates.second_moment if use_corr else None,
-                crosscorr=self.estimates.crosscorr if use_corr else None,
-                col_ind=self.estimates.col_ind if use_corr else None,
-                row_ind=self.estimates.row_ind if use_corr else None,
-                corr_img_mode=corr_img_mode if use_corr else None,
-                downscale_matrix=self.estimates.downscale_matrix if
-                (self.is1p and ssub_B > 1) else None,
-                upscale_matrix=self.estimates.upscale_matrix if
-                (self.is1p and ssub_B > 1) else None,
-                max_img=self.estimates.max_img if use_corr else None)
-
-            num_added = len(self.ind_A) - self.N
-
-            if num_added > 0:
-                # import matplotlib.pyplot as plt
-                # plt.figure(figsize=(15, 10))
-                # plt.subplot(231)
-                # plt.imshow(self.estimates.corr_img)
-                # foo = summary_images.update_local_correlations(
-                # np.inf, np.zeros((0,) + self.estimates.dims, order='F'),
-                # self.estimates.first_moment, self.estimates.second_moment,
-                # self.estimates.crosscorr, self.estimates.col_ind, self.estimates.row_ind,
-                # self.estimates.num_neigbors, self.estimates.corrM)
-                # plt.subplot(232)
-                # plt.imshow(foo)
-                # plt.subplot(233)
-                # plt.imshow(self.estimates.Ab_dense[:,self.M].reshape(self.estimates.dims, order='F'))
-                # plt.subplot(234)
-                # plt.imshow(old_max_img)
-                # plt.subplot(235)
-                # plt.imshow(self.estimates.max_img)
-                # plt.show()
-                
-                self.N += num_added
-                self.M += num_added
-                if self.N + self.params.get('online', 'max_num_added') > expected_comps:
-                    expected_comps += 200
-                    self.params.set('online', {'expected_comps': expected_comps})
-                    self.estimates.CY.resize(
-                        [expected_comps + nb_, self.estimates.CY.shape[-1]])
-                    # refcheck can trigger "ValueError: cannot resize an array references or is referenced
-                    #                       by another array in this way.  Use the resize function"
-                    # np.resize didn't work, but refcheck=False seems fine
-                    self.estimates.C_on.resize(
-                        [expected_comps + nb_, self.estimates.C_on.shape[-1]], refcheck=False)
-                    self.estimates.noisyC.resize(
-                        [expected_comps + nb_, self.estimates.C_on.shape[-1]])
-                    if self.params.get('online', 'use_dense'):  # resize won't work due to contingency issue
-                        # self.estimates.Ab_dense.resize([self.estimates.CY.shape[-1], expected_comps+nb_])
-                        self.estimates.Ab_dense = np.zeros((self.estimates.CY.shape[-1], expected_comps + nb_),
-                                                 dtype=np.float32)
-                        self.estimates.Ab_dense[:, :Ab_.shape[1]] = Ab_.toarray()
-                    logging.info('Increasing number of expected components to:' +
-                          str(expected_comps))
-                self.update_counter.resize(self.N, refcheck=False)
-
-                self.estimates.noisyC[self.M - num_added:self.M, t - mbs +
-                            1:t + 1] = Cf_temp[self.M - num_added:self.M]
-
-                for _ct in range(self.M - num_added, self.M):
-                    self.time_neuron_added.append((_ct - nb_, t))
-                    if self.params.get('preprocess', 'p'):
-                        # N.B. OASISinstances are already updated within update_num_components
-                        self.estimates.C_on[_ct, t - mbs + 1: t +
-                                  1] = self.estimates.OASISinstances[_ct - nb_].get_c(mbs)
-                    else:
-                        self.estimates.C_on[_ct, t - mbs + 1: t + 1] = np.maximum(
-                            0, self.estimates.noisyC[_ct, t - mbs + 1: t + 1])
-                    if self.params.get('online', 'simultaneously') and self.params.get('online', 'n_refit'):
-                        self.estimates.AtY_buf = np.concatenate((
-                            self.estimates.AtY_buf, [Ab_.data[Ab_.indptr[_ct]:Ab_.indptr[_ct + 1]].dot(
-                                self.estimates.Yr_buf.T[Ab_.indices[Ab_.indptr[_ct]:Ab_.indptr[_ct + 1]]])]))
-                    # N.B. Ab_dense is already updated within update_num_components as side effect
-
-                # self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
-                # faster incremental update of AtA instead of above line:
-                AtA = self.estimates.AtA
-                self.estimates.AtA = np.zeros((self.M, self.M), dtype=np.float32)
-                self.estimates.AtA[:-num_added, :-num_added] = AtA
-                if self.params.get('online', 'use_dense'):
-                    self.estimates.AtA[:, -num_added:] = self.estimates.Ab.T.dot(
-                        self.estimates.Ab_dense[:, self.M - num_added:self.M])
-                else:
-                    self.estimates.AtA[:, -num_added:] = self.estimates.Ab.T.dot(
-                        self.estimates.Ab[:, -num_added:]).toarray()
-                self.estimates.AtA[-num_added:] = self.estimates.AtA[:, -num_added:].T
-                
-                if self.is1p:
-                    # # update XXt and W: TODO only update necessary pixels not all!
-                    # x = (y - self.Ab.dot(ccf).T - self.b0).T if ssub_B == 1
-                    #         else (downscale((y.T - self.Ab.dot(ccf) - self.b0[:, None])
-                    #                .reshape(self.dims2 + (-1,), order='F'), (ssub_B, ssub_B, 1))
-                    #      .reshape((-1, len(y)), order='F'))
-
-                    # for p in range(self.W.shape[0]):
-                    #     index = self.get_indices_of_pixels_on_ring(p)
-                    #     self.W.data[self.W.indptr[p]:self.W.indptr[p + 1]] = \
-                    #         np.linalg.inv(self.XXt[index[:, None], index]).dot(self.XXt[index, p])
-
-                    if ssub_B == 1:
-                        # self.estimates.AtW = Ab_.T.dot(self.estimates.W)
-                        # self.estimates.AtWA = self.estimates.AtW.dot(Ab_).toarray()
-                        # faster incremental update of AtW and AtWA instead of above lines:
-                        csr_append(self.estimates.AtW, Ab_.T[-num_added:].dot(self.estimates.W))
-                        AtWA = self.estimates.AtWA
-                        self.estimates.AtWA = np.zeros((self.M, self.M), dtype=np.float32)
-                        self.estimates.AtWA[:-num_added, :-num_added] = AtWA
-                        self.estimates.AtWA[:, -num_added:] = self.estimates.AtW.dot(
-                            Ab_[:, -num_added:]).toarray()
-                        self.estimates.AtWA[-num_added:] = self.estimates.AtW[-num_added:].dot(
-                            Ab_).toarray()
-                        self.estimates.Atb = self.estimates.AtW.dot(
-                            self.estimates.b0) - Ab_.T.dot(self.estimates.b0)
-                    else:
-                        A_ds = self.estimates.downscale_matrix.dot(self.estimates.Ab)
-                        # self.estimates.AtW = A_ds.T.dot(self.estimates.W)
-                        # self.estimates.AtWA = self.estimates.AtW.dot(A_ds).toarray()
-                        # faster incremental update of AtW and AtWA instead of above lines:
-                        csr_append(self.estimates.AtW, A_ds.T[-num_added:].dot(self.estimates.W))
-                        AtWA = self.estimates.AtWA
-                        self.estimates.AtWA = np.zeros((self.M, self.M), dtype=np.float32)
-                        self.estimates.AtWA[:-num_added, :-num_added] = AtWA
-                        self.estimates.AtWA[:, -num_added:] = self.estimates.AtW.dot(
-                            A_ds[:, -num_added:]).toarray()
-                        self.estimates.AtWA[-num_added:] = self.estimates.AtW[-num_added:].dot(
-                            A_ds).toarray()
-                        self.estimates.Atb = ssub_B**2 * self.estimates.AtW.dot(
-                            self.estimates.downscale_matrix.dot(
-                                self.estimates.b0)) - Ab_.T.dot(self.estimates.b0)
-
-                # set the update counter to 0 for components that are overlaping the newly added
-                idx_overlap = self.estimates.AtA[nb_:-num_added, -num_added:].nonzero()[0]
-                self.update_counter[idx_overlap] = 0
-            self.t_detect.append(time() - t_new)
+            num_added = self._update_num_components(t)
+        self.t_detect.append(time() - t_new)
         t_stat = time()
         if self.params.get('online', 'batch_update_suff_stat'):
         # faster update using minibatch of frames
@@ -766,124 +581,7 @@ class OnACID(object):
         if not self.params.get('online', 'dist_shape_update'):  # bulk shape update
             if ((t + 1 - self.params.get('online', 'init_batch')) %
                     self.params.get('online', 'update_freq') == 0):
-                logging.info('Updating Shapes')
-
-                if self.N > self.params.get('online', 'max_comp_update_shape'):
-                    indicator_components = np.where(self.update_counter <=
-                                                    self.params.get('online', 'num_times_comp_updated'))[0]
-                    # np.random.choice(self.N,10,False)
-                    self.update_counter[indicator_components] += 1
-                else:
-                    indicator_components = None
-
-                if self.params.get('online', 'use_dense'):
-                    # update dense Ab and sparse Ab simultaneously;
-                    # this is faster than calling update_shapes with sparse Ab only
-                    Ab_, self.ind_A, self.estimates.Ab_dense[:, :self.M] = update_shapes(
-                        self.estimates.CY, self.estimates.CC, self.estimates.Ab, self.ind_A,
-                        indicator_components=indicator_components,
-                        Ab_dense=self.estimates.Ab_dense[:, :self.M],
-                        sn=self.estimates.sn, q=0.5, iters=self.params.get('online', 'iters_shape'))
-                else:
-                    Ab_, self.ind_A, _ = update_shapes(
-                        self.estimates.CY, self.estimates.CC, Ab_, self.ind_A,
-                        indicator_components=indicator_components, sn=self.estimates.sn,
-                        q=0.5, iters=self.params.get('online', 'iters_shape'))
-
-                self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
-                if self.is1p and ((t + 1 - self.params.get('online', 'init_batch')) %
-                    (self.params.get('online', 'W_update_factor') * self.params.get('online', 'update_freq')) == 0):
-                    W = self.estimates.W
-                    # for p in range(W.shape[0]):
-                    #     # index = self.get_indices_of_pixels_on_ring(p)
-                    #     index = W.indices[W.indptr[p]:W.indptr[p + 1]]
-                    #     # for _ in range(3):  # update W via coordinate decent
-                    #     #     for k, i in enumerate(index):
-                    #     #         self.W.data[self.W.indptr[p] + k] += ((self.XXt[p, i] -
-                    #     #                                      self.W.data[self.W.indptr[p]:self.W.indptr[p+1]].dot(self.XXt[index, i])) /
-                    #     #                                     self.XXt[i, i])
-                    #     # update W using normal equations
-                    #     tmp = XXt[index[:, None], index]
-                    #     tmp[np.diag_indices(len(tmp))] += np.trace(tmp) * 1e-5
-                    #     W.data[W.indptr[p]:W.indptr[p + 1]] = np.linalg.inv(tmp).dot(XXt[index, p])
-                    if self.params.get('online', 'full_XXt'):
-                        XXt = self.estimates.XXt  # alias for considerably faster look up in large loop
-                        def process_pixel(p):
-                            # index = W.indices[W.indptr[p]:W.indptr[p + 1]]
-                            index = self.W_ind[p]
-                            tmp = XXt[index[:, None], index]
-                            tmp[np.diag_indices(len(tmp))] += np.trace(tmp) * 1e-5
-                            return pd_solve(tmp, XXt[index, p])
-                        if False:  # current_process().name == 'MainProcess':
-                            W.data = np.concatenate(parmap(process_pixel, range(W.shape[0])))
-                        else:
-                            W.data = np.concatenate(list(map(process_pixel, range(W.shape[0]))))
-                    else:
-                        XXt_mats = self.XXt_mats
-                        XXt_vecs = self.XXt_vecs
-#                        def process_pixel2(p):
-#                            #return np.linalg.solve(a[0], a[1])
-#                            return np.linalg.solve(XXt_mats[p], XXt_vecs[p])
-                       # W.data = np.concatenate(list(map(process_pixel2, range(W.shape[0]))))
-                        if self.dview is None: 
-                            W.data = np.concatenate(list(map(inv_mat_vec, zip(XXt_mats, XXt_vecs))))
-                        elif 'multiprocessing' in str(type(self.dview)):
-                            W.data = np.concatenate(list(self.dview.imap(inv_mat_vec, zip(XXt_mats, XXt_vecs), chunksize=256)))
-                        else:
-                            W.data = np.concatenate(list(self.dview.map_sync(inv_mat_vec, zip(XXt_mats, XXt_vecs))))
-                            self.dview.results.clear()
-                           
-                       #W.data = np.concatenate(parmap(process_pixel2, range(W.shape[0])))
-                       #W.data = np.concatenate(parmap(process_pixel2, zip(XXt_mats, XXt_vecs)))
-                    
-                    if ssub_B == 1:
-                        self.estimates.Atb = Ab_.T.dot(W.dot(self.estimates.b0) - self.estimates.b0)
-                        self.estimates.AtW = Ab_.T.dot(W)
-                        self.estimates.AtWA = self.estimates.AtW.dot(Ab_).toarray()
-                    else:
-                        d1, d2 = self.estimates.dims
-                        A_ds = self.estimates.downscale_matrix.dot(self.estimates.Ab)
-                        self.estimates.Atb = Ab_.T.dot(self.estimates.upscale_matrix.dot(W.dot(
-                            self.estimates.downscale_matrix.dot(self.estimates.b0))) - self.estimates.b0)
-                        self.estimates.AtW = A_ds.T.dot(W)
-                        self.estimates.AtWA = self.estimates.AtW.dot(A_ds).toarray()
-
-                ind_zero = list(np.where(self.estimates.AtA.diagonal() < 1e-10)[0])
-                if len(ind_zero) > 0:
-                    ind_zero.sort()
-                    ind_zero = ind_zero[::-1]
-                    ind_keep = list(set(range(Ab_.shape[-1])) - set(ind_zero))
-                    ind_keep.sort()
-
-                    if self.params.get('online', 'use_dense'):
-                        self.estimates.Ab_dense = np.delete(
-                            self.estimates.Ab_dense, ind_zero, axis=1)
-                    self.estimates.AtA = np.delete(self.estimates.AtA, ind_zero, axis=0)
-                    self.estimates.AtA = np.delete(self.estimates.AtA, ind_zero, axis=1)
-                    self.estimates.CY = np.delete(self.estimates.CY, ind_zero, axis=0)
-                    self.estimates.CC = np.delete(self.estimates.CC, ind_zero, axis=0)
-                    self.estimates.CC = np.delete(self.estimates.CC, ind_zero, axis=1)
-                    self.M -= len(ind_zero)
-                    self.N -= len(ind_zero)
-                    self.estimates.noisyC = np.delete(self.estimates.noisyC, ind_zero, axis=0)
-                    for ii in ind_zero:
-                        del self.estimates.OASISinstances[ii - self.params.get('init', 'nb')]
-                        #del self.ind_A[ii-self.params.init['nb']]
-
-                    self.estimates.C_on = np.delete(self.estimates.C_on, ind_zero, axis=0)
-                    self.estimates.AtY_buf = np.delete(self.estimates.AtY_buf, ind_zero, axis=0)
-                    #Ab_ = Ab_[:,ind_keep]
-                    Ab_ = csc_matrix(Ab_[:, ind_keep])
-                    #Ab_ = csc_matrix(self.estimates.Ab_dense[:,:self.M])
-                    self.Ab_dense_copy = self.estimates.Ab_dense
-                    self.Ab_copy = Ab_
-                    self.estimates.Ab = Ab_
-                    self.ind_A = list(
-                        [(self.estimates.Ab.indices[self.estimates.Ab.indptr[ii]:self.estimates.Ab.indptr[ii + 1]]) for ii in range(self.params.get('init', 'nb'), self.M)])
-                    self.estimates.groups = list(map(list, update_order(Ab_)[0]))
-
-                if self.params.get('online', 'n_refit'):
-                    self.estimates.AtY_buf = Ab_.T.dot(self.estimates.Yr_buf.T)
+                self._update_shapes(t)
 
         else:  # distributed shape update
             self.update_counter *= 2**(-1. / self.params.get('online', 'update_freq'))
@@ -927,6 +625,455 @@ class OnACID(object):
 
         return self
 
+    @profile
+    def fit_next_batch(self, t, frames, num_iters_hals=3):
+        """
+        This method fits a block of consecutive frames using the CaImAn online
+        algorithm and updates the object. The activity of all frames is demixed
+        at once, the sufficient statistics are updated with one product over
+        the block, and new components are searched for and shapes updated once
+        per block. This trades per-frame latency for throughput, e.g. when
+        processing recorded data. 1p data, simultaneous demixing and
+        deconvolution, and distributed shape updates fall back to fit_next.
+        With batch_update_suff_stat, the statistics are updated with the same
+        minibatches and weights as in fit_next, using the activity estimated
+        at the end of the block.
+
+        Args
+            t : int
+                time of the first frame of the block, measured in number of frames
+
+            frames : array
+                array of shape (# frames, x * y [ * z]) containing the flattened
+                images of times t, t + 1, ...
+
+            num_iters_hals: int, optional
+                maximal number of iterations for HALS (NNLS via blockCD)
+        """
+        if (self.is1p or self.params.get('online', 'dist_shape_update') or
+                (self.params.get('online', 'simultaneously') and self.params.get('preprocess', 'p'))):
+            for i, frame in enumerate(frames):
+                self.fit_next(t + i, frame, num_iters_hals=num_iters_hals)
+            return self
+
+        nb_ = self.params.get('init', 'nb')
+        mbs = self.params.get('online', 'minibatch_shape')
+        batch_update = self.params.get('online', 'batch_update_suff_stat')
+        min_batch = min(self.params.get('online', 'update_freq'), mbs)
+        lag = 0 if batch_update else self.params.get('online', 'minibatch_suff_stat')
+        max_frames = mbs - lag  # the block and the lagged frames must fit in the buffer
+        if batch_update:
+            # blocks end at the minibatches of the statistics updates of fit_next
+            max_frames = min(max_frames, (self.params.get('online', 'init_batch') - t - 1) % min_batch + 1)
+        if len(frames) > max_frames:
+            self.fit_next_batch(t, frames[:max_frames], num_iters_hals=num_iters_hals)
+            self.fit_next_batch(t + max_frames, frames[max_frames:], num_iters_hals=num_iters_hals)
+            return self
+
+        frames = np.asarray(frames, dtype=np.float32)
+        n = len(frames)
+        t_end = t + n - 1
+        for frame in frames:
+            self.estimates.Yr_buf.append(frame)
+        if len(self.estimates.ind_new) > 0:
+            self.estimates.mean_buff = self.estimates.Yres_buf.mean(0)
+
+        # get noisy fluor values of the whole block via NNLS, starting from the last frame
+        t_demix = time()
+        C_in = np.repeat(self.estimates.noisyC[:self.M, t - 1:t], n, axis=1)
+        self.estimates.C_on[:self.M, t:t_end + 1], self.estimates.noisyC[:self.M, t:t_end + 1] = HALS4activity(
+            frames.T, self.estimates.Ab, C_in, self.estimates.AtA, iters=num_iters_hals,
+            groups=self.estimates.groups)
+        self.t_demix.append(time() - t_demix)
+        t_deconv = time()
+        if self.params.get('preprocess', 'p'):
+            # denoise & deconvolve, the pools are extended frame by frame
+            for i, o in enumerate(self.estimates.OASISinstances):
+                for tt in range(t, t_end + 1):
+                    o.fit_next(self.estimates.noisyC[nb_ + i, tt])
+                    self.estimates.C_on[nb_ + i, tt - o.get_l_of_last_pool() +
+                                        1: tt + 1] = o.get_c_of_last_pool()
+        self.t_deconv.append(time() - t_deconv)
+
+        res = frames - self.estimates.Ab.dot(self.estimates.C_on[:self.M, t:t_end + 1]).T
+        # merge the running mean and variance of the residuals with those of the block
+        mn_b, vr_b = res.mean(0), res.var(0)
+        delta = self.estimates.mn - mn_b
+        self.estimates.mn = ((t - 1) * self.estimates.mn + n * mn_b) / t_end
+        self.estimates.vr = ((t - 1) * self.estimates.vr + n * vr_b +
+                             (t - 1) * n / t_end * delta**2) / t_end
+        self.estimates.sn = np.sqrt(self.estimates.vr)
+
+        t_new = time()
+        if self.params.get('online', 'update_num_comps'):
+            Yres_buf = self.estimates.Yres_buf
+            del_frames = np.asarray(Yres_buf[(Yres_buf.cur + np.arange(n)) % mbs])
+            if self.params.get('online', 'use_corr_img'):
+                corr_stats = self.estimates.corr_stats
+                self.estimates.corr_img = corr_stats.update(
+                    res, del_frames=del_frames if corr_stats.mode == 'simple' else None)
+                self.estimates.max_img = np.maximum(self.estimates.max_img, np.reshape(
+                    res.max(0), self.estimates.dims, order='F'))
+            self.estimates.mean_buff += (res.sum(0) - del_frames.sum(0)) / mbs
+            for i, res_frame in enumerate(res):
+                Yres_buf.append(res_frame)
+                if not self.params.get('online', 'use_corr_img'):
+                    rho = imblur(np.maximum(res_frame.reshape(self.estimates.dims, order='F'), 0),
+                                 sig=self.params.get('init', 'gSig'),
+                                 siz=self.params.get('init', 'gSiz'),
+                                 nDimBlur=len(self.params.get('data', 'dims')))**2
+                    rho = np.reshape(rho, np.prod(self.params.get('data', 'dims')))
+                    self.estimates.rho_buf.append(rho)
+                    if i < n - 1:  # the last frame is accounted for in update_num_components
+                        self.estimates.sv = np.maximum(
+                            self.estimates.sv - self.estimates.rho_buf.get_first() + rho, 0)
+
+            self._update_num_components(t_end)
+        self.t_detect.append(time() - t_new)
+
+        t_stat = time()
+        if batch_update:
+            # as in fit_next, once the minibatch of min_batch frames that ends the block is complete
+            if (t_end + 1 - self.params.get('online', 'init_batch')) % min_batch == 0:
+                ccf = self.estimates.C_on[:self.M, t_end - min_batch + 1:t_end + 1]
+                y = self.estimates.Yr_buf.get_last_frames(min_batch)
+                self._update_suff_stat(ccf, y, (t_end - min_batch) / t_end, 1. / t_end)
+        else:
+            # update the sufficient statistics with the whole block,
+            # equivalent to n consecutive updates with weights 1 - 1/t and 1/t
+            ccf = self.estimates.C_on[:self.M, t - lag:t_end + 1 - lag]
+            y = self.estimates.Yr_buf.get_last_frames(n + lag)[:n]
+            self._update_suff_stat(ccf, y, (t - 1) / t_end, 1. / t_end)
+        self.t_stat.append(time() - t_stat)
+
+        # update shapes if the update time falls within the block
+        t_sh = time()
+        update_freq = self.params.get('online', 'update_freq')
+        if (t_end + 1 - self.params.get('online', 'init_batch')) // update_freq > \
+                (t - self.params.get('online', 'init_batch')) // update_freq:
+            self._update_shapes(t_end)
+        self.t_shapes.append(time() - t_sh)
+
+        return self
+
+    def _update_suff_stat(self, ccf, y, w1, w2):
+        """Updates the sufficient statistics CY and CC with the activity ccf
+        of the frames y, with weights w1 for the old and w2 for the new values.
+        """
+        nb_ = self.params.get('init', 'nb')
+        ccf = np.ascontiguousarray(ccf)
+        y = np.asfortranarray(y)
+        for m in range(self.N):
+            self.estimates.CY[m + nb_, self.ind_A[m]] *= w1
+            self.estimates.CY[m + nb_, self.ind_A[m]] += w2 * \
+                ccf[m + nb_].dot(y[:, self.ind_A[m]])
+        self.estimates.CY[:nb_] = self.estimates.CY[:nb_] * w1 + w2 * ccf[:nb_].dot(y)
+        self.estimates.CC = self.estimates.CC * w1 + w2 * ccf.dot(ccf.T)
+
+    def _update_num_components(self, t):
+        """Searches the buffer of residuals for new components after frame t
+        and adds them to the model. Returns the number of added components.
+        """
+        nb_ = self.params.get('init', 'nb')
+        Ab_ = self.estimates.Ab
+        mbs = self.params.get('online', 'minibatch_shape')
+        ssub_B = self.params.get('init', 'ssub_B') * self.params.get('init', 'ssub')
+        expected_comps = self.params.get('online', 'expected_comps')
+        use_corr = self.params.get('online', 'use_corr_img')
+        if use_corr:
+            corr_stats = self.estimates.corr_stats
+            corr_img_mode = corr_stats.mode
+        # old_max_img = self.estimates.max_img.copy()
+        if self.params.get('preprocess', 'p') == 1:
+            g_est = np.mean(self.estimates.g)
+        elif self.params.get('preprocess', 'p') == 2:
+            g_est = np.mean(self.estimates.g, 0)
+        else:
+            g_est = 0
+        (self.estimates.Ab, Cf_temp, self.estimates.Yres_buf, self.estimates.rho_buf,
+            self.estimates.CC, self.estimates.CY, self.ind_A, self.estimates.sv,
+            self.estimates.groups, self.estimates.ind_new, self.ind_new_all,
+            self.estimates.sv, self.cnn_pos) = update_num_components(
+            t, self.estimates.sv, self.estimates.Ab, self.estimates.C_on[:self.M, (t - mbs + 1):(t + 1)],
+            self.estimates.Yres_buf, self.estimates.Yr_buf, self.estimates.rho_buf,
+            self.params.get('data', 'dims'), self.params.get('init', 'gSig'),
+            self.params.get('init', 'gSiz'), self.ind_A, self.estimates.CY, self.estimates.CC,
+            rval_thr=self.params.get('online', 'rval_thr'),
+            thresh_fitness_delta=self.params.get('online', 'thresh_fitness_delta'),
+            thresh_fitness_raw=self.params.get('online', 'thresh_fitness_raw'),
+            thresh_overlap=self.params.get('online', 'thresh_overlap'), groups=self.estimates.groups,
+            batch_update_suff_stat=self.params.get('online', 'batch_update_suff_stat'),
+            gnb=self.params.get('init', 'nb'), sn=self.estimates.sn, 
+            g=g_est, s_min=self.params.get('temporal', 's_min'),
+            Ab_dense=self.estimates.Ab_dense if self.params.get('online', 'use_dense') else None,
+            oases=self.estimates.OASISinstances if self.params.get('preprocess', 'p') else None,
+            N_samples_exceptionality=self.params.get('online', 'N_samples_exceptionality'),
+            max_num_added=self.params.get('online', 'max_num_added'),
+            min_num_trial=self.params.get('online', 'min_num_trial'),
+            loaded_model = self.loaded_model, test_both=self.params.get('online', 'test_both'),
+            thresh_CNN_noisy = self.params.get('online', 'thresh_CNN_noisy'),
+            sniper_mode=self.params.get('online', 'sniper_mode'),
+            use_peak_max=self.params.get('online', 'use_peak_max'),
+            mean_buff=self.estimates.mean_buff,
+            tf_in=self.tf_in, tf_out=self.tf_out,
+            ssub_B=ssub_B, W=self.estimates.W if self.is1p else None,
+            b0=self.estimates.b0 if self.is1p else None,
+            corr_img=self.estimates.corr_img if use_corr else None,
+            first_moment=corr_stats.first_moment if use_corr else None,
+            second_moment=corr_stats.second_moment if use_corr else None,
+            crosscorr=corr_stats.crosscorr if use_corr else None,
+            col_ind=corr_stats.col_ind if use_corr else None,
+            row_ind=corr_stats.row_ind if use_corr else None,
+            corr_img_mode=corr_img_mode if use_corr else None,
+            downscale_matrix=self.estimates.downscale_matrix if
+            (self.is1p and ssub_B > 1) else None,
+            upscale_matrix=self.estimates.upscale_matrix if
+            (self.is1p and ssub_B > 1) else None,
+            max_img=self.estimates.max_img if use_corr else None)
+
+        num_added = len(self.ind_A) - self.N
+
+        if num_added > 0:
+            # import matplotlib.pyplot as plt
+            # plt.figure(figsize=(15, 10))
+            # plt.subplot(231)
+            # plt.imshow(self.estimates.corr_img)
+            # foo = summary_images.update_local_correlations(
+            # np.inf, np.zeros((0,) + self.estimates.dims, order='F'),
+            # self.estimates.first_moment, self.estimates.second_moment,
+            # self.estimates.crosscorr, self.estimates.col_ind, self.estimates.row_ind,
+            # self.estimates.num_neigbors, self.estimates.corrM)
+            # plt.subplot(232)
+            # plt.imshow(foo)
+            # plt.subplot(233)
+            # plt.imshow(self.estimates.Ab_dense[:,self.M].reshape(self.estimates.dims, order='F'))
+            # plt.subplot(234)
+            # plt.imshow(old_max_img)
+            # plt.subplot(235)
+            # plt.imshow(self.estimates.max_img)
+            # plt.show()
+            
+            self.N += num_added
+            self.M += num_added
+            if self.N + self.params.get('online', 'max_num_added') > expected_comps:
+                expected_comps += 200
+                self.params.set('online', {'expected_comps': expected_comps})
+                self.estimates.CY.resize(
+                    [expected_comps + nb_, self.estimates.CY.shape[-1]])
+                # refcheck can trigger "ValueError: cannot resize an array references or is referenced
+                #                       by another array in this way.  Use the resize function"
+                # np.resize didn't work, but refcheck=False seems fine
+                self.estimates.C_on.resize(
+                    [expected_comps + nb_, self.estimates.C_on.shape[-1]], refcheck=False)
+                self.estimates.noisyC.resize(
+                    [expected_comps + nb_, self.estimates.C_on.shape[-1]])
+                if self.params.get('online', 'use_dense'):  # resize won't work due to contingency issue
+                    # self.estimates.Ab_dense.resize([self.estimates.CY.shape[-1], expected_comps+nb_])
+                    self.estimates.Ab_dense = np.zeros((self.estimates.CY.shape[-1], expected_comps + nb_),
+                                             dtype=np.float32)
+                    self.estimates.Ab_dense[:, :Ab_.shape[1]] = Ab_.toarray()
+                logging.info('Increasing number of expected components to:' +
+                      str(expected_comps))
+            self.update_counter.resize(self.N, refcheck=False)
+
+            self.estimates.noisyC[self.M - num_added:self.M, t - mbs +
+                        1:t + 1] = Cf_temp[self.M - num_added:self.M]
+
+            for _ct in range(self.M - num_added, self.M):
+                self.time_neuron_added.append((_ct - nb_, t))
+                if self.params.get('preprocess', 'p'):
+                    # N.B. OASISinstances are already updated within update_num_components
+                    self.estimates.C_on[_ct, t - mbs + 1: t +
+                              1] = self.estimates.OASISinstances[_ct - nb_].get_c(mbs)
+                else:
+                    self.estimates.C_on[_ct, t - mbs + 1: t + 1] = np.maximum(
+                        0, self.estimates.noisyC[_ct, t - mbs + 1: t + 1])
+                if self.params.get('online', 'simultaneously') and self.params.get('online', 'n_refit'):
+                    self.estimates.AtY_buf = np.concatenate((
+                        self.estimates.AtY_buf, [Ab_.data[Ab_.indptr[_ct]:Ab_.indptr[_ct + 1]].dot(
+                            self.estimates.Yr_buf.T[Ab_.indices[Ab_.indptr[_ct]:Ab_.indptr[_ct + 1]]])]))
+                # N.B. Ab_dense is already updated within update_num_components as side effect
+
+            # self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
+            # faster incremental update of AtA instead of above line:
+            AtA = self.estimates.AtA
+            self.estimates.AtA = np.zeros((self.M, self.M), dtype=np.float32)
+            self.estimates.AtA[:-num_added, :-num_added] = AtA
+            if self.params.get('online', 'use_dense'):
+                self.estimates.AtA[:, -num_added:] = self.estimates.Ab.T.dot(
+                    self.estimates.Ab_dense[:, self.M - num_added:self.M])
+            else:
+                self.estimates.AtA[:, -num_added:] = self.estimates.Ab.T.dot(
+                    self.estimates.Ab[:, -num_added:]).toarray()
+            self.estimates.AtA[-num_added:] = self.estimates.AtA[:, -num_added:].T
+            
+            if self.is1p:
+                # # update XXt and W: TODO only update necessary pixels not all!
+                # x = (y - self.Ab.dot(ccf).T - self.b0).T if ssub_B == 1
+                #         else (downscale((y.T - self.Ab.dot(ccf) - self.b0[:, None])
+                #                .reshape(self.dims2 + (-1,), order='F'), (ssub_B, ssub_B, 1))
+                #      .reshape((-1, len(y)), order='F'))
+
+                # for p in range(self.W.shape[0]):
+                #     index = self.get_indices_of_pixels_on_ring(p)
+                #     self.W.data[self.W.indptr[p]:self.W.indptr[p + 1]] = \
+                #         np.linalg.inv(self.XXt[index[:, None], index]).dot(self.XXt[index, p])
+
+                if ssub_B == 1:
+                    # self.estimates.AtW = Ab_.T.dot(self.estimates.W)
+                    # self.estimates.AtWA = self.estimates.AtW.dot(Ab_).toarray()
+                    # faster incremental update of AtW and AtWA instead of above lines:
+                    csr_append(self.estimates.AtW, Ab_.T[-num_added:].dot(self.estimates.W))
+                    AtWA = self.estimates.AtWA
+                    self.estimates.AtWA = np.zeros((self.M, self.M), dtype=np.float32)
+                    self.estimates.AtWA[:-num_added, :-num_added] = AtWA
+                    self.estimates.AtWA[:, -num_added:] = self.estimates.AtW.dot(
+                        Ab_[:, -num_added:]).toarray()
+                    self.estimates.AtWA[-num_added:] = self.estimates.AtW[-num_added:].dot(
+                        Ab_).toarray()
+                    self.estimates.Atb = self.estimates.AtW.dot(
+                        self.estimates.b0) - Ab_.T.dot(self.estimates.b0)
+                else:
+                    A_ds = self.estimates.downscale_matrix.dot(self.estimates.Ab)
+                    # self.estimates.AtW = A_ds.T.dot(self.estimates.W)
+                    # self.estimates.AtWA = self.estimates.AtW.dot(A_ds).toarray()
+                    # faster incremental update of AtW and AtWA instead of above lines:
+                    csr_append(self.estimates.AtW, A_ds.T[-num_added:].dot(self.estimates.W))
+                    AtWA = self.estimates.AtWA
+                    self.estimates.AtWA = np.zeros((self.M, self.M), dtype=np.float32)
+                    self.estimates.AtWA[:-num_added, :-num_added] = AtWA
+                    self.estimates.AtWA[:, -num_added:] = self.estimates.AtW.dot(
+                        A_ds[:, -num_added:]).toarray()
+                    self.estimates.AtWA[-num_added:] = self.estimates.AtW[-num_added:].dot(
+                        A_ds).toarray()
+                    self.estimates.Atb = ssub_B**2 * self.estimates.AtW.dot(
+                        self.estimates.downscale_matrix.dot(
+                            self.estimates.b0)) - Ab_.T.dot(self.estimates.b0)
+
+            # set the update counter to 0 for components that are overlaping the newly added
+            idx_overlap = self.estimates.AtA[nb_:-num_added, -num_added:].nonzero()[0]
+            self.update_counter[idx_overlap] = 0
+        return num_added
+
+    def _update_shapes(self, t):
+        """Bulk update of all (or the least updated) shapes from the sufficient
+        statistics after frame t
+        """
+        Ab_ = self.estimates.Ab
+        ssub_B = self.params.get('init', 'ssub_B') * self.params.get('init', 'ssub')
+        logging.info('Updating Shapes')
+
+        if self.N > self.params.get('online', 'max_comp_update_shape'):
+            indicator_components = np.where(self.update_counter <=
+                                            self.params.get('online', 'num_times_comp_updated'))[0]
+            # np.random.choice(self.N,10,False)
+            self.update_counter[indicator_components] += 1
+        else:
+            indicator_components = None
+
+        if self.params.get('online', 'use_dense'):
+            # update dense Ab and sparse Ab simultaneously;
+            # this is faster than calling update_shapes with sparse Ab only
+            Ab_, self.ind_A, self.estimates.Ab_dense[:, :self.M] = update_shapes(
+                self.estimates.CY, self.estimates.CC, self.estimates.Ab, self.ind_A,
+                indicator_components=indicator_components,
+                Ab_dense=self.estimates.Ab_dense[:, :self.M],
+                sn=self.estimates.sn, q=0.5, iters=self.params.get('online', 'iters_shape'))
+        else:
+            Ab_, self.ind_A, _ = update_shapes(
+                self.estimates.CY, self.estimates.CC, Ab_, self.ind_A,
+                indicator_components=indicator_components, sn=self.estimates.sn,
+                q=0.5, iters=self.params.get('online', 'iters_shape'))
+
+        self.estimates.AtA = (Ab_.T.dot(Ab_)).toarray()
+        if self.is1p and ((t + 1 - self.params.get('online', 'init_batch')) %
+            (self.params.get('online', 'W_update_factor') * self.params.get('online', 'update_freq')) == 0):
+            W = self.estimates.W
+            # for p in range(W.shape[0]):
+            #     # index = self.get_indices_of_pixels_on_ring(p)
+            #     index = W.indices[W.indptr[p]:W.indptr[p + 1]]
+            #     # for _ in range(3):  # update W via coordinate decent
+            #     #     for k, i in enumerate(index):
+            #     #         self.W.data[self.W.indptr[p] + k] += ((self.XXt[p, i] -
+            #     #                                      self.W.data[self.W.indptr[p]:self.W.indptr[p+1]].dot(self.XXt[index, i])) /
+            #     #                                     self.XXt[i, i])
+            #     # update W using normal equations
+            #     tmp = XXt[index[:, None], index]
+            #     tmp[np.diag_indices(len(tmp))] += np.trace(tmp) * 1e-5
+            #     W.data[W.indptr[p]:W.indptr[p + 1]] = np.linalg.inv(tmp).dot(XXt[index, p])
+            if self.params.get('online', 'full_XXt'):
+                XXt = self.estimates.XXt  # alias for considerably faster look up in large loop
+                def process_pixel(p):
+                    # index = W.indices[W.indptr[p]:W.indptr[p + 1]]
+                    index = self.W_ind[p]
+                    tmp = XXt[index[:, None], index]
+                    tmp[np.diag_indices(len(tmp))] += np.trace(tmp) * 1e-5
+                    return pd_solve(tmp, XXt[index, p])
+                if False:  # current_process().name == 'MainProcess':
+                    W.data = np.concatenate(parmap(process_pixel, range(W.shape[0])))
+                else:
+                    W.data = np.concatenate(list(map(process_pixel, range(W.shape[0]))))
+            else:
+                XXt_mats = self.XXt_mats
+                XXt_vecs = self.XXt_vecs
+#                        def process_pixel2(p):
+#                            #return np.linalg.solve(a[0], a[1])
+#                            return np.linalg.solve(XXt_mats[p], XXt_vecs[p])
+               # W.data = np.concatenate(list(map(process_pixel2, range(W.shape[0]))))
+                W.data = np.concatenate(parallel_map(self.dview, inv_mat_vec, zip(XXt_mats, XXt_vecs)))
+                   
+               #W.data = np.concatenate(parmap(process_pixel2, range(W.shape[0])))
+               #W.data = np.concatenate(parmap(process_pixel2, zip(XXt_mats, XXt_vecs)))
+            
+            if ssub_B == 1:
+                self.estimates.Atb = Ab_.T.dot(W.dot(self.estimates.b0) - self.estimates.b0)
+                self.estimates.AtW = Ab_.T.dot(W)
+                self.estimates.AtWA = self.estimates.AtW.dot(Ab_).toarray()
+            else:
+                d1, d2 = self.estimates.dims
+                A_ds = self.estimates.downscale_matrix.dot(self.estimates.Ab)
+                self.estimates.Atb = Ab_.T.dot(self.estimates.upscale_matrix.dot(W.dot(
+                    self.estimates.downscale_matrix.dot(self.estimates.b0))) - self.estimates.b0)
+                self.estimates.AtW = A_ds.T.dot(W)
+                self.estimates.AtWA = self.estimates.AtW.dot(A_ds).toarray()
+
+        ind_zero = list(np.where(self.estimates.AtA.diagonal() < 1e-10)[0])
+        if len(ind_zero) > 0:
+            ind_zero.sort()
+            ind_zero = ind_zero[::-1]
+            ind_keep = list(set(range(Ab_.shape[-1])) - set(ind_zero))
+            ind_keep.sort()
+
+            if self.params.get('online', 'use_dense'):
+                self.estimates.Ab_dense = np.delete(
+                    self.estimates.Ab_dense, ind_zero, axis=1)
+            self.estimates.AtA = np.delete(self.estimates.AtA, ind_zero, axis=0)
+            self.estimates.AtA = np.delete(self.estimates.AtA, ind_zero, axis=1)
+            self.estimates.CY = np.delete(self.estimates.CY, ind_zero, axis=0)
+            self.estimates.CC = np.delete(self.estimates.CC, ind_zero, axis=0)
+            self.estimates.CC = np.delete(self.estimates.CC, ind_zero, axis=1)
+            self.M -= len(ind_zero)
+            self.N -= len(ind_zero)
+            self.estimates.noisyC = np.delete(self.estimates.noisyC, ind_zero, axis=0)
+            for ii in ind_zero:
+                del self.estimates.OASISinstances[ii - self.params.get('init', 'nb')]
+                #del self.ind_A[ii-self.params.init['nb']]
+
+            self.estimates.C_on = np.delete(self.estimates.C_on, ind_zero, axis=0)
+            self.estimates.AtY_buf = np.delete(self.estimates.AtY_buf, ind_zero, axis=0)
+            #Ab_ = Ab_[:,ind_keep]
+            Ab_ = csc_matrix(Ab_[:, ind_keep])
+            #Ab_ = csc_matrix(self.estimates.Ab_dense[:,:self.M])
+            self.Ab_dense_copy = self.estimates.Ab_dense
+            self.Ab_copy = Ab_
+            self.estimates.Ab = Ab_
+            self.ind_A = list(
+                [(self.estimates.Ab.indices[self.estimates.Ab.indptr[ii]:self.estimates.Ab.indptr[ii + 1]]) for ii in range(self.params.get('init', 'nb'), self.M)])
+            self.estimates.groups = list(map(list, update_order(Ab_)[0]))
+
+        if self.params.get('online', 'n_refit'):
+            self.estimates.AtY_buf = Ab_.T.dot(self.estimates.Yr_buf.T)
+
     def initialize_online(self, model_LN=None, T=None):
         fls = self.params.get('data', 'fnames')
         opts = self.params.get_group('online')
@@ -1067,11 +1214,15 @@ class OnACID(object):
             raise Exception("Unsupported file extension")
 
 
-    def mc_next(self, t, frame):
+    def mc_next(self, t, frame, t_templ=None):
+        """Motion corrects frame t against the model of the frames before t_templ
+        (default t), i.e. the last fitted frame when frames are fit in blocks."""
+        if t_templ is None:
+            t_templ = t
         frame_ = frame.flatten(order='F')
         if self.is1p and self.estimates.W is not None:
             templ = self.estimates.Ab.dot(
-                np.median(self.estimates.C_on[:self.M, t-50:t], 1))            
+                np.median(self.estimates.C_on[:self.M, t_templ-50:t_templ], 1))
             if self.params.get('init','ssub_B') == 1:
                 B = self.estimates.W.dot(frame_ - templ - self.estimates.b0) + self.estimates.b0
             else:
@@ -1080,7 +1231,7 @@ class OnACID(object):
                 B += self.estimates.b0
             templ += B
         else:
-            templ = self.estimates.Ab.dot(self.estimates.C_on[:self.M, t-1])
+            templ = self.estimates.Ab.dot(self.estimates.C_on[:self.M, t_templ-1])
         templ = templ.reshape(self.params.get('data', 'dims'), order='F')
         if self.params.get('online', 'normalize'):
             templ *= self.img_norm
@@ -1181,10 +1332,15 @@ class OnACID(object):
         init_files = 1
         t = init_batch
         self.Ab_epoch:List = []
-        t_online = []
+        self.t_online = t_online = []
+        frame_budget = self.params.get('online', 'frame_budget')
         ssub_B = self.params.get('init', 'ssub_B') * self.params.get('init', 'ssub')
         d1, d2 = self.params.get('data', 'dims')
         max_shifts_online = self.params.get('online', 'max_shifts_online')
+        # frames are fit in blocks unless each frame's result is needed right away
+        batch_frames = 1 if (model_LN is not None or self.params.get('online', 'show_movie')) \
+            else self.params.get('online', 'batch_frames')
+        frames_batch = []
         if extra_files == 0:     # check whether there are any additional files
             process_files = fls[:init_files]     # end processing at this file
             init_batc_iter = [init_batch]         # place where to start
@@ -1254,7 +1410,9 @@ class OnACID(object):
                         # Motion Correction
                         t_mot = time()
                         if self.params.get('online', 'motion_correct'):    # motion correct
-                            frame_cor = self.mc_next(t, frame_)
+                            # the frames of a pending block are registered against the
+                            # template of the last fitted frame
+                            frame_cor = self.mc_next(t, frame_, t_templ=t - len(frames_batch))
                         else:
                             templ = None
                             frame_cor = frame_
@@ -1263,7 +1421,16 @@ class OnACID(object):
                         if self.params.get('online', 'normalize'):
                             frame_cor = frame_cor/self.img_norm
                         # Fit next frame
-                        self.fit_next(t, frame_cor.reshape(-1, order='F'))
+                        t_block = 0.
+                        if batch_frames > 1:
+                            frames_batch.append(frame_cor.reshape(-1, order='F'))
+                            if len(frames_batch) == batch_frames:
+                                t_block = time()
+                                self.fit_next_batch(t + 1 - batch_frames, frames_batch)
+                                t_block = time() - t_block
+                                frames_batch = []
+                        else:
+                            self.fit_next(t, frame_cor.reshape(-1, order='F'))
                         # Show
                         if self.params.get('online', 'show_movie'):
                             self.t = t
@@ -1279,8 +1446,18 @@ class OnACID(object):
                             if cv2.waitKey(1) & 0xFF == ord('q'):
                                 break
                         t += 1
-                        t_online.append(time() - t_frame_start)
+                        t_online.append(time() - t_frame_start - t_block)
+                        if batch_frames == 1:
+                            if frame_budget is not None and t_online[-1] > frame_budget:
+                                self.on_frame_over_budget(t - 1, t_online[-1])
+                        elif t_block:
+                            self._charge_block(t, batch_frames, t_block, frame_budget)
                     except  (StopIteration, RuntimeError):
+                        if frames_batch:  # fit the remaining frames of the file
+                            t_block = time()
+                            self.fit_next_batch(t - len(frames_batch), frames_batch)
+                            self._charge_block(t, len(frames_batch), time() - t_block, frame_budget)
+                            frames_batch = []
                         break
         
             self.Ab_epoch.append(self.estimates.Ab.copy())
@@ -1320,11 +1497,98 @@ class OnACID(object):
         if self.params.get('online', 'show_movie'):
             cv2.destroyAllWindows()
         self.t_online = t_online
+        self.estimates.timings = self.timings()
         self.estimates.C_on = self.estimates.C_on[:self.M]
         self.estimates.noisyC = self.estimates.noisyC[:self.M]
 
         return self
 
+    def _charge_block(self, t, num_frames, t_block, frame_budget):
+        """Shares the time t_block spent fitting the block of the num_frames
+        frames before t between their latencies, and checks them against the
+        frame budget
+        """
+        for i in range(len(self.t_online) - num_frames, len(self.t_online)):
+            self.t_online[i] += t_block / num_frames
+            if frame_budget is not None and self.t_online[i] > frame_budget:
+                self.on_frame_over_budget(t - len(self.t_online) + i, self.t_online[i])
+
+    def timings(self):
+        """Returns the latencies (in seconds) of each stage of the online
+        processing, one entry per call of fit_next (or per block for
+        fit_next_batch), and per frame for motion correction and in total.
+        The total latency of the frames of a block includes an equal share
+        of the fit of the block.
+
+        Returns:
+            timings: dict
+                stage name -> np.ndarray of latencies. The stages are 'motion',
+                'demix', 'deconvolve', 'detect', 'stats', 'shapes' and 'total'
+        """
+        stages = (('motion', 't_motion'), ('demix', 't_demix'), ('deconvolve', 't_deconv'),
+                  ('detect', 't_detect'), ('stats', 't_stat'), ('shapes', 't_shapes'),
+                  ('total', 't_online'))
+        return {stage: np.array(getattr(self, attr, []), dtype=float) for stage, attr in stages}
+
+    def timing_stats(self, bins=20):
+        """Summarizes the latencies of each stage of the online processing
+
+        Args:
+            bins: int or sequence
+                bins of the latency histograms (see np.histogram)
+
+        Returns:
+            stats: dict
+                stage name -> dict with the 'mean', 'p50', 'p99' and 'max'
+                latencies and the 'hist' tuple (counts, bin edges)
+        """
+        stats = {}
+        for stage, latencies in self.timings().items():
+            if len(latencies) == 0:
+                continue
+            stats[stage] = {'mean': latencies.mean(), 'p50': np.percentile(latencies, 50),
+                            'p99': np.percentile(latencies, 99), 'max': latencies.max(),
+                            'hist': np.histogram(latencies, bins=bins)}
+        return stats
+
+    def save_timings(self, fname):
+        """Saves the latencies of each stage of the online processing, as
+        columns of a CSV file if fname ends with .csv, otherwise as datasets
+        of an HDF5 file. Stages with fewer entries are padded with NaN in the
+        CSV file.
+
+        Args:
+            fname: str
+                name of the file
+        """
+        timings = self.timings()
+        if os.path.splitext(fname)[-1] == '.csv':
+            num_rows = max(len(latencies) for latencies in timings.values())
+            table = np.full((num_rows, len(timings)), np.nan)
+            for i, latencies in enumerate(timings.values()):
+                table[:len(latencies), i] = latencies
+            np.savetxt(fname, table, delimiter=',', header=','.join(timings), comments='')
+        else:
+            save_dict_to_hdf5(timings, fname)
+
+    def on_frame_over_budget(self, t, latency):
+        """Called by fit_online when the processing of frame t took longer
+        than params.online['frame_budget']. Logs a warning with the latencies
+        of the last call of each stage; override to react otherwise.
+
+        Args:
+            t: int
+                time of the frame
+
+            latency: float
+                processing time of the frame in seconds
+        """
+        last = {stage: latencies[-1] for stage, latencies in self.timings().items()
+                if len(latencies) and stage != 'total'}
+        logging.warning('Frame {} took {:.1f} ms (budget {:.1f} ms): '.format(
+            t, 1e3 * latency, 1e3 * self.params.get('online', 'frame_budget')) +
+            ', '.join('{} {:.1f} ms'.format(stage, 1e3 * tt) for stage, tt in last.items()))
+
     def create_frame(self, frame_cor, show_residuals=True, resize_fact=3, transpose=True):
         if show_residuals:
             caption = 'Corr*PSNR buffer' if self.params.get('online', 'use_corr_img') else 'Mean Residual Buffer'
@@ -2606,6 +2870,8 @@ def load_OnlineCNMF(filename, dview = None):
         elif key == 'estimates':
             estim = Estimates()
             for key_est, val_est in val.items():
+                if key_est == 'corr_stats' and isinstance(val_est, dict):
+                    val_est = summary_images.LocalCorrelations.from_state(val_est)
                 setattr(estim, key_est, val_est)
             new_obj.estimates = estim
         else:
@@ -371,6 +371,11 @@ class CNMFParams(object):
             num_blocks_per_run: int, default: 20
                 Parallelization of A'*Y operation
 
+            n_threads: int or None, default: None
+                Number of threads deconvolving the traces and updating the residuals in the calling process
+                (None: all the cpus). Traces that OASIS cannot deconvolve in batch are sent to dview when it runs
+                processes, and to the threads otherwise
+
             s_min: float or None, default: None
                 Minimum spike threshold amplitude (computed in the code if used).
 
@@ -418,6 +423,11 @@ class CNMFParams(object):
             N_samples_exceptionality: int, default: np.ceil(decay_time*fr),
                 Number of frames over which trace SNR is computed (usually length of a typical transient)
 
+            batch_frames: int, default: 1
+                Number of frames fit together with OnACID.fit_next_batch during
+                fit_online (1: fit frame by frame). With motion_correct, the frames
+                of a block are registered against the template of the last fitted frame
+
             batch_update_suff_stat: bool, default: False
                 Whether to update sufficient statistics in batch mode
 
@@ -433,6 +443,11 @@ class CNMFParams(object):
             expected_comps: int, default: 500
                 number of expected components (for memory allocation purposes)
 
+            frame_budget: float or None, default: None
+                maximal processing time per frame in seconds. Frames exceeding it are
+                reported by OnACID.on_frame_over_budget (None: no monitoring). The frames of
+                a block (see batch_frames) share its fitting time and are checked once it is fit
+
             full_XXt: bool, default: False
                 save the full residual sufficient statistic matrix for updating W in 1p.
                 If set to False, a list of submatrices is saved (typically faster).
@@ -766,6 +781,7 @@ class CNMFParams(object):
             'noise_method': 'mean',     # averaging method ('mean','median','logmexp')
             'noise_range': [.25, .5],   # range of normalized frequencies over which to average
             'num_blocks_per_run_temp': num_blocks_per_run_temp, # number of process to parallelize residual computation ** DECREASE IF MEMORY ISSUES
+            'n_threads': None,          # threads updating the components in this process (None: all the cpus)
             'p': p,                     # order of AR indicator dynamics
             's_min': s_min,             # minimum spike threshold
             'solvers': ['ECOS', 'SCS'],
@@ -794,11 +810,13 @@ class CNMFParams(object):
 
         self.online = {
             'N_samples_exceptionality': N_samples_exceptionality,  # timesteps to compute SNR
+            'batch_frames': 1,                 # number of frames fit together in fit_online
             'batch_update_suff_stat': batch_update_suff_stat,
             'dist_shape_update': False,        # update shapes in a distributed way
             'ds_factor': 1,                    # spatial downsampling for faster processing
             'epochs': 1,                       # number of epochs
             'expected_comps': expected_comps,  # number of expected components
+            'frame_budget': None,              # maximal processing time per frame (s)
             'full_XXt': False,                 # store entire XXt matrix (as opposed to a list of sub-matrices) 
             'init_batch': 200,                 # length of mini batch for initialization
             'init_method': 'bare',             # initialization method for first batch,
@@ -19,15 +19,23 @@
 
 import numpy as np
 import scipy
+import scipy.signal
 import shutil
 import tempfile
 import logging
 from builtins import map
 from builtins import range
+from ...executors import parallel_map
 from ...mmapping import load_memmap
 from past.builtins import basestring
 from past.utils import old_div
 
+try:
+    import scipy.fft as scipy_fft
+    HAS_SCIPY_FFT = True
+except ImportError:     # scipy < 1.4
+    HAS_SCIPY_FFT = False
+
 #%%
 
 
@@ -138,6 +146,148 @@ def get_noise_welch(Y, noise_range=[0.25, 0.5], noise_method='logmexp',
     return sn
 
 
+def get_noise_welch_stream(frames, noise_range=[0.25, 0.5], noise_method='logmexp', nperseg=256,
+                           chunk_size=None, var_name_hdf5='mov', max_bytes=2**28):
+    """Estimate the noise level for each pixel from a single sequential read of the movie.
+
+    The Welch periodograms (Hann windows of nperseg frames overlapping by half, as
+    scipy.signal.welch) are accumulated chunk by chunk, so the movie never needs to be
+    in memory nor readable pixel by pixel. The result is get_noise_welch on the whole movie,
+    without max_num_samples_fft, computed in single precision.
+
+    Besides the periodograms, the memory holds the frames of one segment and one chunk: the
+    frames are kept in their dtype (float32 for double precision input).
+
+    Args:
+        frames: iterable or string
+            frames of the movie in temporal order (e.g. caiman.base.movies.load_iter or a
+            T x d1 x d2 array), or the name of a file to read with load_iter
+
+        noise_range: np.ndarray [2 x 1] between 0 and 0.5
+            Range of frequencies compared to Nyquist rate over which the power spectrum is averaged
+            default: [0.25,0.5]
+
+        noise method: string
+            method of averaging the noise.
+            Choices:
+                'mean': Mean
+                'median': Median
+                'logmexp': Exponential of the mean of the logarithm of PSD (default)
+
+        nperseg: int
+            length of the segments of the periodograms
+
+        chunk_size: int
+            number of frames processed at once, by default as many as fit in max_bytes
+
+        var_name_hdf5: str
+            if reading from hdf5 name of the variable to load
+
+        max_bytes: int
+            memory budget of the chunks of frames and of the Fourier transforms
+
+    Returns:
+        sn: np.ndarray
+            Noise level for each pixel, with the shape of the frames
+    """
+    if isinstance(frames, basestring):
+        from ...base.movies import load_iter
+        frames = load_iter(frames, var_name_hdf5=var_name_hdf5)
+    step = nperseg - nperseg // 2
+
+    def chunks():
+        chunk, size = [], chunk_size
+        for frame in frames:
+            frame = np.asarray(frame)
+            if frame.dtype.itemsize > 4 or frame.dtype.kind not in 'uif':
+                frame = frame.astype(np.float32)
+            if size is None:
+                size = max(max_bytes // max(frame.nbytes, 1), 1)
+            chunk.append(frame)
+            if len(chunk) == size:
+                yield np.array(chunk)
+                chunk = []
+        if chunk:
+            yield np.array(chunk)
+
+    buffer = None   # frames not processed yet, starting with the next segment
+    Pxx = 0
+    n_segments = 0
+    for chunk in chunks():
+        shape = chunk.shape[1:]
+        chunk = chunk.reshape(len(chunk), -1)
+        buffer = chunk if buffer is None else np.concatenate((buffer, chunk))
+        starts = np.arange(0, len(buffer) - nperseg + 1, step)
+        if len(starts):
+            Pxx = Pxx + welch_psd(buffer, starts, nperseg, noise_range, max_bytes=max_bytes)
+            n_segments += len(starts)
+            buffer = buffer[starts[-1] + step:]
+
+    if buffer is None:
+        raise Exception('The movie has no frames')
+    if n_segments == 0:
+        # shorter than one segment, as scipy.signal.welch
+        ff, Pxx = scipy.signal.welch(buffer.astype(np.float32), axis=0)
+        Pxx = Pxx[(ff >= noise_range[0]) & (ff <= noise_range[1])]
+    else:
+        Pxx = Pxx / n_segments
+    sn = {
+        'mean': lambda Pxx: np.sqrt(np.mean(Pxx, 0) / 2),
+        'median': lambda Pxx: np.sqrt(np.median(Pxx, 0) / 2),
+        'logmexp': lambda Pxx: np.sqrt(np.exp(np.mean(np.log(Pxx / 2), 0)))
+    }[noise_method](Pxx)
+    return sn.reshape(shape)
+
+
+def welch_psd(Y, starts, nperseg=256, noise_range=[0.25, 0.5], max_bytes=2**28):
+    """Sum of the periodograms of the segments Y[start:start + nperseg] over the frequencies of noise_range
+
+    The segments are detrended and windowed, and the periodograms scaled, as by
+    scipy.signal.welch: dividing the sum by the number of segments gives its estimate when
+    starts are the multiples of nperseg - nperseg // 2. Single precision (and integer) movies
+    are transformed in single precision, in blocks of pixels that fit in max_bytes.
+
+    Args:
+        Y: np.ndarray
+            movie with time in the first axis (T x n_pixels)
+
+        starts: list
+            first frames of the segments
+
+        nperseg: int
+            length of the segments
+
+        noise_range: np.ndarray [2 x 1] between 0 and 0.5
+            Range of frequencies compared to Nyquist rate
+
+        max_bytes: int
+            memory budget of the windowed segments and of their Fourier transforms
+
+    Returns:
+        Pxx: np.ndarray
+            sum of the power spectral densities (n_frequencies x n_pixels)
+    """
+    dtype = np.float64 if Y.dtype == np.float64 else np.float32
+    window = scipy.signal.get_window('hann', nperseg).astype(dtype)
+    ff = np.fft.rfftfreq(nperseg)
+    ind = (ff >= noise_range[0]) & (ff <= noise_range[1])
+    # one sided power spectral density, as scipy.signal.welch(scaling='density')
+    scale = (np.where((ff > 0) & (ff < .5), 2., 1.)[ind] / (window ** 2).sum()).astype(dtype)
+    rfft = scipy_fft.rfft if HAS_SCIPY_FFT else np.fft.rfft
+    shape = Y.shape[1:]
+    Y = Y.reshape(len(Y), -1)
+    # segment, its transform and its power per pixel
+    block = max(int(max_bytes // (nperseg * 4 * np.dtype(dtype).itemsize)), 1)
+    Pxx = np.zeros((ind.sum(), Y.shape[1]), dtype=dtype)
+    for first in range(0, Y.shape[1], block):
+        pixels = slice(first, first + block)
+        for start in starts:
+            segment = np.asarray(Y[start:start + nperseg, pixels], dtype=dtype)
+            segment = (segment - segment.mean(0)) * window[:, None]
+            Pxx[:, pixels] += np.abs(rfft(segment, axis=0)[ind]) ** 2
+    return (Pxx * scale[:, None]).reshape(Pxx.shape[:1] + shape)
+
+
 def get_noise_fft(Y, noise_range=[0.25, 0.5], noise_method='logmexp', max_num_samples_fft=3072,
                   opencv=True):
     """Estimate the noise level for each pixel by averaging the power spectral density.
@@ -250,23 +400,7 @@ def get_noise_fft_parallel(Y, n_pixels_per_process=100, dview=None, **kwargs):
         argsin.append(
             (Y_name, Y.shape[0] - pixels_remaining, pixels_remaining, kwargs))
 
-    if dview is None:
-        print('Single Thread')
-        results = list(map(fft_psd_multithreading, argsin))
-
-    else:
-        if 'multiprocessing' in str(type(dview)):
-            results = dview.map_async(
-                fft_psd_multithreading, argsin).get(4294967)
-        else:
-            ne = len(dview)
-            print(('Running on %d engines.' % (ne)))
-            if dview.client.profile == 'default':
-                results = dview.map_sync(fft_psd_multithreading, argsin)
-
-            else:
-                print(('PROFILE:' + dview.client.profile))
-                results = dview.map_sync(fft_psd_multithreading, argsin)
+    results = parallel_map(dview, fft_psd_multithreading, argsin)
 
     _, _, psx_ = results[0]
     sn_s = np.zeros(Y.shape[0])
@@ -497,8 +631,13 @@ def preprocess_data(Y, sn=None, dview=None, n_pixels_per_process=100,
     Performs the pre-processing operations described above.
 
     Args:
-        Y: ndarray
-            input movie (n_pixels x Time). Can be also memory mapped file.
+        Y: ndarray or string
+            input movie (n_pixels x Time). Can be also memory mapped file, or the name of a
+            file only readable in frame order (tif, hdf5, ... see movies.load_iter): the noise is
+            then estimated by get_noise_welch_stream in a single read of the file, the pixels
+            in Fortran order as in memory mapped files. The file name is returned as Y: missing
+            data cannot be interpolated in the file, so with check_nan an exception is raised
+            when the noise of some pixels is NaN.
 
         n_processes: [optional] int
             number of processes/threads to use concurrently
@@ -537,6 +676,17 @@ def preprocess_data(Y, sn=None, dview=None, n_pixels_per_process=100,
             file where to store the results of computation.
     """
 
+    if isinstance(Y, basestring):
+        if compute_g:
+            raise Exception('compute_g requires the movie in memory or memory mapped')
+        if sn is None:
+            sn = get_noise_welch_stream(Y, noise_range=noise_range,
+                                        noise_method=noise_method).flatten(order='F')
+        if check_nan and np.isnan(sn).any():
+            raise Exception('{} pixels of {} have missing data (NaN): interpolating them requires the '
+                            'movie in memory or memory mapped'.format(np.isnan(sn).sum(), Y))
+        return Y, sn, None, None
+
     if check_nan:
         Y, coor = interpolate_missing_data(Y)
 
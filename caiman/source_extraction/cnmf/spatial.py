@@ -27,14 +27,15 @@ from scipy.ndimage import label, binary_dilation
 from scipy.ndimage.filters import median_filter
 from scipy.ndimage.morphology import binary_closing
 from scipy.ndimage.morphology import generate_binary_structure, iterate_structure
-import shutil
 from sklearn.decomposition import NMF
 import tempfile
 import time
 import psutil
 from typing import List
 
-from ...mmapping import load_memmap, parallel_dot_product
+from ...executors import parallel_map
+from ...shared_arrays import SharedArrays, attach
+from ...mmapping import load_memmap, product_cache
 from ...utils.stats import csc_column_remove
 
 
@@ -212,32 +213,38 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
     if b_in is None:
         b_in = b_
 
-    logging.info('Memory mapping')
-    # we create a memory map file if not already the case, we send Cf, a
-    # matrix that include background components
-    C_name, Y_name, folder = creatememmap(Y, np.vstack((C, f)), dview)
-
-    # we create a pixel group array (chunks for the cnmf)for the parallelization of the process
-    logging.info('Updating Spatial Components using lasso lars')
-    cct = np.diag(C.dot(C.T))
-    pixel_groups = []
-    for i in range(0, np.prod(dims) - n_pixels_per_process + 1, n_pixels_per_process):
-        pixel_groups.append([Y_name, C_name, sn, ind2_[i:i + n_pixels_per_process], list(
-            range(i, i + n_pixels_per_process)), method_ls, cct, ])
-    if i + n_pixels_per_process < np.prod(dims):
-        pixel_groups.append([Y_name, C_name, sn, ind2_[(i + n_pixels_per_process):np.prod(dims)], list(
-            range(i + n_pixels_per_process, np.prod(dims))), method_ls, cct])
-    #A_ = scipy.sparse.lil_matrix((d, nr + np.size(f, 0)))
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            parallel_result = dview.map_async(
-                regression_ipyparallel, pixel_groups).get(4294967)
+    logging.info('Sharing data with the workers')
+    # Cf, a matrix that include background components, is published once for all the
+    # workers; the movie is passed by file name if memory mapped
+    with SharedArrays(dview) as shared:
+        Cf = np.vstack((C, f))
+        C_name = shared.publish(Cf)
+        if isinstance(Y, np.memmap) and shared.mode != 'memory':
+            Y_name = Y.filename
         else:
-            parallel_result = dview.map_sync(
-                regression_ipyparallel, pixel_groups)
-            dview.results.clear()
-    else:
-        parallel_result = list(map(regression_ipyparallel, pixel_groups))
+            Y_name = shared.publish(Y)
+
+        # the products of the (centered) components are computed once, in double precision, the
+        # workers compute the products of their pixels with the components and solve the
+        # regressions from them
+        Cf_mean = Cf.mean(1, dtype=np.float64)
+        Cf_centered = Cf - Cf_mean[:, None]
+        CCt = Cf_centered.dot(Cf_centered.T)
+        CCt_name = shared.publish(CCt)
+        del Cf_centered
+
+        # we create a pixel group array (chunks for the cnmf)for the parallelization of the process
+        logging.info('Updating Spatial Components using lasso lars')
+        cct = (np.diag(CCt) + Cf.shape[1] * Cf_mean ** 2)[:len(C)]
+        pixel_groups = []
+        for i in range(0, np.prod(dims) - n_pixels_per_process + 1, n_pixels_per_process):
+            pixel_groups.append([Y_name, C_name, sn, ind2_[i:i + n_pixels_per_process], list(
+                range(i, i + n_pixels_per_process)), method_ls, cct, CCt_name])
+        if i + n_pixels_per_process < np.prod(dims):
+            pixel_groups.append([Y_name, C_name, sn, ind2_[(i + n_pixels_per_process):np.prod(dims)], list(
+                range(i + n_pixels_per_process, np.prod(dims))), method_ls, cct, CCt_name])
+        #A_ = scipy.sparse.lil_matrix((d, nr + np.size(f, 0)))
+        parallel_result = parallel_map(dview, regression_ipyparallel, pixel_groups)
     data:List = []
     rows:List = []
     cols:List = []
@@ -278,7 +285,8 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
         if 'memmap' in str(type(Y)):
             bl_siz1 = Y.shape[0] // (num_blocks_per_run_spat - 1)
             bl_siz2 = psutil.virtual_memory().available // (4*Y.shape[-1]*(num_blocks_per_run_spat + 1))
-            Y_resf = parallel_dot_product(Y, f.T, dview=dview, block_size=min(bl_siz1, bl_siz2), num_blocks_per_run=num_blocks_per_run_spat) - \
+            Y_resf = product_cache.dot_product(Y, f.T, dview=dview, block_size=min(bl_siz1, bl_siz2),
+                                               num_blocks_per_run=num_blocks_per_run_spat) - \
                 A_.dot(C[:nr].dot(f.T))
         else:
             # Y*f' - A*(C*f')
@@ -303,12 +311,6 @@ def update_spatial_components(Y, C=None, f=None, A_in=None, sn=None, dims=None,
     # print(("--- %s seconds ---" % (time.time() - start_time)))
     logging.info('Updating done in ' + 
                  '{0}s'.format(str(time.time() - start_time).split(".")[0]))
-    try:  # clean up
-        # remove temporary file created
-        logging.info("Removing created tempfiles")
-        shutil.rmtree(folder)
-    except:
-        raise Exception("Failed to delete: " + folder)
 
     return csc_matrix(A_), b, C, f
 
@@ -336,6 +338,11 @@ def regression_ipyparallel(pars):
 
        for each pixel the search is limited to a few spatial components
 
+       The regressions only depend on the products of the pixels and centered components over
+       time (Y(i,:)*(C - mean(C))', the covariance of C and the means), which are computed for
+       the whole group of pixels with one matrix product. Each problem is then solved in the
+       space of its components, so that its cost does not grow with the number of frames.
+
        Args:
            C_name: string
                 memmap C
@@ -354,6 +361,9 @@ def regression_ipyparallel(pars):
                     'nnls_L0'. Nonnegative least square with L0 penalty
                     'lasso_lars' lasso lars function from scikit learn
 
+           CCt_name:
+               (C - mean(C))*(C - mean(C))', published by update_spatial_components (computed if None)
+
        Returns:
            px: np.ndarray
                 positions o the regression
@@ -373,23 +383,38 @@ def regression_ipyparallel(pars):
     import gc
     from sklearn import linear_model
 
-    Y_name, C_name, noise_sn, idxs_C, idxs_Y, method_least_square, cct = pars
+    Y_name, C_name, noise_sn, idxs_C, idxs_Y, method_least_square, cct = pars[:7]
+    CCt_name = pars[7] if len(pars) > 7 else None
     # we load from the memmap file
-    if isinstance(Y_name, basestring):
+    if isinstance(Y_name, basestring) and Y_name.endswith('.mmap'):
         Y, _, _ = load_memmap(Y_name)
         Y = np.array(Y[idxs_Y, :])
     else:
-        Y = Y_name[idxs_Y, :]
-    if isinstance(C_name, basestring):
-        C = np.load(C_name, mmap_mode='r')
-        C = np.array(C)
-    else:
-        C = C_name
+        Y = np.asarray(attach(Y_name)[idxs_Y, :])
+    # published by SharedArrays (see update_spatial_components) or saved by creatememmap
+    C = attach(C_name)
 
     _, T = np.shape(C)  # initialize values
+
+    # sufficient statistics of the regressions of the pixels, on the components they can use
+    used = np.unique(np.concatenate([np.asarray(idx, dtype=int) for idx in idxs_C] + [np.zeros(0, dtype=int)]))
+    position = np.zeros(C.shape[0], dtype=int)
+    position[used] = np.arange(len(used))
+    # centered products, the products of the traces are obtained by adding the means back, which
+    # does not lose precision like centering the products would
+    C_used = np.asarray(C[used], dtype=np.float64)
+    C_mean = C_used.mean(1)
+    C_used -= C_mean[:, None]
+    YCt = Y.dot(C_used.T)
+    if CCt_name is None:
+        CCt = C_used.dot(C_used.T)
+    else:
+        CCt = attach(CCt_name)[np.ix_(used, used)]
+    Y_mean = Y.mean(1, dtype=np.float64)
+    YYt = (Y.astype(np.float64) ** 2).sum(1)
+
     As = []
-    for y, px, idx_px_from_0 in zip(Y, idxs_Y, range(len(idxs_C))):
-        c = C[idxs_C[idx_px_from_0], :]
+    for px, idx_px_from_0 in zip(idxs_Y, range(len(idxs_C))):
         idx_only_neurons = idxs_C[idx_px_from_0]
         if len(idx_only_neurons) > 0:
             cct_ = cct[idx_only_neurons[idx_only_neurons < len(cct)]]
@@ -397,24 +422,30 @@ def regression_ipyparallel(pars):
             cct_ = []
 
         # skip if no components OR pixel has 0 activity
-        if np.size(c) > 0 and noise_sn[px] > 0:
+        if len(idx_only_neurons) > 0 and noise_sn[px] > 0:
+            loc = position[np.asarray(idx_only_neurons, dtype=int)]
+            Cov = CCt[np.ix_(loc, loc)]
+            Xy = YCt[idx_px_from_0, loc]
+            c_mean = C_mean[loc]
             sn = noise_sn[px] ** 2 * T
             if method_least_square == 'lasso_lars_old':
                 raise Exception("Obsolete parameter") # Old code, support was removed
 
             elif method_least_square == 'nnls_L0':  # Nonnegative least square with L0 penalty
-                a = nnls_L0(c.T, y, 1.2 * sn)
+                a = nnls_L0_gram(Cov + T * np.outer(c_mean, c_mean), Xy + T * c_mean * Y_mean[idx_px_from_0],
+                                 YYt[idx_px_from_0], 1.2 * sn)
 
             elif method_least_square == 'lasso_lars':  # lasso lars function from scikit learn
                 lambda_lasso = 0 if np.size(cct_) == 0 else \
                     .5 * noise_sn[px] * np.sqrt(np.max(cct_)) / T
-                clf = linear_model.LassoLars(alpha=lambda_lasso, positive=True,
-                                             fit_intercept=True)
-#                clf = linear_model.Lasso(alpha=lambda_lasso, positive=True,
-#                                         fit_intercept=True, normalize=True,
-#                                         selection='random')
-                a_lrs = clf.fit(np.array(c.T), np.ravel(y))
-                a = a_lrs.coef_
+                # same as LassoLars(alpha=lambda_lasso, positive=True, fit_intercept=True,
+                # normalize=True): centered components scaled to unit norm
+                scale = np.sqrt(np.diag(Cov))
+                scale[scale == 0] = 1
+                _, _, coef_path = linear_model.lars_path_gram(
+                    Xy / scale, Cov / np.outer(scale, scale),
+                    n_samples=T, alpha_min=lambda_lasso, method='lasso', positive=True)
+                a = coef_path[:, -1] / scale
 
             else:
                 raise Exception(
@@ -517,14 +548,7 @@ def threshold_components(A, dims, medw=None, thr_method='max', maxthr=0.1, nrgth
         pars.append([A_1[:, i], i, dims,
                      medw, d, thr_method, se, ss, maxthr, nrgthr, extract_cc])
 
-    if dview is not None:
-        if 'multiprocessing' in str(type(dview)):
-            res = dview.map_async(
-                threshold_components_parallel, pars).get(4294967)
-        else:
-            res = dview.map_async(threshold_components_parallel, pars)
-    else:
-        res = list(map(threshold_components_parallel, pars))
+    res = parallel_map(dview, threshold_components_parallel, pars)
 
     res.sort(key=lambda x: x[1])
     indices:List = []
@@ -672,6 +696,41 @@ def nnls_L0(X, Yp, noise):
         else:
             W_lam[eliminate[np.argmin(np.array(eliminate)[:, 1])][0]] = 0
 
+def nnls_L0_gram(Gram, Xy, yy, noise):
+    """
+    Nonnegative least square with L0 penalty, from the sufficient statistics of the regression
+
+    Same as nnls_L0(X, Yp, noise) given Gram = X'X, Xy = X'Yp and yy = Yp'Yp: the residual
+    of the regression is the one of a square problem plus a constant, so the problem is solved
+    with as many equations as regressors.
+
+    Args:
+        Gram: np.array
+            products of the regressors
+
+        Xy: np.array
+            products of the regressors with the regressand
+
+        yy: float
+            squared norm of the regressand
+
+        noise: float
+            bound of the squared residual
+
+    Returns:
+        W_lam: np.array
+            the learned weights
+    """
+    # X = U S V' and ||Yp - X W||^2 = ||S V' W - U' Yp||^2 + yy - ||U' Yp||^2
+    eigvals, V = np.linalg.eigh(Gram)
+    keep = eigvals > eigvals.max(initial=0) * len(eigvals) * np.finfo(np.float64).eps
+    if not np.any(keep):
+        return np.zeros(len(Xy))
+    S = np.sqrt(eigvals[keep])
+    X = S[:, None] * V[:, keep].T
+    Yp = V[:, keep].T.dot(Xy) / S
+    return nnls_L0(X, Yp, noise - max(yy - Yp.dot(Yp), 0))
+
 #####
 # auxiliary functions
 
@@ -897,14 +956,7 @@ def determine_search_location(A, dims, method='ellipse', min_size=3, max_size=8,
             for i in range(nr):
                 pars.append([Coor, cm[i], A[:, i], Vr, dims,
                              dist, max_size, min_size, d])
-            if dview is None:
-                res = list(map(construct_ellipse_parallel, pars))
-            else:
-                if 'multiprocessing' in str(type(dview)):
-                    res = dview.map_async(
-                        construct_ellipse_parallel, pars).get(4294967)
-                else:
-                    res = dview.map_sync(construct_ellipse_parallel, pars)
+            res = parallel_map(dview, construct_ellipse_parallel, pars)
             for r in res:
                 dist_indicator.append(r)
 
@@ -942,13 +994,7 @@ def determine_search_location(A, dims, method='ellipse', min_size=3, max_size=8,
             for i in range(nr):
                 pars.append([A[:, i], dims, expandCore, d])
 
-            if 'multiprocessing' in str(type(dview)):
-                parallel_result = dview.map_async(
-                    construct_dilate_parallel, pars).get(4294967)
-            else:
-                parallel_result = dview.map_sync(
-                    construct_dilate_parallel, pars)
-                dview.results.clear()
+            parallel_result = parallel_map(dview, construct_dilate_parallel, pars)
 
             i = 0
             for res in parallel_result:
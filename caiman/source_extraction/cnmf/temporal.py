@@ -8,16 +8,19 @@ components and temporal components
 from builtins import str
 from builtins import map
 from builtins import range
+import concurrent.futures
 import logging
+import os
 from scipy.sparse import spdiags, diags, coo_matrix, csc_matrix  # ,csgraph
 import scipy
 import numpy as np
 import platform
 import psutil
-from .deconvolution import constrained_foopsi
+from .deconvolution import constrained_foopsi, constrained_foopsi_batch, oasis_batch_supported
 from .utilities import update_order_greedy
 import sys
-from ...mmapping import parallel_dot_product
+from ...executors import FuturesExecutor, IPyParallelExecutor, SerialExecutor, as_executor
+from ...mmapping import product_cache
 
 def make_G_matrix(T, g):
     """
@@ -64,6 +67,57 @@ def constrained_foopsi_parallel(arg_in):
 
     return C_, Sp_, Ytemp_, cb_, c1_, sn_, gn_, jj_, lam_
 
+def deconvolve_traces(Ytemp, dview=None, bl=None, c1=None, g=None, sn=None, **argss):
+    """ Deconvolves several fluorescence traces, the rows of Ytemp
+
+    When OASIS supports it (see oasis_batch_supported) all the traces are deconvolved at once by
+    constrained_foopsi_batch, in threads of this process. Otherwise every trace is a task of
+    dview running constrained_foopsi_parallel.
+
+    Args:
+        Ytemp: np.ndarray
+            fluorescence traces (K x T)
+
+        dview:
+            executor for the traces that cannot be deconvolved in batch
+
+        bl, c1, g, sn: [optional] list
+            parameters of each trace, estimated if None
+
+        argss: dict
+            all the other parameters passed to constrained_foopsi
+
+    Returns:
+        C, S: np.ndarray
+            denoised and deconvolved traces (K x T)
+
+        YrA: np.ndarray
+            residuals Ytemp - C
+
+        bl, c1, sn, g, lam: list
+            parameters of each trace
+    """
+    K = len(Ytemp)
+    if oasis_batch_supported(**argss):
+        cc, cb, c1, gn, sn, sp, lam = constrained_foopsi_batch(
+            Ytemp, bl=None if bl is None or any(b_ is None for b_ in bl) else bl,
+            c1=None, g=None if g is None or any(g_ is None for g_ in g) else list(g),
+            sn=None if sn is None or any(s_ is None for s_ in sn) else sn, **argss)
+        # add back the initial calcium, decaying with the largest root of the AR process
+        gd = np.array([np.max(np.real(np.roots(np.hstack((1, -g_))))) for g_ in gn])
+        C = cc + cb[:, None] + c1[:, None] * gd[:, None] ** np.arange(np.shape(Ytemp)[1])
+        return C, sp, Ytemp - C, list(cb), list(c1), list(sn), list(gn), list(lam)
+
+    none = np.repeat(None, K)
+    args_in = [(Ytemp[jj], None, jj, (none if bl is None else bl)[jj], (none if c1 is None else c1)[jj],
+                (none if g is None else g)[jj], (none if sn is None else sn)[jj], argss) for jj in range(K)]
+    results = as_executor(dview).map(constrained_foopsi_parallel, args_in)
+    C, S, YrA, bl, c1, sn, g, jj, lam = zip(*results)
+    order = np.argsort(jj)
+    return (np.stack([C[i] for i in order]), np.stack([S[i] for i in order]),
+            np.stack([YrA[i] for i in order]), [bl[i] for i in order], [c1[i] for i in order],
+            [sn[i] for i in order], [g[i] for i in order], [lam[i] for i in order])
+
 def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=None, nb=1, ITER=2, block_size_temp=5000, num_blocks_per_run_temp=20, debug=False, dview=None, **kwargs):
     """Update temporal components and background given spatial components using a block coordinate descent approach.
 
@@ -204,8 +258,9 @@ def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=N
         bl_siz1 = d // (np.maximum(num_blocks_per_run_temp - 1, 1))
         bl_siz2 = int(psutil.virtual_memory().available/(num_blocks_per_run_temp + 1) - 4*A.nnz) // int(4*T)
         # block_size_temp
-        YA = parallel_dot_product(Y, A.tocsr(), dview=dview, block_size=min(bl_siz1, bl_siz2),
-                                  transpose=True, num_blocks_per_run=num_blocks_per_run_temp) * diags(1. / nA);
+        # reused by later updates and residual computations, as long as A does not change
+        YA = product_cache.dot_product(Y, A, dview=dview, block_size=min(bl_siz1, bl_siz2), transpose=True,
+                                       num_blocks_per_run=num_blocks_per_run_temp) * diags(1. / nA)
     else:
         YA = (A.T.dot(Y).T) * diags(1. / nA)
     AA = ((A.T.dot(A)) * diags(1. / nA)).tocsr()
@@ -213,8 +268,11 @@ def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=N
     # creating the patch of components to be computed in parallel
     parrllcomp, len_parrllcomp = update_order_greedy(AA[:nr, :][:, :nr])
     logging.info("entering the deconvolution ")
-    C, S, bl, YrA, c1, sn, g, lam = update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
-                                                     ITER, YrA, c1, sn, g, Cin, T, nA, dview, debug, AA, kwargs)
+    # one pool of threads, sharing YrA and C, for all the iterations
+    with concurrent.futures.ThreadPoolExecutor(kwargs.get('n_threads') or os.cpu_count() or 1) as threads:
+        C, S, bl, YrA, c1, sn, g, lam = update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
+                                                         ITER, YrA, c1, sn, g, Cin, T, nA, dview, debug, AA, kwargs,
+                                                         threads=threads)
     ff = np.where(np.sum(C, axis=1) == 0)  # remove empty components
     if np.size(ff) > 0:  # Eliminating empty temporal components
         ff = ff[0]
@@ -245,7 +303,7 @@ def update_temporal_components(Y, A, b, Cin, fin, bl=None, c1=None, g=None, sn=N
 
 
 def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
-                     ITER, YrA, c1, sn, g, Cin, T, nA, dview, debug, AA, kwargs):
+                     ITER, YrA, c1, sn, g, Cin, T, nA, dview, debug, AA, kwargs, threads=None):
     """Update temporal components and background given spatial components using a block coordinate descent approach.
 
     Args:
@@ -305,6 +363,9 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
             primary and secondary (if problem unfeasible for approx solution)
             solvers to be used with cvxpy, default is ['ECOS','SCS']
 
+        threads: [optional] concurrent.futures.ThreadPoolExecutor
+            pool updating blocks of frames of YrA, and deconvolving the traces when dview runs no processes
+
     Note:
         The temporal components are updated in parallel by default by forming of sequence of vertex covers.
 
@@ -333,51 +394,47 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
 """
 
     lam = np.repeat(None, nr)
+    executor = as_executor(dview)
+    if isinstance(executor, IPyParallelExecutor) and platform.system() == 'Darwin':
+        executor = as_executor(None)
+    # the groups are updated by threads that share YrA and C: without worker processes the
+    # traces are deconvolved by the threads, and every thread subtracts the changes of the
+    # group from its own block of frames of YrA
+    if threads is None:
+        threads = SerialExecutor()
+    elif isinstance(executor, SerialExecutor):
+        executor = FuturesExecutor(threads)
+    n_threads = kwargs.get('n_threads') or os.cpu_count() or 1
+    frame_blocks = [slice(rows[0], rows[-1] + 1)
+                    for rows in np.array_split(np.arange(YrA.shape[0]), n_threads) if len(rows)]
+
+    def update_residuals(jo, dC):
+        # YrA -= AA[jo, :].T.dot(dC).T
+        AA_jo = AA[jo].T.tocsr()
+
+        def update_block(rows):
+            YrA[rows] -= AA_jo.dot(dC[:, rows]).T
+        list(threads.map(update_block, frame_blocks))
+
     for _ in range(ITER):
 
         for count, jo_ in enumerate(parrllcomp):
             # INITIALIZE THE PARAMS
             jo = np.array(list(jo_))
-            Ytemp = YrA[:, jo.flatten()] + Cin[jo, :].T
-            Ctemp = np.zeros((np.size(jo), T))
-            Stemp = np.zeros((np.size(jo), T))
-            nT = nA[jo]
-            args_in = [(np.squeeze(np.array(Ytemp[:, jj])), nT[jj], jj, None,
-                        None, None, None, kwargs) for jj in range(len(jo))]
+            Ytemp = np.array(YrA[:, jo.flatten()] + Cin[jo, :].T).T
             # computing the most likely discretized spike train underlying a fluorescence trace
-            if 'multiprocessing' in str(type(dview)):
-                results = dview.map_async(
-                    constrained_foopsi_parallel, args_in).get(4294967)
-
-            elif dview is not None and platform.system() != 'Darwin':
-                if debug:
-                    results = dview.map_async(
-                        constrained_foopsi_parallel, args_in)
-                    results.get()
-                    for outp in results.stdout:
-                        print((outp[:-1]))
-                        sys.stdout.flush()
-                    for outp in results.stderr:
-                        print((outp[:-1]))
-                        sys.stderr.flush()
-                else:
-                    results = dview.map_sync(
-                        constrained_foopsi_parallel, args_in)
-
-            else:
-                results = list(map(constrained_foopsi_parallel, args_in))
-            # unparsing and updating the result
-            for chunk in results:
-                C_, Sp_, Ytemp_, cb_, c1_, sn_, gn_, jj_, lam_ = chunk
-                Ctemp[jj_, :] = C_[None, :]
-                Stemp[jj_, :] = Sp_[None, :]
-                bl[jo[jj_]] = cb_
-                c1[jo[jj_]] = c1_
-                sn[jo[jj_]] = sn_
-                g[jo[jj_]] = gn_.T if kwargs['p'] > 0 else []
-                lam[jo[jj_]] = lam_
-
-            YrA -= AA[jo, :].T.dot(Ctemp - C[jo, :]).T
+            Ctemp, Stemp, _, cb, c1_, sn_, gn, lam_ = deconvolve_traces(Ytemp, dview=executor, **kwargs)
+            if debug:
+                logging.debug('Deconvolution task times: {0}'.format(executor.timing()))
+            # updating the result
+            for jj_ in range(len(jo)):
+                bl[jo[jj_]] = cb[jj_]
+                c1[jo[jj_]] = c1_[jj_]
+                sn[jo[jj_]] = sn_[jj_]
+                g[jo[jj_]] = gn[jj_].T if kwargs['p'] > 0 else []
+                lam[jo[jj_]] = lam_[jj_]
+
+            update_residuals(jo, Ctemp - C[jo, :])
             C[jo, :] = Ctemp.copy()
             S[jo, :] = Stemp
             logging.info("{0} ".format(np.sum(len_parrllcomp[:count + 1])) +
@@ -386,12 +443,9 @@ def update_iteration(parrllcomp, len_parrllcomp, nb, C, S, bl, nr,
 
         for ii in np.arange(nr, nr + nb):
             cc = np.maximum(YrA[:, ii] + Cin[ii], -np.Inf)
-            YrA -= AA[ii, :].T.dot((cc - Cin[ii])[None, :]).T
+            update_residuals([ii], (cc - Cin[ii])[None, :])
             C[ii, :] = cc
 
-        if dview is not None and not('multiprocessing' in str(type(dview))):
-            dview.results.clear()
-
         try:
             if scipy.linalg.norm(Cin - C, 'fro') <= 1e-3*scipy.linalg.norm(C, 'fro'):
                 logging.info("stopping: overall temporal component not changing" +
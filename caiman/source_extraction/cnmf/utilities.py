@@ -38,8 +38,10 @@ from typing import List
 
 from .initialization import greedyROI
 from ...base.rois import com
-from ...mmapping import parallel_dot_product, load_memmap
+from ...mmapping import parallel_dot_product, load_memmap, product_cache
+from ...zarr_storage import load_zarr
 from ...cluster import extract_patch_coordinates
+from ...executors import parallel_map
 from ...utils.stats import df_percentile
 
 
@@ -899,8 +901,8 @@ def compute_residuals(Yr_mmap_file, A_, b_, C_, f_, dview=None, block_size=1000,
     nA = np.ravel(Ab.power(2).sum(axis=0))
 
     if 'mmap' in str(type(Yr_mmap_file)):
-        YA = parallel_dot_product(Yr_mmap_file, Ab, dview=dview, block_size=block_size,
-                                  transpose=True, num_blocks_per_run=num_blocks_per_run) * scipy.sparse.spdiags(old_div(1., nA), 0, Ab.shape[-1], Ab.shape[-1])
+        YA = product_cache.dot_product(Yr_mmap_file, Ab, dview=dview, block_size=block_size, transpose=True,
+                                       num_blocks_per_run=num_blocks_per_run) * scipy.sparse.spdiags(old_div(1., nA), 0, Ab.shape[-1], Ab.shape[-1])
     else:
         YA = (Ab.T.dot(Yr_mmap_file)).T * \
             spdiags(old_div(1., nA), 0, Ab.shape[-1], Ab.shape[-1])
@@ -1007,6 +1009,12 @@ def get_file_size(file_name, var_name_hdf5='mov'):
                 filename = os.path.split(file_name)[-1]
                 Yr, dims, T = load_memmap(os.path.join(
                         os.path.split(file_name)[0], filename))
+            elif extension == '.npy':
+                siz = np.load(file_name, mmap_mode='r').shape
+                T, dims = siz[0], siz[1:]
+            elif extension == '.zarr':
+                siz = load_zarr(file_name).shape
+                T, dims = siz[0], siz[1:]
             elif extension in ('.h5', '.hdf5', '.nwb'):
                 with h5py.File(file_name, "r") as f:
                     kk = list(f.keys())
@@ -1114,10 +1122,7 @@ def fast_graph_Laplacian(mmap_file, dims, max_radius=10, kernel='heat',
         for i in range(Np):
             pars.append([i, mmap_file, dims, max_radius, kernel, sigma, thr,
                          p, normalize, use_NN])
-        if dview is None:
-            res = list(map(fast_graph_Laplacian_pixel, pars))
-        else:
-            res = dview.map(fast_graph_Laplacian_pixel, pars, chunksize=128)
+        res = parallel_map(dview, fast_graph_Laplacian_pixel, pars)
         indptr = np.cumsum(np.array([0] + [len(r[0]) for r in res]))
         indeces = [item for sublist in res for item in sublist[0]]
         data = [item for sublist in res for item in sublist[1]]
@@ -1130,10 +1135,7 @@ def fast_graph_Laplacian(mmap_file, dims, max_radius=10, kernel='heat',
         for i in range(len(indices)):
             pars.append([mmap_file, indices[i], kernel, sigma, thr, p,
                          normalize, use_NN])
-        if dview is None:
-            res = list(map(fast_graph_Laplacian_patches, pars))
-        else:
-            res = dview.map(fast_graph_Laplacian_patches, pars)
+        res = parallel_map(dview, fast_graph_Laplacian_patches, pars)
         W = res
         D = [scipy.sparse.spdiags(w.sum(0), 0, w.shape[0], w.shape[0]) for w in W]
         L = [d - w for (d, w) in zip(W, D)]
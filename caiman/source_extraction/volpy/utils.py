@@ -12,6 +12,7 @@ import numpy as np
 import os
 import tensorflow as tf
 import caiman as cm
+from caiman import model_registry
 from caiman.external.cell_magic_wand import cell_magic_wand_single_point
 from caiman.paths import caiman_datadir
 
@@ -121,15 +122,22 @@ def mrcnn_inference(img, size_range, weights_path, display_result=True):
         IMAGE_MAX_DIM = 512
         RPN_NMS_THRESHOLD = 0.7
         POST_NMS_ROIS_INFERENCE = 1000
-    config = InferenceConfig()
-    config.display()
     model_dir = os.path.join(caiman_datadir(), 'model')
     DEVICE = "/cpu:0"  # /cpu:0 or /gpu:0
-    with tf.device(DEVICE):
-        model = modellib.MaskRCNN(mode="inference", model_dir=model_dir,
-                                  config=config)
-    model.load_weights(weights_path, by_name=True)
-    results = model.detect([img], verbose=1)
+
+    def loader():
+        config = InferenceConfig()
+        config.display()
+        with tf.device(DEVICE):
+            model = modellib.MaskRCNN(mode="inference", model_dir=model_dir,
+                                      config=config)
+        model.load_weights(weights_path, by_name=True)
+        return model
+
+    # the network is built once per process and shared through the model registry
+    entry = model_registry.get_model(('mrcnn', os.path.abspath(weights_path)), loader)
+    with entry.lock:
+        results = entry.model.detect([img], verbose=1)
     r = results[0]
     selection = np.logical_and(r['masks'].sum(axis=(0,1)) > size_range[0] ** 2, 
                                r['masks'].sum(axis=(0,1)) < size_range[1] ** 2)
@@ -13,22 +13,29 @@ See Also:
 from builtins import range
 
 import cv2
+import itertools
 import logging
 import numpy as np
 from scipy.ndimage import convolve, generate_binary_structure
 from scipy.sparse import coo_matrix
-from typing import Any, List, Optional, Tuple
+from typing import Any, Iterable, List, Optional, Tuple
 
 import caiman as cm
-from caiman.source_extraction.cnmf.pre_processing import get_noise_fft
+from caiman.executors import as_executor, parallel_map
+from caiman.shared_arrays import SharedArrays, attach
+from caiman.source_extraction.cnmf.pre_processing import get_noise_fft, welch_psd
 from caiman.source_extraction.cnmf.utilities import get_file_size
 
-def max_correlation_image(Y, bin_size: int = 1000, eight_neighbours: bool = True, swap_dim: bool = True) -> np.ndarray:
+def max_correlation_image(Y, bin_size: int = 1000, eight_neighbours: bool = True, swap_dim: bool = True,
+                          dview=None, var_name_hdf5: str = 'mov') -> np.ndarray:
     """Computes the max-correlation image for the input dataset Y with bin_size
 
+    The correlation image of each bin is computed from its statistics (see correlation_stats),
+    the bins being spread over the workers of dview and, for files, read one by one.
+
     Args:
-        Y:  np.ndarray (3D or 4D)
-            Input movie data in 3D or 4D format
+        Y:  np.ndarray (3D or 4D) or str
+            Input movie data in 3D or 4D format, or movie file (time in the first axis)
 
         bin_size: scalar (integer)
              Length of bin_size (if last bin is smaller than bin_size < 2 bin_size is increased to impose uniform bins)
@@ -41,32 +48,44 @@ def max_correlation_image(Y, bin_size: int = 1000, eight_neighbours: bool = True
             True indicates that time is listed in the last axis of Y (matlab format)
             and moves it in the front
 
+        dview: map object
+            Use it for parallel computation
+
+        var_name_hdf5: str
+            if loading from hdf5 name of the variable to load
+
     Returns:
         Cn: d1 x d2 [x d3] matrix,
             max correlation image
     """
 
-    if swap_dim:
-        Y = np.transpose(Y, tuple(np.hstack((Y.ndim - 1, list(range(Y.ndim))[:-1]))))
+    if isinstance(Y, str):
+        T = get_file_size(Y, var_name_hdf5)[1]
+    else:
+        if swap_dim:
+            Y = np.transpose(Y, tuple(np.hstack((Y.ndim - 1, list(range(Y.ndim))[:-1]))))
+        T = Y.shape[0]
 
-    T = Y.shape[0]
     if T <= bin_size:
-        Cn_bins = local_correlations_fft(Y, eight_neighbours=eight_neighbours, swap_dim=False)
-        return Cn_bins
-    else:
-        if T % bin_size < bin_size / 2.:
-            bin_size = T // (T // bin_size)
+        bin_size = T
+    elif T % bin_size < bin_size / 2.:
+        bin_size = T // (T // bin_size)
 
-        n_bins = T // bin_size
-        Cn_bins = np.zeros(((n_bins,) + Y.shape[1:]))
-        for i in range(n_bins):
-            Cn_bins[i] = local_correlations_fft(Y[i * bin_size:(i + 1) * bin_size],
-                                                eight_neighbours=eight_neighbours,
-                                                swap_dim=False)
-            logging.debug(i * bin_size)
+    n_bins = T // bin_size
+    Cn_bins = parallel_map(dview, _bin_correlation_image, [
+        (Y if isinstance(Y, str) else Y[i * bin_size:(i + 1) * bin_size], i * bin_size, (i + 1) * bin_size,
+         eight_neighbours, var_name_hdf5) for i in range(n_bins)])
 
-        Cn = np.max(Cn_bins, axis=0)
-        return Cn
+    Cn = np.max(Cn_bins, axis=0)
+    return Cn
+
+
+def _bin_correlation_image(args) -> np.ndarray:
+    Y, start, stop, eight_neighbours, var_name_hdf5 = args
+    frames = _load_frames(Y, start, stop, var_name_hdf5) if isinstance(Y, str) else Y
+    logging.debug(start)
+    return correlation_image_from_stats(correlation_stats(frames, eight_neighbours),
+                                        eight_neighbours).astype(np.float32)
 
 
 #%%
@@ -290,42 +309,25 @@ def local_correlations(Y, eight_neighbours: bool = True, swap_dim: bool = True,
     return rho
 
 
-def correlation_pnr(Y, gSig=None, center_psf: bool = True, swap_dim: bool = True,
-                    background_filter: str = 'disk') -> Tuple[np.ndarray, np.ndarray]:
+def filter_frames(frames, gSig=None, center_psf: bool = True, background_filter: str = 'disk') -> np.ndarray:
     """
-    compute the correlation image and the peak-to-noise ratio (PNR) image.
-    If gSig is provided, then spatially filtered the video.
+    Spatially filters a chunk of frames, as done by correlation_pnr
 
     Args:
-        Y:  np.ndarray (3D or 4D).
-            Input movie data in 3D or 4D format
+        frames: np.ndarray (3D)
+            frames to filter (T x d1 x d2)
         gSig:  scalar or vector.
             gaussian width. If gSig == None, no spatial filtering
         center_psf: Boolean
             True indicates subtracting the mean of the filtering kernel
-        swap_dim: Boolean
-            True indicates that time is listed in the last axis of Y (matlab format)
-            and moves it in the front
         background_filter: str
             (undocumented)
 
     Returns:
-        cn: np.ndarray (2D or 3D).
-            local correlation image of the spatially filtered (or not)
-            data
-        pnr: np.ndarray (2D or 3D).
-            peak-to-noise ratios of all pixels/voxels
-
+        data_filtered: np.ndarray (3D)
+            filtered frames in float32
     """
-    if swap_dim:
-        Y = np.transpose(Y, tuple(np.hstack((Y.ndim - 1, list(range(Y.ndim))[:-1]))))
-
-    # parameters
-    _, d1, d2 = Y.shape
-    data_raw = Y.reshape(-1, d1, d2).astype('float32')
-
-    # filter data
-    data_filtered = data_raw.copy()
+    data_filtered = np.array(frames, dtype='float32')
     if gSig:
         if not isinstance(gSig, list):
             gSig = [gSig, gSig]
@@ -351,6 +353,46 @@ def correlation_pnr(Y, gSig=None, center_psf: bool = True, swap_dim: bool = True
             for idx, img in enumerate(data_filtered):
                 data_filtered[idx,] = cv2.GaussianBlur(img, ksize=ksize, sigmaX=gSig[0], sigmaY=gSig[1], borderType=1)
 
+    return data_filtered
+
+
+def correlation_pnr(Y, gSig=None, center_psf: bool = True, swap_dim: bool = True,
+                    background_filter: str = 'disk') -> Tuple[np.ndarray, np.ndarray]:
+    """
+    compute the correlation image and the peak-to-noise ratio (PNR) image.
+    If gSig is provided, then spatially filtered the video.
+
+    Args:
+        Y:  np.ndarray (3D or 4D).
+            Input movie data in 3D or 4D format
+        gSig:  scalar or vector.
+            gaussian width. If gSig == None, no spatial filtering
+        center_psf: Boolean
+            True indicates subtracting the mean of the filtering kernel
+        swap_dim: Boolean
+            True indicates that time is listed in the last axis of Y (matlab format)
+            and moves it in the front
+        background_filter: str
+            (undocumented)
+
+    Returns:
+        cn: np.ndarray (2D or 3D).
+            local correlation image of the spatially filtered (or not)
+            data
+        pnr: np.ndarray (2D or 3D).
+            peak-to-noise ratios of all pixels/voxels
+
+    """
+    if swap_dim:
+        Y = np.transpose(Y, tuple(np.hstack((Y.ndim - 1, list(range(Y.ndim))[:-1]))))
+
+    # parameters
+    _, d1, d2 = Y.shape
+    data_raw = Y.reshape(-1, d1, d2).astype('float32')
+
+    # filter data
+    data_filtered = filter_frames(data_raw, gSig, center_psf, background_filter)
+
     # compute peak-to-noise ratio
     data_filtered -= data_filtered.mean(axis=0)
     data_max = np.max(data_filtered, axis=0)
@@ -368,6 +410,204 @@ def correlation_pnr(Y, gSig=None, center_psf: bool = True, swap_dim: bool = True
     return cn, pnr
 
 
+def _neighbour_offsets(ndim: int, eight_neighbours: bool = True) -> List[Tuple]:
+    """ Offsets to half of the neighbours of a pixel, the other half being their opposites """
+    offsets = [o for o in itertools.product((-1, 0, 1), repeat=ndim) if o > (0,) * ndim]
+    if not eight_neighbours:
+        offsets = [o for o in offsets if np.sum(np.abs(o)) == 1]
+    return offsets
+
+
+def _neighbour_slices(offset: Tuple) -> Tuple[Tuple, Tuple]:
+    """ Slices of the pixels that have a neighbour at offset, and of these neighbours """
+    src = tuple(slice(None, -1) if o == 1 else slice(1, None) if o == -1 else slice(None) for o in offset)
+    dst = tuple(slice(1, None) if o == 1 else slice(None, -1) if o == -1 else slice(None) for o in offset)
+    return src, dst
+
+
+def correlation_stats(frames, eight_neighbours: bool = True) -> Tuple[int, np.ndarray, np.ndarray, np.ndarray]:
+    """Sufficient statistics of the local correlations of a chunk of frames
+
+    The statistics of consecutive chunks add up (see reduce_stats), so that the correlation image
+    of a movie can be computed from chunks streamed from the file, possibly by different workers.
+
+    Args:
+        frames: np.ndarray (3D or 4D)
+            chunk of the movie, time in the first axis
+
+        eight_neighbours: Boolean
+            Use 8 neighbors if true, and 4 if false for 3D data
+            Use 26 neighbors if true, and 6 if false for 4D data
+
+    Returns:
+        T: int
+            number of frames
+
+        sum_x, sum_xx: np.ndarray
+            sum over time of each pixel and of its square
+
+        sum_xy: np.ndarray
+            sum over time of the products of each pixel with its neighbours at the offsets
+            of _neighbour_offsets (one image per offset)
+    """
+    Y = np.asarray(frames, dtype=np.float64)
+    offsets = _neighbour_offsets(Y.ndim - 1, eight_neighbours)
+    sum_xy = np.zeros((len(offsets),) + Y.shape[1:])
+    for xy, offset in zip(sum_xy, offsets):
+        src, dst = _neighbour_slices(offset)
+        xy[src] = np.einsum('i...,i...->...', Y[(slice(None),) + src], Y[(slice(None),) + dst])
+    return len(Y), Y.sum(0), np.einsum('i...,i...->...', Y, Y), sum_xy
+
+
+def reduce_stats(stats: Iterable[Tuple]) -> Tuple:
+    """ Adds up the statistics (tuples of arrays) computed on the chunks of a movie, one chunk at a time """
+    total = None
+    for chunk_stats in stats:
+        total = chunk_stats if total is None else tuple(t + s for t, s in zip(total, chunk_stats))
+    return total
+
+
+def correlation_image_from_stats(stats: Tuple, eight_neighbours: bool = True) -> np.ndarray:
+    """Computes the correlation image from the statistics returned by correlation_stats
+
+    Same as local_correlations_fft: the average of the correlations of each pixel with its
+    neighbours, constant pixels having null correlations.
+
+    Args:
+        stats: tuple
+            statistics of the whole movie, see correlation_stats
+
+        eight_neighbours: Boolean
+            must be the value given to correlation_stats
+
+    Returns:
+        Cn: d1 x d2 [x d3] matrix, cross-correlation with adjacent pixels
+    """
+    T, sum_x, sum_xx, sum_xy = stats
+    mean = sum_x / T
+    var = sum_xx / T - mean**2
+    # constant pixels, up to the rounding errors of the sums
+    var[var <= 1e-12 * sum_xx / T] = 0
+    std = np.sqrt(var)
+    std[std == 0] = np.inf
+    Cn = np.zeros(sum_x.shape)
+    neighbours = np.zeros(sum_x.shape)
+    for xy, offset in zip(sum_xy, _neighbour_offsets(sum_x.ndim, eight_neighbours)):
+        src, dst = _neighbour_slices(offset)
+        corr = (xy[src] / T - mean[src] * mean[dst]) / (std[src] * std[dst])
+        Cn[src] += corr
+        Cn[dst] += corr
+        neighbours[src] += 1
+        neighbours[dst] += 1
+    return Cn / neighbours
+
+
+def _load_frames(Y, start: int, stop: int, var_name_hdf5: str = 'mov') -> np.ndarray:
+    """ Frames start to stop of a movie file or array, time in the first axis """
+    if isinstance(Y, str):
+        return np.asarray(cm.load(Y, subindices=range(start, stop), var_name_hdf5=var_name_hdf5, in_memory=True))
+    return np.asarray(Y[start:stop])
+
+
+def _pnr_stats(args) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Sum, max and sum of Welch periodograms of the filtered frames start to stop """
+    Y, start, stop, T, nperseg, filter_params, var_name_hdf5 = args
+    # the periodograms of the segments starting in this chunk need the next frames
+    step = nperseg - nperseg // 2
+    starts = np.arange(start, stop, step)
+    starts = starts[starts + nperseg <= T]
+    end = max(stop, starts[-1] + nperseg) if len(starts) else stop
+    data = filter_frames(_load_frames(Y, start, end, var_name_hdf5), **filter_params)
+    Pxx = welch_psd(data.reshape(len(data), -1), starts - start, nperseg)
+    return (data[:stop - start].sum(0, dtype=np.float64), data[:stop - start].max(0),
+            Pxx.sum(0).reshape(data.shape[1:]), len(starts))
+
+
+def _pnr_correlation_stats(args) -> Tuple:
+    """ Correlation statistics of the filtered frames start to stop, normalized and thresholded """
+    Y, start, stop, mean, std, filter_params, var_name_hdf5 = args
+    data = filter_frames(_load_frames(Y, start, stop, var_name_hdf5), **filter_params)
+    data -= attach(mean)
+    data /= attach(std)
+    data[data < 3] = 0
+    return correlation_stats(data)
+
+
+def correlation_pnr_offline(file_name, gSig=None, center_psf: bool = True, background_filter: str = 'disk',
+                            chunk_size: int = 1000, Tot_frames=None, var_name_hdf5: str = 'mov',
+                            dview=None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Out-of-core computation of the correlation and peak-to-noise ratio (PNR) images
+
+    Same as correlation_pnr, but the movie is read twice in chunks of frames, spread over the
+    workers of dview, which return statistics that are added up as they arrive: the temporal mean, max
+    and noise level of each pixel in the first pass, the sums needed by the correlations of the
+    normalized and thresholded movie (see correlation_stats) in the second one. The noise
+    level is averaged over the Welch power spectral density of the whole movie, instead of the
+    FFT of at most 3072 frames.
+
+    Args:
+        file_name: str or np.ndarray (3D)
+            movie file (anything caiman.load reads by frames) or array, time in the first axis
+        gSig:  scalar or vector.
+            gaussian width. If gSig == None, no spatial filtering
+        center_psf: Boolean
+            True indicates subtracting the mean of the filtering kernel
+        background_filter: str
+            (undocumented)
+        chunk_size: int
+            number of frames of each chunk
+        Tot_frames: int
+            Number of total frames considered
+        var_name_hdf5: str
+            if loading from hdf5 name of the variable to load
+        dview: map object
+            Use it for parallel computation
+
+    Returns:
+        cn: np.ndarray (2D).
+            local correlation image of the spatially filtered (or not)
+            data
+        pnr: np.ndarray (2D).
+            peak-to-noise ratios of all pixels
+    """
+    if Tot_frames is None:
+        Tot_frames = get_file_size(file_name, var_name_hdf5)[1] if isinstance(file_name, str) else len(file_name)
+    nperseg = min(256, Tot_frames)
+    step = nperseg - nperseg // 2
+    chunk_size = max(chunk_size // step, 1) * step
+    chunks = [(start, min(start + chunk_size, Tot_frames)) for start in range(0, Tot_frames, chunk_size)]
+    filter_params = dict(gSig=gSig, center_psf=center_psf, background_filter=background_filter)
+
+    # the results of the chunks are folded into running totals as they arrive
+    executor = as_executor(dview)
+    sums = maxs = Pxx = None
+    n_segments = 0
+    for chunk_sums, chunk_maxs, chunk_Pxx, chunk_segments in executor.imap(_pnr_stats, [
+            (file_name, start, stop, Tot_frames, nperseg, filter_params, var_name_hdf5) for start, stop in chunks]):
+        if sums is None:
+            sums, maxs, Pxx = chunk_sums, chunk_maxs, chunk_Pxx
+        else:
+            sums += chunk_sums
+            np.maximum(maxs, chunk_maxs, out=maxs)
+            Pxx += chunk_Pxx
+        n_segments += chunk_segments
+    mean = sums / Tot_frames
+    data_max = maxs - mean
+    n_frequencies = np.sum((np.fft.rfftfreq(nperseg) >= .25) & (np.fft.rfftfreq(nperseg) <= .5))
+    data_std = np.sqrt(Pxx / n_segments / n_frequencies / 2)
+    pnr = np.divide(data_max, data_std)
+    pnr[pnr < 0] = 0
+
+    with SharedArrays(dview) as shared:
+        mean_, std_ = shared.publish(mean.astype(np.float32)), shared.publish(data_std.astype(np.float32))
+        stats = reduce_stats(executor.imap(_pnr_correlation_stats, [
+            (file_name, start, stop, mean_, std_, filter_params, var_name_hdf5) for start, stop in chunks]))
+    cn = correlation_image_from_stats(stats)
+
+    return cn.astype(np.float32), pnr.astype(np.float32)
+
+
 def iter_chunk_array(arr: np.array, chunk_size: int):
     if ((arr.shape[0] // chunk_size) - 1) > 0:
         for i in range((arr.shape[0] // chunk_size) - 1):
@@ -390,10 +630,7 @@ def correlation_image_ecobost(mov, chunk_size: int = 1000, dview=None):
     """
     # MAP
     if type(mov) is list:
-        if dview is not None:
-            res = dview.map(map_corr, mov)
-        else:
-            res = map(map_corr, mov)
+        res = parallel_map(dview, map_corr, mov)
 
     else:
         scan = mov.astype(np.float32)
@@ -472,6 +709,152 @@ def map_corr(scan) -> Tuple[Any, Any, Any, int]:
     return chunk_sum, chunk_sqsum, chunk_xysum, num_frames
 
 
+class LocalCorrelations(object):
+    """Running local correlation image, updated as frames arrive
+
+    Keeps the sufficient statistics of the correlation image (the first and second moments of
+    every pixel and the cross moments of neighbouring pixels) and updates them for batches of
+    frames, with the same result as updating them frame by frame. The moments are averages:
+        'simple': over the last `window` frames; the frames leaving the window must be given
+        'cumulative': over all the frames seen so far
+        'exponential': exponentially decaying, with a time constant of `window` frames
+
+    Args:
+        Y:  np.ndarray (3D or 4D)
+            Initial frames (the moments start as their averages)
+
+        window: int
+            Window length in frames, the number of frames of Y by default
+
+        mode: 'simple', 'exponential', or 'cumulative'
+            Mode of moving average
+
+        swap_dim: Boolean
+            True indicates that time is listed in the last axis of Y (matlab format)
+            and moves it in the front
+
+        eight_neighbours: Boolean
+            Use 8 neighbors if true, and 4 if false for 3D data
+            Use 18 neighbors if true, and 6 if false for 4D data
+    """
+    __slots__ = ('dims', 'mode', 'window', 't', 'first_moment', 'second_moment', 'crosscorr',
+                 'row_ind', 'col_ind', 'num_neighbors', 'M')
+
+    def __init__(self, Y=None, window: Optional[int] = None, mode: str = 'simple', swap_dim: bool = False,
+                 eight_neighbours: bool = False) -> None:
+        if mode not in ('simple', 'exponential', 'cumulative'):
+            raise Exception('mode of the moving average must be simple, exponential or cumulative')
+        self.mode = mode
+        if Y is None:   # filled by from_state
+            return
+        if swap_dim:
+            Y = np.transpose(Y, (Y.ndim - 1,) + tuple(range(Y.ndim - 1)))
+
+        T = len(Y)
+        self.dims = Y.shape[1:]
+        self.window = T if window is None else window
+        self.t = T
+        Yr = Y.T.reshape(-1, T)
+        if Y.ndim == 4:
+            sz = generate_binary_structure(3, 2 if eight_neighbours else 1)
+            sz[1, 1, 1] = 0
+        else:
+            if eight_neighbours:
+                sz = np.ones((3, 3), dtype='uint8')
+                sz[1, 1] = 0
+            else:
+                sz = np.array([[0, 1, 0], [1, 0, 1], [0, 1, 0]], dtype='uint8')
+
+        # neighbours of every pixel (in Fortran order), in the order of the offsets in sz
+        coords = np.unravel_index(np.arange(np.prod(self.dims)), self.dims, order='F')
+        neighbors = np.transpose([i - 1 for i in np.nonzero(sz)])
+        inside = np.ones((len(neighbors), len(coords[0])), dtype=bool)
+        for ax, d in enumerate(self.dims):
+            x = coords[ax] + neighbors[:, ax, None]
+            inside &= (x >= 0) & (x < d)
+        col_ind = np.ravel_multi_index(tuple(np.clip(coords[ax] + neighbors[:, ax, None], 0, d - 1)
+                                             for ax, d in enumerate(self.dims)), self.dims, order='F')
+        self.row_ind = np.nonzero(inside.T)[0]
+        self.col_ind = col_ind.T[inside.T]
+        self.num_neighbors = np.repeat(inside.sum(0), inside.sum(0)).astype(Yr.dtype)
+
+        self.first_moment = Yr.mean(1)
+        self.second_moment = (Yr**2).mean(1)
+        self.crosscorr = np.mean(Yr[self.row_ind] * Yr[self.col_ind], 1)
+        self.M = coo_matrix((np.zeros(len(self.row_ind), dtype=Yr.dtype), (self.row_ind, self.col_ind)),
+                            shape=(len(Yr), len(Yr)))
+
+    def update(self, frames, del_frames=None) -> np.ndarray:
+        """Updates the statistics with a batch of frames and returns the correlation image
+
+        Args:
+            frames: np.ndarray
+                new frames, time in the first axis
+
+            del_frames: np.ndarray
+                frames leaving the window, as many as frames ('simple' mode only)
+
+        Returns:
+            cn: np.ndarray
+                correlation image
+        """
+        n = len(frames)
+        if n:
+            frames = np.reshape(frames, (n, -1), order='F')
+            if self.mode == 'simple':
+                if del_frames is None:
+                    raise Exception('the frames leaving the window are needed in simple mode')
+                self._add(np.reshape(del_frames, (len(del_frames), -1), order='F'),
+                          np.full(len(del_frames), -1. / self.window))
+                weights = np.full(n, 1. / self.window)
+            elif self.mode == 'cumulative':
+                decay = self.t / (self.t + n)
+                weights = np.full(n, 1. / (self.t + n))
+            else:
+                decay = (1 - 1. / self.window)**n
+                weights = (1 - 1. / self.window)**np.arange(n - 1, -1, -1) / self.window
+            if self.mode != 'simple':
+                self.first_moment *= decay
+                self.second_moment *= decay
+                self.crosscorr *= decay
+            self._add(frames, weights)
+            self.t += n
+        return self.image()
+
+    def _add(self, frames, weights, max_elements=2**24) -> None:
+        self.first_moment += weights.dot(frames).astype(self.first_moment.dtype)
+        self.second_moment += weights.dot(frames**2).astype(self.second_moment.dtype)
+        step = max(max_elements // max(len(self.row_ind), 1), 1)
+        for i in range(0, len(frames), step):
+            f = frames[i:i + step]
+            self.crosscorr += np.einsum('i,ij,ij->j', weights[i:i + step], f[:, self.row_ind],
+                                        f[:, self.col_ind]).astype(self.crosscorr.dtype)
+
+    def image(self) -> np.ndarray:
+        """ Returns the correlation image of the current statistics """
+        sig = np.sqrt(self.second_moment - self.first_moment**2)
+        self.M.data = ((self.crosscorr - self.first_moment[self.row_ind] * self.first_moment[self.col_ind]) /
+                       (sig[self.row_ind] * sig[self.col_ind]) / self.num_neighbors)
+        return self.M.dot(np.ones(self.M.shape[1], dtype=self.M.dtype)).reshape(self.dims, order='F')
+
+    def state(self) -> dict:
+        """ Returns the state as a dictionary of arrays, see from_state """
+        return {key: np.asarray(getattr(self, key)) for key in self.__slots__ if key != 'M'}
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'LocalCorrelations':
+        """ Restores the object whose state was returned by state """
+        self = cls(mode=str(np.asarray(state['mode']).astype(str)))
+        for key in cls.__slots__:
+            if key not in ('M', 'mode'):
+                setattr(self, key, np.asarray(state[key]))
+        self.dims = tuple(int(d) for d in self.dims)
+        self.window, self.t = int(self.window), int(self.t)
+        self.M = coo_matrix((np.zeros(len(self.row_ind), dtype=self.crosscorr.dtype), (self.row_ind, self.col_ind)),
+                            shape=(np.prod(self.dims),) * 2)
+        return self
+
+
 def prepare_local_correlations(Y, swap_dim: bool = False,
                                eight_neighbours: bool = False) -> Tuple[Any, Any, Any, Any, Any, Any, Any, Any]:
     """Computes the correlation image and some statistics to update it online
@@ -490,66 +873,10 @@ def prepare_local_correlations(Y, swap_dim: bool = False,
 
     """
     # TODO: Tighten prototype above
-    if swap_dim:
-        Y = np.transpose(Y, (Y.ndim - 1,) + tuple(range(Y.ndim - 1)))
-
-    T = len(Y)
-    dims = Y.shape[1:]
-    Yr = Y.T.reshape(-1, T)
-    if Y.ndim == 4:
-        d1, d2, d3 = dims
-        sz = generate_binary_structure(3, 2 if eight_neighbours else 1)
-        sz[1, 1, 1] = 0
-    else:
-        d1, d2 = dims
-        if eight_neighbours:
-            sz = np.ones((3, 3), dtype='uint8')
-            sz[1, 1] = 0
-        else:
-            sz = np.array([[0, 1, 0], [1, 0, 1], [0, 1, 0]], dtype='uint8')
-
-    idx = [i - 1 for i in np.nonzero(sz)]
-
-    def get_indices_of_neighbors(pixel):
-        pixel = np.unravel_index(pixel, dims, order='F')
-        x = pixel[0] + idx[0]
-        y = pixel[1] + idx[1]
-        if len(dims) == 3:
-            z = pixel[2] + idx[2]
-            inside = (x >= 0) * (x < d1) * (y >= 0) * (y < d2) * (z >= 0) * (z < d3)
-            return np.ravel_multi_index((x[inside], y[inside], z[inside]), dims, order='F')
-        else:
-            inside = (x >= 0) * (x < d1) * (y >= 0) * (y < d2)
-            return np.ravel_multi_index((x[inside], y[inside]), dims, order='F')
-
-    # more compact but slower code
-    # idx = np.asarray([i - 1 for i in np.nonzero(sz)])
-    # def get_indices_of_neighbors(pixel):
-    #     pixel = np.asarray(np.unravel_index(pixel, dims, order='F'))
-    #     xyz = pixel[:, None] + idx
-    #     inside = np.all([(x >= 0) * (x < d) for (x, d) in zip(xyz, dims)], 0)
-    #     return np.ravel_multi_index(xyz[:, inside], dims, order='F')
-
-    N = [get_indices_of_neighbors(p) for p in range(np.prod(dims))]
-    col_ind = np.concatenate(N)
-    row_ind = np.concatenate([[i] * len(k) for i, k in enumerate(N)])
-    num_neigbors = np.concatenate([[len(k)] * len(k) for k in N]).astype(Yr.dtype)
-
-    first_moment = Yr.mean(1)
-    second_moment = (Yr**2).mean(1)
-    crosscorr = np.mean(Yr[row_ind] * Yr[col_ind], 1)
-    # slower for small T, less memory intensive, but memory not an issue:
-    # crosscorr = np.array([Yr[r_].dot(Yr[c_])
-    #                       for (r_, c_) in zip(row_ind, col_ind)]) / Yr.shape[1]
-    sig = np.sqrt(second_moment - first_moment**2)
-
-    M = coo_matrix(
-        ((crosscorr - first_moment[row_ind] * first_moment[col_ind]) / (sig[row_ind] * sig[col_ind]) / num_neigbors,
-         (row_ind, col_ind)),
-        dtype=Yr.dtype)
-    cn = M.dot(np.ones(M.shape[1], dtype=M.dtype)).reshape(dims, order='F')
-
-    return first_moment, second_moment, crosscorr, col_ind, row_ind, num_neigbors, M, cn
+    corr = LocalCorrelations(Y, swap_dim=swap_dim, eight_neighbours=eight_neighbours)
+    cn = corr.image()
+    return (corr.first_moment, corr.second_moment, corr.crosscorr, corr.col_ind, corr.row_ind,
+            corr.num_neighbors, corr.M, cn)
 
 
 def update_local_correlations(t,
@@ -766,14 +1093,7 @@ def local_correlations_movie_offline(file_name,
                    order_mean, ismulticolor, remove_baseline, winSize_baseline,
                    quantil_min_baseline, gaussian_blur])
 
-    if dview is None:
-        parallel_result = list(map(local_correlations_movie_parallel, params))
-    else:
-        if 'multiprocessing' in str(type(dview)):
-            parallel_result = dview.map_async(local_correlations_movie_parallel, params).get(4294967)
-        else:
-            parallel_result = dview.map_sync(local_correlations_movie_parallel, params)
-            dview.results.clear()
+    parallel_result = parallel_map(dview, local_correlations_movie_parallel, params)
 
     mm = cm.movie(np.concatenate(parallel_result, axis=0), fr=fr/len(parallel_result))
     return mm
@@ -790,6 +1110,10 @@ def local_correlations_movie_parallel(params: Tuple) -> np.ndarray:
 
     if ismulticolor:
         return local_correlations_multicolor(mv, swap_dim=swap_dim)[None, :, :].astype(np.float32)
+    elif order_mean == 1 and not eight_neighbours and not swap_dim:
+        # same as local_correlations, which averages the diagonal neighbours differently
+        return correlation_image_from_stats(correlation_stats(mv, eight_neighbours),
+                                            eight_neighbours)[None, :, :].astype(np.float32)
     else:
         return local_correlations(mv, eight_neighbours=eight_neighbours, swap_dim=swap_dim,
                                   order_mean=order_mean)[None, :, :].astype(np.float32)
@@ -833,14 +1157,7 @@ def mean_image(file_name,
     if remain_frames > 0:
         params.append([file_name, range(int(Tot_frames / window) * window, Tot_frames)])
 
-    if dview is None:
-        parallel_result = list(map(mean_image_parallel, params))
-    else:
-        if 'multiprocessing' in str(type(dview)):
-            parallel_result = dview.map_async(mean_image_parallel, params).get(4294967)
-        else:
-            parallel_result = dview.map_sync(mean_image_parallel, params)
-            dview.results.clear()
+    parallel_result = parallel_map(dview, mean_image_parallel, params)
 
     mm = cm.movie(np.concatenate(parallel_result, axis=0), fr=fr/len(parallel_result))
     if remain_frames > 0:
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+""" Micro-benchmarks of the robust statistics of caiman.utils.stats
+
+Compares the batched implementations with the row by row ones (see test_stats)
+on random traces of increasing size:
+
+    python -m caiman.tests.benchmark_stats [--repeat 3]
+"""
+
+import argparse
+import numpy as np
+import timeit
+
+from caiman.tests.test_stats import df_percentile_reference, mode_reference
+from caiman.utils import stats
+
+SIZES = [(100, 1000), (1000, 1000), (1000, 10000)]
+
+
+def traces(K, T, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.maximum(rng.randn(K, T), 0) * 5 * rng.rand(K, 1) + rng.randn(K, T)
+
+
+def benchmark(fun, repeat):
+    return min(timeit.repeat(fun, number=1, repeat=repeat))
+
+
+def main(repeat=3):
+    cases = [('mode_robust', lambda x: stats.mode_robust(x, axis=1), lambda x: mode_reference(x, 1)),
+             ('mode_robust_fast', lambda x: stats.mode_robust_fast(x, axis=1), lambda x: mode_reference(x, 1)),
+             ('df_percentile', lambda x: stats.df_percentile(x, axis=1), df_percentile_reference)]
+    print('{:<18}{:>14}{:>14}{:>14}{:>10}'.format('function', 'size', 'rows (s)', 'batched (s)', 'speedup'))
+    for name, batched, reference in cases:
+        for K, T in SIZES:
+            x = traces(K, T)
+            t_ref = benchmark(lambda: reference(x), repeat)
+            t_new = benchmark(lambda: batched(x), repeat)
+            print('{:<18}{:>14}{:>14.3f}{:>14.3f}{:>10.1f}'.format(name, '{}x{}'.format(K, T), t_ref, t_new,
+                                                                  t_ref / t_new))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3, help='number of timings, the best one is reported')
+    main(parser.parse_args().repeat)
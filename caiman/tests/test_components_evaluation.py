@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import cv2
+import numpy as np
+import numpy.testing as npt
+import scipy.ndimage
+import scipy.sparse
+import scipy.special
+
+from caiman import components_evaluation
+from caiman.utils.stats import mode_robust
+
+
+def test_extract_crops():
+    # the crops built from the sparse entries match the crops of the dense components
+    rng = np.random.RandomState(0)
+    dims, K, patch_size, half_crop = (40, 30), 150, 50, (13, 13)
+    A = np.zeros(dims + (K,), np.float32)
+    for k, (x, y) in enumerate(zip(rng.randint(0, dims[0], K), rng.randint(0, dims[1], K))):
+        A[max(x - 4, 0):x + 5, max(y - 4, 0):y + 5, k] = rng.rand(*A[max(x - 4, 0):x + 5, max(y - 4, 0):y + 5, k].shape)
+    A = scipy.sparse.csc_matrix(A.reshape((-1, K), order='F'))
+    expected = []
+    for a in A.T.toarray():
+        img = a.reshape(dims, order='F')
+        com = np.minimum(np.maximum(scipy.ndimage.center_of_mass(img), half_crop), np.array(dims) - half_crop).astype(int)
+        crop = img[com[0] - half_crop[0]:com[0] + half_crop[0], com[1] - half_crop[1]:com[1] + half_crop[1]]
+        expected.append(cv2.resize(crop / np.linalg.norm(crop), (patch_size, patch_size)))
+    npt.assert_allclose(components_evaluation.extract_crops(A, dims, half_crop, patch_size), expected, atol=1e-6)
+
+    class Model:
+        # stand-in for the keras classifier
+        def predict(self, crops, **kwargs):
+            return np.stack([crops.sum((1, 2, 3)), crops.max((1, 2, 3))], 1)
+
+    predictions, crops = components_evaluation.evaluate_components_CNN(
+        A, dims, (3, 3), loaded_model=Model(), batch_size=64)
+    npt.assert_allclose(crops, expected, atol=1e-6)
+    npt.assert_allclose(predictions, Model().predict(np.array(expected)[..., None]), rtol=1e-5)
+
+
+def test_compute_event_exceptionality():
+    # the blocks of traces match the exceptionality computed trace by trace
+    rng = np.random.RandomState(0)
+    traces = np.maximum(rng.randn(60, 500), 1.5) + .5 * rng.randn(60, 500)
+    traces[:, :4] = traces[:, 4:8]                             # ties
+    fitness, erfc, sd_r, md = components_evaluation.compute_event_exceptionality(traces, N=5, block_size=7,
+                                                                                 n_threads=2)
+    for k, trace in enumerate(traces):
+        mode = mode_robust(trace)
+        under = np.maximum(mode - trace, 0)
+        noise = np.sqrt(np.sum(under**2) / np.sum(under > 0))
+        logp = np.cumsum(scipy.special.log_ndtr(-(trace - mode) / (3 * noise)))
+        logp[5:] -= logp[:-5].copy()
+        assert md[k] == mode
+        npt.assert_allclose([sd_r[k], fitness[k]], [noise, logp.min()], rtol=1e-7)
+        npt.assert_allclose(erfc[k], logp, rtol=1e-7, atol=1e-9)
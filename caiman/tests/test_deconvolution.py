@@ -5,7 +5,7 @@ import numpy.testing as npt
 import numpy as np
 from time import time
 
-from caiman.source_extraction.cnmf.deconvolution import constrained_foopsi
+from caiman.source_extraction.cnmf.deconvolution import constrained_foopsi, constrained_foopsi_batch
 
 # Set up the logger; change this if you like.
 # You can log to a file using the filename parameter, or make the output more or less
@@ -77,3 +77,18 @@ def foo(method, p):
 def test_oasis():
     foo('oasis', 1)
     foo('oasis', 2)
+
+
+def test_oasis_batch():
+    # the traces deconvolved at once match the ones deconvolved one at a time
+    Y = gen_data([.95], .3, N=20, b=1)[0]
+    Y2 = gen_data([1.7, -.71], .3, N=20, b=1)[0]
+    for Y, p, s_min, bl_in in ((Y, 1, None, None), (Y, 1, -2, None), (Y, 2, None, None), (Y2, 2, None, None),
+                               (Y2, 2, None, .9 * np.ones(20))):
+        c, bl, c1, g, sn, sp, lam = constrained_foopsi_batch(Y, bl=bl_in, p=p, s_min=s_min, n_threads=3)
+        for k, y in enumerate(Y):
+            res = constrained_foopsi(y, bl=None if bl_in is None else bl_in[k], p=p, s_min=s_min)
+            npt.assert_allclose(c[k], res[0], atol=1e-4)
+            npt.assert_allclose(sp[k], res[-2], atol=1e-4)
+            npt.assert_allclose([bl[k], c1[k], sn[k]], res[1:3] + (res[4],), atol=1e-4)
+            npt.assert_allclose(g[k], res[3], atol=1e-6)
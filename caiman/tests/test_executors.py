@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import concurrent.futures
+import multiprocessing
+import tempfile
+
+import numpy as np
+import nose
+
+from caiman import executors
+
+
+def square(x):
+    return x * x
+
+
+def allocate(n_bytes):
+    return np.ones(n_bytes, dtype=np.uint8).sum()
+
+
+def map_file(n_bytes):
+    with tempfile.TemporaryFile() as f:
+        f.truncate(n_bytes)
+        return np.memmap(f, dtype=np.uint8, mode='r', shape=(n_bytes,)).size
+
+
+def test_map_backends():
+    args = list(range(20))
+    pool = multiprocessing.Pool(2)
+    thread_pool = concurrent.futures.ThreadPoolExecutor(2)
+    try:
+        assert executors.MultiprocessingExecutor(pool, n_workers=2).n_workers == 2
+        threads = executors.FuturesExecutor(n_workers=3)
+        assert threads.n_workers == 3
+        threads.shutdown()
+        for dview in (None, pool, thread_pool):
+            executor = executors.as_executor(dview)
+            assert executor.map(square, args) == [x * x for x in args]
+            assert list(executor.imap(square, args)) == [x * x for x in args]
+            assert sorted(executor.imap_unordered(square, args)) == [x * x for x in args]
+            assert executor.timing()['n_tasks'] == 3 * len(args)
+            assert executors.as_executor(executor) is executor
+    finally:
+        pool.terminate()
+        thread_pool.shutdown()
+
+
+def test_cancel():
+    executor = executors.SerialExecutor()
+    results = executor.imap_unordered(square, range(10))
+    assert next(results) == 0
+    executor.cancel()
+    nose.tools.assert_raises(concurrent.futures.CancelledError, next, results)
+
+
+def test_memory_limit():
+    if not executors.HAS_RESOURCE:
+        raise nose.SkipTest('no resource module')
+    executor = executors.MultiprocessingExecutor(n_workers=1, memory_limit=2**28)
+    try:
+        assert executor.map(allocate, [2**20]) == [2**20]
+        nose.tools.assert_raises(MemoryError, executor.map, allocate, [2**30])
+        # the limit is lifted after every task
+        assert executor.map(allocate, [2**20]) == [2**20]
+        # memory mapped files do not count
+        assert executor.map(map_file, [2**30]) == [2**30]
+    finally:
+        executor.shutdown()
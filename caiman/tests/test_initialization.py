@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import numpy as np
+import numpy.testing as npt
+import scipy.sparse
+from skimage.morphology import disk
+
+from caiman.source_extraction.cnmf import initialization
+
+
+def test_compute_W():
+    # the ring model matches the regressions of each pixel on its ring, in memory and streamed
+    rng = np.random.RandomState(0)
+    d1, d2, T, radius = 23, 19, 150, 4
+    Y = (rng.rand(d1 * d2, T) + np.repeat(rng.randn(1, T), d1 * d2, 0) + 3).astype(np.float32)
+    A = scipy.sparse.random(d1 * d2, 3, .05, random_state=rng).tocsc()
+    C = rng.rand(3, T)
+    W, b0 = initialization.compute_W(Y, A, C, (d1, d2), radius)
+    npt.assert_allclose(b0, Y.mean(1) - A.dot(C.mean(1)), rtol=1e-5)
+    X = Y - A.dot(C) - b0[:, None]
+    ring = disk(radius + 1)
+    ring[1:-1, 1:-1] -= disk(radius)
+    for p in rng.choice(d1 * d2, 20, replace=False):
+        x, y = [i - radius - 1 for i in np.nonzero(ring)]
+        x, y = x + p % d1, y + p // d1
+        inside = (x >= 0) & (x < d1) & (y >= 0) & (y < d2)
+        index = x[inside] + y[inside] * d1
+        B = X[index]
+        G = B.dot(B.T)
+        G[np.diag_indices(len(G))] += np.trace(G) * 1e-5
+        npt.assert_array_equal(W.indices[W.indptr[p]:W.indptr[p + 1]], index)
+        npt.assert_allclose(W.data[W.indptr[p]:W.indptr[p + 1]], np.linalg.solve(G, B.dot(X[p])),
+                            rtol=1e-4, atol=1e-6)
+    for ssub, tsub in ((1, 1), (2, 2)):
+        W_ref, _ = initialization.compute_W(Y, A, C, (d1, d2), radius, ssub=ssub, tsub=tsub)
+        W_chunks, _ = initialization.compute_W(Y, A, C, (d1, d2), radius, ssub=ssub, tsub=tsub,
+                                               data_fits_in_memory=False, chunk_size=30, parallel=True)
+        npt.assert_allclose(W_chunks.toarray(), W_ref.toarray(), rtol=1e-4, atol=1e-5)
+        # strips of few rows
+        W_strips, _ = initialization.compute_W(Y, A, C, (d1, d2), radius, ssub=ssub, tsub=tsub, max_bytes=2**16)
+        npt.assert_allclose(W_strips.toarray(), W_ref.toarray(), rtol=1e-4, atol=1e-5)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import pathlib
+import shutil
+import tempfile
+
+import numpy as np
+import numpy.testing as npt
+
+from caiman import mmapping
+from caiman.source_extraction.cnmf import map_reduce, params
+
+
+def gen_data(T=200, dims=(30, 30), centers=((8, 9), (20, 12), (14, 22)), sig=2.):
+    np.random.seed(0)
+    grid = np.mgrid[:dims[0], :dims[1]]
+    A = np.stack([np.exp(-((grid[0] - x)**2 + (grid[1] - y)**2) / (2 * sig**2))
+                  for x, y in centers], -1)
+    C = np.maximum(np.random.randn(len(centers), T), 0)
+    C = np.array([np.convolve(c, .9**np.arange(20))[:T] for c in C])
+    Y = A.dot(C).transpose(2, 0, 1) + .1 * np.random.randn(T, *dims)
+    return Y.astype(np.float32)
+
+
+def test_patch_in_memory():
+    # a patch fitted on a view of the memory mapped file matches the one read into memory
+    tmpdir = pathlib.Path(tempfile.mkdtemp())
+    try:
+        data = gen_data()
+        fname = mmapping.save_memmap([data], base_name=str(tmpdir / "Yr"), order="C")
+        dims = data.shape[1:]
+        idx = np.ravel_multi_index(np.mgrid[2:28, 4:26].reshape(2, -1), dims, order='F')
+        res = []
+        for in_memory in (True, False):
+            opts = params.CNMFParams(params_dict={'in_memory': in_memory, 'K': 3, 'gSig': (2, 2),
+                                                  'p': 0, 'nb_patch': 1})
+            res.append(map_reduce.cnmf_patches((fname, idx, dims, opts)))
+        (A_mem, C_mem), (A_map, C_map) = [(r[2].toarray(), r[4]) for r in res]
+        npt.assert_allclose(A_map, A_mem, rtol=1e-3, atol=1e-5)
+        npt.assert_allclose(C_map, C_mem, rtol=1e-3, atol=1e-3)
+        assert res[0][-1]['bytes_used'] == len(idx) * data.shape[0] * 4
+        assert res[1][-1] is None
+        # the products cached by the fits are dropped when they return
+        assert mmapping.product_cache.nbytes == 0
+    finally:
+        shutil.rmtree(tmpdir)
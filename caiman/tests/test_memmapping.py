@@ -1,10 +1,17 @@
+import itertools
+import os
 import pathlib
+import shutil
+import tempfile
 
 import numpy as np
+import numpy.testing as npt
+import scipy.sparse
 import nose
+import tifffile
 
 from caiman import mmapping
-from caiman.paths import caiman_datadir
+from caiman.paths import caiman_datadir, memmap_metadata_filename
 
 
 TWO_D_FNAME = (
@@ -73,3 +80,134 @@ def test_load_successful_3d():
     assert (d1, d2, d3) == (10, 11, 13)
     assert T == 12
     assert isinstance(Yr, np.memmap)
+
+
+def test_save_load_metadata_uint16():
+    tmpdir = pathlib.Path(tempfile.mkdtemp())
+    data = np.random.randint(0, 1000, size=(12, 10, 11)).astype(np.uint16)
+    fname = mmapping.save_memmap([data], base_name=str(tmpdir / "Yr"), order="C", dtype="uint16", fr=15.,
+                                 compute_checksums=True)
+    try:
+        metadata = mmapping.load_memmap_metadata(fname)
+        assert metadata["dtype"] == "uint16"
+        assert metadata["fr"] == 15.
+        assert mmapping.verify_memmap(fname) == []
+
+        # the sidecar, not the file name, describes the data
+        renamed = tmpdir / "renamed.mmap"
+        os.rename(fname, renamed)
+        os.rename(memmap_metadata_filename(fname), memmap_metadata_filename(str(renamed)))
+        Yr, (d1, d2), T = mmapping.load_memmap(str(renamed))
+        assert (d1, d2) == (10, 11)
+        assert T == 12
+        assert Yr.dtype == np.uint16
+        npt.assert_array_equal(np.reshape(Yr.T, (T, d1, d2), order="F"), data)
+        del Yr
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_save_memmap_streaming():
+    tmpdir = pathlib.Path(tempfile.mkdtemp())
+    data = np.random.rand(22, 30, 31).astype(np.float32) * 100
+    data[:, 0, 0] = np.nan                                     # as left by motion correction with border_nan
+    fname_tif = str(tmpdir / "mov.tif")
+    tifffile.imsave(fname_tif, data)
+    try:
+        for resize_fact, order, border_to_0 in itertools.product(((1, 1, 1), (.5, .5, .5)), ("C", "F"), (0, 3)):
+            fname_ref = mmapping.save_memmap([data.copy()], base_name=str(tmpdir / "ref"), order=order,
+                                             resize_fact=resize_fact, remove_init=2, add_to_movie=3,
+                                             border_to_0=border_to_0)
+            Yr_ref, dims_ref, T_ref = mmapping.load_memmap(fname_ref)
+            fname = mmapping.save_memmap_streaming(fname_tif, base_name=str(tmpdir / "Yr"), order=order,
+                                                   resize_fact=resize_fact, remove_init=2, add_to_movie=3,
+                                                   border_to_0=border_to_0, block_size=4, compute_checksums=True)
+            Yr, dims, T = mmapping.load_memmap(fname)
+            assert (dims, T) == (dims_ref, T_ref)
+            assert mmapping.verify_memmap(fname) == []
+            npt.assert_allclose(Yr, Yr_ref, rtol=1e-5)
+            del Yr, Yr_ref
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_chunk_checksums():
+    # the checksums of the blocks written one after the other match the ones read from the file
+    tmpdir = pathlib.Path(tempfile.mkdtemp())
+    data = np.random.rand(13, 57).astype(np.float32)
+    fname = str(tmpdir / "data.bin")
+    data.tofile(fname)
+    try:
+        checksums = mmapping.ChunkChecksums(chunk_bytes=100)
+        for t in range(0, 13, 5):
+            checksums.update(data[t:t + 5])
+        assert checksums.result() == mmapping.compute_memmap_checksums(fname, chunk_bytes=100)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_transpose_memmap():
+    tmpdir = pathlib.Path(tempfile.mkdtemp())
+    data = np.random.rand(17, 13, 11).astype(np.float32)
+    try:
+        fname_F = mmapping.save_memmap([data], base_name=str(tmpdir / "Yr"), order="F")
+        fname_C = mmapping.save_memmap([fname_F], base_name=str(tmpdir / "Yr"), order="C")
+        fname_F2 = mmapping.transpose_memmap(fname_C, order="F", band_size=5, tile_size=3)
+        Yr_F, dims, T = mmapping.load_memmap(fname_F)
+        for fname, order in ((fname_C, "C"), (fname_F2, "F")):
+            Yr, dims_new, T_new = mmapping.load_memmap(fname)
+            assert mmapping.memmap_layout(fname)[0] == order
+            assert (dims_new, T_new) == (dims, T)
+            npt.assert_array_equal(Yr, Yr_F)
+            del Yr
+        del Yr_F
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_load_memmap_patch():
+    tmpdir = pathlib.Path(tempfile.mkdtemp())
+    data = np.random.rand(9, 23, 19).astype(np.float32)
+    slices = [slice(4, 15), slice(3, 11)]
+    try:
+        for order in ("C", "F"):
+            fname = mmapping.save_memmap([data], base_name=str(tmpdir / ("Yr" + order)), order=order)
+            Yr, dims, T = mmapping.load_memmap(fname)
+            ref = np.reshape(Yr.T, [T] + list(dims), order="F")[tuple([slice(T)] + slices)]
+            for max_gap_bytes, block_bytes in ((0, 1), (2**20, 2**26)):
+                patch, stats = mmapping.load_memmap_patch(fname, slices, max_gap_bytes=max_gap_bytes,
+                                                          block_bytes=block_bytes)
+                npt.assert_array_equal(np.reshape(patch.T, ref.shape, order="F"), ref)
+                assert stats["bytes_used"] == ref.nbytes
+                assert stats["bytes_read"] >= stats["bytes_used"]
+            del Yr
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_product_cache():
+    tmpdir = pathlib.Path(tempfile.mkdtemp())
+    data = np.random.rand(30, 10, 12).astype(np.float32)
+    A = scipy.sparse.random(120, 4, density=.3, format="csc", dtype=np.float32)
+    f = np.random.rand(30, 3)
+    try:
+        fname = mmapping.save_memmap([data], base_name=str(tmpdir / "Yr"), order="C")
+        Yr, _, _ = mmapping.load_memmap(fname)
+        cache = mmapping.ProductCache()
+        # products are computed once, then reused
+        for misses in (1, 1):
+            YA = cache.dot_product(Yr, A, block_size=17, transpose=True)
+            assert cache.misses == misses
+            assert YA.dtype == np.float32
+            npt.assert_allclose(YA, np.array(Yr).T.dot(A.toarray()), rtol=1e-4)
+        assert cache.hits == 1
+        # a new factor is a new product, in the type of the factor
+        Yf = cache.dot_product(Yr, f, block_size=17)
+        assert cache.misses == 2
+        assert Yf.dtype == np.float64
+        npt.assert_allclose(Yf, np.array(Yr).dot(f))
+        npt.assert_allclose(cache.dot_product(Yr, 2 * A, block_size=17, transpose=True), 2 * YA, rtol=1e-6)
+        assert cache.misses == 3
+        del Yr
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import numpy as np
+import numpy.testing as npt
+import scipy.sparse
+import scipy.stats
+
+from caiman.source_extraction.cnmf import merging
+
+
+def test_merge_graph():
+    # the incremental graph matches the overlaps and correlations of the merged components
+    rng = np.random.RandomState(0)
+    d1, K, T = 30, 40, 200
+    A = np.zeros((d1 * d1, K))
+    for k, (x, y) in enumerate(rng.randint(3, d1 - 3, (K, 2))):
+        a = np.zeros((d1, d1))
+        a[x - 3:x + 4, y - 3:y + 4] = rng.rand(7, 7)
+        A[:, k] = a.ravel()
+    C = np.maximum(rng.randn(K // 4, T), 0)[np.arange(K) // 4] + .3 * rng.rand(K, T)
+    A = scipy.sparse.csc_matrix(A)
+
+    graph = merging.MergeGraph(A, C)
+    overlaps = scipy.sparse.triu(A.T.dot(A), k=1).tocoo()
+    npt.assert_array_equal(sorted(zip(overlaps.row, overlaps.col)), list(zip(graph.rows, graph.cols)))
+    npt.assert_allclose(graph.corr, [scipy.stats.pearsonr(C[i], C[j])[0] for i, j in zip(graph.rows, graph.cols)])
+
+    groups, cor = graph.groups(.7)
+    assert len(groups) > 0 and all(len(group) > 1 for group in groups)
+    keep = np.setdiff1d(np.arange(K), np.hstack(groups))
+    A_new = scipy.sparse.hstack([A[:, keep]] + [A[:, group].sum(1) for group in groups]).tocsc()
+    C_new = np.vstack([C[keep]] + [C[group].mean(0) for group in groups])
+    graph.update(keep, A_new, C_new)
+    assert graph.matches(A_new, C_new) and not graph.matches(A, C)
+    fresh = merging.MergeGraph(A_new, C_new)
+    npt.assert_array_equal(graph.rows, fresh.rows)
+    npt.assert_array_equal(graph.cols, fresh.cols)
+    npt.assert_allclose(graph.corr, fresh.corr)
+
+
+def test_merge_components_reuses_graph():
+    # merging the output of a merge again reuses the graph, changed components rebuild it
+    rng = np.random.RandomState(1)
+    d1, K, T = 20, 12, 300
+    A = np.zeros((d1 * d1, K))
+    for k, (x, y) in enumerate(rng.randint(3, d1 - 3, (K, 2))):
+        a = np.zeros((d1, d1))
+        a[x - 3:x + 4, y - 3:y + 4] = rng.rand(7, 7)
+        A[:, k] = a.ravel()
+    C = np.maximum(rng.randn(K // 2, T), 0)[np.arange(K) // 2] + .1 * rng.rand(K, T)
+    A = scipy.sparse.csc_matrix(A)
+    Y = A.dot(C)
+
+    graph = merging.MergeGraph()
+    resets = []
+    reset = graph.reset
+    graph.reset = lambda A, C: resets.append(A.shape) or reset(A, C)
+    merged = [0]
+    calls = 0
+    while len(merged) > 0:
+        A, C, nr, merged = merging.merge_components(Y, A, [], C, None, [], C, [], {'p': 0}, {}, thr=.5,
+                                                    mx=np.inf, merge_graph=graph)[:4]
+        calls += 1
+    assert calls > 1 and len(resets) == 1 and C.shape[0] < K
+    merging.merge_components(Y, A, [], C + 1, None, [], C, [], {'p': 0}, {}, thr=.5, merge_graph=graph)
+    assert len(resets) == 2
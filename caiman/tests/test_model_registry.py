@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import numpy.testing as npt
+import threading
+import time
+
+from caiman import model_registry
+
+
+def test_registry():
+    # concurrent requests load a model once, and the least recently used model is evicted
+    registry = model_registry.ModelRegistry(max_models=2)
+    loads, closed = [], []
+
+    class Model:
+        def __init__(self, key):
+            self.key = key
+
+        def close(self):
+            closed.append(self.key)
+
+    def loader(key):
+        def load():
+            loads.append(key)
+            time.sleep(.05)
+            return Model(key)
+        return load
+
+    with ThreadPoolExecutor(8) as pool:
+        entries = list(pool.map(lambda i: registry.get('a', loader('a')), range(8)))
+    assert loads == ['a'] and all(entry is entries[0] for entry in entries)
+    assert isinstance(entries[0].lock, type(threading.RLock()))
+    registry.get('b', loader('b'))
+    registry.get('a', loader('a'))
+    registry.get('c', loader('c'))
+    # the evicted model is still usable by whoever holds it
+    assert loads == ['a', 'b', 'c'] and closed == []
+    assert registry.keys() == ['a', 'c']
+    registry.clear()
+    assert registry.keys() == [] and sorted(closed) == ['a', 'c']
+
+
+def test_classifier():
+    # the predictions of all backends go through predict in batches
+    class Interpreter:
+        # stand-in for the TF-Lite interpreter
+        def __init__(self):
+            self.shape, self.sizes = np.array([1, 4, 4, 1]), []
+
+        def allocate_tensors(self):
+            pass
+
+        def get_input_details(self):
+            return [{'index': 0, 'shape': self.shape}]
+
+        def get_output_details(self):
+            return [{'index': 1}]
+
+        def resize_tensor_input(self, index, shape):
+            self.shape = np.array(shape)
+
+        def set_tensor(self, index, x):
+            self.sizes.append(len(x))
+            self.x = x
+
+        def invoke(self):
+            self.y = np.stack([self.x.sum((1, 2, 3)), self.x.max((1, 2, 3))], 1)
+
+        def get_tensor(self, index):
+            return self.y
+
+    classifier = model_registry.Classifier('tflite', Interpreter())
+    assert classifier.input_shape == (4, 4, 1)
+    classifier.warm_up()
+    x = np.random.RandomState(0).rand(70, 4, 4, 1)
+    npt.assert_allclose(classifier.predict(x, batch_size=32), np.stack([x.sum((1, 2, 3)), x.max((1, 2, 3))], 1),
+                        rtol=1e-5)
+    assert classifier.model.sizes == [1, 32, 32, 6]
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+import numpy as np
+import numpy.testing as npt
+from scipy.ndimage import gaussian_filter, shift
+
+from caiman import motion_correction
+
+
+def gen_frames(n_frames=12, dims=(60, 47), max_shift=4):
+    rng = np.random.RandomState(0)
+    template = gaussian_filter(rng.rand(*dims), 2) * 100 + 10
+    frames = np.array([shift(template, rng.uniform(-max_shift, max_shift, len(dims))) + rng.rand(*dims)
+                       for _ in range(n_frames)])
+    return frames, template
+
+
+def test_register_translation_batch():
+    frames, template = gen_frames()
+    for upsample_factor in (1, 10):
+        for bounds in ({'max_shifts': (6, 6)}, {'shifts_lb': (-2, -3), 'shifts_ub': (3, 1)}):
+            shifts, phasediffs = motion_correction.register_translation_batch(
+                frames, template, upsample_factor=upsample_factor, **bounds)
+            for frame, sh, ph in zip(frames, shifts, phasediffs):
+                sh_ref, _, ph_ref = motion_correction.register_translation(
+                    frame, template, upsample_factor=upsample_factor, **bounds)
+                npt.assert_allclose(sh, sh_ref)
+                npt.assert_allclose(ph, ph_ref, atol=1e-10)
+
+
+def test_correct_rigid_batch():
+    frames, template = gen_frames()
+    for shifts_opencv in (False, True):
+        for border_nan in (True, False, 'min', 'copy'):
+            mc, shifts = motion_correction.correct_rigid_batch(
+                frames, template, (6, 6), add_to_movie=5., shifts_opencv=shifts_opencv,
+                border_nan=border_nan, batch_size=5)
+            for frame, img, sh in zip(frames, mc, shifts):
+                img_ref, sh_ref, _, _ = motion_correction.tile_and_correct(
+                    frame, template, None, None, (6, 6), add_to_movie=5., max_deviation_rigid=0,
+                    shifts_opencv=shifts_opencv, border_nan=border_nan)
+                npt.assert_allclose(sh, sh_ref)
+                npt.assert_allclose(img, img_ref.astype(np.float32), rtol=1e-5, atol=1e-3)
+
+
+def test_patch_stack():
+    for dims, overlaps, strides, window in (((100, 77), (10, 12), (24, 20), motion_correction.sliding_window),
+                                            ((40, 37, 20), (4, 4, 3), (12, 10, 6), motion_correction.sliding_window_3d)):
+        img = np.random.rand(*dims)
+        patches, grid, starts = motion_correction.patch_stack(img, overlaps, strides)
+        ref = list(window(img, overlaps, strides))
+        npt.assert_array_equal(patches, [it[-1] for it in ref])
+        assert grid == [it[:len(dims)] for it in ref]
+        assert starts == [it[len(dims):-1] for it in ref]
+
+
+def test_batch_3d():
+    frames, template = gen_frames(n_frames=4, dims=(30, 27, 14), max_shift=3)
+    shifts, phasediffs = motion_correction.register_translation_batch(
+        frames, template, upsample_factor=10, max_shifts=(5, 5, 4))
+    for frame, sh, ph in zip(frames, shifts, phasediffs):
+        sh_ref, _, ph_ref = motion_correction.register_translation_3d(
+            frame, template, upsample_factor=10, max_shifts=(5, 5, 4))
+        npt.assert_allclose(sh, sh_ref)
+        npt.assert_allclose(ph, ph_ref, atol=1e-6)
+    new_frames = motion_correction.apply_shifts_dft_batch(frames, -shifts, phasediffs, border_nan='copy')
+    for frame, new_frame, sh, ph in zip(frames, new_frames, shifts, phasediffs):
+        npt.assert_allclose(new_frame, motion_correction.apply_shifts_dft(
+            frame, -sh, ph, is_freq=False, border_nan='copy'), atol=1e-8)
+
+
+def test_template_spectra():
+    frames, template = gen_frames(n_frames=3, dims=(64, 60))
+    cache = motion_correction.TemplateSpectra()
+    for frame in frames:
+        for max_deviation_rigid in (0, 2):
+            res = motion_correction.tile_and_correct(
+                frame, template, (24, 24), (12, 12), (6, 6), add_to_movie=5., max_deviation_rigid=max_deviation_rigid)
+            res_cached = motion_correction.tile_and_correct(
+                frame, template, (24, 24), (12, 12), (6, 6), add_to_movie=5., max_deviation_rigid=max_deviation_rigid,
+                template_spectra=cache)
+            npt.assert_allclose(res_cached[0], res[0], atol=1e-8)
+            npt.assert_allclose(res_cached[1], res[1])
+    # the spectra of the template and of its patches are computed once
+    assert cache.report()['n_spectra'] == 2 and cache.misses == 2 and cache.hits == 7
+    assert cache.nbytes > 0
+    # the least recently used spectra are dropped for other templates
+    cache.get(template + 1)
+    assert cache.report()['n_spectra'] == 2 and cache.misses == 3
+    cache.get(template, 5., (12, 12), (24, 24))
+    assert cache.misses == 3
+    cache.get(template + 2)
+    cache.get(template + 1)
+    assert cache.report()['n_spectra'] == 2 and cache.misses == 5
+    cache.invalidate()
+    assert cache.nbytes == 0
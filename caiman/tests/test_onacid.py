@@ -1,10 +1,27 @@
 #!/usr/bin/env python
+import functools
+import numpy as np
 import numpy.testing as npt
 import os
+import pathlib
+import scipy.signal
+import tempfile
+import tifffile
 from caiman.source_extraction import cnmf
 from caiman.paths import caiman_datadir
 
 
+def tmp_path_fixture(test):
+    # pytest passes its tmp_path fixture, under nose a temporary directory is made and removed
+    @functools.wraps(test)
+    def wrapper(tmp_path=None):
+        if tmp_path is not None:
+            return test(tmp_path)
+        with tempfile.TemporaryDirectory() as folder:
+            return test(pathlib.Path(folder))
+    return wrapper
+
+
 def demo():
 
     fname = [os.path.join(caiman_datadir(), 'example_movies', 'demoMovie.tif')]
@@ -53,3 +70,80 @@ def demo():
 def test_onacid():
     demo()
     pass
+
+
+@tmp_path_fixture
+def test_fit_next_batch(tmp_path):
+    # fitting blocks of frames gives the same traces and shapes as fitting frame by frame
+    rng = np.random.RandomState(0)
+    T, d1, d2, K = 400, 40, 40, 6
+    yy, xx = np.mgrid[:d1, :d2]
+    A = np.stack([np.exp(-((yy - y)**2 + (xx - x)**2) / 8.) for y, x in rng.randint(6, d1 - 6, (K, 2))], -1)
+    C = scipy.signal.lfilter([1], [1, -.9], (rng.rand(K, T) < .02) * rng.rand(K, T) * 3, axis=1)
+    Y = np.einsum('ijk,kt->tij', A, C) + .2 * rng.randn(T, d1, d2) + 1
+    fname = str(tmp_path / 'mov.tif')
+    tifffile.imwrite(fname, Y.astype(np.float32))
+    results = []
+    for batch_frames in (1, 10):
+        opts = cnmf.params.CNMFParams(params_dict={
+            'fnames': [fname], 'fr': 10, 'decay_time': .5, 'gSig': (3, 3), 'p': 1, 'nb': 1,
+            'init_batch': 200, 'K': K, 'motion_correct': False, 'init_method': 'bare',
+            'update_num_comps': False, 'batch_frames': batch_frames})
+        cnm = cnmf.online_cnmf.OnACID(params=opts)
+        cnm.fit_online()
+        results.append(cnm.estimates)
+    npt.assert_allclose(results[1].C, results[0].C, atol=1e-2 * results[0].C.max())
+    npt.assert_allclose(results[1].A.toarray(), results[0].A.toarray(), atol=1e-2 * results[0].A.max())
+    # the statistics are updated with the minibatches of fit_next
+    for batch_frames in (1, 7):
+        opts.change_params({'batch_update_suff_stat': True, 'batch_frames': batch_frames})
+        cnm_ = cnmf.online_cnmf.OnACID(params=opts)
+        cnm_.fit_online()
+        results.append(cnm_.estimates)
+    npt.assert_allclose(results[3].C, results[2].C, atol=1e-2 * results[2].C.max())
+    npt.assert_allclose(results[3].CC, results[2].CC, atol=1e-3 * np.abs(results[2].CC).max())
+    # the frames of a block are checked against the budget once it is fit, with a share of its fit
+    class OnACID(cnmf.online_cnmf.OnACID):
+        def on_frame_over_budget(self, t, latency):
+            over_budget.append((t, latency))
+    over_budget = []
+    opts.change_params({'batch_update_suff_stat': False, 'batch_frames': 10, 'frame_budget': 0})
+    cnm_ = OnACID(params=opts)
+    cnm_.fit_online()
+    assert [t for t, _ in over_budget] == list(range(200, T))
+    npt.assert_allclose([latency for _, latency in over_budget], cnm_.estimates.timings['total'])
+    assert cnm_.estimates.timings['total'].sum() >= cnm_.estimates.timings['demix'].sum()
+    # the latencies of the stages are exported with one entry per block
+    timings = results[1].timings
+    assert len(timings['total']) == T - 200 and len(timings['demix']) == (T - 200) // 10
+    stats = cnm.timing_stats()
+    assert stats['demix']['p50'] <= stats['demix']['p99'] <= stats['demix']['max']
+    assert stats['total']['hist'][0].sum() == T - 200
+    fname = str(tmp_path / 'timings.csv')
+    cnm.save_timings(fname)
+    npt.assert_allclose(np.genfromtxt(fname, delimiter=',', names=True)['stats'][:len(timings['stats'])],
+                        timings['stats'])
+
+
+@tmp_path_fixture
+def test_fit_next_batch_motion_correct(tmp_path):
+    # the frames of a block are registered against the last fitted frame, and new components are found
+    rng = np.random.RandomState(0)
+    T, d1, d2, K = 400, 40, 40, 8
+    yy, xx = np.mgrid[:d1, :d2]
+    A = np.stack([np.exp(-((yy - y)**2 + (xx - x)**2) / 8.) for y, x in rng.randint(8, d1 - 8, (K, 2))], -1)
+    C = scipy.signal.lfilter([1], [1, -.9], (rng.rand(K, T) < .02) * rng.rand(K, T) * 3 + .3, axis=1)
+    Y = np.einsum('ijk,kt->tij', A, C) + .2 * rng.randn(T, d1, d2) + 1
+    shifts = rng.randint(-2, 3, (T, 2))
+    shifts[:200] = 0
+    Y = np.stack([np.roll(y, s, (0, 1)) for y, s in zip(Y, shifts)])
+    fname = str(tmp_path / 'mov.tif')
+    tifffile.imwrite(fname, Y.astype(np.float32))
+    opts = cnmf.params.CNMFParams(params_dict={
+        'fnames': [fname], 'fr': 10, 'decay_time': .5, 'gSig': (3, 3), 'p': 1, 'nb': 1,
+        'init_batch': 200, 'K': 5, 'motion_correct': True, 'max_shifts_online': 4,
+        'init_method': 'bare', 'update_num_comps': True, 'batch_frames': 10})
+    cnm = cnmf.online_cnmf.OnACID(params=opts)
+    cnm.fit_online()
+    npt.assert_allclose(cnm.estimates.shifts[200:], -shifts[200:], atol=.5)
+    assert cnm.estimates.A.shape[-1] > 5
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+import os
+import tempfile
+import tifffile
 import numpy.testing as npt
 import numpy as np
 from caiman.source_extraction import cnmf as cnmf
@@ -12,3 +15,30 @@ def test_axcov():
     print(C)
 
     npt.assert_allclose(C, np.concatenate((np.zeros(maxlag), np.array([1]), np.zeros(maxlag))), atol=1)
+
+
+def test_noise_welch_stream():
+    # the noise accumulated over chunks of frames is the Welch estimate on the whole movie
+    Y = np.random.randn(700, 6, 5) * np.random.rand(6, 5) + .1 * np.cumsum(np.random.randn(700, 6, 5), 0)
+    for method in ('mean', 'median', 'logmexp'):
+        expected = cnmf.pre_processing.get_noise_welch(Y.transpose(1, 2, 0), noise_method=method,
+                                                       max_num_samples_fft=len(Y))
+        for chunk_size, max_bytes in ((99, 2**28), (None, 2**12)):
+            sn = cnmf.pre_processing.get_noise_welch_stream(iter(Y), noise_method=method, chunk_size=chunk_size,
+                                                            max_bytes=max_bytes)
+            assert sn.dtype == np.float32
+            npt.assert_allclose(sn, expected, rtol=1e-5)
+
+
+def test_preprocess_file():
+    # a movie file is not interpolated: missing data is reported
+    Y = np.random.rand(300, 6, 5).astype(np.float32)
+    with tempfile.TemporaryDirectory() as folder:
+        fname = os.path.join(folder, 'mov.tif')
+        tifffile.imwrite(fname, Y)
+        Yr, sn = cnmf.pre_processing.preprocess_data(fname)[:2]
+        assert Yr == fname and sn.shape == (30,)
+        Y[100, 2, 3] = np.nan
+        tifffile.imwrite(fname, Y)
+        npt.assert_raises(Exception, cnmf.pre_processing.preprocess_data, fname)
+        assert np.isnan(cnmf.pre_processing.preprocess_data(fname, check_nan=False)[1]).sum() == 1
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import numpy.testing as npt
+import nose
+import scipy.sparse
+
+from caiman import mmapping, shared_arrays
+from caiman.executors import parallel_map
+
+
+def column_sum(pars):
+    handle, column = pars
+    return np.asarray(shared_arrays.attach(handle)[:, column].sum())
+
+
+def test_publish():
+    dense = np.random.rand(50, 7)
+    sparse = scipy.sparse.random(50, 7, density=.2, format='csc')
+    pool = multiprocessing.Pool(2)
+    try:
+        for dview in (None, pool):
+            with shared_arrays.SharedArrays(dview) as shared:
+                for array in (dense, sparse):
+                    handle = shared.publish(array)
+                    sums = parallel_map(dview, column_sum, [(handle, i) for i in range(7)])
+                    npt.assert_allclose(np.ravel(sums), np.ravel(array.sum(0)))
+                    if dview is not None:
+                        assert shared.mode == ('shared' if shared_arrays.HAS_SHARED_MEMORY else 'file')
+                        npt.assert_allclose(shared_arrays.attach(handle).sum(), array.sum())
+            if dview is not None and shared_arrays.HAS_SHARED_MEMORY:
+                # the blocks are gone once the registry is released
+                nose.tools.assert_raises(FileNotFoundError, shared_arrays.attach, handle.data)
+    finally:
+        pool.terminate()
+
+
+TRACKER_SCRIPT = """
+import multiprocessing
+import numpy as np
+from caiman import shared_arrays
+from caiman.executors import parallel_map
+
+def total(handle):
+    return float(shared_arrays.attach(handle).sum())
+
+early = multiprocessing.Pool(2, maxtasksperchild=1)
+with shared_arrays.SharedArrays(early) as shared:
+    handle = shared.publish(np.ones(1000))
+    late = multiprocessing.Pool(2, maxtasksperchild=1)
+    for pool in (early, late):
+        assert parallel_map(pool, total, [handle] * 6) == [1000.] * 6
+    assert shared_arrays.attach(handle).sum() == 1000
+early.terminate()
+late.terminate()
+"""
+
+
+def test_resource_tracker():
+    # workers started before (own resource tracker) or after (shared one) the first block was
+    # published neither unlink it when they exit nor make the tracker complain at release
+    if not shared_arrays.HAS_SHARED_MEMORY or os.name != 'posix':
+        raise nose.SkipTest('no resource tracker')
+    res = subprocess.run([sys.executable, '-c', TRACKER_SCRIPT], stderr=subprocess.PIPE, universal_newlines=True)
+    assert res.returncode == 0, res.stderr
+    assert 'resource_tracker' not in res.stderr and 'KeyError' not in res.stderr, res.stderr
+
+
+def test_parallel_dot_product():
+    tmpdir = pathlib.Path(tempfile.mkdtemp())
+    data = np.random.rand(30, 10, 12).astype(np.float32)
+    b = np.random.rand(30, 4).astype(np.float32)
+    pool = multiprocessing.Pool(2)
+    try:
+        fname = mmapping.save_memmap([data], base_name=str(tmpdir / "Yr"), order="C")
+        Yr, _, _ = mmapping.load_memmap(fname)
+        for dview in (None, pool):
+            npt.assert_allclose(mmapping.parallel_dot_product(Yr, b, block_size=17, dview=dview),
+                                np.array(Yr).dot(b), rtol=1e-4)
+            bt = np.random.rand(120, 3).astype(np.float32)
+            npt.assert_allclose(mmapping.parallel_dot_product(Yr, bt, block_size=17, dview=dview, transpose=True),
+                                np.array(Yr).T.dot(bt), rtol=1e-4)
+        del Yr
+    finally:
+        pool.terminate()
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+import numpy as np
+import numpy.testing as npt
+from sklearn.linear_model import LassoLars
+import warnings
+
+from caiman.source_extraction.cnmf import spatial
+
+
+def test_regression_gram():
+    # the regressions solved from the covariances of C and Y match the ones on the traces
+    rng = np.random.RandomState(0)
+    T, K, P = 500, 6, 60
+    C = np.maximum(rng.randn(K, T), 0) + 100 * rng.rand(K, 1)   # large baselines, ill-conditioned C*C'
+    C[-1] = 1
+    A = np.maximum(rng.randn(P, K), 0) * (rng.rand(P, K) > .5)
+    Y = (A.dot(C) + .3 * rng.randn(P, T)).astype(np.float32)
+    sn = np.full(P, .3)
+    idxs_C = [np.where(a > 0)[0] if np.any(a > 0) else np.array([K - 1]) for a in A]
+    cct = np.diag(C.dot(C.T))[:-1]
+    for method in ('lasso_lars', 'nnls_L0'):
+        for CCt in (None, (C - C.mean(1, keepdims=True)).dot((C - C.mean(1, keepdims=True)).T)):
+            result = spatial.regression_ipyparallel([Y, C, sn, idxs_C, list(range(P)), method, cct, CCt])
+            assert len(result) == P
+            for px, idxs, a in result:
+                y, c = Y[px].astype(np.float64), C[idxs].T
+                if method == 'lasso_lars':
+                    cct_ = cct[idxs[idxs < len(cct)]]
+                    alpha = 0 if cct_.size == 0 else .5 * sn[px] * np.sqrt(np.max(cct_)) / T
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore')                # normalize is deprecated
+                        expected = LassoLars(alpha=alpha, positive=True, fit_intercept=True,
+                                             normalize=True).fit(c, y).coef_
+                else:
+                    expected = spatial.nnls_L0(c, y, 1.2 * sn[px] ** 2 * T)
+                npt.assert_allclose(a, expected, atol=1e-8)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import numpy as np
+import numpy.testing as npt
+
+from caiman.utils import stats
+
+
+def hsm_reference(data):
+    # recursive half-sample mode of sorted data, as previously implemented in stats._hsm
+    if data.size == 1:
+        return data[0]
+    elif data.size == 2:
+        return data.mean()
+    elif data.size == 3:
+        i1 = data[1] - data[0]
+        i2 = data[2] - data[1]
+        if i1 < i2:
+            return data[:2].mean()
+        elif i2 > i1:
+            return data[1:].mean()
+        else:
+            return data[1]
+    else:
+        wMin = np.inf
+        N = data.size // 2 + data.size % 2
+        for i in range(0, N):
+            w = data[i + N - 1] - data[i]
+            if w < wMin:
+                wMin = w
+                j = i
+        return hsm_reference(data[j:j + N])
+
+
+def mode_reference(data, axis):
+    return np.apply_along_axis(lambda x: hsm_reference(np.sort(x)), axis, data)
+
+
+def df_percentile_reference(data):
+    # kde and df_percentile of one row at a time
+    result = np.array([stats.df_percentile(row) for row in data])
+    return result[:, 0], result[:, 1]
+
+
+def test_mode_robust():
+    # the vectorized half-sample mode matches the recursive one, along any axis and in batches
+    rng = np.random.RandomState(0)
+    for T in (1, 2, 3, 4, 5, 8, 101):
+        for dtype in (np.float32, np.float64):
+            data = (10 * rng.randn(4, 3, T)).astype(dtype)
+            data[..., ::3] = data[..., :1]                     # ties
+            for axis in (0, 1, -1):
+                expected = mode_reference(data, axis)
+                for mode in (stats.mode_robust(data, axis=axis, batch_size=5),
+                             stats.mode_robust_fast(data, axis=axis)):
+                    assert mode.dtype == expected.dtype
+                    npt.assert_array_equal(mode, expected)
+            assert stats.mode_robust(data) == hsm_reference(np.sort(data.ravel()))
+    data = rng.randn(20, 50)
+    data[3, :5] = np.nan
+    npt.assert_array_equal(stats.mode_robust_rows(data), mode_reference(data, 1))
+
+
+def test_df_percentile():
+    # the batched density estimation matches the estimation row by row
+    rng = np.random.RandomState(0)
+    for dtype in (np.float32, np.float64):
+        data = (np.maximum(rng.randn(30, 1000), 0) * 5 * rng.rand(30, 1) + rng.randn(30, 1000)).astype(dtype)
+        data[0] = 1                                            # degenerate density, estimated on its own
+        data_prct, val = stats.df_percentile(data, axis=1, batch_size=8)
+        expected_prct, expected_val = df_percentile_reference(data)
+        npt.assert_allclose(data_prct, expected_prct, rtol=1e-6)
+        npt.assert_allclose(val, expected_val, rtol=1e-6)
+        data_prct, val = stats.df_percentile(data.T, axis=0)
+        npt.assert_allclose(data_prct, expected_prct, rtol=1e-6)
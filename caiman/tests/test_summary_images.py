@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import numpy as np
+import numpy.testing as npt
+
+from caiman import summary_images
+from caiman.source_extraction.cnmf.pre_processing import get_noise_welch
+
+
+def test_correlation_stats():
+    # the correlation image from the statistics of chunks matches the one of the whole movie
+    Y = np.random.randn(400, 20, 25).astype(np.float32) + 100
+    Y[:, 3:8, 3:8] += 3 * np.maximum(np.random.randn(400, 1, 1), 0)
+    for eight_neighbours in (True, False):
+        stats = summary_images.reduce_stats(summary_images.correlation_stats(Y[i:i + 150], eight_neighbours)
+                                            for i in range(0, 400, 150))
+        npt.assert_allclose(summary_images.correlation_image_from_stats(stats, eight_neighbours),
+                            summary_images.local_correlations_fft(Y, eight_neighbours, swap_dim=False), atol=1e-5)
+
+
+def test_correlation_pnr_offline():
+    # streamed chunks give the images of the whole filtered movie, with the Welch noise level
+    T = 700
+    Y = np.random.randn(T, 30, 35).astype(np.float32) + 100
+    Y[:, 10:15, 10:15] += 5 * np.maximum(np.random.randn(T, 1, 1), 0)
+    filtered = summary_images.filter_frames(Y, gSig=3)
+    filtered -= filtered.mean(0)
+    std = get_noise_welch(filtered.transpose(1, 2, 0), noise_method='mean', max_num_samples_fft=T)
+    thresholded = filtered / std
+    thresholded[thresholded < 3] = 0
+    cn, pnr = summary_images.correlation_pnr_offline(Y, gSig=3, chunk_size=200)
+    npt.assert_allclose(pnr, np.maximum(filtered.max(0) / std, 0), rtol=1e-4)
+    npt.assert_allclose(cn, summary_images.local_correlations_fft(thresholded, swap_dim=False), atol=1e-3)
+
+
+def test_local_correlations_class():
+    # batch updates match frame by frame updates, and the restored state the original one
+    Y = np.random.randn(160, 12, 15).astype(np.float32)
+    for mode in ('simple', 'exponential', 'cumulative'):
+        frame_by_frame = summary_images.LocalCorrelations(Y[:40], mode=mode)
+        batched = summary_images.LocalCorrelations(Y[:40], mode=mode)
+        for t in range(40, 160):
+            cn = frame_by_frame.update(Y[t:t + 1], Y[t - 40:t - 39] if mode == 'simple' else None)
+        for t in range(40, 160, 30):
+            cn_batch = batched.update(Y[t:t + 30], Y[t - 40:t - 10] if mode == 'simple' else None)
+        npt.assert_allclose(cn_batch, cn, atol=1e-5)
+        if mode == 'simple':
+            npt.assert_allclose(cn, summary_images.local_correlations(Y[-40:], False, swap_dim=False), atol=1e-4)
+        restored = summary_images.LocalCorrelations.from_state(batched.state())
+        npt.assert_array_equal(restored.image(), cn_batch)
@@ -2,6 +2,7 @@
 
 import numpy.testing as npt
 import numpy as np
+import scipy.sparse
 from caiman.source_extraction import cnmf
 
 
@@ -21,3 +22,19 @@ def test_make_G_matrix():
     # yapf: enable
 
     npt.assert_allclose(G, true_G)
+
+
+def test_update_temporal_threads():
+    # the residuals updated by several threads match the ones of a single thread
+    rng = np.random.RandomState(0)
+    d, K, T = 400, 12, 300
+    A = scipy.sparse.random(d, K, density=.1, random_state=rng, format='csc')
+    C = np.maximum(rng.randn(K, T), 0)
+    b, f = rng.rand(d, 1), np.ones((1, T))
+    Y = A.dot(C) + b.dot(f) + .1 * rng.randn(d, T)
+    results = [cnmf.temporal.update_temporal_components(
+        Y, A, b, C, f, p=1, method_deconvolution='oasis', n_threads=n_threads)
+        for n_threads in (1, 3)]
+    for r1, r3 in zip(*results):
+        if isinstance(r1, np.ndarray) and r1.dtype != object:
+            npt.assert_allclose(r1, r3)
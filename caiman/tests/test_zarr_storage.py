@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+
+import nose
+import numpy as np
+import numpy.testing as npt
+
+from caiman import mmapping, zarr_storage
+from caiman.cluster import extract_patch_coordinates
+from caiman.base.movies import load, load_iter
+from caiman.source_extraction.cnmf import map_reduce, params
+from caiman.tests.test_map_reduce import gen_data
+
+
+def test_patch_aligned_chunks():
+    chunks = zarr_storage.patch_aligned_chunks((100, 90), rf=16, stride=4, chunk_bytes=28 * 28 * 4 * 10)
+    assert chunks == (10, 28, 28)
+    # the patches start on a chunk boundary, but the last ones along each dimension end on the border
+    coords = extract_patch_coordinates((100, 90), [16, 16], [4, 4])[0]
+    starts = np.array([np.unravel_index(idx.min(), (100, 90), order='F') for idx in coords])
+    for dim_starts, dim, chunk in zip(starts.T, (100, 90), chunks[1:]):
+        dim_starts = np.unique(dim_starts)
+        assert np.all(dim_starts[:-1] % chunk == 0)
+        assert dim_starts[-1] == dim - 2 * 16
+
+
+def test_save_load_zarr():
+    if not zarr_storage.HAS_ZARR:
+        raise nose.SkipTest('zarr is not installed')
+    tmpdir = tempfile.mkdtemp()
+    data = np.random.rand(25, 20, 21).astype(np.float32)
+    try:
+        fname = zarr_storage.save_zarr([data[:12], data[12:]], os.path.join(tmpdir, 'mov.zarr'),
+                                       rf=5, stride=2, fr=20.)
+        Y = zarr_storage.load_zarr(fname)
+        assert Y.chunks[1:] == (8, 8)
+        npt.assert_array_equal(Y[:], data)
+
+        m = load(fname, fr=None)
+        assert m.fr == 20.
+        npt.assert_array_equal(m, data)
+        npt.assert_array_equal(load(fname, subindices=slice(3, 20, 2)), data[3:20:2])
+        npt.assert_array_equal(np.array(list(load_iter(fname, subindices=slice(3, 20, 2)))), data[3:20:2])
+
+        # the chunks are copied to the rows they cover, with the values saved from the array
+        fname_mmap = mmapping.save_memmap([fname], base_name=os.path.join(tmpdir, 'Yr'), order='C')
+        fname_ref = mmapping.save_memmap([data], base_name=os.path.join(tmpdir, 'ref'), order='C')
+        Yr, dims, T = mmapping.load_memmap(fname_mmap)
+        Yr_ref, _, _ = mmapping.load_memmap(fname_ref)
+        npt.assert_array_equal(Yr, Yr_ref)
+        assert mmapping.load_memmap_metadata(fname_mmap)['fr'] == 20.
+        del Yr, Yr_ref
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_zarr_patch():
+    if not zarr_storage.HAS_ZARR:
+        raise nose.SkipTest('zarr is not installed')
+    # a patch read from the store is fitted as the one read from the memory mapped file
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data = gen_data()
+        dims = data.shape[1:]
+        fname_zarr = zarr_storage.save_zarr([data], os.path.join(tmpdir, 'mov.zarr'), rf=8, stride=2)
+        fname_mmap = mmapping.save_memmap([data], base_name=os.path.join(tmpdir, 'Yr'), order='C')
+        idx = np.ravel_multi_index(np.mgrid[2:28, 4:26].reshape(2, -1), dims, order='F')
+        opts = params.CNMFParams(params_dict={'K': 3, 'gSig': (2, 2), 'p': 0, 'nb_patch': 1})
+        res_zarr, res_mmap = [map_reduce.cnmf_patches((fname, idx, dims, opts)) for fname in (fname_zarr, fname_mmap)]
+        npt.assert_allclose(res_zarr[2].toarray(), res_mmap[2].toarray(), rtol=1e-5, atol=1e-7)
+        npt.assert_allclose(res_zarr[4], res_mmap[4], rtol=1e-5, atol=1e-5)
+    finally:
+        shutil.rmtree(tmpdir)
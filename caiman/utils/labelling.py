@@ -9,6 +9,7 @@ Created on Thu Oct 20 15:18:21 2016
 
 from builtins import map
 import caiman as cm
+from caiman.executors import parallel_map
 #%%
 
 def pre_preprocess_movie_labeling(dview, file_names, median_filter_size=(2, 1, 1),
@@ -70,10 +71,6 @@ def pre_preprocess_movie_labeling(dview, file_names, median_filter_size=(2, 1, 1
         args.append(
             [name, resize_factors, diameter_bilateral_blur, median_filter_size])
 
-    if dview is not None:
-        file_res = dview.map_sync(pre_process_handle, args)
-        dview.results.clear()
-    else:
-        file_res = list(map(pre_process_handle, args))
+    file_res = parallel_map(dview, pre_process_handle, args)
 
     return file_res
@@ -7,7 +7,6 @@ Created on Thu Oct 20 13:49:57 2016
 """
 
 from builtins import range
-from past.utils import old_div
 
 import logging
 import numpy as np
@@ -24,19 +23,17 @@ from scipy import fftpack
 #%%
 
 
-def mode_robust_fast(inputData, axis=None):
+def mode_robust_fast(inputData, axis=None, batch_size=None):
     """
     Robust estimator of the mode of a data set using the half-sample mode.
 
+    Along an axis, the data are processed in batches of batch_size rows (see mode_robust_rows).
+
     .. versionadded: 1.0.3
     """
 
     if axis is not None:
-
-        def fnc(x):
-            return mode_robust_fast(x)
-
-        dataMode = np.apply_along_axis(fnc, axis, inputData)
+        dataMode = _mode_along_axis(inputData, axis, batch_size)
     else:
         # Create the function that we can use for the half-sample mode
         data = inputData.ravel()
@@ -51,47 +48,28 @@ def mode_robust_fast(inputData, axis=None):
 #%%
 
 
-def mode_robust(inputData, axis=None, dtype=None):
+def mode_robust(inputData, axis=None, dtype=None, batch_size=None):
     """
     Robust estimator of the mode of a data set using the half-sample mode.
 
+    Along an axis, the data are processed in batches of batch_size rows (see mode_robust_rows).
+
     .. versionadded: 1.0.3
     """
     if axis is not None:
+        if type(inputData).__name__ == "MaskedArray":
+            # the rows have different lengths once compressed
 
-        def fnc(x):
-            return mode_robust(x, dtype=dtype)
+            def fnc(x):
+                return mode_robust(x, dtype=dtype)
 
-        dataMode = np.apply_along_axis(fnc, axis, inputData)
+            dataMode = np.apply_along_axis(fnc, axis, inputData)
+        else:
+            data = np.asarray(inputData)
+            if dtype is not None:
+                data = data.astype(dtype)
+            dataMode = _mode_along_axis(data, axis, batch_size)
     else:
-        # Create the function that we can use for the half-sample mode
-        def _hsm(data):
-            if data.size == 1:
-                return data[0]
-            elif data.size == 2:
-                return data.mean()
-            elif data.size == 3:
-                i1 = data[1] - data[0]
-                i2 = data[2] - data[1]
-                if i1 < i2:
-                    return data[:2].mean()
-                elif i2 > i1:
-                    return data[1:].mean()
-                else:
-                    return data[1]
-            else:
-
-                wMin = np.inf
-                N = data.size // 2 + data.size % 2
-
-                for i in range(0, N):
-                    w = data[i + N - 1] - data[i]
-                    if w < wMin:
-                        wMin = w
-                        j = i
-
-                return _hsm(data[j:j + N])
-
         data = inputData.ravel()
         if type(data).__name__ == "MaskedArray":
             data = data.compressed()
@@ -107,36 +85,74 @@ def mode_robust(inputData, axis=None, dtype=None):
     return dataMode
 
 
+def _mode_along_axis(data, axis, batch_size=None):
+    """ half-sample mode along axis, in batches of batch_size rows """
+    data = np.moveaxis(np.asarray(data), axis, -1)
+    shape, n = data.shape[:-1], data.shape[-1]
+    rows = data.reshape(-1, n)
+    if batch_size is None:
+        batch_size = max(2**22 // max(n, 1), 1)
+    modes = [mode_robust_rows(rows[i:i + batch_size]) for i in range(0, len(rows), batch_size)]
+    if not modes:
+        return np.zeros(shape, dtype=data.dtype)
+    return np.concatenate(modes).reshape(shape)
+
+
 #%%
-#@numba.jit("void(f4[:])")
 
 
 def _hsm(data):
-    if data.size == 1:
-        return data[0]
-    elif data.size == 2:
-        return data.mean()
-    elif data.size == 3:
-        i1 = data[1] - data[0]
-        i2 = data[2] - data[1]
-        if i1 < i2:
-            return data[:2].mean()
-        elif i2 > i1:
-            return data[1:].mean()
-        else:
-            return data[1]
-    else:
+    """ half-sample mode of sorted data """
+    return mode_robust_rows(data[None], presorted=True)[0]
 
-        wMin = np.inf
-        N = old_div(data.size, 2) + data.size % 2
 
-        for i in range(0, N):
-            w = data[i + N - 1] - data[i]
-            if w < wMin:
-                wMin = w
-                j = i
+def mode_robust_rows(data, presorted=False):
+    """
+    Half-sample mode of each row of a 2D array, vectorized over the rows.
 
-        return _hsm(data[j:j + N])
+    All the rows have the same length, hence the same number of halvings: at each
+    step the shortest window of the remaining half of every row is found at once,
+    among the N windows that start in the first half of the remaining samples.
+
+    Args:
+        data: ndarray
+            2D array, the mode of each row is estimated
+
+        presorted: bool
+            whether the rows of data are already sorted in ascending order
+
+    Returns:
+        dataMode: ndarray
+            mode of each row
+    """
+    data = np.asarray(data)
+    if not presorted:
+        data = np.sort(data, axis=1)
+    K, n = data.shape
+    rows = np.arange(K)[:, None]
+    start = np.zeros(K, dtype=np.intp)
+    has_nan = data.dtype.kind == 'f' and np.isnan(data[:, -1]).any()
+    while n > 3:
+        N = n // 2 + n % 2
+        if n == data.shape[1]:
+            w = data[:, N - 1:2 * N - 1] - data[:, :N]
+        else:
+            idx = start[:, None] + np.arange(N)
+            w = data[rows, idx + N - 1] - data[rows, idx]
+        if has_nan:
+            # NaNs are sorted last, windows that contain them are never the shortest
+            w[np.isnan(w)] = np.inf
+        start += np.argmin(w, 1)
+        n = N
+
+    if n == 1:
+        return data[rows[:, 0], start]
+    pairs = np.stack([data[rows[:, 0], start], data[rows[:, 0], start + 1]])
+    if n == 2:
+        return pairs.mean(0)
+    i1 = pairs[1] - pairs[0]
+    i2 = data[rows[:, 0], start + 2] - pairs[1]
+    return np.where(i1 < i2, pairs.mean(0), pairs[1])
 
 
 def compressive_nmf(A, L, R, r, X=None, Y=None, max_iter=100, ls=0):
@@ -194,20 +210,23 @@ def mode_robust_kde(inputData, axis=None):
     return dataMode
 
 
-def df_percentile(inputData, axis=None):
+def df_percentile(inputData, axis=None, batch_size=256):
     """
     Extracting the percentile of the data where the mode occurs and its value.
     Used to determine the filtering level for DF/F extraction. Note that
     computation can be innacurate for short traces.
+
+    Along an axis, the densities of batches of batch_size rows are estimated
+    at once (see kde_rows).
     """
     if axis is not None:
-
-        def fnc(x):
-            return df_percentile(x)
-
-        result = np.apply_along_axis(fnc, axis, inputData)
-        data_prct = result[:, 0]
-        val = result[:, 1]
+        data = np.moveaxis(np.asarray(inputData), axis, -1)
+        shape = data.shape[:-1]
+        rows = data.reshape(-1, data.shape[-1])
+        data_prct, val = np.zeros(len(rows)), np.zeros(len(rows))
+        for i in range(0, len(rows), batch_size):
+            data_prct[i:i + batch_size], val[i:i + batch_size] = _df_percentile_rows(rows[i:i + batch_size])
+        data_prct, val = data_prct.reshape(shape), val.reshape(shape)
     else:
         # Create the function that we can use for the half-sample mode
         err = True
@@ -237,6 +256,20 @@ def df_percentile(inputData, axis=None):
     return data_prct, val
 
 
+def _df_percentile_rows(data):
+    """ df_percentile of each row of a 2D array, rows for which the batched
+    estimate fails are processed one by one """
+    data_prct, val = np.full(len(data), np.nan), np.full(len(data), np.nan)
+    if data.shape[-1] > 1:
+        _, mesh, density, cdf = kde_rows(data)
+        peak = np.argmax(density, 1)
+        rows = np.arange(len(data))
+        data_prct, val = cdf[rows, peak] * 100, mesh[rows, peak]
+    for i in np.where(~((data_prct >= 0) & (data_prct < 100)))[0]:
+        data_prct[i], val[i] = df_percentile(data[i])
+    return data_prct, val
+
+
 """
 An implementation of the kde bandwidth selection method outlined in:
 Z. I. Botev, J. F. Grotowski, and D. P. Kroese. Kernel density
@@ -305,6 +338,154 @@ def fixed_point(t, M, I, a2):
     return t - (2 * M * scipy.sqrt(scipy.pi) * f)**(-2 / 5)
 
 
+def kde_rows(data, N=None):
+    """
+    Kernel density estimation (see kde) of each row of a 2D array.
+
+    The densities of all the rows are estimated at once, the bandwidths are found
+    with a root finder vectorized over the rows. The density of rows for which
+    the root finding fails is NaN.
+
+    Args:
+        data: ndarray
+            2D array, the density of each row is estimated
+
+        N: int
+            number of mesh points, rounded up to a power of 2 (default 2**12)
+
+    Returns:
+        bandwidth, mesh, density, cdf: ndarray
+            as returned by kde, with one row per row of data
+    """
+    N = 2**12 if N is None else int(2**np.ceil(np.log2(N)))
+    K, M = data.shape
+
+    # Parameters to set up the mesh on which to calculate
+    minimum, maximum = data.min(1), data.max(1)
+    Range = (maximum - minimum).astype(np.float64)
+    MIN = minimum - Range / 10
+    MAX = maximum + Range / 10
+    # Range of the data
+    R = MAX - MIN
+
+    # Histogram the data to get a crude first approximation of the density
+    DataHist, bins = zip(*[np.histogram(row, bins=N, range=(lo, hi)) for row, lo, hi in zip(data, MIN, MAX)])
+    DataHist = np.array(DataHist) / M
+    DCTData = fftpack.dct(DataHist, norm=None)
+
+    I = np.arange(1, N, dtype=np.float64)**2
+    SqDCTData = (DCTData[:, 1:] / 2)**2
+
+    # The fixed point calculation finds the bandwidth = t_star
+    def f(t, idx):
+        return fixed_point_rows(t, np.float64(M), I, SqDCTData[idx])
+
+    # degenerate rows give NaN densities
+    with np.errstate(all='ignore'):
+        t_star, converged = _brentq_rows(f, 0, 0.1, K)
+        t_star[~converged] = np.nan
+
+        # Smooth the DCTransformed data using t_star
+        SmDCTData = DCTData * np.exp(-np.arange(N)**2 * np.pi**2 * t_star[:, None] / 2)
+        # Inverse DCT to get density
+        density = fftpack.idct(SmDCTData, norm=None) * N / R[:, None]
+        # the edges have the precision of the data
+        bins = np.array(bins)
+        mesh = ((bins[:, :-1] + bins[:, 1:]) / 2).astype(np.float64)
+        bandwidth = np.sqrt(t_star) * R
+
+        density = density / np.trapz(density, mesh)[:, None]
+        cdf = np.cumsum(density, 1) * (mesh[:, 1:2] - mesh[:, :1])
+
+    return bandwidth, mesh, density, cdf
+
+
+def fixed_point_rows(t, M, I, a2):
+    """ fixed_point for the rows of a2, at the bandwidths t """
+
+    def terms_sum(s, t):
+        # the terms beyond the ones where exp(-I * pi**2 * t) underflows to 0 for all rows are skipped
+        t_min = np.min(t)
+        n = np.searchsorted(I, 746 / (np.pi**2 * t_min)) if t_min > 0 else len(I)
+        return np.sum(I[:n]**s * a2[:, :n] * np.exp(-I[:n] * np.pi**2 * t[:, None]), 1)
+
+    l = 7
+    f = 2 * np.pi**(2 * l) * terms_sum(l, t)
+    for s in range(l, 1, -1):
+        K0 = np.prod(range(1, 2 * s, 2)) / np.sqrt(2 * np.pi)
+        const = (1 + (1 / 2)**(s + 1 / 2)) / 3
+        time = (2 * const * K0 / M / f)**(2 / (3 + 2 * s))
+        f = 2 * np.pi**(2 * s) * terms_sum(s, time)
+    return t - (2 * M * np.sqrt(np.pi) * f)**(-2 / 5)
+
+
+def _brentq_rows(f, xa, xb, K, xtol=2e-12, rtol=4 * np.finfo(float).eps, maxiter=100):
+    """ Brent's method of scipy.optimize.brentq for K functions at once
+
+    Args:
+        f: callable
+            f(x, idx) evaluates the functions of rows idx at x
+
+        xa, xb: float
+            bracketing interval, the same for all the functions
+
+    Returns:
+        root: ndarray
+            root of each function
+
+        converged: ndarray
+            whether the root of each function was found
+    """
+    xpre, xcur = np.full(K, float(xa)), np.full(K, float(xb))
+    everything = np.arange(K)
+    fpre, fcur = f(xpre, everything), f(xcur, everything)
+    xblk, fblk, spre, scur = np.zeros(K), np.zeros(K), np.zeros(K), np.zeros(K)
+    root = np.where(fpre == 0, xpre, xcur)
+    converged = (fpre == 0) | (fcur == 0)
+    active = ~converged & (np.signbit(fpre) != np.signbit(fcur))
+    with np.errstate(all='ignore'):
+        for _ in range(maxiter):
+            idx = np.where(active)[0]
+            if len(idx) == 0:
+                break
+            xp, xc, xb_, fp, fc, fb, sp, sc = (v[idx] for v in (xpre, xcur, xblk, fpre, fcur, fblk, spre, scur))
+
+            bracket = (fp != 0) & (fc != 0) & (np.signbit(fp) != np.signbit(fc))
+            xb_, fb = np.where(bracket, xp, xb_), np.where(bracket, fp, fb)
+            sp, sc = np.where(bracket, xc - xp, sp), np.where(bracket, xc - xp, sc)
+
+            swap = np.abs(fb) < np.abs(fc)
+            xp, xc, xb_ = np.where(swap, xc, xp), np.where(swap, xb_, xc), np.where(swap, xc, xb_)
+            fp, fc, fb = np.where(swap, fc, fp), np.where(swap, fb, fc), np.where(swap, fc, fb)
+
+            delta = (xtol + rtol * np.abs(xc)) / 2
+            sbis = (xb_ - xc) / 2
+            done = (fc == 0) | (np.abs(sbis) < delta)
+            root[idx[done]] = xc[done]
+            converged[idx[done]] = True
+            active[idx[done]] = False
+
+            # interpolate or extrapolate
+            dpre, dblk = (fp - fc) / (xp - xc), (fb - fc) / (xb_ - xc)
+            stry = np.where(xp == xb_, -fc * (xc - xp) / (fc - fp),
+                            -fc * (fb * dblk - fp * dpre) / (dblk * dpre * (fb - fp)))
+            short = ((np.abs(sp) > delta) & (np.abs(fc) < np.abs(fp)) &
+                     (2 * np.abs(stry) < np.minimum(np.abs(sp), 3 * np.abs(sbis) - delta)))
+            sp, sc = np.where(short, sc, sbis), np.where(short, stry, sbis)
+
+            xp, fp = xc, fc
+            xc = xc + np.where(np.abs(sc) > delta, sc, np.where(sbis > 0, delta, -delta))
+
+            keep = ~done
+            idx = idx[keep]
+            for v, w in zip((xpre, xcur, xblk, fpre, fblk, spre, scur), (xp, xc, xb_, fp, fb, sp, sc)):
+                v[idx] = w[keep]
+            if len(idx):
+                fcur[idx] = f(xcur[idx], idx)
+
+    return root, converged
+
+
 def csc_column_remove(A, ind):
     """ Removes specified columns for a scipy.sparse csc_matrix
     Args:
@@ -45,6 +45,7 @@ from urllib.request import urlopen
 
 from ..external.cell_magic_wand import cell_magic_wand
 from ..source_extraction.cnmf.spatial import threshold_components
+from caiman.executors import parallel_map
 from caiman.paths import caiman_datadir
 import caiman.utils
 
@@ -400,10 +401,7 @@ def apply_magic_wand(A, gSig, dims, A_thr=None, coms=None, dview=None,
 
     logging.debug(len(params))
 
-    if dview is not None:
-        masks = np.array(list(dview.map(cell_magic_wand_wrapper, params)))
-    else:
-        masks = np.array(list(map(cell_magic_wand_wrapper, params)))
+    masks = np.array(parallel_map(dview, cell_magic_wand_wrapper, params))
 
     return masks
 
@@ -522,6 +520,8 @@ def recursively_save_dict_contents_to_group(h5file:h5py.File, path:str, dic:Dict
             h5file[path + key] = np.array(item)
         elif type(item).__name__ in ['CNMFParams', 'Estimates']: #  parameter object
             recursively_save_dict_contents_to_group(h5file, path + key + '/', item.__dict__)
+        elif type(item).__name__ == 'LocalCorrelations':
+            recursively_save_dict_contents_to_group(h5file, path + key + '/', item.state())
         else:
             raise ValueError("Cannot save %s type for key '%s'." % (type(item), key))
 
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Chunked, compressed storage of movies in zarr directory stores
+
+Movies are stored frame-major as a (T, d1, d2[, d3]) array, compressed with Blosc.
+The spatial chunks can be aligned to the grid of patches used by run_CNMF_patches,
+so that each patch worker only reads and decompresses the chunks it covers instead
+of striding through a flat memory mapped file. The steps of CNMF on the whole FOV
+still read the C order memory mapped file written by zarr_to_memmap.
+
+zarr is an optional dependency.
+"""
+
+import itertools
+import logging
+import numpy as np
+import os
+import time
+from typing import Any, List, Optional, Tuple, Union
+
+try:
+    import zarr
+    from numcodecs import Blosc
+    HAS_ZARR = True
+except ImportError:
+    HAS_ZARR = False
+
+
+def is_zarr(file_name) -> bool:
+    """ Whether file_name points to a zarr directory store """
+    return isinstance(file_name, str) and os.path.splitext(file_name.rstrip('/\\'))[1].lower() == '.zarr'
+
+
+def zarr_compressor(cname: str = 'lz4', clevel: int = 5) -> Any:
+    """ Blosc compressor with byte shuffling, fast enough to decompress at disk speed """
+    if not HAS_ZARR:
+        raise Exception('zarr module unavailable')
+    return Blosc(cname=cname, clevel=clevel, shuffle=Blosc.SHUFFLE)
+
+
+def patch_aligned_chunks(dims: Tuple, rf: Union[int, List, Tuple] = 16, stride: Union[int, List, Tuple] = 4,
+                         chunk_bytes: int = 2**22, itemsize: int = 4) -> Tuple:
+    """ Chunk shape aligned to the patches produced by cluster.extract_patch_coordinates
+
+    Patches of half-size rf and overlap stride start every 2 * rf - stride pixels along
+    each dimension, which is used as the spatial chunk size: these patches start on a chunk
+    boundary and cover their own chunk and the first stride + 1 pixels of the next one. The
+    last patch along each dimension ends on the border of the frame instead, so unless the
+    dimension fits the grid it starts inside a chunk and reads parts of one more chunk.
+    The number of frames per chunk is chosen so that a chunk holds about chunk_bytes bytes.
+
+    Args:
+        dims: tuple
+            frame dimensions
+
+        rf: int or list
+            half-size of the patches, as in params.patch['rf']
+
+        stride: int or list
+            overlap between patches, as in params.patch['stride']
+
+        chunk_bytes: int
+            target size of an uncompressed chunk
+
+        itemsize: int
+            size in bytes of an element
+
+    Returns:
+        chunks: tuple
+            chunk shape (frames, d1, d2[, d3])
+    """
+    rfs = [rf] * len(dims) if np.isscalar(rf) else rf
+    strides = [stride] * len(dims) if np.isscalar(stride) else stride
+    spatial = tuple(int(min(max(2 * r - s, 1), d)) for r, s, d in zip(rfs, strides, dims))
+    frames = max(1, chunk_bytes // (int(np.prod(spatial)) * itemsize))
+    return (int(frames),) + spatial
+
+
+def load_zarr(file_name: str, mode: str = 'r') -> Any:
+    """ Opens a movie saved with save_zarr
+
+    Args:
+        file_name: str
+            path of the zarr directory store
+
+        mode: str
+            One of 'r', 'r+'. How to interact with the store
+
+    Returns:
+        Y: zarr.Array
+            array of shape (T, d1, d2[, d3]), read lazily chunk by chunk
+
+    Raises:
+        Exception 'zarr module unavailable'
+    """
+    if not HAS_ZARR:
+        raise Exception('zarr module unavailable')
+    return zarr.open_array(file_name, mode=mode)
+
+
+def save_zarr(movies: List,
+              file_name: str,
+              chunks: Optional[Tuple] = None,
+              rf: Union[int, List, Tuple] = 16,
+              stride: Union[int, List, Tuple] = 4,
+              var_name_hdf5: str = 'mov',
+              dtype=np.float32,
+              fr: Optional[float] = None,
+              compressor=None) -> str:
+    """ Writes movies into a single compressed, chunked zarr store
+
+    Files are read with movies.load_iter one time-chunk at a time, so the movie is
+    never held in memory as a whole.
+
+    Args:
+        movies: list
+            list of file names or of arrays (T, d1, d2[, d3]), concatenated in time
+
+        file_name: str
+            path of the zarr directory store to create (should end in .zarr)
+
+        chunks: tuple
+            chunk shape. If None, chunks are aligned to the patch grid of rf and stride
+            (see patch_aligned_chunks)
+
+        rf, stride: int or list
+            patch half-size and overlap the chunks are aligned to
+
+        var_name_hdf5: str
+            if loading from hdf5 name of the variable to load
+
+        dtype: np.dtype
+            data type of the stored movie
+
+        fr: float
+            frame rate, stored in the attributes of the array
+
+        compressor: numcodecs codec
+            defaults to Blosc with LZ4 (see zarr_compressor)
+
+    Returns:
+        file_name: str
+            path of the zarr store
+
+    Raises:
+        Exception 'zarr module unavailable'
+    """
+    from caiman.base.movies import load_iter
+    from caiman.source_extraction.cnmf.utilities import get_file_size
+
+    if not HAS_ZARR:
+        raise Exception('zarr module unavailable')
+    if compressor is None:
+        compressor = zarr_compressor()
+    dtype = np.dtype(dtype)
+
+    shapes = [get_file_size(m, var_name_hdf5=var_name_hdf5)[::-1] if isinstance(m, str)
+              else (m.shape[0], tuple(m.shape[1:])) for m in movies]
+    dims = shapes[0][1]
+    if any(tuple(s[1]) != tuple(dims) for s in shapes):
+        raise ValueError('All the movies must have the same frame dimensions')
+    T = int(sum(s[0] for s in shapes))
+    if chunks is None:
+        chunks = patch_aligned_chunks(dims, rf, stride, itemsize=dtype.itemsize)
+
+    start = time.time()
+    Y = zarr.open_array(file_name, mode='w', shape=(T,) + tuple(dims), chunks=chunks,
+                        dtype=dtype, compressor=compressor)
+    t = 0
+    for m in movies:
+        frames = load_iter(m, var_name_hdf5=var_name_hdf5) if isinstance(m, str) else iter(m)
+        while True:
+            # write whole time-chunks so that no chunk is compressed twice
+            block = [frame for _, frame in zip(range(chunks[0] - t % chunks[0]), frames)]
+            if len(block) == 0:
+                break
+            Y[t:t + len(block)] = np.array(block, dtype=dtype)
+            t += len(block)
+
+    Y.attrs['fr'] = fr
+    Y.attrs['source_files'] = [m if isinstance(m, str) else '<array>' for m in movies]
+    logging.info(f'Saved {file_name}: {Y.nbytes / 2**20:.1f} MB stored in {Y.nbytes_stored / 2**20:.1f} MB '
+                 f'in {time.time() - start:.2f} s')
+    return file_name
+
+
+def zarr_to_memmap(file_name: str,
+                   base_name: str = 'Yr',
+                   add_to_movie: float = 0,
+                   dtype=np.float32,
+                   fr: Optional[float] = None,
+                   compute_checksums: bool = False,
+                   block_bytes: int = 2**28) -> str:
+    """ Writes a zarr store into a C order memory mapped file, as save_memmap does for other movies
+
+    The (pixels x frames) matrix is filled one spatial chunk at a time: every chunk of the
+    store is decompressed once, and the pixels it covers are written as runs of consecutive
+    rows, instead of decompressing whole frames and striding through the output for each of
+    them. Values get the same conversion as in save_memmap (see mmapping.to_memmap_dtype).
+
+    Args:
+        file_name: str
+            path of the zarr store
+
+        base_name: str
+            base of the name of the memory mapped file, placed next to the store
+
+        add_to_movie: float
+            value added to each element
+
+        dtype: np.dtype
+            data type of the memory mapped file, one of float32, uint16 or int16
+
+        fr: float
+            frame rate stored in the metadata, by default the one of the store
+
+        compute_checksums: bool
+            whether to store per-chunk checksums of the file in its metadata
+
+        block_bytes: int
+            approximate size of the blocks of frames read at a time
+
+    Returns:
+        fname_new: str
+            path of the memory mapped file
+
+    Raises:
+        Exception 'zarr module unavailable'
+    """
+    from caiman.mmapping import check_memmap_dtype, prepare_shape, save_memmap_metadata, to_memmap_dtype
+    from caiman.paths import memmap_frames_filename
+
+    dtype = check_memmap_dtype(dtype)
+    Y = load_zarr(file_name)
+    T, dims, chunks = Y.shape[0], Y.shape[1:], Y.chunks[1:]
+    fname_new = os.path.join(os.path.split(file_name.rstrip('/\\'))[0],
+                             memmap_frames_filename(base_name, dims, T, 'C'))
+    big_mov = np.memmap(fname_new, mode='w+', dtype=dtype, shape=prepare_shape((int(np.prod(dims)), T)), order='C')
+    # rows of the memmap, pixels being flattened in F order
+    pixels = np.arange(int(np.prod(dims))).reshape(dims, order='F')
+    n_frames = max(1, block_bytes // (int(np.prod(chunks)) * Y.dtype.itemsize) // Y.chunks[0]) * Y.chunks[0]
+    start = time.time()
+    for corner in itertools.product(*[range(0, d, c) for d, c in zip(dims, chunks)]):
+        block = tuple(slice(c0, min(c0 + c, d)) for c0, c, d in zip(corner, chunks, dims))
+        rows = pixels[block].ravel(order='F')
+        for t0 in range(0, T, n_frames):
+            frames = np.asarray(Y[(slice(t0, t0 + n_frames),) + block])
+            big_mov[rows, t0:t0 + len(frames)] = to_memmap_dtype(
+                frames.reshape(len(frames), -1, order='F').T, dtype, add_to_movie)
+    big_mov.flush()
+    del big_mov
+    logging.info(f'Converted {file_name} to {fname_new} in {time.time() - start:.2f} s')
+    save_memmap_metadata(fname_new, dims, T, order='C', dtype=dtype, fr=Y.attrs.get('fr') if fr is None else fr,
+                         source_files=[file_name], compute_checksums=compute_checksums)
+    return fname_new